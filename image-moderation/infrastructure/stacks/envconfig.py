@@ -25,6 +25,72 @@ class EnvConfig:
                  moderation_image_blacklist_whitelist_enabled=True,
                  moderation_image_blacklist_whitelist_read_capacity=100,
                  moderation_image_blacklist_whitelist_write_capacity=20,
+                 moderation_verdict_cache_enabled=True,
+                 moderation_verdict_cache_max_size=4096,
+                 moderation_verdict_cache_ttl_seconds=3600,
+                 moderation_backend_response_cache_enabled=True,
+                 moderation_backend_response_cache_max_size=16384,
+                 moderation_backend_response_cache_ttl_seconds=3600,
+                 moderation_disk_cache_enabled=True,
+                 moderation_disk_cache_max_bytes=268435456,
+                 moderation_s3_etag_cache_enabled=True,
+                 moderation_url_cache_enabled=True,
+                 moderation_backend_executors_enabled=True,
+                 moderation_backend_executor_max_workers=16,
+                 moderation_backend_executor_max_queue_size=64,
+                 moderation_backend_executor_limits='',
+                 moderation_backend_max_in_flight=64,
+                 moderation_pipeline_max_workers=8,
+                 moderation_speculative_qrcode_enabled=False,
+                 moderation_request_timeout_seconds=25.0,
+                 moderation_backend_read_timeout_seconds=25.0,
+                 moderation_mandatory_return_sources='DetectModerationLabels',
+                 moderation_hedging_enabled=False,
+                 moderation_hedging_return_sources='DetectModerationLabels,DetectByCustomModels',
+                 moderation_hedging_percentile=95.0,
+                 moderation_hedging_max_ratio=0.05,
+                 moderation_hedging_limits='',
+                 moderation_hedging_max_workers=32,
+                 moderation_retry_enabled=True,
+                 moderation_retry_max_attempts=3,
+                 moderation_retry_base_seconds=0.05,
+                 moderation_retry_cap_seconds=1.0,
+                 moderation_retry_budget_ratio=0.1,
+                 moderation_rate_limit_enabled=False,
+                 moderation_rate_limits='DetectLabels:50:50,DetectModerationLabels:50:50,SearchFacesByImage:50:50,RecognizeCelebrities:50:50',
+                 moderation_rate_limit_max_wait_seconds=1.0,
+                 moderation_rate_limit_shared_enabled=False,
+                 moderation_rate_limit_lease_size=5,
+                 moderation_adaptive_concurrency_enabled=False,
+                 moderation_adaptive_concurrency_initial_limit=16,
+                 moderation_adaptive_concurrency_min_limit=1,
+                 moderation_adaptive_concurrency_max_limit=128,
+                 moderation_adaptive_concurrency_tolerance=2.0,
+                 moderation_circuit_breaker_enabled=False,
+                 moderation_circuit_breaker_failure_rate=0.5,
+                 moderation_circuit_breaker_slow_call_seconds=10.0,
+                 moderation_circuit_breaker_slow_call_rate=0.8,
+                 moderation_circuit_breaker_open_seconds=30.0,
+                 moderation_circuit_breaker_skip_return_sources='',
+                 moderation_priority_lanes_enabled=False,
+                 moderation_lane_capacity=32,
+                 moderation_lane_interactive_reserved=8,
+                 moderation_lane_limits='',
+                 moderation_fair_share_enabled=False,
+                 moderation_fair_share_capacity=32,
+                 moderation_tenant_weights='',
+                 moderation_tenant_quotas='',
+                 moderation_tenant_quota_max_wait_seconds=0.5,
+                 moderation_early_exit_enabled=False,
+                 moderation_early_exit_labels='Explicit Nudity:95',
+                 moderation_cascade_enabled=False,
+                 moderation_cascade_tiers='DetectModerationLabels:1:1,DetectByCustomModels:1:1,DetectLabels:2:1,FaceSearch:2:1,CelebritySearch:2:1',
+                 moderation_cascade_uncertain_min_confidence=50.0,
+                 moderation_cascade_uncertain_max_confidence=90.0,
+                 moderation_cascade_escalation_labels='Violence:2',
+                 moderation_job_max_receive_count=3,
+                 moderation_hash_list_cache_ttl_seconds=10,
+                 moderation_hash_list_cache_max_size=10000,
                  sagemaker_endpoint_instance_type='ml.g4dn.2xlarge',
                  sagemaker_endpoint_instance_count=6,
                  sagemaker_endpoint_workers=7,
@@ -56,6 +122,72 @@ class EnvConfig:
         self.moderation_image_blacklist_whitelist_enabled = moderation_image_blacklist_whitelist_enabled
         self.moderation_image_blacklist_whitelist_read_capacity = moderation_image_blacklist_whitelist_read_capacity
         self.moderation_image_blacklist_whitelist_write_capacity = moderation_image_blacklist_whitelist_write_capacity
+        self.moderation_verdict_cache_enabled = moderation_verdict_cache_enabled
+        self.moderation_verdict_cache_max_size = moderation_verdict_cache_max_size
+        self.moderation_verdict_cache_ttl_seconds = moderation_verdict_cache_ttl_seconds
+        self.moderation_backend_response_cache_enabled = moderation_backend_response_cache_enabled
+        self.moderation_backend_response_cache_max_size = moderation_backend_response_cache_max_size
+        self.moderation_backend_response_cache_ttl_seconds = moderation_backend_response_cache_ttl_seconds
+        self.moderation_disk_cache_enabled = moderation_disk_cache_enabled
+        self.moderation_disk_cache_max_bytes = moderation_disk_cache_max_bytes
+        self.moderation_s3_etag_cache_enabled = moderation_s3_etag_cache_enabled
+        self.moderation_url_cache_enabled = moderation_url_cache_enabled
+        self.moderation_backend_executors_enabled = moderation_backend_executors_enabled
+        self.moderation_backend_executor_max_workers = moderation_backend_executor_max_workers
+        self.moderation_backend_executor_max_queue_size = moderation_backend_executor_max_queue_size
+        self.moderation_backend_executor_limits = moderation_backend_executor_limits
+        self.moderation_backend_max_in_flight = moderation_backend_max_in_flight
+        self.moderation_pipeline_max_workers = moderation_pipeline_max_workers
+        self.moderation_speculative_qrcode_enabled = moderation_speculative_qrcode_enabled
+        self.moderation_request_timeout_seconds = moderation_request_timeout_seconds
+        self.moderation_backend_read_timeout_seconds = moderation_backend_read_timeout_seconds
+        self.moderation_mandatory_return_sources = moderation_mandatory_return_sources
+        self.moderation_hedging_enabled = moderation_hedging_enabled
+        self.moderation_hedging_return_sources = moderation_hedging_return_sources
+        self.moderation_hedging_percentile = moderation_hedging_percentile
+        self.moderation_hedging_max_ratio = moderation_hedging_max_ratio
+        self.moderation_hedging_limits = moderation_hedging_limits
+        self.moderation_hedging_max_workers = moderation_hedging_max_workers
+        self.moderation_retry_enabled = moderation_retry_enabled
+        self.moderation_retry_max_attempts = moderation_retry_max_attempts
+        self.moderation_retry_base_seconds = moderation_retry_base_seconds
+        self.moderation_retry_cap_seconds = moderation_retry_cap_seconds
+        self.moderation_retry_budget_ratio = moderation_retry_budget_ratio
+        self.moderation_rate_limit_enabled = moderation_rate_limit_enabled
+        self.moderation_rate_limits = moderation_rate_limits
+        self.moderation_rate_limit_max_wait_seconds = moderation_rate_limit_max_wait_seconds
+        self.moderation_rate_limit_shared_enabled = moderation_rate_limit_shared_enabled
+        self.moderation_rate_limit_lease_size = moderation_rate_limit_lease_size
+        self.moderation_adaptive_concurrency_enabled = moderation_adaptive_concurrency_enabled
+        self.moderation_adaptive_concurrency_initial_limit = moderation_adaptive_concurrency_initial_limit
+        self.moderation_adaptive_concurrency_min_limit = moderation_adaptive_concurrency_min_limit
+        self.moderation_adaptive_concurrency_max_limit = moderation_adaptive_concurrency_max_limit
+        self.moderation_adaptive_concurrency_tolerance = moderation_adaptive_concurrency_tolerance
+        self.moderation_circuit_breaker_enabled = moderation_circuit_breaker_enabled
+        self.moderation_circuit_breaker_failure_rate = moderation_circuit_breaker_failure_rate
+        self.moderation_circuit_breaker_slow_call_seconds = moderation_circuit_breaker_slow_call_seconds
+        self.moderation_circuit_breaker_slow_call_rate = moderation_circuit_breaker_slow_call_rate
+        self.moderation_circuit_breaker_open_seconds = moderation_circuit_breaker_open_seconds
+        self.moderation_circuit_breaker_skip_return_sources = moderation_circuit_breaker_skip_return_sources
+        self.moderation_priority_lanes_enabled = moderation_priority_lanes_enabled
+        self.moderation_lane_capacity = moderation_lane_capacity
+        self.moderation_lane_interactive_reserved = moderation_lane_interactive_reserved
+        self.moderation_lane_limits = moderation_lane_limits
+        self.moderation_fair_share_enabled = moderation_fair_share_enabled
+        self.moderation_fair_share_capacity = moderation_fair_share_capacity
+        self.moderation_tenant_weights = moderation_tenant_weights
+        self.moderation_tenant_quotas = moderation_tenant_quotas
+        self.moderation_tenant_quota_max_wait_seconds = moderation_tenant_quota_max_wait_seconds
+        self.moderation_early_exit_enabled = moderation_early_exit_enabled
+        self.moderation_early_exit_labels = moderation_early_exit_labels
+        self.moderation_cascade_enabled = moderation_cascade_enabled
+        self.moderation_cascade_tiers = moderation_cascade_tiers
+        self.moderation_cascade_uncertain_min_confidence = moderation_cascade_uncertain_min_confidence
+        self.moderation_cascade_uncertain_max_confidence = moderation_cascade_uncertain_max_confidence
+        self.moderation_cascade_escalation_labels = moderation_cascade_escalation_labels
+        self.moderation_job_max_receive_count = moderation_job_max_receive_count
+        self.moderation_hash_list_cache_ttl_seconds = moderation_hash_list_cache_ttl_seconds
+        self.moderation_hash_list_cache_max_size = moderation_hash_list_cache_max_size
         self.sagemaker_endpoint_instance_type = sagemaker_endpoint_instance_type
         self.sagemaker_endpoint_instance_count = sagemaker_endpoint_instance_count
         self.sagemaker_endpoint_workers = sagemaker_endpoint_workers
@@ -91,6 +223,72 @@ class EnvConfig:
             "moderation_detect_moderation_label_filter_enabled": self.moderation_detect_moderation_label_filter_enabled,
             "moderation_detect_moderation_label_inclusion_filter": self.moderation_detect_moderation_label_inclusion_filter,
             "moderation_rekognition_collection_id": self.moderation_rekognition_collection_id,
+            "moderation_verdict_cache_enabled": self.moderation_verdict_cache_enabled,
+            "moderation_verdict_cache_max_size": self.moderation_verdict_cache_max_size,
+            "moderation_verdict_cache_ttl_seconds": self.moderation_verdict_cache_ttl_seconds,
+            "moderation_backend_response_cache_enabled": self.moderation_backend_response_cache_enabled,
+            "moderation_backend_response_cache_max_size": self.moderation_backend_response_cache_max_size,
+            "moderation_backend_response_cache_ttl_seconds": self.moderation_backend_response_cache_ttl_seconds,
+            "moderation_disk_cache_enabled": self.moderation_disk_cache_enabled,
+            "moderation_disk_cache_max_bytes": self.moderation_disk_cache_max_bytes,
+            "moderation_s3_etag_cache_enabled": self.moderation_s3_etag_cache_enabled,
+            "moderation_url_cache_enabled": self.moderation_url_cache_enabled,
+            "moderation_backend_executors_enabled": self.moderation_backend_executors_enabled,
+            "moderation_backend_executor_max_workers": self.moderation_backend_executor_max_workers,
+            "moderation_backend_executor_max_queue_size": self.moderation_backend_executor_max_queue_size,
+            "moderation_backend_executor_limits": self.moderation_backend_executor_limits,
+            "moderation_backend_max_in_flight": self.moderation_backend_max_in_flight,
+            "moderation_pipeline_max_workers": self.moderation_pipeline_max_workers,
+            "moderation_speculative_qrcode_enabled": self.moderation_speculative_qrcode_enabled,
+            "moderation_request_timeout_seconds": self.moderation_request_timeout_seconds,
+            "moderation_backend_read_timeout_seconds": self.moderation_backend_read_timeout_seconds,
+            "moderation_mandatory_return_sources": self.moderation_mandatory_return_sources,
+            "moderation_hedging_enabled": self.moderation_hedging_enabled,
+            "moderation_hedging_return_sources": self.moderation_hedging_return_sources,
+            "moderation_hedging_percentile": self.moderation_hedging_percentile,
+            "moderation_hedging_max_ratio": self.moderation_hedging_max_ratio,
+            "moderation_hedging_limits": self.moderation_hedging_limits,
+            "moderation_hedging_max_workers": self.moderation_hedging_max_workers,
+            "moderation_retry_enabled": self.moderation_retry_enabled,
+            "moderation_retry_max_attempts": self.moderation_retry_max_attempts,
+            "moderation_retry_base_seconds": self.moderation_retry_base_seconds,
+            "moderation_retry_cap_seconds": self.moderation_retry_cap_seconds,
+            "moderation_retry_budget_ratio": self.moderation_retry_budget_ratio,
+            "moderation_rate_limit_enabled": self.moderation_rate_limit_enabled,
+            "moderation_rate_limits": self.moderation_rate_limits,
+            "moderation_rate_limit_max_wait_seconds": self.moderation_rate_limit_max_wait_seconds,
+            "moderation_rate_limit_shared_enabled": self.moderation_rate_limit_shared_enabled,
+            "moderation_rate_limit_lease_size": self.moderation_rate_limit_lease_size,
+            "moderation_adaptive_concurrency_enabled": self.moderation_adaptive_concurrency_enabled,
+            "moderation_adaptive_concurrency_initial_limit": self.moderation_adaptive_concurrency_initial_limit,
+            "moderation_adaptive_concurrency_min_limit": self.moderation_adaptive_concurrency_min_limit,
+            "moderation_adaptive_concurrency_max_limit": self.moderation_adaptive_concurrency_max_limit,
+            "moderation_adaptive_concurrency_tolerance": self.moderation_adaptive_concurrency_tolerance,
+            "moderation_circuit_breaker_enabled": self.moderation_circuit_breaker_enabled,
+            "moderation_circuit_breaker_failure_rate": self.moderation_circuit_breaker_failure_rate,
+            "moderation_circuit_breaker_slow_call_seconds": self.moderation_circuit_breaker_slow_call_seconds,
+            "moderation_circuit_breaker_slow_call_rate": self.moderation_circuit_breaker_slow_call_rate,
+            "moderation_circuit_breaker_open_seconds": self.moderation_circuit_breaker_open_seconds,
+            "moderation_circuit_breaker_skip_return_sources": self.moderation_circuit_breaker_skip_return_sources,
+            "moderation_priority_lanes_enabled": self.moderation_priority_lanes_enabled,
+            "moderation_lane_capacity": self.moderation_lane_capacity,
+            "moderation_lane_interactive_reserved": self.moderation_lane_interactive_reserved,
+            "moderation_lane_limits": self.moderation_lane_limits,
+            "moderation_fair_share_enabled": self.moderation_fair_share_enabled,
+            "moderation_fair_share_capacity": self.moderation_fair_share_capacity,
+            "moderation_tenant_weights": self.moderation_tenant_weights,
+            "moderation_tenant_quotas": self.moderation_tenant_quotas,
+            "moderation_tenant_quota_max_wait_seconds": self.moderation_tenant_quota_max_wait_seconds,
+            "moderation_early_exit_enabled": self.moderation_early_exit_enabled,
+            "moderation_early_exit_labels": self.moderation_early_exit_labels,
+            "moderation_cascade_enabled": self.moderation_cascade_enabled,
+            "moderation_cascade_tiers": self.moderation_cascade_tiers,
+            "moderation_cascade_uncertain_min_confidence": self.moderation_cascade_uncertain_min_confidence,
+            "moderation_cascade_uncertain_max_confidence": self.moderation_cascade_uncertain_max_confidence,
+            "moderation_cascade_escalation_labels": self.moderation_cascade_escalation_labels,
+            "moderation_job_max_receive_count": self.moderation_job_max_receive_count,
+            "moderation_hash_list_cache_ttl_seconds": self.moderation_hash_list_cache_ttl_seconds,
+            "moderation_hash_list_cache_max_size": self.moderation_hash_list_cache_max_size,
             "deploy_partition": self.deploy_partition,
             "sagemaker_endpoint_instance_type": self.sagemaker_endpoint_instance_type,
             "sagemaker_endpoint_instance_count": self.sagemaker_endpoint_instance_count,
@@ -141,6 +339,72 @@ class EnvConfig:
             json_dct['moderation_image_blacklist_whitelist_enabled'],
             json_dct['moderation_image_blacklist_whitelist_read_capacity'],
             json_dct['moderation_image_blacklist_whitelist_write_capacity'],
+            json_dct['moderation_verdict_cache_enabled'],
+            json_dct['moderation_verdict_cache_max_size'],
+            json_dct['moderation_verdict_cache_ttl_seconds'],
+            json_dct['moderation_backend_response_cache_enabled'],
+            json_dct['moderation_backend_response_cache_max_size'],
+            json_dct['moderation_backend_response_cache_ttl_seconds'],
+            json_dct['moderation_disk_cache_enabled'],
+            json_dct['moderation_disk_cache_max_bytes'],
+            json_dct['moderation_s3_etag_cache_enabled'],
+            json_dct['moderation_url_cache_enabled'],
+            json_dct['moderation_backend_executors_enabled'],
+            json_dct['moderation_backend_executor_max_workers'],
+            json_dct['moderation_backend_executor_max_queue_size'],
+            json_dct['moderation_backend_executor_limits'],
+            json_dct['moderation_backend_max_in_flight'],
+            json_dct['moderation_pipeline_max_workers'],
+            json_dct['moderation_speculative_qrcode_enabled'],
+            json_dct['moderation_request_timeout_seconds'],
+            json_dct['moderation_backend_read_timeout_seconds'],
+            json_dct['moderation_mandatory_return_sources'],
+            json_dct['moderation_hedging_enabled'],
+            json_dct['moderation_hedging_return_sources'],
+            json_dct['moderation_hedging_percentile'],
+            json_dct['moderation_hedging_max_ratio'],
+            json_dct['moderation_hedging_limits'],
+            json_dct['moderation_hedging_max_workers'],
+            json_dct['moderation_retry_enabled'],
+            json_dct['moderation_retry_max_attempts'],
+            json_dct['moderation_retry_base_seconds'],
+            json_dct['moderation_retry_cap_seconds'],
+            json_dct['moderation_retry_budget_ratio'],
+            json_dct['moderation_rate_limit_enabled'],
+            json_dct['moderation_rate_limits'],
+            json_dct['moderation_rate_limit_max_wait_seconds'],
+            json_dct['moderation_rate_limit_shared_enabled'],
+            json_dct['moderation_rate_limit_lease_size'],
+            json_dct['moderation_adaptive_concurrency_enabled'],
+            json_dct['moderation_adaptive_concurrency_initial_limit'],
+            json_dct['moderation_adaptive_concurrency_min_limit'],
+            json_dct['moderation_adaptive_concurrency_max_limit'],
+            json_dct['moderation_adaptive_concurrency_tolerance'],
+            json_dct['moderation_circuit_breaker_enabled'],
+            json_dct['moderation_circuit_breaker_failure_rate'],
+            json_dct['moderation_circuit_breaker_slow_call_seconds'],
+            json_dct['moderation_circuit_breaker_slow_call_rate'],
+            json_dct['moderation_circuit_breaker_open_seconds'],
+            json_dct['moderation_circuit_breaker_skip_return_sources'],
+            json_dct['moderation_priority_lanes_enabled'],
+            json_dct['moderation_lane_capacity'],
+            json_dct['moderation_lane_interactive_reserved'],
+            json_dct['moderation_lane_limits'],
+            json_dct['moderation_fair_share_enabled'],
+            json_dct['moderation_fair_share_capacity'],
+            json_dct['moderation_tenant_weights'],
+            json_dct['moderation_tenant_quotas'],
+            json_dct['moderation_tenant_quota_max_wait_seconds'],
+            json_dct['moderation_early_exit_enabled'],
+            json_dct['moderation_early_exit_labels'],
+            json_dct['moderation_cascade_enabled'],
+            json_dct['moderation_cascade_tiers'],
+            json_dct['moderation_cascade_uncertain_min_confidence'],
+            json_dct['moderation_cascade_uncertain_max_confidence'],
+            json_dct['moderation_cascade_escalation_labels'],
+            json_dct['moderation_job_max_receive_count'],
+            json_dct['moderation_hash_list_cache_ttl_seconds'],
+            json_dct['moderation_hash_list_cache_max_size'],
             json_dct['sagemaker_endpoint_instance_type'],
             json_dct['sagemaker_endpoint_instance_count'],
             json_dct['sagemaker_endpoint_workers'],
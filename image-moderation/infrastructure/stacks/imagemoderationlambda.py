@@ -8,6 +8,9 @@ from aws_cdk import (
     aws_iam as iam,
     aws_apigateway as apigateway,
     aws_lambda,
+    aws_lambda_event_sources,
+    aws_sqs as sqs,
+    aws_dynamodb as dynamodb,
     Duration
 )
 
@@ -40,6 +43,9 @@ class ImageModeration(Construct):
     def create_chalice_app(self):
         self._principal = iam.ServicePrincipal("lambda.amazonaws.com")
         default_role = self._create_role(self._sagemaker.endpoint_ref)
+        self._create_job_resources(default_role)
+        self._create_hash_list_resources(default_role)
+        self._create_rate_limit_resources(default_role)
 
         self._docker_lambda = aws_lambda.DockerImageFunction(
             self,
@@ -48,33 +54,175 @@ class ImageModeration(Construct):
             # architecture=aws_lambda.Architecture.ARM_64,
             timeout=Duration.seconds(60 * 15),  # Default is only 3 seconds
             memory_size=2048,  # If your docker code is pretty complex
-            environment={
-                'MODERATION_REKOGNITION_COLLECTION_ID': self._env.moderation_rekognition_collection_id,
-                'MODERATION_CUSTOMER_FACIAL_THRESHOLD': str(self._env.moderation_customer_facial_threshold),
-                'MODERATION_ANIMATION_EXTRACTION_SMALL_DEFAULT_MAX_THRESHOLD': str(self._env.moderation_animation_extraction_small_default_max_threshold),
-                'MODERATION_ANIMATION_EXTRACTION_LARGE_DEFAULT_THRESHOLD_SIZE': str(self._env.moderation_animation_extraction_large_default_threshold_size),
-                'MODERATION_ANIMATION_EXTRACTION_SIZE_THRESHOLD': str(self._env.moderation_animation_extraction_size_threshold),
-                'MODERATION_IMAGE_COMPRESS_QUALITY_STEP': str(self._env.moderation_image_compress_quality_step),
-                'MODERATION_IMAGE_COMPRESSION_SIZE_THRESHOLD': str(self._env.moderation_image_compression_size_threshold),
-                'MODERATION_CELEBRITY_FACIAL_THRESHOLD': str(self._env.moderation_celebrity_facial_threshold),
-                'MODERATION_DETECT_LABEL_INCLUSION_FILTER': self._env.moderation_detect_label_inclusion_filter,
-                'MODERATION_DETECT_MODERATION_LABEL_FILTER_ENABLED': str(self._env.moderation_detect_moderation_label_filter_enabled),
-                'MODERATION_DETECT_MODERATION_LABEL_INCLUSION_FILTER': self._env.moderation_detect_moderation_label_inclusion_filter,
-                'MODERATION_BACKEND_SERVICES': self._env.moderation_backend_services,
-                'MODERATION_IMAGE_BLACKLIST_WHITELIST_ENABLED': str(self._env.moderation_image_blacklist_whitelist_enabled),
-                'SAGEMAKER_ENDPOINT_NAME': self._sagemaker.endpoint_name
-            },
+            environment=self._lambda_environment(),
             role=default_role,
             tracing=aws_lambda.Tracing.ACTIVE,
             vpc=self._vpc
         )
 
+        # worker of asynchronous moderation jobs, same image with the sqs handler as entry point
+        self._docker_job_worker_lambda = aws_lambda.DockerImageFunction(
+            self,
+            'WorkshopDockerJobWorkerLambda',
+            code=DockerImageCode.from_image_asset('../runtime', cmd=['app.process_moderation_jobs']),
+            timeout=Duration.seconds(60 * 15),
+            memory_size=2048,
+            environment=self._lambda_environment(),
+            role=default_role,
+            tracing=aws_lambda.Tracing.ACTIVE,
+            vpc=self._vpc
+        )
+        self._docker_job_worker_lambda.add_event_source(
+            aws_lambda_event_sources.SqsEventSource(self._job_queue, batch_size=1))
+
         api_gateway = self._create_api_gateway(self._docker_lambda)
         self._add_permission_for_api_gateway(principal=self._principal,
                                              api_gateway=api_gateway)
 
         cdk.CfnOutput(self, "LambdaRoleName", value=default_role.role_name)
 
+    def _create_job_resources(self, default_role):
+        # jobs failing with retryable errors are received again, then moved to the dead letter queue
+        self._job_dead_letter_queue = sqs.Queue(self,
+                                                'ModerationJobDeadLetterQueue',
+                                                retention_period=Duration.days(14),
+                                                enforce_ssl=True)
+        # visibility timeout must not be shorter than the worker timeout
+        self._job_queue = sqs.Queue(self,
+                                    'ModerationJobQueue',
+                                    visibility_timeout=Duration.seconds(60 * 15),
+                                    dead_letter_queue=sqs.DeadLetterQueue(
+                                        max_receive_count=int(self._env.moderation_job_max_receive_count),
+                                        queue=self._job_dead_letter_queue),
+                                    enforce_ssl=True)
+        self._job_table = dynamodb.Table(self,
+                                         'ModerationJobTable',
+                                         partition_key=dynamodb.Attribute(name='JobId',
+                                                                          type=dynamodb.AttributeType.STRING),
+                                         billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                                         time_to_live_attribute='ExpiresAt')
+
+        self._job_queue.grant_send_messages(default_role)
+        self._job_table.grant_read_write_data(default_role)
+
+    def _create_hash_list_resources(self, default_role):
+        hash_key = dynamodb.Attribute(name='Hash', type=dynamodb.AttributeType.STRING)
+        self._blacklist_table = dynamodb.Table(self,
+                                               'moderationBlackListTable',
+                                               partition_key=hash_key,
+                                               billing_mode=dynamodb.BillingMode.PROVISIONED,
+                                               read_capacity=int(self._env.moderation_image_blacklist_whitelist_read_capacity),
+                                               write_capacity=int(self._env.moderation_image_blacklist_whitelist_write_capacity))
+        self._whitelist_table = dynamodb.Table(self,
+                                               'moderationWhiteListTable',
+                                               partition_key=hash_key,
+                                               billing_mode=dynamodb.BillingMode.PROVISIONED,
+                                               read_capacity=int(self._env.moderation_image_blacklist_whitelist_read_capacity),
+                                               write_capacity=int(self._env.moderation_image_blacklist_whitelist_write_capacity))
+
+        self._blacklist_table.grant_read_write_data(default_role)
+        self._whitelist_table.grant_read_write_data(default_role)
+
+    def _create_rate_limit_resources(self, default_role):
+        # token buckets of the backend operations shared by all the containers
+        self._rate_limit_table = dynamodb.Table(self,
+                                                'ModerationRateLimitTable',
+                                                partition_key=dynamodb.Attribute(name='Name',
+                                                                                 type=dynamodb.AttributeType.STRING),
+                                                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST)
+
+        self._rate_limit_table.grant_read_write_data(default_role)
+
+    def _lambda_environment(self):
+        return {
+            'MODERATION_REKOGNITION_COLLECTION_ID': self._env.moderation_rekognition_collection_id,
+            'MODERATION_CUSTOMER_FACIAL_THRESHOLD': str(self._env.moderation_customer_facial_threshold),
+            'MODERATION_ANIMATION_EXTRACTION_SMALL_DEFAULT_MAX_THRESHOLD': str(self._env.moderation_animation_extraction_small_default_max_threshold),
+            'MODERATION_ANIMATION_EXTRACTION_LARGE_DEFAULT_THRESHOLD_SIZE': str(self._env.moderation_animation_extraction_large_default_threshold_size),
+            'MODERATION_ANIMATION_EXTRACTION_SIZE_THRESHOLD': str(self._env.moderation_animation_extraction_size_threshold),
+            'MODERATION_IMAGE_COMPRESS_QUALITY_STEP': str(self._env.moderation_image_compress_quality_step),
+            'MODERATION_IMAGE_COMPRESSION_SIZE_THRESHOLD': str(self._env.moderation_image_compression_size_threshold),
+            'MODERATION_CELEBRITY_FACIAL_THRESHOLD': str(self._env.moderation_celebrity_facial_threshold),
+            'MODERATION_DETECT_LABEL_INCLUSION_FILTER': self._env.moderation_detect_label_inclusion_filter,
+            'MODERATION_DETECT_MODERATION_LABEL_FILTER_ENABLED': str(self._env.moderation_detect_moderation_label_filter_enabled),
+            'MODERATION_DETECT_MODERATION_LABEL_INCLUSION_FILTER': self._env.moderation_detect_moderation_label_inclusion_filter,
+            'MODERATION_BACKEND_SERVICES': self._env.moderation_backend_services,
+            'MODERATION_IMAGE_BLACKLIST_WHITELIST_ENABLED': str(self._env.moderation_image_blacklist_whitelist_enabled),
+            'MODERATION_BLACKLIST_TABLE_NAME': self._blacklist_table.table_name,
+            'MODERATION_WHITELIST_TABLE_NAME': self._whitelist_table.table_name,
+            'MODERATION_VERDICT_CACHE_ENABLED': str(self._env.moderation_verdict_cache_enabled),
+            'MODERATION_VERDICT_CACHE_MAX_SIZE': str(self._env.moderation_verdict_cache_max_size),
+            'MODERATION_VERDICT_CACHE_TTL_SECONDS': str(self._env.moderation_verdict_cache_ttl_seconds),
+            'MODERATION_BACKEND_RESPONSE_CACHE_ENABLED': str(self._env.moderation_backend_response_cache_enabled),
+            'MODERATION_BACKEND_RESPONSE_CACHE_MAX_SIZE': str(self._env.moderation_backend_response_cache_max_size),
+            'MODERATION_BACKEND_RESPONSE_CACHE_TTL_SECONDS': str(self._env.moderation_backend_response_cache_ttl_seconds),
+            'MODERATION_DISK_CACHE_ENABLED': str(self._env.moderation_disk_cache_enabled),
+            'MODERATION_DISK_CACHE_MAX_BYTES': str(self._env.moderation_disk_cache_max_bytes),
+            'MODERATION_S3_ETAG_CACHE_ENABLED': str(self._env.moderation_s3_etag_cache_enabled),
+            'MODERATION_URL_CACHE_ENABLED': str(self._env.moderation_url_cache_enabled),
+            'MODERATION_BACKEND_EXECUTORS_ENABLED': str(self._env.moderation_backend_executors_enabled),
+            'MODERATION_BACKEND_EXECUTOR_MAX_WORKERS': str(self._env.moderation_backend_executor_max_workers),
+            'MODERATION_BACKEND_EXECUTOR_MAX_QUEUE_SIZE': str(self._env.moderation_backend_executor_max_queue_size),
+            'MODERATION_BACKEND_EXECUTOR_LIMITS': str(self._env.moderation_backend_executor_limits),
+            'MODERATION_BACKEND_MAX_IN_FLIGHT': str(self._env.moderation_backend_max_in_flight),
+            'MODERATION_PIPELINE_MAX_WORKERS': str(self._env.moderation_pipeline_max_workers),
+            'MODERATION_SPECULATIVE_QRCODE_ENABLED': str(self._env.moderation_speculative_qrcode_enabled),
+            'MODERATION_REQUEST_TIMEOUT_SECONDS': str(self._env.moderation_request_timeout_seconds),
+            'MODERATION_BACKEND_READ_TIMEOUT_SECONDS': str(self._env.moderation_backend_read_timeout_seconds),
+            'MODERATION_MANDATORY_RETURN_SOURCES': str(self._env.moderation_mandatory_return_sources),
+            'MODERATION_HEDGING_ENABLED': str(self._env.moderation_hedging_enabled),
+            'MODERATION_HEDGING_RETURN_SOURCES': str(self._env.moderation_hedging_return_sources),
+            'MODERATION_HEDGING_PERCENTILE': str(self._env.moderation_hedging_percentile),
+            'MODERATION_HEDGING_MAX_RATIO': str(self._env.moderation_hedging_max_ratio),
+            'MODERATION_HEDGING_LIMITS': str(self._env.moderation_hedging_limits),
+            'MODERATION_HEDGING_MAX_WORKERS': str(self._env.moderation_hedging_max_workers),
+            'MODERATION_RETRY_ENABLED': str(self._env.moderation_retry_enabled),
+            'MODERATION_RETRY_MAX_ATTEMPTS': str(self._env.moderation_retry_max_attempts),
+            'MODERATION_RETRY_BASE_SECONDS': str(self._env.moderation_retry_base_seconds),
+            'MODERATION_RETRY_CAP_SECONDS': str(self._env.moderation_retry_cap_seconds),
+            'MODERATION_RETRY_BUDGET_RATIO': str(self._env.moderation_retry_budget_ratio),
+            'MODERATION_RATE_LIMIT_ENABLED': str(self._env.moderation_rate_limit_enabled),
+            'MODERATION_RATE_LIMITS': str(self._env.moderation_rate_limits),
+            'MODERATION_RATE_LIMIT_MAX_WAIT_SECONDS': str(self._env.moderation_rate_limit_max_wait_seconds),
+            'MODERATION_RATE_LIMIT_SHARED_ENABLED': str(self._env.moderation_rate_limit_shared_enabled),
+            'MODERATION_RATE_LIMIT_LEASE_SIZE': str(self._env.moderation_rate_limit_lease_size),
+            'MODERATION_ADAPTIVE_CONCURRENCY_ENABLED': str(self._env.moderation_adaptive_concurrency_enabled),
+            'MODERATION_ADAPTIVE_CONCURRENCY_INITIAL_LIMIT': str(self._env.moderation_adaptive_concurrency_initial_limit),
+            'MODERATION_ADAPTIVE_CONCURRENCY_MIN_LIMIT': str(self._env.moderation_adaptive_concurrency_min_limit),
+            'MODERATION_ADAPTIVE_CONCURRENCY_MAX_LIMIT': str(self._env.moderation_adaptive_concurrency_max_limit),
+            'MODERATION_ADAPTIVE_CONCURRENCY_TOLERANCE': str(self._env.moderation_adaptive_concurrency_tolerance),
+            'MODERATION_CIRCUIT_BREAKER_ENABLED': str(self._env.moderation_circuit_breaker_enabled),
+            'MODERATION_CIRCUIT_BREAKER_FAILURE_RATE': str(self._env.moderation_circuit_breaker_failure_rate),
+            'MODERATION_CIRCUIT_BREAKER_SLOW_CALL_SECONDS': str(self._env.moderation_circuit_breaker_slow_call_seconds),
+            'MODERATION_CIRCUIT_BREAKER_SLOW_CALL_RATE': str(self._env.moderation_circuit_breaker_slow_call_rate),
+            'MODERATION_CIRCUIT_BREAKER_OPEN_SECONDS': str(self._env.moderation_circuit_breaker_open_seconds),
+            'MODERATION_CIRCUIT_BREAKER_SKIP_RETURN_SOURCES': str(self._env.moderation_circuit_breaker_skip_return_sources),
+            'MODERATION_PRIORITY_LANES_ENABLED': str(self._env.moderation_priority_lanes_enabled),
+            'MODERATION_LANE_CAPACITY': str(self._env.moderation_lane_capacity),
+            'MODERATION_LANE_INTERACTIVE_RESERVED': str(self._env.moderation_lane_interactive_reserved),
+            'MODERATION_LANE_LIMITS': str(self._env.moderation_lane_limits),
+            'MODERATION_FAIR_SHARE_ENABLED': str(self._env.moderation_fair_share_enabled),
+            'MODERATION_FAIR_SHARE_CAPACITY': str(self._env.moderation_fair_share_capacity),
+            'MODERATION_TENANT_WEIGHTS': str(self._env.moderation_tenant_weights),
+            'MODERATION_TENANT_QUOTAS': str(self._env.moderation_tenant_quotas),
+            'MODERATION_TENANT_QUOTA_MAX_WAIT_SECONDS': str(self._env.moderation_tenant_quota_max_wait_seconds),
+            'MODERATION_EARLY_EXIT_ENABLED': str(self._env.moderation_early_exit_enabled),
+            'MODERATION_EARLY_EXIT_LABELS': str(self._env.moderation_early_exit_labels),
+            'MODERATION_CASCADE_ENABLED': str(self._env.moderation_cascade_enabled),
+            'MODERATION_CASCADE_TIERS': str(self._env.moderation_cascade_tiers),
+            'MODERATION_CASCADE_UNCERTAIN_MIN_CONFIDENCE': str(self._env.moderation_cascade_uncertain_min_confidence),
+            'MODERATION_CASCADE_UNCERTAIN_MAX_CONFIDENCE': str(self._env.moderation_cascade_uncertain_max_confidence),
+            'MODERATION_CASCADE_ESCALATION_LABELS': str(self._env.moderation_cascade_escalation_labels),
+            'MODERATION_JOB_MAX_RECEIVE_COUNT': str(self._env.moderation_job_max_receive_count),
+            'MODERATION_HASH_LIST_CACHE_TTL_SECONDS': str(self._env.moderation_hash_list_cache_ttl_seconds),
+            'MODERATION_HASH_LIST_CACHE_MAX_SIZE': str(self._env.moderation_hash_list_cache_max_size),
+            'MODERATION_RATE_LIMIT_TABLE_NAME': self._rate_limit_table.table_name,
+            'SAGEMAKER_ENDPOINT_NAME': self._sagemaker.endpoint_name,
+            'MODERATION_JOB_QUEUE_NAME': self._job_queue.queue_name,
+            'MODERATION_JOB_QUEUE_URL': self._job_queue.queue_url,
+            'MODERATION_JOB_TABLE_NAME': self._job_table.table_name
+        }
+
     def _create_role(self, sagemaker_endpoint_ref):
         default_role = iam.Role(self, "DefaultWorkshopRole",
                                 assumed_by=self._principal)
@@ -145,10 +293,27 @@ class ImageModeration(Construct):
                                            source_arn=api_gateway.arn_for_execute_api())
 
     def _create_api_gateway(self, lambda_docker):
+        # only the admin role can change the hash lists, callers allowed to detect labels can't whitelist their images
+        self._hash_list_admin_role = iam.Role(self,
+                                              'ModerationHashListAdminRole',
+                                              assumed_by=iam.AccountRootPrincipal())
+        api_policy = iam.PolicyDocument(statements=[
+            iam.PolicyStatement(effect=iam.Effect.ALLOW,
+                                principals=[iam.AccountRootPrincipal()],
+                                actions=['execute-api:Invoke'],
+                                resources=['execute-api:/*']),
+            iam.PolicyStatement(effect=iam.Effect.DENY,
+                                principals=[iam.AnyPrincipal()],
+                                actions=['execute-api:Invoke'],
+                                resources=['execute-api:/*/POST/Moderation/ImageHashList'],
+                                conditions={'ArnNotEquals': {
+                                    'aws:PrincipalArn': self._hash_list_admin_role.role_arn}}),
+        ])
 
         api = apigateway.LambdaRestApi(self,
                                        "image-moderation-workshop",
                                        handler=lambda_docker,
+                                       policy=api_policy,
                                        # endpoint_types=[apigateway.EndpointType.EDGE]
                                        proxy=False,
                                        deploy_options={
@@ -160,9 +325,72 @@ class ImageModeration(Construct):
         self._add_detection_resources_to_api_gateway(
             api,
             root_resource.add_resource("DetectImageLabels"))
+        self._add_batch_detection_resources_to_api_gateway(
+            api,
+            root_resource.add_resource("DetectImageLabelsBatch"))
+        self._add_job_resources_to_api_gateway(
+            api,
+            root_resource.add_resource("DetectImageLabelsJobs"))
+        hash_list_resource = root_resource.add_resource("ImageHashList")
+        hash_list_resource.add_method("POST",
+                                      authorization_type=apigateway.AuthorizationType.IAM)
+        hash_list_resource.add_cors_preflight(allow_origins=apigateway.Cors.ALL_ORIGINS, allow_methods=['POST'])
+        self._hash_list_admin_role.add_to_principal_policy(
+            iam.PolicyStatement(effect=iam.Effect.ALLOW,
+                                actions=['execute-api:Invoke'],
+                                resources=[api.arn_for_execute_api('POST', '/Moderation/ImageHashList')]))
+        cdk.CfnOutput(self, "HashListAdminRoleArn", value=self._hash_list_admin_role.role_arn)
+        root_resource.add_resource("Metrics").add_method("GET",
+                                                         authorization_type=apigateway.AuthorizationType.IAM)
 
         return api
 
+    def _add_job_resources_to_api_gateway(self,
+                                          api,
+                                          parent_resource: apigateway.Resource):
+        parent_resource.add_method("POST",
+                                   authorization_type=apigateway.AuthorizationType.IAM)
+        parent_resource.add_cors_preflight(allow_origins=apigateway.Cors.ALL_ORIGINS, allow_methods=['POST'])
+
+        job_resource = parent_resource.add_resource("{job_id}")
+        job_resource.add_method("GET",
+                                authorization_type=apigateway.AuthorizationType.IAM)
+        job_resource.add_cors_preflight(allow_origins=apigateway.Cors.ALL_ORIGINS, allow_methods=['GET'])
+
+    def _add_batch_detection_resources_to_api_gateway(self,
+                                                      api,
+                                                      parent_resource: apigateway.Resource):
+        batchContentModerationModel = apigateway.Model(self, "BatchContentModerationModel",
+                                                       rest_api=api,
+                                                       content_type="application/json",
+                                                       model_name="BatchContentModerationModel",
+                                                       description="To validate the batch moderation body",
+                                                       schema=apigateway.JsonSchema(
+                                                           type=apigateway.JsonSchemaType.OBJECT,
+                                                           properties={
+                                                               "Images": apigateway.JsonSchema(type=apigateway.JsonSchemaType.ARRAY,
+                                                                                               min_items=1),
+                                                               "MinConfidence": apigateway.JsonSchema(type=apigateway.JsonSchemaType.INTEGER,
+                                                                                                      minimum=20,
+                                                                                                      maximum=100)
+                                                           },
+                                                           required=["Images"],
+                                                       ),
+                                                       )
+
+        parent_resource.add_method("POST",
+                                   request_validator=apigateway.RequestValidator(self,
+                                                                                 "BatchContentModerationValidator",
+                                                                                 rest_api=api,
+                                                                                 request_validator_name="batch-content-moderation-body-validator",
+                                                                                 validate_request_body=True
+                                                                                 ),
+                                   request_models={
+                                       "application/json": batchContentModerationModel
+                                   },
+                                   authorization_type=apigateway.AuthorizationType.IAM)
+        parent_resource.add_cors_preflight(allow_origins=apigateway.Cors.ALL_ORIGINS, allow_methods=['POST'])
+
     # add api_key_required
     def _add_detection_resources_to_api_gateway(self, 
                                                 api, 
@@ -1,15 +1,23 @@
 import os
+import copy
 import logging
 import json
+import uuid
+
+from threading import Thread, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
 
 from botocore.client import Config
 import boto3
 from marshmallow import Schema, fields, ValidationError, validate, validates_schema, INCLUDE
-from chalice import Chalice, Response, BadRequestError, TooManyRequestsError
+from chalice import Chalice, Response, BadRequestError, TooManyRequestsError, ChaliceViewError, NotFoundError
 
 from chalicelib import rekognition, moderationhandler, sagemaker
-from chalicelib import imagehandler, exception, qrcodehandler
-from chalicelib.concurrentutils import Stopwatch
+from chalicelib import imagehandler, exception, qrcodehandler, jobqueue, cache, diskcache, hashlist, perceptualhash
+from chalicelib import pipeline, hedging, retry, ratelimit, adaptivelimit, circuitbreaker, lanes
+from chalicelib import fairshare, cascade
+from chalicelib.singleflight import SingleFlight, SingleFlightTimeoutException
+from chalicelib.concurrentutils import Stopwatch, CountDownLatch, BoundedExecutor, Deadline, deadline_timeout
 from chalicelib.paramsutils import Strings
 
 app = Chalice(app_name='image-moderation')
@@ -19,6 +27,27 @@ app.log.setLevel(logging.DEBUG)
 _SESSION = None
 _REKOGNITION_CLIENT = None
 _SAGEMAKER_CLIENT = None
+_JOB_QUEUE = None
+_JOB_STORE = None
+_VERDICT_CACHE = None
+_BACKEND_RESPONSE_CACHE = None
+_DISK_CACHE = None
+_URL_CACHE = None
+_BACKEND_EXECUTORS = None
+_BACKEND_IN_FLIGHT = None
+_BACKEND_HEDGERS = None
+_RETRY_POLICY = None
+_RATE_LIMITERS = None
+_CONCURRENCY_LIMITERS = None
+_CIRCUIT_BREAKERS = None
+_LANE_SCHEDULERS = None
+_FAIR_SHARE_SCHEDULERS = None
+_TENANT_QUOTAS = None
+_CASCADE = None
+_HASH_LIST_STORE = None
+_PERCEPTUAL_HASH_INDEX = None
+_DETECTION_PIPELINE = None
+_SINGLE_FLIGHT = SingleFlight()
 
 _MODERATION_BACKEND_SERVICES = [
     "DetectLabels",
@@ -38,6 +67,8 @@ _DEFAULT_MODERATION_LABEL_INCLUSION_FILTERS = ['Explicit Nudity', 'Partial Nudit
                                                'Violence', 'Explosions And Blasts', 'Gambling',
                                                'Army', 'Smoking', 'Drinking', 'Nazi Party']
 
+_BLACKLISTED_LABEL = hashlist.BLACKLISTED_LABEL
+
 _STRINGS_HELPER = Strings()
 
 _RETURN_RESOURCES = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_BACKEND_SERVICES'),
@@ -45,24 +76,491 @@ _RETURN_RESOURCES = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERAT
 
 _ENABLE_BLACK_WHITE_LIST = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_IMAGE_BLACKLIST_WHITELIST_ENABLED'),
                                                         False)
+# lookups of the hash list in DynamoDB are kept this long, changes made by other containers are seen after it
+_HASH_LIST_CACHE_TTL_SECONDS = _STRINGS_HELPER.get_float_from_string(
+    os.environ.get('MODERATION_HASH_LIST_CACHE_TTL_SECONDS'), 10.0)
+_HASH_LIST_CACHE_MAX_SIZE = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_HASH_LIST_CACHE_MAX_SIZE'),
+                                                               10000)
+
+_BATCH_MAX_IMAGES = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_BATCH_MAX_IMAGES'), 32)
+_BATCH_MAX_CONCURRENCY = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_BATCH_MAX_CONCURRENCY'), 32)
+# return sources failing a request with partial results, the others are left out of the labels if they fail
+_MANDATORY_RETURN_SOURCES = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_MANDATORY_RETURN_SOURCES'), ['DetectModerationLabels'])
+
+_ENABLE_VERDICT_CACHE = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_VERDICT_CACHE_ENABLED'), False)
+_VERDICT_CACHE_MAX_SIZE = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_VERDICT_CACHE_MAX_SIZE'), 4096)
+_VERDICT_CACHE_TTL_SECONDS = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_VERDICT_CACHE_TTL_SECONDS'), 3600)
+
+_ENABLE_DISK_CACHE = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_DISK_CACHE_ENABLED'), False)
+_DISK_CACHE_PATH = os.environ.get('MODERATION_DISK_CACHE_PATH', '/tmp/image-moderation-cache.db')
+_DISK_CACHE_MAX_BYTES = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_DISK_CACHE_MAX_BYTES'), 256 << 20)
+
+_ENABLE_BACKEND_EXECUTORS = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_BACKEND_EXECUTORS_ENABLED'), False)
+_BACKEND_EXECUTOR_MAX_WORKERS = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_BACKEND_EXECUTOR_MAX_WORKERS'), 16)
+_BACKEND_EXECUTOR_MAX_QUEUE_SIZE = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_BACKEND_EXECUTOR_MAX_QUEUE_SIZE'), 64)
+# per return source overrides as ReturnSource:MaxWorkers:MaxQueueSize, e.g. DetectByCustomModels:4:32
+_BACKEND_EXECUTOR_LIMITS = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_BACKEND_EXECUTOR_LIMITS'), [])
+
+_BACKEND_MAX_IN_FLIGHT = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_BACKEND_MAX_IN_FLIGHT'), 64)
+
+# calls of the return sources slower than the percentile latency are hedged, within max ratio of extra calls
+_ENABLE_HEDGING = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_HEDGING_ENABLED'), False)
+_HEDGING_RETURN_SOURCES = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_HEDGING_RETURN_SOURCES'), ['DetectModerationLabels', 'DetectByCustomModels'])
+_HEDGING_PERCENTILE = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_HEDGING_PERCENTILE'), 95.0)
+_HEDGING_MAX_RATIO = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_HEDGING_MAX_RATIO'), 0.05)
+# per return source overrides as ReturnSource:Percentile:MaxRatio, e.g. DetectByCustomModels:99:0.02
+_HEDGING_LIMITS = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_HEDGING_LIMITS'), [])
+_HEDGING_MAX_WORKERS = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_HEDGING_MAX_WORKERS'), 32)
+
+# backend calls failing with retryable errors are called again with jittered backoff, retries are capped to budget ratio of the calls
+_ENABLE_RETRIES = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_RETRY_ENABLED'), True)
+_RETRY_MAX_ATTEMPTS = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_RETRY_MAX_ATTEMPTS'), 3)
+_RETRY_BASE_SECONDS = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_RETRY_BASE_SECONDS'), 0.05)
+_RETRY_CAP_SECONDS = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_RETRY_CAP_SECONDS'), 1.0)
+_RETRY_BUDGET_RATIO = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_RETRY_BUDGET_RATIO'), 0.1)
+
+# backend calls wait for tokens of the TPS quota of their operation, shared by all the containers in a dynamodb table if enabled
+_ENABLE_RATE_LIMITS = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_RATE_LIMIT_ENABLED'), False)
+# Operation:TokensPerSecond:Burst, operation is DetectLabels, DetectModerationLabels, SearchFacesByImage, RecognizeCelebrities or InvokeEndpoint
+_RATE_LIMITS = ratelimit.parse_limits(_STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_RATE_LIMITS'), ['DetectLabels:50:50', 'DetectModerationLabels:50:50', 'SearchFacesByImage:50:50', 'RecognizeCelebrities:50:50']), 'MODERATION_RATE_LIMITS')
+_RATE_LIMIT_MAX_WAIT_SECONDS = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_RATE_LIMIT_MAX_WAIT_SECONDS'), 1.0)
+_ENABLE_SHARED_RATE_LIMITS = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_RATE_LIMIT_SHARED_ENABLED'), False)
+_RATE_LIMIT_LEASE_SIZE = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_RATE_LIMIT_LEASE_SIZE'), 5)
+
+# calls in flight of each return source are capped by a limit following the latency and throttles of its backend
+_ENABLE_ADAPTIVE_CONCURRENCY = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_ADAPTIVE_CONCURRENCY_ENABLED'), False)
+_ADAPTIVE_CONCURRENCY_INITIAL_LIMIT = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_ADAPTIVE_CONCURRENCY_INITIAL_LIMIT'), 16)
+_ADAPTIVE_CONCURRENCY_MIN_LIMIT = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_ADAPTIVE_CONCURRENCY_MIN_LIMIT'), 1)
+_ADAPTIVE_CONCURRENCY_MAX_LIMIT = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_ADAPTIVE_CONCURRENCY_MAX_LIMIT'), 128)
+_ADAPTIVE_CONCURRENCY_TOLERANCE = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_ADAPTIVE_CONCURRENCY_TOLERANCE'), 2.0)
+
+# calls of a backend fail fast once its failure rate or slow call rate reaches the threshold, until a probe succeeds
+_ENABLE_CIRCUIT_BREAKERS = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_CIRCUIT_BREAKER_ENABLED'), False)
+_CIRCUIT_BREAKER_FAILURE_RATE = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_CIRCUIT_BREAKER_FAILURE_RATE'), 0.5)
+_CIRCUIT_BREAKER_SLOW_CALL_SECONDS = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_CIRCUIT_BREAKER_SLOW_CALL_SECONDS'), 10.0)
+_CIRCUIT_BREAKER_SLOW_CALL_RATE = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_CIRCUIT_BREAKER_SLOW_CALL_RATE'), 0.8)
+_CIRCUIT_BREAKER_OPEN_SECONDS = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_CIRCUIT_BREAKER_OPEN_SECONDS'), 30.0)
+# return sources left out of the labels instead of failing the request while their circuit is open
+_CIRCUIT_BREAKER_SKIP_RETURN_SOURCES = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_CIRCUIT_BREAKER_SKIP_RETURN_SOURCES'), [])
+
+# backend calls of interactive and bulk requests are scheduled in lanes, reserved slots are left to interactive calls
+_ENABLE_PRIORITY_LANES = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_PRIORITY_LANES_ENABLED'), False)
+_LANE_CAPACITY = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_LANE_CAPACITY'), 32)
+_LANE_INTERACTIVE_RESERVED = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_LANE_INTERACTIVE_RESERVED'), 8)
+# per return source overrides as ReturnSource:Capacity:Reserved, e.g. DetectByCustomModels:8:4
+_LANE_LIMITS = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_LANE_LIMITS'), [])
+_PRIORITY_HEADER = 'X-Moderation-Priority'
+
+# backend calls are shared by tenants with deficit round robin, tenants are IAM principals or given by the tenant header
+_ENABLE_FAIR_SHARE = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_FAIR_SHARE_ENABLED'), False)
+_FAIR_SHARE_CAPACITY = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_FAIR_SHARE_CAPACITY'), 32)
+# weights as Tenant:Weight and quotas of backend calls per second as Tenant:Rate:Burst, tenants may be ARNs with colons
+_TENANT_WEIGHTS = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_TENANT_WEIGHTS'), [])
+_TENANT_QUOTA_LIMITS = ratelimit.parse_limits(_STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_TENANT_QUOTAS'), []), 'MODERATION_TENANT_QUOTAS')
+_TENANT_QUOTA_MAX_WAIT_SECONDS = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_TENANT_QUOTA_MAX_WAIT_SECONDS'), 0.5)
+_TENANT_HEADER = 'X-Moderation-Tenant'
+
+# a label at or above its min confidence ends the detection, as Label:MinConfidence
+_ENABLE_EARLY_EXIT = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_EARLY_EXIT_ENABLED'), False)
+_EARLY_EXIT_LABELS = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_EARLY_EXIT_LABELS'), ['Explicit Nudity:95'])
+
+# tiers of return sources are called one after the other while labels are uncertain, as ReturnSource:Tier:Cost
+_ENABLE_CASCADE = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_CASCADE_ENABLED'), False)
+_CASCADE_TIERS = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_CASCADE_TIERS'), ['DetectModerationLabels:1:1', 'DetectByCustomModels:1:1', 'DetectLabels:2:1', 'FaceSearch:2:1', 'CelebritySearch:2:1'])
+_CASCADE_UNCERTAIN_MIN_CONFIDENCE = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_CASCADE_UNCERTAIN_MIN_CONFIDENCE'), 50.0)
+_CASCADE_UNCERTAIN_MAX_CONFIDENCE = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_CASCADE_UNCERTAIN_MAX_CONFIDENCE'), 90.0)
+# labels calling the tiers up to theirs whatever their confidence, as Label:Tier
+_CASCADE_ESCALATION_LABELS = _STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_CASCADE_ESCALATION_LABELS'), ['Violence:2'])
+
+_ENABLE_URL_CACHE = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_URL_CACHE_ENABLED'), False)
+_URL_CACHE_MAX_SIZE = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_URL_CACHE_MAX_SIZE'), 16384)
+_ENABLE_S3_ETAG_CACHE = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_S3_ETAG_CACHE_ENABLED'), False)
+
+_ENABLE_BACKEND_RESPONSE_CACHE = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_BACKEND_RESPONSE_CACHE_ENABLED'), False)
+_BACKEND_RESPONSE_CACHE_MAX_SIZE = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_BACKEND_RESPONSE_CACHE_MAX_SIZE'), 16384)
+_BACKEND_RESPONSE_CACHE_TTL_SECONDS = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_BACKEND_RESPONSE_CACHE_TTL_SECONDS'), 3600)
+_BACKEND_RESPONSE_CACHE_MIN_CONFIDENCE = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_BACKEND_RESPONSE_CACHE_MIN_CONFIDENCE'), 50.0)
+_BACKEND_RESPONSE_CACHE_MAX_LABELS = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_BACKEND_RESPONSE_CACHE_MAX_LABELS'), 100)
+
+_ENABLE_PERCEPTUAL_HASH = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_PERCEPTUAL_HASH_ENABLED'), False)
+_PERCEPTUAL_HASH_MAX_DISTANCE = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_PERCEPTUAL_HASH_MAX_DISTANCE'), 4)
+# an entry with the verdict of one label takes about 1.5KB, so the default index takes about 150MB of the function memory
+_PERCEPTUAL_HASH_MAX_SIZE = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_PERCEPTUAL_HASH_MAX_SIZE'), 100000)
+
+_ENABLE_SINGLE_FLIGHT = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_SINGLE_FLIGHT_ENABLED'), True)
+_SINGLE_FLIGHT_TIMEOUT_SECONDS = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_SINGLE_FLIGHT_TIMEOUT_SECONDS'), 25.0)
+
+# requests finish before the 29 seconds of API Gateway, backend calls time out reading by then as well
+_REQUEST_TIMEOUT_SECONDS = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_REQUEST_TIMEOUT_SECONDS'), 25.0)
+_BACKEND_READ_TIMEOUT_SECONDS = _STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_BACKEND_READ_TIMEOUT_SECONDS'), _REQUEST_TIMEOUT_SECONDS)
+
+_PIPELINE_MAX_WORKERS = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_PIPELINE_MAX_WORKERS'), 8)
+_ENABLE_SPECULATIVE_QRCODE = _STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_SPECULATIVE_QRCODE_ENABLED'), False)
+
+_JOB_QUEUE_NAME = os.environ.get('MODERATION_JOB_QUEUE_NAME', 'image-moderation-jobs')
+_JOB_TTL_SECONDS = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_JOB_TTL_SECONDS'), 86400)
+# jobs failing with retryable errors are received again up to the max receive count of the queue, then they fail
+_JOB_MAX_RECEIVE_COUNT = _STRINGS_HELPER.get_int_from_string(os.environ.get('MODERATION_JOB_MAX_RECEIVE_COUNT'), 3)
 
 def get_s3_client():
-    return _get_session().client("s3")
+    return _get_session().client("s3", config=Config(connect_timeout=5, read_timeout=_BACKEND_READ_TIMEOUT_SECONDS))
 
 
-def get_image_handler():
+def get_image_handler(deadline=None):
     return imagehandler.ImageHandler(s3_client=get_s3_client(),
                                      compress_size=int(os.environ['MODERATION_IMAGE_COMPRESSION_SIZE_THRESHOLD']),
                                      compress_quality_step=int(os.environ['MODERATION_IMAGE_COMPRESS_QUALITY_STEP']),
                                      animation_extraction_size_threshold=int(os.environ['MODERATION_ANIMATION_EXTRACTION_SIZE_THRESHOLD']),
                                      animation_default_small_max_frame=int(os.environ['MODERATION_ANIMATION_EXTRACTION_SMALL_DEFAULT_MAX_THRESHOLD']),
                                      animation_default_large_max_frame=int(os.environ['MODERATION_ANIMATION_EXTRACTION_LARGE_DEFAULT_THRESHOLD_SIZE']),
+                                     hash_list=get_hash_list_store() if _ENABLE_BLACK_WHITE_LIST else None,
+                                     frame_cache=get_disk_cache(),
+                                     url_cache=get_url_cache(),
+                                     deadline=deadline,
                                      )
 
 
-def get_detect_labels_handler():
+def get_hash_list_store():
+    """DynamoDB tables if the blacklist/whitelist table names are configured, otherwise an in-process store"""
+    global _HASH_LIST_STORE
+    if _HASH_LIST_STORE is None:
+        blacklist_table_name = os.environ.get('MODERATION_BLACKLIST_TABLE_NAME')
+        whitelist_table_name = os.environ.get('MODERATION_WHITELIST_TABLE_NAME')
+        if blacklist_table_name and whitelist_table_name:
+            _HASH_LIST_STORE = hashlist.DynamoDBHashListStore(_get_session().client('dynamodb'),
+                                                              blacklist_table_name,
+                                                              whitelist_table_name,
+                                                              lookup_cache=cache.LRUCache(
+                                                                  max_size=_HASH_LIST_CACHE_MAX_SIZE,
+                                                                  ttl_seconds=_HASH_LIST_CACHE_TTL_SECONDS))
+        else:
+            _HASH_LIST_STORE = hashlist.InMemoryHashListStore()
+    return _HASH_LIST_STORE
+
+
+def get_verdict_cache():
+    """Verdicts cached by image content hash and detection parameters, None if the cache is disabled"""
+    global _VERDICT_CACHE
+    if not _ENABLE_VERDICT_CACHE:
+        return None
+    if _VERDICT_CACHE is None:
+        _VERDICT_CACHE = cache.LRUCache(max_size=_VERDICT_CACHE_MAX_SIZE, ttl_seconds=_VERDICT_CACHE_TTL_SECONDS)
+        disk_cache = get_disk_cache()
+        if disk_cache is not None:
+            _VERDICT_CACHE = cache.TieredCache(_VERDICT_CACHE, disk_cache)
+    return _VERDICT_CACHE
+
+
+def get_url_cache():
+    """Validators and content hashes of downloaded image urls, None if the url cache is disabled"""
+    global _URL_CACHE
+    if not _ENABLE_URL_CACHE:
+        return None
+    if _URL_CACHE is None:
+        _URL_CACHE = cache.LRUCache(max_size=_URL_CACHE_MAX_SIZE, ttl_seconds=_VERDICT_CACHE_TTL_SECONDS)
+    return _URL_CACHE
+
+
+def get_disk_cache():
+    """Cache of verdicts and resolved frames under /tmp shared by warm invocations, None if it's disabled"""
+    global _DISK_CACHE
+    if not _ENABLE_DISK_CACHE:
+        return None
+    if _DISK_CACHE is None:
+        _DISK_CACHE = diskcache.SQLiteCache(path=_DISK_CACHE_PATH,
+                                            max_bytes=_DISK_CACHE_MAX_BYTES,
+                                            ttl_seconds=_VERDICT_CACHE_TTL_SECONDS)
+    return _DISK_CACHE
+
+
+def get_backend_response_cache():
+    """Raw backend responses cached by frame bytes, None if the cache is disabled"""
+    global _BACKEND_RESPONSE_CACHE
+    if not _ENABLE_BACKEND_RESPONSE_CACHE:
+        return None
+    if _BACKEND_RESPONSE_CACHE is None:
+        _BACKEND_RESPONSE_CACHE = cache.LRUCache(max_size=_BACKEND_RESPONSE_CACHE_MAX_SIZE,
+                                                 ttl_seconds=_BACKEND_RESPONSE_CACHE_TTL_SECONDS)
+    return _BACKEND_RESPONSE_CACHE
+
+
+def get_perceptual_hash_index():
+    """Verdicts of prior images indexed by perceptual hash, None if near-duplicate detection is disabled"""
+    global _PERCEPTUAL_HASH_INDEX
+    if not _ENABLE_PERCEPTUAL_HASH:
+        return None
+    if _PERCEPTUAL_HASH_INDEX is None:
+        _PERCEPTUAL_HASH_INDEX = perceptualhash.MultiIndexHashIndex(max_distance=_PERCEPTUAL_HASH_MAX_DISTANCE,
+                                                                    max_size=_PERCEPTUAL_HASH_MAX_SIZE)
+    return _PERCEPTUAL_HASH_INDEX
+
+
+def get_job_queue():
+    """SQS queue if MODERATION_JOB_QUEUE_URL is configured, otherwise an in-process queue for local runs"""
+    global _JOB_QUEUE
+    if _JOB_QUEUE is None:
+        queue_url = os.environ.get('MODERATION_JOB_QUEUE_URL')
+        if queue_url:
+            _JOB_QUEUE = jobqueue.SqsJobQueue(_get_session().client('sqs'), queue_url)
+        else:
+            _JOB_QUEUE = jobqueue.InMemoryJobQueue(worker=_process_moderation_job,
+                                                   max_receive_count=_JOB_MAX_RECEIVE_COUNT)
+    return _JOB_QUEUE
+
+
+def get_job_store():
+    """DynamoDB table if MODERATION_JOB_TABLE_NAME is configured, otherwise an in-process store for local runs"""
+    global _JOB_STORE
+    if _JOB_STORE is None:
+        table_name = os.environ.get('MODERATION_JOB_TABLE_NAME')
+        if table_name:
+            _JOB_STORE = jobqueue.DynamoDBJobStore(_get_session().client('dynamodb'), table_name, _JOB_TTL_SECONDS)
+        else:
+            _JOB_STORE = jobqueue.InMemoryJobStore()
+    return _JOB_STORE
+
+
+def get_detect_labels_handler(concurrency_budget=None, deadline=None, lane=lanes.INTERACTIVE,
+                              tenant=fairshare.DEFAULT_TENANT):
     return moderationhandler.ModerationHandler(rek_client=get_rekognition_client(),
-                                               sagemaker_client=get_sagemaker_client())
+                                               sagemaker_client=get_sagemaker_client(),
+                                               concurrency_budget=concurrency_budget,
+                                               executors=get_backend_executors(),
+                                               max_in_flight=get_backend_in_flight(),
+                                               deadline=deadline,
+                                               hedgers=get_backend_hedgers(),
+                                               retry_policy=get_retry_policy(),
+                                               concurrency_limiters=get_concurrency_limiters(),
+                                               skippable_return_sources=_CIRCUIT_BREAKER_SKIP_RETURN_SOURCES
+                                               if _ENABLE_CIRCUIT_BREAKERS else None,
+                                               lane_schedulers=get_lane_schedulers(),
+                                               lane=lane,
+                                               fair_share_schedulers=get_fair_share_schedulers(),
+                                               tenant=tenant,
+                                               tenant_quota=get_tenant_quotas().get(tenant)
+                                               if _ENABLE_FAIR_SHARE else None,
+                                               decisive_labels=_decisive_labels() if _ENABLE_EARLY_EXIT else None,
+                                               cascade=get_cascade())
+
+
+def _decisive_labels():
+    """Min confidence by decisive label name"""
+    decisive_labels = {}
+    for decisive_label in _EARLY_EXIT_LABELS:
+        label, min_confidence = decisive_label.rsplit(':', 1)
+        decisive_labels[label] = float(min_confidence)
+    return decisive_labels
+
+
+def get_lane_schedulers():
+    """Lane scheduler by return source living as long as the container, None if priority lanes are disabled"""
+    global _LANE_SCHEDULERS
+    if not _ENABLE_PRIORITY_LANES:
+        return None
+    if _LANE_SCHEDULERS is None:
+        limits = {}
+        for limit in _LANE_LIMITS:
+            return_source, capacity, reserved = limit.split(':')
+            limits[return_source] = (int(capacity), int(reserved))
+        _LANE_SCHEDULERS = {}
+        for return_source in _MODERATION_BACKEND_SERVICES:
+            capacity, reserved = limits.get(return_source, (_LANE_CAPACITY, _LANE_INTERACTIVE_RESERVED))
+            _LANE_SCHEDULERS[return_source] = lanes.LaneScheduler(return_source, capacity=capacity, reserved=reserved)
+    return _LANE_SCHEDULERS
+
+
+def get_fair_share_schedulers():
+    """Fair share scheduler of the tenants by return source living as long as the container, None if it's disabled"""
+    global _FAIR_SHARE_SCHEDULERS
+    if not _ENABLE_FAIR_SHARE:
+        return None
+    if _FAIR_SHARE_SCHEDULERS is None:
+        weights = {}
+        for weight in _TENANT_WEIGHTS:
+            tenant, value = weight.rsplit(':', 1)
+            weights[tenant] = float(value)
+            if not weights[tenant] > 0:
+                raise ValueError(f'Weight of tenant {tenant} in MODERATION_TENANT_WEIGHTS must be positive: {weight}')
+        _FAIR_SHARE_SCHEDULERS = {return_source: fairshare.FairShareScheduler(return_source,
+                                                                              capacity=_FAIR_SHARE_CAPACITY,
+                                                                              weights=weights)
+                                  for return_source in _MODERATION_BACKEND_SERVICES}
+    return _FAIR_SHARE_SCHEDULERS
+
+
+def get_tenant_quotas():
+    """Rate limiter of the backend calls by tenant living as long as the container, tenants without quota aren't in it"""
+    global _TENANT_QUOTAS
+    if _TENANT_QUOTAS is None:
+        _TENANT_QUOTAS = {}
+        for tenant, rate, burst in _TENANT_QUOTA_LIMITS:
+            _TENANT_QUOTAS[tenant] = ratelimit.RateLimiter(tenant, rate, burst,
+                                                           max_wait_seconds=_TENANT_QUOTA_MAX_WAIT_SECONDS)
+    return _TENANT_QUOTAS
+
+
+def get_cascade():
+    """Cascade of the tiers of return sources living as long as the container, None if it's disabled"""
+    global _CASCADE
+    if not _ENABLE_CASCADE:
+        return None
+    if _CASCADE is None:
+        tiers = {}
+        costs = {}
+        for tier in _CASCADE_TIERS:
+            return_source, number, cost = tier.split(':')
+            tiers[return_source] = int(number)
+            costs[return_source] = float(cost)
+        escalation_labels = {}
+        for escalation_label in _CASCADE_ESCALATION_LABELS:
+            label, number = escalation_label.rsplit(':', 1)
+            escalation_labels[label] = int(number)
+        _CASCADE = cascade.Cascade(tiers,
+                                   costs=costs,
+                                   uncertain_min_confidence=_CASCADE_UNCERTAIN_MIN_CONFIDENCE,
+                                   uncertain_max_confidence=_CASCADE_UNCERTAIN_MAX_CONFIDENCE,
+                                   escalation_labels=escalation_labels)
+    return _CASCADE
+
+
+def get_backend_in_flight():
+    """Semaphore capping the backend calls in flight of all the detections in the container"""
+    global _BACKEND_IN_FLIGHT
+    if _BACKEND_IN_FLIGHT is None:
+        _BACKEND_IN_FLIGHT = BoundedSemaphore(_BACKEND_MAX_IN_FLIGHT)
+    return _BACKEND_IN_FLIGHT
+
+
+def get_backend_executors():
+    """Bounded worker pool by return source living as long as the container, None if they're disabled"""
+    global _BACKEND_EXECUTORS
+    if not _ENABLE_BACKEND_EXECUTORS:
+        return None
+    if _BACKEND_EXECUTORS is None:
+        limits = {}
+        for limit in _BACKEND_EXECUTOR_LIMITS:
+            return_source, max_workers, max_queue_size = limit.split(':')
+            limits[return_source] = (int(max_workers), int(max_queue_size))
+        _BACKEND_EXECUTORS = {}
+        for return_source in _MODERATION_BACKEND_SERVICES:
+            max_workers, max_queue_size = limits.get(return_source,
+                                                     (_BACKEND_EXECUTOR_MAX_WORKERS, _BACKEND_EXECUTOR_MAX_QUEUE_SIZE))
+            _BACKEND_EXECUTORS[return_source] = BoundedExecutor(return_source,
+                                                                max_workers=max_workers,
+                                                                max_queue_size=max_queue_size)
+    return _BACKEND_EXECUTORS
+
+
+def get_detection_pipeline():
+    """
+    Stages detecting labels of the resolved frames of an image, on an executor living as long as the container.
+    Downloading and resolving the image are not stages, they run before since the caches are looked up by the hash
+    of the resolved image.
+    """
+    global _DETECTION_PIPELINE
+    if _DETECTION_PIPELINE is None:
+        # the backends are called on executors of the moderation handler, so that the stage doesn't hold a worker
+        # of the pipeline and concurrent detections of a batch are not capped by the pipeline workers
+        stages = [pipeline.Stage('backends', _detect_labels_stage,
+                                 inputs=['handler', 'images', 'url', 'bucket', 'object_name', 'return_sources',
+                                         'min_confidence', 'max_labels', 'mandatory_return_sources'],
+                                 outputs=['backend_labels'],
+                                 calling_thread=True)]
+        qrcode_inputs = ['images', 'backend_labels', 'url', 'deadline']
+        if _ENABLE_SPECULATIVE_QRCODE:
+            # scan the frames for QR codes while the backends run
+            stages.append(pipeline.Stage('qrcode_scan', _scan_qrcode_stage, inputs=['images', 'deadline'],
+                                         outputs=['qrcode_texts']))
+            qrcode_inputs.append('qrcode_texts')
+        stages.append(pipeline.Stage('qrcode', _qrcode_stage, inputs=qrcode_inputs, outputs=['labels']))
+        _DETECTION_PIPELINE = pipeline.Pipeline(stages, executor=ThreadPoolExecutor(max_workers=_PIPELINE_MAX_WORKERS))
+    return _DETECTION_PIPELINE
+
+
+def get_backend_hedgers():
+    """Hedger by hedged return source living as long as the container, None if hedging is disabled"""
+    global _BACKEND_HEDGERS
+    if not _ENABLE_HEDGING:
+        return None
+    if _BACKEND_HEDGERS is None:
+        limits = {}
+        for limit in _HEDGING_LIMITS:
+            return_source, percentile, max_ratio = limit.split(':')
+            limits[return_source] = (float(percentile), float(max_ratio))
+        _BACKEND_HEDGERS = {}
+        for return_source in _HEDGING_RETURN_SOURCES:
+            percentile, max_ratio = limits.get(return_source, (_HEDGING_PERCENTILE, _HEDGING_MAX_RATIO))
+            _BACKEND_HEDGERS[return_source] = hedging.Hedger(return_source, percentile=percentile, max_ratio=max_ratio,
+                                                             max_workers=_HEDGING_MAX_WORKERS)
+    return _BACKEND_HEDGERS
+
+
+def get_retry_policy():
+    """Retry policy of the backend calls with a retry budget living as long as the container, None if disabled"""
+    global _RETRY_POLICY
+    if not _ENABLE_RETRIES:
+        return None
+    if _RETRY_POLICY is None:
+        _RETRY_POLICY = retry.RetryPolicy(max_attempts=_RETRY_MAX_ATTEMPTS,
+                                          base_seconds=_RETRY_BASE_SECONDS,
+                                          cap_seconds=_RETRY_CAP_SECONDS,
+                                          budget=retry.RetryBudget(ratio=_RETRY_BUDGET_RATIO))
+    return _RETRY_POLICY
+
+
+def get_concurrency_limiters():
+    """Adaptive concurrency limiter by return source living as long as the container, None if they're disabled"""
+    global _CONCURRENCY_LIMITERS
+    if not _ENABLE_ADAPTIVE_CONCURRENCY:
+        return None
+    if _CONCURRENCY_LIMITERS is None:
+        _CONCURRENCY_LIMITERS = {return_source: adaptivelimit.AdaptiveConcurrencyLimiter(
+            return_source,
+            initial_limit=_ADAPTIVE_CONCURRENCY_INITIAL_LIMIT,
+            min_limit=_ADAPTIVE_CONCURRENCY_MIN_LIMIT,
+            max_limit=_ADAPTIVE_CONCURRENCY_MAX_LIMIT,
+            tolerance=_ADAPTIVE_CONCURRENCY_TOLERANCE) for return_source in _MODERATION_BACKEND_SERVICES}
+    return _CONCURRENCY_LIMITERS
+
+
+def get_circuit_breakers():
+    """Circuit breaker by backend operation living as long as the container, None if they're disabled"""
+    global _CIRCUIT_BREAKERS
+    if not _ENABLE_CIRCUIT_BREAKERS:
+        return None
+    if _CIRCUIT_BREAKERS is None:
+        _CIRCUIT_BREAKERS = {operation_name: circuitbreaker.CircuitBreaker(
+            operation_name,
+            failure_rate_threshold=_CIRCUIT_BREAKER_FAILURE_RATE,
+            slow_call_seconds=_CIRCUIT_BREAKER_SLOW_CALL_SECONDS,
+            slow_call_rate_threshold=_CIRCUIT_BREAKER_SLOW_CALL_RATE,
+            open_seconds=_CIRCUIT_BREAKER_OPEN_SECONDS)
+            for operation_name in ['DetectLabels', 'DetectModerationLabels', 'SearchFacesByImage',
+                                   'RecognizeCelebrities', 'InvokeEndpoint']}
+    return _CIRCUIT_BREAKERS
+
+
+def get_rate_limiters():
+    """Rate limiter by backend operation living as long as the container, None if rate limits are disabled"""
+    global _RATE_LIMITERS
+    if not _ENABLE_RATE_LIMITS:
+        return None
+    if _RATE_LIMITERS is None:
+        table_name = os.environ.get('MODERATION_RATE_LIMIT_TABLE_NAME')
+        _RATE_LIMITERS = {}
+        for operation_name, rate, burst in _RATE_LIMITS:
+            if _ENABLE_SHARED_RATE_LIMITS and table_name:
+                _RATE_LIMITERS[operation_name] = ratelimit.DynamoDBRateLimiter(
+                    operation_name, rate, burst,
+                    dynamodb_client=_get_session().client('dynamodb'),
+                    table_name=table_name,
+                    lease_size=_RATE_LIMIT_LEASE_SIZE,
+                    max_wait_seconds=_RATE_LIMIT_MAX_WAIT_SECONDS)
+            else:
+                _RATE_LIMITERS[operation_name] = ratelimit.RateLimiter(operation_name, rate, burst,
+                                                                       max_wait_seconds=_RATE_LIMIT_MAX_WAIT_SECONDS)
+    return _RATE_LIMITERS
+
 
 def _get_session():
     global _SESSION
@@ -74,8 +572,13 @@ def _get_session():
 def get_sagemaker_client():
     global _SAGEMAKER_CLIENT
     if _SAGEMAKER_CLIENT is None:
-        _SAGEMAKER_CLIENT = sagemaker.SageMakerClient(_get_session().client("sagemaker-runtime"),
-                                                      os.environ['SAGEMAKER_ENDPOINT_NAME'])
+        # retried by the retry policy of the handler, within the retry budget
+        config = Config(connect_timeout=5, read_timeout=_BACKEND_READ_TIMEOUT_SECONDS, retries={'max_attempts': 0})
+        _SAGEMAKER_CLIENT = sagemaker.SageMakerClient(_get_session().client("sagemaker-runtime", config=config),
+                                                      os.environ['SAGEMAKER_ENDPOINT_NAME'],
+                                                      response_cache=get_backend_response_cache(),
+                                                      rate_limiter=(get_rate_limiters() or {}).get('InvokeEndpoint'),
+                                                      circuit_breaker=(get_circuit_breakers() or {}).get('InvokeEndpoint'))
     return _SAGEMAKER_CLIENT
 
 
@@ -83,7 +586,7 @@ def get_sagemaker_client():
 def get_rekognition_client():
     global _REKOGNITION_CLIENT
     if _REKOGNITION_CLIENT is None:
-        config = Config(connect_timeout=5, retries={'max_attempts': 0})
+        config = Config(connect_timeout=5, read_timeout=_BACKEND_READ_TIMEOUT_SECONDS, retries={'max_attempts': 0})
         _REKOGNITION_CLIENT = rekognition.RekognitonClient(
             boto3_client=_get_session().client('rekognition', config=config),
             customer_facial_threshold=_STRINGS_HELPER.get_float_from_string(os.environ.get('MODERATION_CUSTOMER_FACIAL_THRESHOLD'), 85.0),
@@ -91,7 +594,12 @@ def get_rekognition_client():
             enable_moderation_filter=_STRINGS_HELPER.get_bool_from_string(os.environ.get('MODERATION_DETECT_MODERATION_LABEL_FILTER_ENABLED'),False),
             label_inclusion_filters=_STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_DETECT_LABEL_INCLUSION_FILTER'),_DEFAULT_LABEL_INCLUSION_FILTERS),
             moderation_label_inclusion_filters=_STRINGS_HELPER.get_list_from_string(os.environ.get('MODERATION_DETECT_MODERATION_LABEL_INCLUSION_FILTER'),_DEFAULT_MODERATION_LABEL_INCLUSION_FILTERS),
-            collection_id=os.environ['MODERATION_REKOGNITION_COLLECTION_ID'])
+            collection_id=os.environ['MODERATION_REKOGNITION_COLLECTION_ID'],
+            response_cache=get_backend_response_cache(),
+            cached_min_confidence=_BACKEND_RESPONSE_CACHE_MIN_CONFIDENCE,
+            cached_max_labels=_BACKEND_RESPONSE_CACHE_MAX_LABELS,
+            rate_limiters=get_rate_limiters(),
+            circuit_breakers=get_circuit_breakers())
     return _REKOGNITION_CLIENT
 
 
@@ -130,6 +638,53 @@ class DetectLabelsSchema(Schema):
     ReturnSource = fields.List(fields.String(), required=False, validate=validate_return_resource)
     MinConfidence = fields.Integer(validate=lambda value: 20 <= value <= 100)
     MaxLabels = fields.Integer(required=False, validate=lambda value: 1 <= value <= 4096)
+    PartialResults = fields.Boolean(required=False)
+    Priority = fields.String(required=False, validate=validate.OneOf(lanes.LANES))
+
+class DetectLabelsBatchSchema(Schema):
+    class Meta:
+        unknown = INCLUDE
+
+    Images = fields.List(fields.Nested(nested=ListItemSchema), required=True,
+                         validate=validate.Length(min=1, max=_BATCH_MAX_IMAGES))
+    ReturnSource = fields.List(fields.String(), required=False, validate=validate_return_resource)
+    MinConfidence = fields.Integer(validate=lambda value: 20 <= value <= 100)
+    MaxLabels = fields.Integer(required=False, validate=lambda value: 1 <= value <= 4096)
+    PartialResults = fields.Boolean(required=False)
+    Priority = fields.String(required=False, validate=validate.OneOf(lanes.LANES))
+
+class ImageHashListSchema(Schema):
+    Action = fields.String(required=True, validate=validate.OneOf(['Add', 'Remove']))
+    ListType = fields.String(required=True, validate=validate.OneOf(hashlist.LIST_TYPES))
+    Hashes = fields.List(fields.String(validate=validate.Regexp('^[0-9a-f]{64}$')), required=False,
+                         validate=validate.Length(max=100))
+    Images = fields.List(fields.Nested(ImageSchema), required=False, validate=validate.Length(max=10))
+
+    @validates_schema
+    def validate_hashes(self, data, **kwargs):
+        if len(data.get('Hashes', [])) == 0 and len(data.get('Images', [])) == 0:
+            raise ValidationError('Either of Hashes or Images is required!')
+
+def _request_lane(body, default_lane):
+    """Lane of the Priority of the body, or of the priority header if the body has none"""
+    if body.get('Priority') is not None:
+        return body['Priority']
+    priority = app.current_request.headers.get(_PRIORITY_HEADER) if app.current_request.headers is not None else None
+    if priority is None:
+        return default_lane
+    if priority not in lanes.LANES:
+        raise BadRequestError(f'{_PRIORITY_HEADER} {priority} not one of {lanes.LANES}')
+    return priority
+
+def _request_tenant():
+    """Tenant of the IAM principal of the request, or of the tenant header for requests without a principal"""
+    context = app.current_request.context if app.current_request.context is not None else {}
+    principal = (context.get('identity') or {}).get('userArn')
+    if principal:
+        # sessions of an assumed role are the same tenant
+        return principal.rsplit('/', 1)[0] if ':assumed-role/' in principal else principal
+    tenant = app.current_request.headers.get(_TENANT_HEADER) if app.current_request.headers is not None else None
+    return tenant if tenant else fairshare.DEFAULT_TENANT
 
 def __get_image(image):
     if image is None:
@@ -165,19 +720,249 @@ def detect_image_labels():
     min_confidence = body.get('MinConfidence') if body.get('MinConfidence') is not None else 60
     max_labels = body.get('MaxLabels') if body.get('MaxLabels') is not None else 50
 
+    partial_results = body.get('PartialResults') is True
+    lane = _request_lane(body, lanes.INTERACTIVE)
+
     stopwatch = Stopwatch().start()
+    deadline = Deadline(_REQUEST_TIMEOUT_SECONDS)
     labels = _detect_labels(url=url,
                             bucket=bucket,
                             object_name=object_name,
                             return_sources=body.get('ReturnSource'),
                             min_confidence=min_confidence,
-                            max_labels=max_labels)
+                            max_labels=max_labels,
+                            detect_labels_handler=get_detect_labels_handler(deadline=deadline, lane=lane,
+                                                                            tenant=_request_tenant()),
+                            deadline=deadline,
+                            partial_results=partial_results)
     lapsed = stopwatch.stop()
     app.log.info("Detected finally labels lapsed time {} by {}: {}".format('%.3f' % lapsed, body, labels))
-    return {'Labels': labels}
+    return _labels_response({'Labels': labels}, labels, partial_results)
+
+
+@app.route('/Moderation/DetectImageLabelsBatch', methods=['POST'])
+def detect_image_labels_batch():
+    """Detect image labels for a list of images in one invocation"""
+    app.log.debug("Detect batch labels details, request {}, request raw body {}"
+                  .format(app.current_request.path, app.current_request.raw_body))
+    try:
+        body = json.loads(app.current_request.raw_body)
+        DetectLabelsBatchSchema().load(body, unknown=None)
+    except ValidationError as e:
+        app.log.error("Schema error for the request {}, request raw body {}, current request{}: {}"
+                      .format(app.current_request.path, app.current_request.raw_body, app.current_request, e.messages))
+        raise BadRequestError(e.messages)
+
+    min_confidence = body.get('MinConfidence') if body.get('MinConfidence') is not None else 60
+    max_labels = body.get('MaxLabels') if body.get('MaxLabels') is not None else 50
+
+    stopwatch = Stopwatch().start()
+    results = _detect_labels_batch(items=body['Images'],
+                                   return_sources=body.get('ReturnSource'),
+                                   min_confidence=min_confidence,
+                                   max_labels=max_labels,
+                                   deadline=Deadline(_REQUEST_TIMEOUT_SECONDS),
+                                   partial_results=body.get('PartialResults') is True,
+                                   lane=_request_lane(body, lanes.INTERACTIVE),
+                                   tenant=_request_tenant())
+    lapsed = stopwatch.stop()
+    app.log.info("Detected finally batch labels lapsed time {} for {} images".format('%.3f' % lapsed, len(results)))
+    return {'Results': results}
+
+
+@app.route('/Moderation/DetectImageLabelsJobs', methods=['POST'])
+def submit_detect_image_labels_job():
+    """Submit a job to detect image labels asynchronously, poll the result with the returned JobId"""
+    app.log.debug("Submit detect labels job, request {}, request raw body {}"
+                  .format(app.current_request.path, app.current_request.raw_body))
+    try:
+        body = json.loads(app.current_request.raw_body)
+        DetectLabelsSchema().load(body, unknown=None)
+    except ValidationError as e:
+        app.log.error("Schema error for the request {}, request raw body {}, current request{}: {}"
+                      .format(app.current_request.path, app.current_request.raw_body, app.current_request, e.messages))
+        raise BadRequestError(e.messages)
+    # failed jobs are received again instead of returning degraded labels
+    if body.get('PartialResults') is True:
+        raise BadRequestError('PartialResults is not supported by jobs')
+
+    # jobs are backfills unless they ask for interactive priority, resolved before the job is created so that a bad
+    # priority doesn't leave a job which is never processed
+    lane = _request_lane(body, lanes.BULK)
+    tenant = _request_tenant()
+    job_id = str(uuid.uuid4())
+    try:
+        get_job_store().create(job_id, body)
+        get_job_queue().submit({'JobId': job_id, 'Request': body, 'Priority': lane, 'Tenant': tenant})
+    except exception.InvocationException as e:
+        raise TooManyRequestsError(e.message)
+
+    app.log.info("Submitted detect labels job {} by {}".format(job_id, body))
+    return Response(body={'JobId': job_id, 'Status': jobqueue.JOB_STATUS_SUBMITTED}, status_code=202)
 
 
-def _qrcode_handle(image_data_list, qrcode_label, url):
+@app.route('/Moderation/DetectImageLabelsJobs/{job_id}', methods=['GET'])
+def get_detect_image_labels_job(job_id):
+    """Get status of a detect labels job, with Labels or Error once it's done"""
+    try:
+        job = get_job_store().get(job_id)
+    except exception.InvocationException as e:
+        raise TooManyRequestsError(e.message)
+
+    if job is None:
+        raise NotFoundError(f'Job {job_id} not found')
+    return job
+
+
+@app.on_sqs_message(queue=_JOB_QUEUE_NAME, batch_size=1)
+def process_moderation_jobs(event):
+    """Worker entry point of the sqs queue, a job raising retryable errors is received again"""
+    for record in event:
+        attributes = record.to_dict().get('attributes', {})
+        _process_moderation_job(json.loads(record.body),
+                                receive_count=int(attributes.get('ApproximateReceiveCount', 1)))
+
+
+def _process_moderation_job(job, receive_count=1):
+    """
+    Detect the labels of a job. Bad requests fail the job, other errors such as throttles are raised so that the job
+    is received again, until its last receive where the job fails.
+    """
+    job_id = job['JobId']
+    body = job['Request']
+    store = get_job_store()
+    store.start(job_id)
+
+    url, bucket, object_name = __get_image(body['Image'])
+    min_confidence = body.get('MinConfidence') if body.get('MinConfidence') is not None else 60
+    max_labels = body.get('MaxLabels') if body.get('MaxLabels') is not None else 50
+
+    stopwatch = Stopwatch().start()
+    try:
+        labels = _detect_labels(url=url,
+                                bucket=bucket,
+                                object_name=object_name,
+                                return_sources=body.get('ReturnSource'),
+                                min_confidence=min_confidence,
+                                max_labels=max_labels,
+                                detect_labels_handler=get_detect_labels_handler(
+                                    lane=job.get('Priority', lanes.BULK),
+                                    tenant=job.get('Tenant', fairshare.DEFAULT_TENANT)))
+    except BadRequestError as e:
+        app.log.error("Detected labels job {} failed: {}".format(job_id, e))
+        store.fail(job_id, type(e).__name__, str(e))
+        return
+    except Exception as e:
+        if receive_count < _JOB_MAX_RECEIVE_COUNT:
+            app.log.warning("Detected labels job {} failed in receive {} of {}, it's received again: {}".format(
+                job_id, receive_count, _JOB_MAX_RECEIVE_COUNT, e))
+            raise
+        app.log.exception("Detected labels job {} failed in its last receive".format(job_id))
+        store.fail(job_id, type(e).__name__ if isinstance(e, ChaliceViewError) else 'InternalServerError', str(e))
+        return
+
+    lapsed = stopwatch.stop()
+    store.complete(job_id, labels)
+    app.log.info("Detected job {} labels lapsed time {} by {}: {}".format(job_id, '%.3f' % lapsed, body, labels))
+
+
+@app.route('/Moderation/ImageHashList', methods=['POST'])
+def update_image_hash_list():
+    """Add or remove image hashes to/from blacklist or whitelist, hashes can be given directly or by images"""
+    app.log.debug("Update image hash list, request {}, request raw body {}"
+                  .format(app.current_request.path, app.current_request.raw_body))
+    try:
+        body = json.loads(app.current_request.raw_body)
+        ImageHashListSchema().load(body, unknown=None)
+    except ValidationError as e:
+        app.log.error("Schema error for the request {}, request raw body {}, current request{}: {}"
+                      .format(app.current_request.path, app.current_request.raw_body, app.current_request, e.messages))
+        raise BadRequestError(e.messages)
+
+    hashes = list(body.get('Hashes', []))
+    image_handler = get_image_handler()
+    for image in body.get('Images', []):
+        url, bucket, object_name = __get_image(image)
+        try:
+            hash_data = image_handler.generate_hash(url, bucket=bucket, object_name=object_name)
+        except exception.CannotDownloadImageException as e:
+            raise BadRequestError(e.message)
+        if len(hash_data) == 0:
+            raise BadRequestError(f'Cannot download image from {url}, {bucket}/{object_name}')
+        hashes.append(hash_data)
+
+    store = get_hash_list_store()
+    try:
+        if body['Action'] == 'Add':
+            store.add(body['ListType'], hashes)
+        else:
+            store.remove(body['ListType'], hashes)
+    except exception.InvocationException as e:
+        raise TooManyRequestsError(e.message)
+
+    app.log.info("Updated image hash list {} {}: {}".format(body['ListType'], body['Action'], hashes))
+    return {'Action': body['Action'], 'ListType': body['ListType'], 'Hashes': hashes}
+
+
+@app.route('/Moderation/Metrics', methods=['GET'])
+def get_metrics():
+    """Counters of the in-process components of this container"""
+    metrics = {}
+    verdict_cache = get_verdict_cache()
+    if verdict_cache is not None:
+        metrics['VerdictCache'] = verdict_cache.stats()
+    disk_cache = get_disk_cache()
+    if disk_cache is not None:
+        metrics['DiskCache'] = disk_cache.stats()
+    url_cache = get_url_cache()
+    if url_cache is not None:
+        metrics['UrlCache'] = url_cache.stats()
+    backend_executors = get_backend_executors()
+    if backend_executors is not None:
+        metrics['BackendExecutors'] = {return_source: executor.stats()
+                                       for return_source, executor in backend_executors.items()}
+    backend_hedgers = get_backend_hedgers()
+    if backend_hedgers is not None:
+        metrics['BackendHedging'] = {return_source: hedger.stats() for return_source, hedger in backend_hedgers.items()}
+    lane_schedulers = get_lane_schedulers()
+    if lane_schedulers is not None:
+        metrics['BackendLanes'] = {return_source: scheduler.stats()
+                                   for return_source, scheduler in lane_schedulers.items()}
+    fair_share_schedulers = get_fair_share_schedulers()
+    if fair_share_schedulers is not None:
+        metrics['BackendFairShare'] = {return_source: scheduler.stats()
+                                       for return_source, scheduler in fair_share_schedulers.items()}
+        metrics['TenantQuotas'] = {tenant: quota.stats() for tenant, quota in get_tenant_quotas().items()}
+    circuit_breakers = get_circuit_breakers()
+    if circuit_breakers is not None:
+        metrics['BackendCircuitBreakers'] = {operation_name: circuit_breaker.stats()
+                                             for operation_name, circuit_breaker in circuit_breakers.items()}
+    concurrency_limiters = get_concurrency_limiters()
+    if concurrency_limiters is not None:
+        metrics['BackendConcurrencyLimits'] = {return_source: limiter.stats()
+                                               for return_source, limiter in concurrency_limiters.items()}
+    rate_limiters = get_rate_limiters()
+    if rate_limiters is not None:
+        metrics['BackendRateLimits'] = {operation_name: rate_limiter.stats()
+                                        for operation_name, rate_limiter in rate_limiters.items()}
+    retry_policy = get_retry_policy()
+    if retry_policy is not None:
+        metrics['BackendRetries'] = retry_policy.stats()
+    backend_cascade = get_cascade()
+    if backend_cascade is not None:
+        metrics['BackendCascade'] = backend_cascade.stats()
+    backend_response_cache = get_backend_response_cache()
+    if backend_response_cache is not None:
+        metrics['BackendResponseCache'] = backend_response_cache.stats()
+    perceptual_hash_index = get_perceptual_hash_index()
+    if perceptual_hash_index is not None:
+        metrics['PerceptualHashIndex'] = perceptual_hash_index.stats()
+    metrics['SingleFlight'] = _SINGLE_FLIGHT.stats()
+    metrics['Pipeline'] = get_detection_pipeline().stats()
+    return metrics
+
+
+def _qrcode_handle(image_data_list, qrcode_label, url, deadline=None):
     handler = qrcodehandler.QrcodeHandler()
     texts = []
 
@@ -187,6 +972,8 @@ def _qrcode_handle(image_data_list, qrcode_label, url):
     bounding_box = qrcode_label.get('BoundingBox')
 
     for image_data in image_data_list:
+        if deadline is not None:
+            deadline.check('qrcode')
         tmp_texts = handler.decode(image_data, bounding_box)
         if tmp_texts is None or len(tmp_texts) == 0:
             continue
@@ -199,12 +986,179 @@ def _qrcode_handle(image_data_list, qrcode_label, url):
         del qrcode_label['BoundingBox']
 
 
-def _detect_labels(url, bucket, object_name, return_sources, min_confidence, max_labels):
+def _labels_response(response, labels, partial_results):
     """
-    Facade method to call image handler to get proper images and call moderation handler to detect labels
+    Add the status of every return source to a response with partial results, flag labels of a detection ended by a
+    decisive label, reused or not, and add the tiers of the cascade called, unless the labels are reused
     """
+    source_status = getattr(labels, 'source_status', None)
+    if partial_results and source_status is not None:
+        response['SourceStatus'] = source_status
+    if getattr(labels, 'short_circuited', False):
+        response['ShortCircuited'] = True
+    tiers = getattr(labels, 'tiers', None)
+    if tiers is not None:
+        response['CascadeTiers'] = tiers
+    return response
 
-    image_handler = get_image_handler()
+
+def _detect_labels_batch(items, return_sources, min_confidence, max_labels, deadline=None, partial_results=False,
+                         lane=lanes.INTERACTIVE, tenant=fairshare.DEFAULT_TENANT):
+    """
+    Download and detect every item concurrently, all backend calls share one concurrency budget.
+    Errors are reported per item instead of failing the whole batch, items not done by the deadline fail.
+    """
+    handler = get_detect_labels_handler(concurrency_budget=BoundedSemaphore(_BATCH_MAX_CONCURRENCY), deadline=deadline,
+                                        lane=lane, tenant=tenant)
+    results = [None] * len(items)
+    done_signal = CountDownLatch(len(items))
+
+    def task(index, item):
+        result = {'Index': index}
+        if item.get('Description') is not None:
+            result['Description'] = item['Description']
+        try:
+            url, bucket, object_name = __get_image(item['Image'])
+            labels = _detect_labels(url=url,
+                                    bucket=bucket,
+                                    object_name=object_name,
+                                    return_sources=return_sources,
+                                    min_confidence=min_confidence,
+                                    max_labels=max_labels,
+                                    detect_labels_handler=handler,
+                                    deadline=deadline,
+                                    partial_results=partial_results)
+            result['Labels'] = labels
+            _labels_response(result, labels, partial_results)
+        except ChaliceViewError as e:
+            result['Error'] = {'Code': type(e).__name__, 'Message': str(e)}
+        except Exception as e:
+            app.log.exception('Detected batch item %d with unexpected errors' % index)
+            result['Error'] = {'Code': 'InternalServerError', 'Message': str(e)}
+        finally:
+            results[index] = result
+            done_signal.count_down()
+
+    for index, item in enumerate(items):
+        Thread(target=task, args=(index, item)).start()
+    if done_signal.wait(deadline_timeout(deadline)):
+        return results
+
+    # items still in flight are left behind
+    app.log.warning('Detected batch with items not done by the deadline')
+    timed_out_results = []
+    for index, result in enumerate(list(results)):
+        if result is None:
+            result = {'Index': index}
+            if items[index].get('Description') is not None:
+                result['Description'] = items[index]['Description']
+            result['Error'] = {'Code': 'TooManyRequestsError',
+                               'Message': f'Deadline of {deadline.timeout_seconds} seconds exceeded'}
+        timed_out_results.append(result)
+    return timed_out_results
+
+
+def _detect_labels(url, bucket, object_name, return_sources, min_confidence, max_labels, detect_labels_handler=None,
+                   deadline=None, partial_results=False):
+    """
+    Facade method to call image handler to get proper images and call moderation handler to detect labels.
+    Downloads, decoding, backend calls and QR decoding stop with 429 once the deadline has passed.
+    With partial results, failures of the return sources which are not mandatory leave their labels out instead of
+    failing with 429, such degraded labels are not cached.
+    """
+
+    image_handler = get_image_handler(deadline=deadline)
+    verdict_cache = get_verdict_cache()
+    object_verdict_key = None
+    if _ENABLE_S3_ETAG_CACHE and verdict_cache is not None and url is None:
+        object_verdict_key = _object_verdict_key(image_handler, bucket, object_name, return_sources,
+                                                 min_confidence, max_labels)
+
+    if _ENABLE_URL_CACHE and verdict_cache is not None and url is not None:
+        # reuse the verdict of an image url not modified, without downloading it
+        hash_data = image_handler.revalidate_url(url)
+        if hash_data is not None:
+            # the image may have been listed since its verdict was cached
+            listed_labels = _hash_listed_labels(hash_data)
+            if listed_labels is not None:
+                return listed_labels
+            labels = verdict_cache.get(cache.verdict_cache_key(
+                hash_data,
+                moderationhandler.ModerationHandler.effective_return_sources(return_sources),
+                min_confidence,
+                max_labels))
+            if labels is not None:
+                app.log.debug(f'Found cached verdict for not modified image from {url}')
+                return labels
+
+    if object_verdict_key is None:
+        return _detect_image_labels(image_handler, url, bucket, object_name, return_sources, min_confidence,
+                                    max_labels, detect_labels_handler, deadline, partial_results)[0]
+
+    # reuse the verdict of the same object version without downloading it, unless its content got listed since
+    object_verdict = verdict_cache.get(object_verdict_key)
+    if object_verdict is not None:
+        listed_labels = _hash_listed_labels(object_verdict['Hash'])
+        if listed_labels is not None:
+            return listed_labels
+        app.log.debug(f'Found cached verdict for object {bucket}/{object_name}')
+        return object_verdict['Labels']
+
+    def detect():
+        object_labels, hash_data = _detect_image_labels(image_handler, url, bucket, object_name, return_sources,
+                                                        min_confidence, max_labels, detect_labels_handler, deadline,
+                                                        partial_results)
+        # verdicts of listed images are not kept, they change with the lists
+        if hash_data is not None and not _is_degraded(object_labels):
+            verdict_cache.put(object_verdict_key, {'Hash': hash_data, 'Labels': _cacheable_labels(object_labels)})
+        return object_labels
+
+    if not _ENABLE_SINGLE_FLIGHT:
+        return detect()
+
+    # concurrent requests of the same object version share one download
+    try:
+        return _SINGLE_FLIGHT.do(_flight_key(object_verdict_key, partial_results), detect,
+                                 timeout=deadline_timeout(deadline, _SINGLE_FLIGHT_TIMEOUT_SECONDS))
+    except SingleFlightTimeoutException as e:
+        app.log.error(f'Timed out waiting for in-flight detection of object {bucket}/{object_name}')
+        raise TooManyRequestsError(e.message)
+
+
+def _object_verdict_key(image_handler, bucket, object_name, return_sources, min_confidence, max_labels):
+    """Verdict key of the current version of an S3 object, None if the object cannot be headed"""
+    object_version = image_handler.head_object(bucket, object_name)
+    if object_version is None:
+        return None
+
+    return cache.object_verdict_cache_key(bucket, object_name, object_version['ETag'], object_version['VersionId'],
+                                          moderationhandler.ModerationHandler.effective_return_sources(return_sources),
+                                          min_confidence,
+                                          max_labels)
+
+
+def _hash_listed_labels(hash_data):
+    """Labels of an image hash in the blacklist or the whitelist, None if it's in neither or the lists are disabled"""
+    if not _ENABLE_BLACK_WHITE_LIST:
+        return None
+    try:
+        list_type = get_hash_list_store().lookup(hash_data)
+    except exception.InvocationException as e:
+        app.log.error(f'Cannot look up image hash lists for image with hash {hash_data}')
+        raise TooManyRequestsError(e.message)
+
+    if list_type == hashlist.BLACKLIST:
+        app.log.info(f'Image {hash_data} of a cached verdict is blacklisted')
+        return [_BLACKLISTED_LABEL.copy()]
+    if list_type == hashlist.WHITELIST:
+        app.log.info(f'Image {hash_data} of a cached verdict is whitelisted')
+        return []
+    return None
+
+
+def _detect_image_labels(image_handler, url, bucket, object_name, return_sources, min_confidence, max_labels,
+                         detect_labels_handler=None, deadline=None, partial_results=False):
+    """Return labels and content hash of the image, the hash is None if the labels are not of a detection"""
     # download image
     try:
         stopwatch_download = Stopwatch()
@@ -220,35 +1174,196 @@ def _detect_labels(url, bucket, object_name, return_sources, min_confidence, max
         raise BadRequestError(e.message)
     except exception.CannotDownloadImageException as e:
         raise BadRequestError(e.message)
-                                        
+    except exception.BlacklistedImageException as e:
+        return [_BLACKLISTED_LABEL.copy()], None
+    except exception.DeadlineExceededException as e:
+        app.log.error('Cannot handle image from %s or %s/%s by the deadline' % (url, bucket, object_name))
+        raise TooManyRequestsError(e.message)
+    except exception.InvocationException as e:
+        app.log.error('Cannot look up image hash lists for image from %s or %s/%s' % (url, bucket, object_name))
+        raise TooManyRequestsError(e.message)
+
 
     # no filter found
     if len(image_data_list) == 0:
-        return []
+        return [], None
+
+    # reuse the verdict of the same image detected with the same parameters
+    verdict_cache = get_verdict_cache()
+    verdict_key = cache.verdict_cache_key(hash_data,
+                                          moderationhandler.ModerationHandler.effective_return_sources(return_sources),
+                                          min_confidence,
+                                          max_labels)
+    if verdict_cache is not None:
+        labels = verdict_cache.get(verdict_key)
+        if labels is not None:
+            app.log.debug(f'Found cached verdict for image from {url} or {bucket}/{object_name} with hash {hash_data}')
+            return labels, hash_data
+
+    # reuse the verdict of a near-duplicate image, animated images are excluded as only one frame would be compared
+    perceptual_hash_index = get_perceptual_hash_index() if len(image_data_list) == 1 else None
+    perceptual_hash = None
+    if perceptual_hash_index is not None:
+        perceptual_hash, labels = _search_near_duplicate(perceptual_hash_index, image_data_list[0], verdict_key)
+        if labels is not None:
+            app.log.debug(f'Found near-duplicate verdict for image from {url} or {bucket}/{object_name}')
+            # only the visual labels are shared by near-duplicates, QR codes are decoded from this image
+            labels = copy.deepcopy(labels)
+            try:
+                _qrcode_stage(image_data_list, labels, url, deadline)
+            except exception.DeadlineExceededException as e:
+                app.log.error('Cannot decode qrcode of image from %s or %s/%s by the deadline' % (
+                    url, bucket, object_name))
+                raise TooManyRequestsError(e.message)
+            if verdict_cache is not None:
+                verdict_cache.put(verdict_key, labels)
+            return labels, hash_data
+
+    def detect():
+        labels = _detect_labels_by_backends(image_data_list, url, bucket, object_name, return_sources,
+                                            min_confidence, max_labels, detect_labels_handler, deadline,
+                                            partial_results)
+        if _is_degraded(labels):
+            return labels
+        if verdict_cache is not None:
+            verdict_cache.put(verdict_key, _cacheable_labels(labels))
+        if perceptual_hash is not None:
+            _index_near_duplicate(perceptual_hash_index, perceptual_hash, verdict_key, labels)
+        return labels
+
+    if not _ENABLE_SINGLE_FLIGHT:
+        return detect(), hash_data
+
+    # concurrent requests of the same image share one detection
+    try:
+        return _SINGLE_FLIGHT.do(_flight_key(verdict_key, partial_results), detect,
+                                 timeout=deadline_timeout(deadline, _SINGLE_FLIGHT_TIMEOUT_SECONDS)), hash_data
+    except SingleFlightTimeoutException as e:
+        app.log.error('Timed out waiting for in-flight detection of image from %s or %s/%s' % (
+            url, bucket, object_name))
+        raise TooManyRequestsError(e.message)
+
 
+def _flight_key(verdict_key, partial_results):
+    # requests with partial results don't share the detection of requests without, and the other way around
+    return verdict_key + '|partial' if partial_results else verdict_key
+
+
+def _cacheable_labels(labels):
+    """Labels to cache without the status of the detection, except the flag of a detection ended by a decisive label"""
+    if getattr(labels, 'short_circuited', False):
+        return moderationhandler.DetectedLabels(labels, short_circuited=True)
+    return list(labels)
+
+
+def _is_degraded(labels):
+    return getattr(labels, 'degraded', False)
+
+
+def _detect_labels_by_backends(image_data_list, url, bucket, object_name, return_sources, min_confidence, max_labels,
+                               detect_labels_handler=None, deadline=None, partial_results=False):
     app.log.debug(f'Start to detect labels for image from {url} or {bucket}/{object_name}')
-    # detect labels
-    handler = get_detect_labels_handler()
-    # detect labels
+    handler = detect_labels_handler if detect_labels_handler is not None else get_detect_labels_handler(
+        deadline=deadline)
     stopwatch_detect_labels = Stopwatch()
     stopwatch_detect_labels.start()
+    try:
+        run = get_detection_pipeline().run(deadline=deadline,
+                                           handler=handler,
+                                           images=image_data_list,
+                                           url=url,
+                                           bucket=bucket,
+                                           object_name=object_name,
+                                           return_sources=return_sources,
+                                           min_confidence=min_confidence,
+                                           max_labels=max_labels,
+                                           mandatory_return_sources=_MANDATORY_RETURN_SOURCES if partial_results else None)
+    except exception.DeadlineExceededException as e:
+        app.log.error('Cannot detect labels for resolved image from %s or %s/%s by the deadline' % (
+            url, bucket, object_name))
+        raise TooManyRequestsError(e.message)
+    lapsed = stopwatch_detect_labels.stop()
+    app.log.debug('Detected labels for resolved image with lapsed time %.3f, stages %s from %s or %s/%s' % (
+        lapsed, run.timings, url, bucket, object_name))
+    return run.values['labels']
+
+
+def _detect_labels_stage(handler, images, url, bucket, object_name, return_sources, min_confidence, max_labels,
+                         mandatory_return_sources):
     app.log.debug(f'Start to detect labels for resolved image from {url} or {bucket}/{object_name}')
+    # every return source is mandatory unless the request takes partial results
+    options = {} if mandatory_return_sources is None else {'mandatory_return_sources': mandatory_return_sources}
     try:
-        labels = handler.detect_image_labels(return_sources=return_sources,
-                                             images=image_data_list,
-                                             min_confidence=min_confidence,
-                                             max_labels=max_labels,
-                                             url_hint=url)
+        return handler.detect_image_labels(return_sources=return_sources,
+                                           images=images,
+                                           min_confidence=min_confidence,
+                                           max_labels=max_labels,
+                                           url_hint=url,
+                                           **options)
     except exception.InvocationException as e:
         app.log.error('Detected labels with backend errors for resolved image from %s or %s/%s' % (
         url, bucket, object_name))
         raise TooManyRequestsError(e.message)
 
-    lapsed = stopwatch_detect_labels.stop()
-    qrcode_label = next(filter(lambda label: label['Label'] == 'QR Code', labels), None)
-    if qrcode_label is not None:
-        _qrcode_handle(image_data_list, qrcode_label, url)
-    app.log.debug('Detected labels for resolved image with lapsed time %.3f from %s or %s/%s' % (
-        lapsed, url, bucket, object_name))
-    return labels
+
+def _scan_qrcode_stage(images, deadline):
+    """QR code texts of the whole frames, scanned before knowing if there's a QR code"""
+    handler = qrcodehandler.QrcodeHandler()
+    texts = []
+    for image_data in images:
+        if deadline is not None and deadline.expired():
+            break
+        try:
+            texts.extend(handler.decode(image_data))
+        except Exception:
+            app.log.exception('Cannot scan qrcode of frame')
+    return list(set(texts))
+
+
+def _qrcode_stage(images, backend_labels, url, deadline, qrcode_texts=None):
+    qrcode_label = next(filter(lambda label: label['Label'] == 'QR Code', backend_labels), None)
+    if qrcode_label is None:
+        return backend_labels
+
+    if qrcode_texts is not None and len(qrcode_texts) > 0:
+        qrcode_label['QrcodeData'] = qrcode_texts
+        qrcode_label.pop('BoundingBox', None)
+    else:
+        # QR codes are decoded within their bounding boxes when the whole frames have none
+        _qrcode_handle(images, qrcode_label, url, deadline)
+    return backend_labels
+
+
+def _verdict_params(verdict_key):
+    # verdicts of near-duplicates are shared by the detection parameters, not by the content hash
+    return verdict_key.split('|', 1)[1]
+
+
+def _search_near_duplicate(perceptual_hash_index, image_data, verdict_key):
+    """Return perceptual hash of the image, and labels of a near-duplicate detected with the same parameters"""
+    try:
+        perceptual_hash = perceptualhash.dhash(image_data)
+    except Exception:
+        app.log.exception('Cannot generate perceptual hash')
+        return None, None
+
+    nearest = perceptual_hash_index.search(perceptual_hash)
+    if nearest is None:
+        return perceptual_hash, None
+
+    distance, _, verdicts = nearest
+    labels = verdicts.get(_verdict_params(verdict_key))
+    if labels is not None:
+        app.log.debug(f'Found near-duplicate with distance {distance} for perceptual hash {perceptual_hash:016x}')
+    return perceptual_hash, labels
+
+
+def _index_near_duplicate(perceptual_hash_index, perceptual_hash, verdict_key, labels):
+    """Index the labels of the image without the QR code payloads, which belong to this image only"""
+    labels = _cacheable_labels(copy.deepcopy(labels))
+    for label in labels:
+        label.pop('QrcodeData', None)
+    verdicts = dict(perceptual_hash_index.get(perceptual_hash) or {})
+    verdicts[_verdict_params(verdict_key)] = labels
+    perceptual_hash_index.put(perceptual_hash, verdicts)
 # End of detection Handlers.
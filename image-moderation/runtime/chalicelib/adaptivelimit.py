@@ -0,0 +1,94 @@
+import logging
+from collections import deque
+from threading import Condition
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """
+    Limit of the calls in flight to a backend which follows its capacity, in the way of a gradient limiter. The
+    latency of every call is compared with the minimum latency of the latest window_size calls: the limit grows by one
+    while calls are about as fast as the minimum and the limit is in use, and shrinks by the gradient
+    tolerance * min latency / smoothed latency when latency rises. A throttled or timed out call cuts the limit by
+    backoff_ratio.
+    """
+
+    def __init__(self, name, initial_limit=16, min_limit=1, max_limit=256, tolerance=2.0, backoff_ratio=0.7,
+                 smoothing=0.2, window_size=100):
+        """
+        Args:
+            :tolerance: latency below tolerance times the min latency is not a sign of queueing
+            :smoothing: weight of the latest latency in the smoothed latency
+        """
+        self._name = name
+        self._limit = float(initial_limit)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._tolerance = tolerance
+        self._backoff_ratio = backoff_ratio
+        self._smoothing = smoothing
+        self._latencies = deque(maxlen=window_size)
+        self._smoothed_latency = None
+        self._condition = Condition()
+        self._in_flight = 0
+        self._dropped = 0
+        self._rejected = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def limit(self):
+        with self._condition:
+            return int(self._limit)
+
+    def acquire(self, timeout=None):
+        """Wait for a call to be allowed, return False if it isn't allowed within the timeout"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._in_flight < int(self._limit), timeout=timeout):
+                self._rejected += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self, latency=None, dropped=False):
+        """
+        Release a call and adjust the limit
+
+        Args:
+            :latency: seconds of the call, None if it failed for reasons other than load
+            :dropped: True if the call was throttled or timed out
+        """
+        with self._condition:
+            in_flight = self._in_flight
+            self._in_flight -= 1
+            previous = int(self._limit)
+            if dropped:
+                self._dropped += 1
+                self._limit = max(self._min_limit, self._limit * self._backoff_ratio)
+            elif latency is not None:
+                self._latencies.append(latency)
+                self._smoothed_latency = latency if self._smoothed_latency is None else \
+                    self._smoothed_latency * (1 - self._smoothing) + latency * self._smoothing
+                gradient = min(1.0, self._tolerance * min(self._latencies) / self._smoothed_latency)
+                # grow only if the limit is in use, an idle backend tells nothing of its capacity
+                growth = 1.0 if gradient >= 1.0 and in_flight * 2 >= self._limit else 0.0
+                self._limit = min(self._max_limit, max(self._min_limit, self._limit * gradient + growth))
+
+            if int(self._limit) != previous:
+                logger.debug('Concurrency limit of %s changed from %d to %d' % (self._name, previous, self._limit))
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'Limit': int(self._limit),
+                'InFlight': self._in_flight,
+                'MinLatencyMillis': min(self._latencies) * 1000 if len(self._latencies) > 0 else None,
+                'SmoothedLatencyMillis': self._smoothed_latency * 1000 if self._smoothed_latency is not None else None,
+                'Dropped': self._dropped,
+                'Rejected': self._rejected,
+            }
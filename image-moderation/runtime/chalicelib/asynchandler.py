@@ -0,0 +1,326 @@
+import json
+import base64
+import asyncio
+import logging
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+from .rekognition import RekognitonClient
+from .sagemaker import SageMakerClient
+from .imagehandler import ImageHandler
+from .moderationhandler import ModerationHandler
+from .qrcodehandler import QrcodeHandler
+from .concurrentutils import Stopwatch
+from .hashlist import BLACKLISTED_LABEL
+from .exception import InvocationException, CannotDownloadImageException, BlacklistedImageException
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class AsyncRekognitionClient(object):
+    """
+    Rekognition client on an async AWS client, e.g. an aiobotocore rekognition client. Requests are built and
+    responses are read by a RekognitonClient of the same arguments, its raw response cache, rate limiters and
+    circuit breakers are not used.
+    """
+
+    def __init__(self, aio_client=None, **kwargs):
+        """
+        Args:
+            :aio_client: an async Rekognition client, its methods return awaitables
+            :kwargs: arguments of RekognitonClient
+        """
+        self._aio_client = aio_client
+        self._client = RekognitonClient(**kwargs)
+
+    async def _invoke(self, operation_name, method_name, request, image_bytes, bucket, object_name):
+        try:
+            return await getattr(self._aio_client, method_name)(**request)
+        except Exception as e:
+            logger.exception("Couldn't invoke {} for base64(data): {} or {}/{}".format(
+                operation_name, self._client._image_log_bytes_str(image_bytes), bucket, object_name))
+
+            raise InvocationException.from_client_exception(client_exception=e, operation_name=operation_name)
+
+    async def detect_labels(self, image_bytes, bucket=None, object_name=None, min_confidence=60, max_labels=5):
+        """DetectLabels"""
+        response = await self._invoke('Rekognition_DetectLabels', 'detect_labels',
+                                      self._client._detect_labels_request(image_bytes, bucket, object_name,
+                                                                          min_confidence, max_labels),
+                                      image_bytes, bucket, object_name)
+        return self._client._labels_from_response(response, image_bytes, bucket, object_name)
+
+    async def detect_moderation_labels(self, image_bytes, bucket=None, object_name=None, min_confidence=60,
+                                       max_labels=5):
+        """DetectModerationLabels"""
+        response = await self._invoke('Rekognition_DetectModerationLabels', 'detect_moderation_labels',
+                                      self._client._detect_moderation_labels_request(image_bytes, bucket, object_name,
+                                                                                     min_confidence),
+                                      image_bytes, bucket, object_name)
+        return self._client._moderation_labels_from_response(response, max_labels, image_bytes, bucket,
+                                                             object_name)
+
+    async def search_faces_by_image(self, image_bytes, bucket=None, object_name=None, face_match_threshold=85,
+                                    max_faces=5):
+        """SearchFacesByImage"""
+        try:
+            response = await self._aio_client.search_faces_by_image(
+                **self._client._search_faces_request(image_bytes, bucket, object_name, face_match_threshold,
+                                                     max_faces))
+        except Exception as e:
+            # suppress no face exception
+            if self._client._is_no_faces_exception(e):
+                return []
+
+            logger.exception("Couldn't search faces in collection {} for base64(data): {} or {}/{}".format(
+                self._client._collection_id, self._client._image_log_bytes_str(image_bytes), bucket, object_name))
+
+            raise InvocationException.from_client_exception(client_exception=e,
+                                                            operation_name='Rekognition_SearchFacesByImage')
+
+        return self._client._faces_from_response(response, max_faces, image_bytes, bucket, object_name)
+
+    async def search_celebrities_by_image(self, image_bytes, bucket=None, object_name=None, face_match_threshold=95,
+                                          max_faces=5):
+        """RecognizeCelebrities"""
+        response = await self._invoke('Rekognition_SearchFacesByImage', 'recognize_celebrities',
+                                      {'Image': self._client._image(image_bytes, bucket, object_name)},
+                                      image_bytes, bucket, object_name)
+        return self._client._celebrities_from_response(response, face_match_threshold, max_faces,
+                                                       image_bytes, bucket, object_name)
+
+
+class AsyncSageMakerClient(object):
+    """
+    SageMaker client on an async AWS client, e.g. an aiobotocore sagemaker-runtime client. Requests are built and
+    responses are read by a SageMakerClient of the same endpoint.
+    """
+
+    def __init__(self, aio_client=None, endpoint_name=""):
+        self._aio_client = aio_client
+        self._endpoint_name = endpoint_name
+        self._client = SageMakerClient(endpoint_name=endpoint_name)
+
+    async def detect_labels(self, image_bytes, min_confidence=60):
+        """Send request to sagemaker endpoint to detect labels"""
+        try:
+            response = await self._aio_client.invoke_endpoint(**self._client._invoke_endpoint_request(image_bytes))
+            response = json.loads(await response['Body'].read())
+        except Exception as e:
+            logger.exception(
+                "Detect labels by sagemaker endpoint {} has invocation exception with data base64(data): {}".format(
+                    self._endpoint_name, base64.b64encode(image_bytes)[0:100]))
+
+            raise InvocationException.from_client_exception(client_exception=e,
+                                                            operation_name='Sagemaker_' + self._endpoint_name)
+
+        return self._client._labels_from_response(response, image_bytes, min_confidence)
+
+
+class AsyncImageHandler(object):
+    """
+    Download images with an async HTTP session (e.g. aiohttp.ClientSession) or an async S3 client, and resolve
+    them by an ImageHandler of the same arguments on an executor so that decoding doesn't block the event loop.
+    The url cache is not used. Images are looked up in the hash_list passed in, as ImageHandler does.
+    """
+
+    def __init__(self, http_session=None, aio_s3_client=None, executor=None, **kwargs):
+        """
+        Args:
+            :http_session: async HTTP session, get(url) is an async context manager of a response with read()
+            :aio_s3_client: async S3 client
+            :executor: executor to resolve images on, the default executor of the event loop if None
+            :kwargs: arguments of ImageHandler
+        """
+        self._image_handler = ImageHandler(**kwargs)
+        self._http_session = http_session
+        self._aio_s3_client = aio_s3_client
+        self._executor = executor
+
+    @property
+    def executor(self):
+        return self._executor
+
+    async def image_handler(self, url, bucket, object_name):
+        """Download image, compress it or extract frames for animated images"""
+        stopwatch = Stopwatch().start()
+        logger.debug(f'Start download image from {url}')
+        image = await self._fetch_image(url, bucket=bucket, object_name=object_name)
+        if image is None or len(image) == 0:
+            logger.warning(f'Cannot download image from {url}')
+            return [], ''
+        logger.debug('Downloaded image with lapsed time %.3f from %s' % (stopwatch.stop(), url))
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._image_handler.resolve_image,
+                                                                image, url)
+
+    async def _fetch_image(self, url='', bucket='', object_name=''):
+        try:
+            if url is not None:
+                async with self._http_session.get(url) as res:
+                    return await res.read()
+
+            response = await self._aio_s3_client.get_object(Bucket=bucket, Key=object_name)
+            if response is None or response.get('Body') is None:
+                return bytearray()
+
+            return await response['Body'].read()
+        except Exception:
+            raise CannotDownloadImageException(url, bucket, object_name)
+
+
+class AsyncModerationHandler(object):
+    """
+    Invoke the backends of every frame and return source as coroutines on one event loop, merge the results the
+    same as ModerationHandler. Backend clients are the async clients of this module.
+
+    Only max_in_flight and timeout_seconds protect the backends: unlike ModerationHandler, backend calls have no
+    request deadline, retries, rate limits, circuit breakers, hedging, lanes or fair share, and results are not
+    cached. Callers wanting them have to wrap the calls themselves.
+    """
+
+    def __init__(self, rek_client=None, sagemaker_client=None, max_in_flight=64, timeout_seconds=None):
+        """
+        Args:
+            rek_client: AsyncRekognitionClient
+            sagemaker_client: AsyncSageMakerClient
+            max_in_flight: max number of backend calls in flight of the handler
+            timeout_seconds: optional timeout of each backend call, timed out calls are cancelled and reported
+                as backend errors
+        """
+        self._rek_client = rek_client
+        self._sagemaker_client = sagemaker_client
+        self._max_in_flight = max_in_flight
+        self._timeout_seconds = timeout_seconds
+        # asyncio semaphores are bound to one event loop, calls on other loops have their own
+        self._semaphores = WeakKeyDictionary()
+        self._semaphores_lock = Lock()
+
+    async def detect_image_labels(self,
+                                  images,
+                                  bucket=None,
+                                  object_name=None,
+                                  return_sources=[],
+                                  min_confidence=50,
+                                  max_labels=5,
+                                  url_hint=''):
+        """
+        Detect labels, see ModerationHandler.detect_image_labels. Cancelling the call cancels the backend calls
+        in flight.
+        """
+        if images is None or len(images) == 0:
+            return []
+
+        return_sources = ModerationHandler.effective_return_sources(return_sources)
+        results = await asyncio.gather(*[self._detect(return_source, image,
+                                                      bucket=bucket,
+                                                      object_name=object_name,
+                                                      min_confidence=min_confidence,
+                                                      max_labels=max_labels,
+                                                      url_hint=url_hint)
+                                         for image in images for return_source in return_sources])
+
+        exceptions = [(return_source, e) for return_source, labels, e in results if e is not None]
+        if len(exceptions) > 0:
+            raise InvocationException.backend_exceptions(exceptions=exceptions)
+
+        results_list = ModerationHandler.merge_results([label for _, labels, _ in results for label in labels],
+                                                       max_labels=max_labels)
+        logger.info('Detected labels with for {} image {}, return source {}, min confidence {}, max labels {}, '
+                    'labels: {}'.format(url_hint, base64.b64encode(images[0])[0:100], return_sources,
+                                        min_confidence, max_labels, results_list))
+        return results_list
+
+    async def _detect(self, return_source, image_bytes, url_hint='', **kwargs):
+        """Return (return source, labels, exception) of a backend call"""
+        async with self._semaphore():
+            stopwatch = Stopwatch().start()
+            try:
+                labels = await asyncio.wait_for(self._invoke(return_source, image_bytes, **kwargs),
+                                                self._timeout_seconds)
+            except asyncio.TimeoutError:
+                logger.warning(f'Timed out {return_source} after {stopwatch.stop()} seconds for {url_hint}')
+                return return_source, [], InvocationException(
+                    operation_name=return_source,
+                    error_code='Timeout',
+                    error_message=f'No response in {self._timeout_seconds} seconds')
+            except InvocationException as e:
+                logger.info(f'Detected {return_source} lapsed-error time {stopwatch.stop()} with url {url_hint}: {e}')
+                return return_source, [], e
+
+            logger.info(f'Detected {return_source} lapsed time {stopwatch.stop()} with url {url_hint}: {labels}')
+            return return_source, labels, None
+
+    def _semaphore(self):
+        """Semaphore of the backend calls in flight on the running loop"""
+        loop = asyncio.get_running_loop()
+        with self._semaphores_lock:
+            semaphore = self._semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self._max_in_flight)
+                self._semaphores[loop] = semaphore
+            return semaphore
+
+    def _invoke(self, return_source, image_bytes, bucket=None, object_name=None, min_confidence=60, max_labels=5):
+        if return_source == 'DetectLabels':
+            return self._rek_client.detect_labels(image_bytes=image_bytes, bucket=bucket, object_name=object_name,
+                                                  min_confidence=min_confidence, max_labels=max_labels)
+        if return_source == 'DetectModerationLabels':
+            return self._rek_client.detect_moderation_labels(image_bytes=image_bytes, bucket=bucket,
+                                                             object_name=object_name,
+                                                             min_confidence=min_confidence, max_labels=max_labels)
+        if return_source == 'FaceSearch':
+            return self._rek_client.search_faces_by_image(image_bytes=image_bytes, bucket=bucket,
+                                                          object_name=object_name,
+                                                          face_match_threshold=min_confidence, max_faces=max_labels)
+        if return_source == 'CelebritySearch':
+            return self._rek_client.search_celebrities_by_image(image_bytes=image_bytes, bucket=bucket,
+                                                                object_name=object_name,
+                                                                face_match_threshold=min_confidence,
+                                                                max_faces=max_labels)
+        if return_source == 'DetectByCustomModels':
+            return self._sagemaker_client.detect_labels(image_bytes=image_bytes, min_confidence=min_confidence)
+
+        raise ValueError(f'Unknown return source {return_source}')
+
+
+async def decode_qrcode(image_data_list, qrcode_label, executor=None):
+    """Decode the QR code of every frame on the executor, and set QrcodeData of the label"""
+    handler = QrcodeHandler()
+    bounding_box = qrcode_label.get('BoundingBox')
+    loop = asyncio.get_running_loop()
+    decoded = await asyncio.gather(*[loop.run_in_executor(executor, handler.decode, image_data, bounding_box)
+                                     for image_data in image_data_list])
+
+    qrcode_label['QrcodeData'] = list(set(text for texts in decoded if texts is not None for text in texts))
+    if bounding_box is not None:
+        del qrcode_label['BoundingBox']
+
+
+async def detect_labels(image_handler: AsyncImageHandler,
+                        moderation_handler: AsyncModerationHandler,
+                        url=None,
+                        bucket=None,
+                        object_name=None,
+                        return_sources=None,
+                        min_confidence=50,
+                        max_labels=5):
+    """
+    Download and resolve the image, detect labels of the frames and decode the QR code if there's one.
+    A blacklisted image has the single label Blacklisted and a whitelisted image has no labels, without backend calls.
+    """
+    try:
+        image_data_list, _ = await image_handler.image_handler(url, bucket, object_name)
+    except BlacklistedImageException:
+        return [BLACKLISTED_LABEL.copy()]
+    labels = await moderation_handler.detect_image_labels(image_data_list,
+                                                          return_sources=return_sources,
+                                                          min_confidence=min_confidence,
+                                                          max_labels=max_labels,
+                                                          url_hint=url)
+
+    qrcode_label = next(filter(lambda label: label['Label'] == 'QR Code', labels), None)
+    if qrcode_label is not None:
+        await decode_qrcode(image_data_list, qrcode_label, executor=image_handler.executor)
+    return labels
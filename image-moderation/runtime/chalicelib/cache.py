@@ -0,0 +1,136 @@
+import copy
+import time
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """
+    Thread safe in-process cache, bounded by the number of entries with least recently used eviction,
+    entries expire after ttl seconds. Values are copied in and out so callers can't change cached values.
+    """
+
+    def __init__(self, max_size=1024, ttl_seconds=3600, clock=time.monotonic):
+        self._max_size = max_size
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key):
+        """Return the cached value, None if not cached or expired"""
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key):
+        """Return the cached value and its remaining ttl seconds, (None, None) if not cached or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None, None
+
+            expires_at, value = entry
+            now = self._clock()
+            if expires_at <= now:
+                del self._entries[key]
+                self._expirations += 1
+                self._misses += 1
+                return None, None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return copy.deepcopy(value), expires_at - now
+
+    def put(self, key, value, ttl_seconds=None):
+        ttl_seconds = ttl_seconds if ttl_seconds is not None else self._ttl_seconds
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'Size': len(self._entries),
+                'MaxSize': self._max_size,
+                'Hits': self._hits,
+                'Misses': self._misses,
+                'Evictions': self._evictions,
+                'Expirations': self._expirations,
+            }
+
+
+class TieredCache(object):
+    """
+    In-process cache (L1) in front of a larger and slower cache (L2), e.g. SQLiteCache on /tmp.
+    L2 hits are copied to L1 until the L2 entry expires, puts go to both.
+    """
+
+    def __init__(self, l1, l2):
+        self._l1 = l1
+        self._l2 = l2
+
+    def get(self, key):
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key):
+        value, ttl_seconds = self._l1.get_with_ttl(key)
+        if value is None:
+            value, ttl_seconds = self._l2.get_with_ttl(key)
+            if value is not None:
+                self._l1.put(key, value, ttl_seconds=ttl_seconds)
+        return value, ttl_seconds
+
+    def put(self, key, value, ttl_seconds=None):
+        self._l1.put(key, value, ttl_seconds=ttl_seconds)
+        self._l2.put(key, value, ttl_seconds=ttl_seconds)
+
+    def remove(self, key):
+        self._l1.remove(key)
+        self._l2.remove(key)
+
+    def clear(self):
+        self._l1.clear()
+        self._l2.clear()
+
+    def __len__(self):
+        return len(self._l2)
+
+    def stats(self):
+        return dict(self._l1.stats(), L2=self._l2.stats())
+
+
+def verdict_cache_key(hash_data, return_sources, min_confidence, max_labels):
+    """Key of a moderation verdict, the same image with different detection parameters has different verdicts"""
+    return '{}|{}|{}|{}'.format(hash_data, ','.join(sorted(return_sources)), min_confidence, max_labels)
+
+
+def object_verdict_cache_key(bucket, object_name, etag, version_id, return_sources, min_confidence, max_labels):
+    """Key of the verdict of an S3 object version, looked up before the object is downloaded"""
+    return 's3://{}/{}|{}|{}|{}|{}|{}'.format(bucket, object_name, etag, version_id or '',
+                                            ','.join(sorted(return_sources)), min_confidence, max_labels)
+
+
+def backend_response_cache_key(operation_name, image_bytes):
+    """Key of a raw backend response, frames with the same bytes share the response of a backend operation"""
+    return '{}|{}'.format(operation_name, hashlib.sha256(image_bytes).hexdigest())
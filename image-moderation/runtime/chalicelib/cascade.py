@@ -0,0 +1,74 @@
+import logging
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Cascade(object):
+    """
+    Tiers of return sources called one after the other, from the cheapest. The next tier is called only if the labels
+    of the tiers so far are uncertain: a label has a confidence within the uncertainty band, a return source failed, or
+    a label asks for the tier by the escalation policy. Otherwise the labels of the tiers so far are the detection.
+    """
+
+    def __init__(self, tiers, costs=None, uncertain_min_confidence=50.0, uncertain_max_confidence=90.0,
+                 escalation_labels=None):
+        """
+        Args:
+            :tiers: dict of tier number by return source, return sources not in it are in the first tier
+            :costs: dict of cost of a call by return source, a call of a return source not in it costs 1
+            :escalation_labels: dict of tier number by label name, a label calls the tiers up to its tier
+        """
+        self._tiers = tiers
+        self._costs = costs if costs is not None else {}
+        self._uncertain_min_confidence = uncertain_min_confidence
+        self._uncertain_max_confidence = uncertain_max_confidence
+        self._escalation_labels = escalation_labels if escalation_labels is not None else {}
+        self._first_tier = min(tiers.values()) if len(tiers) > 0 else 1
+        self._lock = Lock()
+        self._detections = 0
+        self._tier_calls = {}
+        self._cost = 0.0
+        self._saved_cost = 0.0
+
+    def plan(self, return_sources):
+        """[(tier, return sources)] of the return sources by ascending tier"""
+        plan = {}
+        for return_source in return_sources:
+            plan.setdefault(self._tiers.get(return_source, self._first_tier), []).append(return_source)
+        return sorted(plan.items())
+
+    def escalate(self, labels, failed_sources, next_tier):
+        """True if the next tier has to be called after the labels and the failed return sources of the tiers so far"""
+        if len(failed_sources) > 0:
+            return True
+        for label in labels:
+            if self._uncertain_min_confidence <= label['Confidence'] < self._uncertain_max_confidence:
+                return True
+            if self._escalation_labels.get(label['Label'], self._first_tier) >= next_tier:
+                return True
+        return False
+
+    def cost(self, return_sources, images):
+        return sum(self._costs.get(return_source, 1.0) for return_source in return_sources) * images
+
+    def record(self, plan, tiers, images):
+        """Record a detection of plan which called the tiers"""
+        with self._lock:
+            self._detections += 1
+            for tier, return_sources in plan:
+                if tier in tiers:
+                    self._tier_calls[tier] = self._tier_calls.get(tier, 0) + 1
+                    self._cost += self.cost(return_sources, images)
+                else:
+                    self._saved_cost += self.cost(return_sources, images)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'Detections': self._detections,
+                'TierCalls': dict(self._tier_calls),
+                'Cost': self._cost,
+                'SavedCost': self._saved_cost,
+            }
@@ -0,0 +1,180 @@
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+
+from .exception import InvocationException
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+CLOSED = 'Closed'
+OPEN = 'Open'
+HALF_OPEN = 'HalfOpen'
+
+# error codes telling that a backend is unhealthy, errors of bad requests and throttles don't
+FAILURE_ERROR_CODES = [
+    'ServiceUnavailableException',
+    'ServiceUnavailable',
+    'InternalServerError',
+    'InternalFailure',
+    'ModelNotReadyException',
+    'ReadTimeoutError',
+    'ConnectTimeoutError',
+    'EndpointConnectionError',
+    'ConnectionClosedError',
+]
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast calls of an unhealthy backend. The breaker opens when the failure rate or the slow call rate of the
+    latest window_size calls reaches its threshold, once there are min_calls of them. Calls are rejected while it's
+    open, and after open_seconds it lets half_open_max_calls probe calls through: it closes if they all succeed, and
+    opens again on the first failure.
+    """
+
+    def __init__(self, name, failure_rate_threshold=0.5, slow_call_seconds=None, slow_call_rate_threshold=1.0,
+                 window_size=50, min_calls=20, open_seconds=30, half_open_max_calls=3,
+                 failure_error_codes=None, clock=time.monotonic):
+        """
+        Args:
+            :slow_call_seconds: calls slower than it count as slow, slow calls are not counted if None
+            :failure_error_codes: error codes of InvocationException counted as failures, FAILURE_ERROR_CODES if None
+        """
+        self._name = name
+        self._failure_rate_threshold = failure_rate_threshold
+        self._slow_call_seconds = slow_call_seconds
+        self._slow_call_rate_threshold = slow_call_rate_threshold
+        self._min_calls = min_calls
+        self._open_seconds = open_seconds
+        self._half_open_max_calls = half_open_max_calls
+        self._failure_error_codes = set(failure_error_codes if failure_error_codes is not None
+                                        else FAILURE_ERROR_CODES)
+        self._clock = clock
+        self._lock = Lock()
+        # (failed, slow) of the latest calls
+        self._outcomes = deque(maxlen=window_size)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._rejected = 0
+        self._transitions = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def state(self):
+        with self._lock:
+            self._half_open_if_due()
+            return self._state
+
+    def allow(self):
+        """Return True if a call can be made, a call allowed has to be recorded with on_success or on_failure"""
+        with self._lock:
+            self._half_open_if_due()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._probes < self._half_open_max_calls:
+                self._probes += 1
+                return True
+            self._rejected += 1
+            return False
+
+    def on_success(self, latency):
+        with self._lock:
+            slow = self._slow_call_seconds is not None and latency > self._slow_call_seconds
+            if self._state == HALF_OPEN:
+                if slow:
+                    self._transition(OPEN)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self._half_open_max_calls:
+                    self._transition(CLOSED)
+                return
+            self._record(failed=False, slow=slow)
+
+    def on_failure(self, error_code):
+        """Record a failed call, errors not telling the health of the backend are recorded as successes"""
+        with self._lock:
+            failed = error_code in self._failure_error_codes
+            if self._state == HALF_OPEN:
+                if failed:
+                    self._transition(OPEN)
+                else:
+                    # the probe slot is given back, the call tells nothing of the backend
+                    self._probes -= 1
+                return
+            self._record(failed=failed, slow=False)
+
+    def stats(self):
+        with self._lock:
+            self._half_open_if_due()
+            calls = len(self._outcomes)
+            return {
+                'State': self._state,
+                'Calls': calls,
+                'FailureRate': sum(1 for failed, _ in self._outcomes if failed) / calls if calls > 0 else 0.0,
+                'SlowCallRate': sum(1 for _, slow in self._outcomes if slow) / calls if calls > 0 else 0.0,
+                'Rejected': self._rejected,
+                'Transitions': dict(self._transitions),
+            }
+
+    def _record(self, failed, slow):
+        self._outcomes.append((failed, slow))
+        if self._state != CLOSED or len(self._outcomes) < self._min_calls:
+            return
+        calls = len(self._outcomes)
+        failure_rate = sum(1 for failed, _ in self._outcomes if failed) / calls
+        slow_call_rate = sum(1 for _, slow in self._outcomes if slow) / calls
+        if failure_rate >= self._failure_rate_threshold or \
+                (self._slow_call_seconds is not None and slow_call_rate >= self._slow_call_rate_threshold):
+            logger.warning('Circuit of %s has failure rate %.2f and slow call rate %.2f of %d calls' % (
+                self._name, failure_rate, slow_call_rate, calls))
+            self._transition(OPEN)
+
+    def _half_open_if_due(self):
+        if self._state == OPEN and self._clock() - self._opened_at >= self._open_seconds:
+            self._transition(HALF_OPEN)
+
+    def _transition(self, state):
+        logger.warning('Circuit of %s changed from %s to %s' % (self._name, self._state, state))
+        self._state = state
+        self._transitions[state] += 1
+        self._probes = 0
+        self._probe_successes = 0
+        if state == OPEN:
+            self._opened_at = self._clock()
+        if state == CLOSED:
+            self._outcomes.clear()
+
+
+@contextmanager
+def guard(circuit_breakers, operation_name):
+    """
+    Run the block of a backend call under the circuit breaker of the operation if there's one, raise
+    InvocationException CircuitOpen without running it if the breaker rejects the call.
+    """
+    circuit_breaker = circuit_breakers.get(operation_name) if circuit_breakers is not None else None
+    if circuit_breaker is None:
+        yield
+        return
+
+    if not circuit_breaker.allow():
+        raise InvocationException(operation_name=operation_name,
+                                  error_code='CircuitOpen',
+                                  error_message=f'Circuit of {operation_name} is open')
+    started_at = time.monotonic()
+    try:
+        yield
+    except InvocationException as e:
+        circuit_breaker.on_failure(e.error_code)
+        raise
+    except BaseException as e:
+        circuit_breaker.on_failure(type(e).__name__)
+        raise
+    circuit_breaker.on_success(time.monotonic() - started_at)
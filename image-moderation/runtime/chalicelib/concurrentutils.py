@@ -1,5 +1,9 @@
 import time
-from threading import Condition, Lock
+from contextlib import contextmanager
+from threading import Condition, Lock, BoundedSemaphore, local
+from concurrent.futures import ThreadPoolExecutor
+
+from .exception import ExecutorRejectedException, DeadlineExceededException
 
 
 class CountDownLatch(object):
@@ -26,15 +30,21 @@ class CountDownLatch(object):
                 # notify all waiting threads that the latch is open
                 self.condition.notify_all()
 
-    # wait for the latch to open
-    def wait(self):
+    # wait for the latch to open, return False if it's still closed after timeout seconds
+    def wait(self, timeout=None):
+        expires_at = time.monotonic() + timeout if timeout is not None else None
         # acquire the lock on the condition
         with self.condition:
-            # check if the latch is already open
-            if self.count == 0:
-                return
-            # wait to be notified when the latch is open
-            self.condition.wait()
+            # wait to be notified when the latch is open, a wakeup doesn't mean it's open
+            while self.count > 0:
+                if expires_at is None:
+                    self.condition.wait()
+                    continue
+                remaining = expires_at - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
 
 
 class Stopwatch(object):
@@ -48,6 +58,85 @@ class Stopwatch(object):
         return time.time() - self._start
 
 
+_ROUND_TRIP_TIMERS = local()
+
+
+def _round_trip_timers():
+    if not hasattr(_ROUND_TRIP_TIMERS, 'timers'):
+        _ROUND_TRIP_TIMERS.timers = []
+    return _ROUND_TRIP_TIMERS.timers
+
+
+class RoundTripTimer(object):
+    """
+    Seconds of the backend round trips made by the thread while the timer is entered, so that a caller of a
+    backend client can tell the latency of the backend apart from cache hits and waits in the client
+    """
+
+    def __init__(self):
+        self._seconds = None
+
+    @property
+    def seconds(self):
+        """Seconds of the round trips, None if no round trip was made"""
+        return self._seconds
+
+    def add(self, seconds):
+        self._seconds = seconds if self._seconds is None else self._seconds + seconds
+
+    def __enter__(self):
+        _round_trip_timers().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _round_trip_timers().remove(self)
+
+
+@contextmanager
+def round_trip():
+    """Time a backend round trip for the round trip timers entered by the thread"""
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        lapsed = time.monotonic() - started_at
+        for timer in _round_trip_timers():
+            timer.add(lapsed)
+
+
+class Deadline(object):
+    """Point in time the work of a request has to be finished by"""
+
+    def __init__(self, timeout_seconds, clock=time.monotonic):
+        self._timeout_seconds = timeout_seconds
+        self._clock = clock
+        self._expires_at = clock() + timeout_seconds
+
+    @property
+    def timeout_seconds(self):
+        return self._timeout_seconds
+
+    def remaining(self):
+        return max(0.0, self._expires_at - self._clock())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, operation_name):
+        """Raise DeadlineExceededException if the deadline has passed before operation_name"""
+        if self.expired():
+            raise DeadlineExceededException(operation_name, self._timeout_seconds)
+
+    def timeout(self, cap=None):
+        """Seconds left, capped by cap"""
+        return self.remaining() if cap is None else min(cap, self.remaining())
+
+
+def deadline_timeout(deadline, cap=None):
+    """Timeout of a blocking call under the deadline, cap if there's no deadline"""
+    return deadline.timeout(cap) if deadline is not None else cap
+
+
 class ThreadSafeList(object):
     """List with lock on append and length"""
 
@@ -101,3 +190,148 @@ class ThreadSafeList(object):
         # acquire the lock
         with self._lock:
             return list(self._list)
+
+
+class ResultSlots(object):
+    """
+    Results of a fixed number of tasks in preallocated slots. Every slot is written by its own task only,
+    so tasks don't contend on a lock. Slots have the writer interface of ThreadSafeList.
+    """
+
+    def __init__(self, size):
+        self._labels = [None] * size
+        self._exceptions = [None] * size
+        self._latencies = [None] * size
+
+    def slot(self, index):
+        return _ResultSlot(self, index)
+
+    def exception(self, index):
+        """(operation name, exception) of the slot, None if it has none"""
+        return self._exceptions[index]
+
+    def labels(self, index):
+        return list(self._labels[index] or [])
+
+    def latency(self, index):
+        """Lapsed seconds of the task of the slot, None if it's not finished"""
+        return self._latencies[index]
+
+    def has_exception(self):
+        return any(exception is not None for exception in self._exceptions)
+
+    def exceptions(self):
+        return [exception for exception in self._exceptions if exception is not None]
+
+    def list(self):
+        return [label for labels in self._labels if labels is not None for label in labels]
+
+
+class _ResultSlot(object):
+    def __init__(self, slots, index):
+        self._slots = slots
+        self._index = index
+
+    def extend(self, values: list):
+        labels = self._slots._labels[self._index] or []
+        self._slots._labels[self._index] = labels + list(values)
+
+    def add_exception(self, operation_name: str, exception):
+        self._slots._exceptions[self._index] = (operation_name, exception)
+
+    def labels(self):
+        return self._slots.labels(self._index)
+
+    def set_latency(self, seconds):
+        self._slots._latencies[self._index] = seconds
+
+
+class BoundedExecutor(object):
+    """
+    Long-lived thread pool with a bounded queue, tasks are rejected with ExecutorRejectedException
+    once max_workers tasks are running and max_queue_size tasks are waiting.
+    Keeps counters of utilisation and queue wait time for sizing.
+    """
+
+    def __init__(self, name, max_workers=16, max_queue_size=64):
+        self._name = name
+        self._max_workers = max_workers
+        self._max_queue_size = max_queue_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = BoundedSemaphore(max_workers + max_queue_size)
+        self._lock = Lock()
+        self._queued = 0
+        self._active = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._total_queue_wait = 0.0
+        self._max_queue_wait = 0.0
+
+    @property
+    def name(self):
+        return self._name
+
+    def submit(self, fn, *args, **kwargs):
+        """Submit fn(*args, **kwargs) and return its future, raise ExecutorRejectedException if the queue is full"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise ExecutorRejectedException(self._name)
+
+        with self._lock:
+            self._submitted += 1
+            self._queued += 1
+        submitted_at = time.monotonic()
+        try:
+            future = self._executor.submit(self._run, submitted_at, fn, *args, **kwargs)
+        except BaseException:
+            self._release_queued()
+            raise
+
+        future.add_done_callback(self._release_cancelled)
+        return future
+
+    def _release_cancelled(self, future):
+        # cancelled tasks never run
+        if future.cancelled():
+            self._release_queued()
+
+    def _release_queued(self):
+        with self._lock:
+            self._queued -= 1
+        self._slots.release()
+
+    def _run(self, submitted_at, fn, *args, **kwargs):
+        queue_wait = time.monotonic() - submitted_at
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+            self._total_queue_wait += queue_wait
+            self._max_queue_wait = max(self._max_queue_wait, queue_wait)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._completed += 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            started = self._submitted - self._queued
+            return {
+                'MaxWorkers': self._max_workers,
+                'MaxQueueSize': self._max_queue_size,
+                'Active': self._active,
+                'Queued': self._queued,
+                'Utilisation': self._active / self._max_workers,
+                'Submitted': self._submitted,
+                'Rejected': self._rejected,
+                'Completed': self._completed,
+                'AvgQueueWaitMillis': self._total_queue_wait * 1000 / started if started > 0 else 0.0,
+                'MaxQueueWaitMillis': self._max_queue_wait * 1000,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
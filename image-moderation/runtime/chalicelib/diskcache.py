@@ -0,0 +1,238 @@
+import os
+import time
+import pickle
+import sqlite3
+import logging
+from threading import Lock, local
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+)
+"""
+_ACCESSED_AT_INDEX = 'CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)'
+_EVICTION_BATCH_SIZE = 64
+
+
+class SQLiteCache(object):
+    """
+    Cache in a SQLite file, e.g. under /tmp of a Lambda container so that it outlives the in-process cache and
+    holds a larger working set. Bounded by the total bytes of values with least recently used eviction, entries
+    expire after ttl seconds.
+
+    Writes are transactions on a write-ahead log, so a crashed writer never leaves a partial entry and readers
+    don't block on writers. A database file found broken, when opened or later on, is dropped and created again.
+    Errors of the cache are logged and treated as misses, the cache never fails a detection.
+
+    Has the same interface as cache.LRUCache, values are pickled.
+    """
+
+    def __init__(self, path='/tmp/image-moderation-cache.db', max_bytes=256 << 20, ttl_seconds=3600,
+                 clock=time.time):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._local = local()
+        # connections of the threads are opened again once the file is created again
+        self._generation = 0
+        self._write_lock = Lock()
+        self._stats_lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._errors = 0
+        self._total_bytes = self._open()
+
+    def get(self, key):
+        """Return the cached value, None if not cached or expired"""
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key):
+        """Return the cached value and its remaining ttl seconds, (None, None) if not cached or expired"""
+        try:
+            row = self._connection().execute('SELECT value, expires_at FROM entries WHERE key = ?',
+                                             (key,)).fetchone()
+            if row is None:
+                self._count(misses=1)
+                return None, None
+
+            value, expires_at = row
+            now = self._clock()
+            if expires_at <= now:
+                self.remove(key)
+                self._count(expirations=1, misses=1)
+                return None, None
+
+            with self._write_lock, self._connection() as connection:
+                connection.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (now, key))
+            self._count(hits=1)
+            return pickle.loads(value), expires_at - now
+        except sqlite3.Error as e:
+            self._error(e, f'Cannot get {key} from disk cache {self._path}')
+            self._count(misses=1)
+            return None, None
+
+    def put(self, key, value, ttl_seconds=None):
+        ttl_seconds = ttl_seconds if ttl_seconds is not None else self._ttl_seconds
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self._max_bytes:
+            logger.debug(f'Skip caching {key} of {len(data)} bytes on disk')
+            return
+
+        now = self._clock()
+        try:
+            with self._write_lock:
+                with self._connection() as connection:
+                    previous = connection.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+                    connection.execute('INSERT OR REPLACE INTO entries (key, value, size, expires_at, accessed_at) '
+                                       'VALUES (?, ?, ?, ?, ?)', (key, data, len(data), now + ttl_seconds, now))
+                self._total_bytes += len(data) - (previous[0] if previous is not None else 0)
+                self._evict()
+        except sqlite3.Error as e:
+            self._error(e, f'Cannot put {key} to disk cache {self._path}')
+
+    def remove(self, key):
+        try:
+            with self._write_lock:
+                with self._connection() as connection:
+                    row = connection.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+                    connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                if row is not None:
+                    self._total_bytes -= row[0]
+        except sqlite3.Error as e:
+            self._error(e, f'Cannot remove {key} from disk cache {self._path}')
+
+    def clear(self):
+        try:
+            with self._write_lock:
+                with self._connection() as connection:
+                    connection.execute('DELETE FROM entries')
+                self._total_bytes = 0
+        except sqlite3.Error as e:
+            self._error(e, f'Cannot clear disk cache {self._path}')
+
+    def __len__(self):
+        try:
+            return self._connection().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        except sqlite3.Error as e:
+            self._error(e, f'Cannot count the entries of disk cache {self._path}')
+            return 0
+
+    def stats(self):
+        # counted before taking the stats lock, errors of the count take it too
+        size = len(self)
+        with self._stats_lock:
+            return {
+                'Size': size,
+                'Bytes': self._total_bytes,
+                'MaxBytes': self._max_bytes,
+                'Hits': self._hits,
+                'Misses': self._misses,
+                'Evictions': self._evictions,
+                'Expirations': self._expirations,
+                'Errors': self._errors,
+            }
+
+    def _evict(self):
+        """Remove expired and then least recently used entries until the total bytes fit, with the write lock held"""
+        connection = self._connection()
+        if self._total_bytes <= self._max_bytes:
+            return
+
+        with connection:
+            expired = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE expires_at <= ?',
+                                         (self._clock(),)).fetchone()
+            connection.execute('DELETE FROM entries WHERE expires_at <= ?', (self._clock(),))
+        self._total_bytes -= expired[1]
+        self._count(expirations=expired[0])
+
+        while self._total_bytes > self._max_bytes:
+            rows = connection.execute('SELECT key, size FROM entries ORDER BY accessed_at LIMIT ?',
+                                      (_EVICTION_BATCH_SIZE,)).fetchall()
+            if len(rows) == 0:
+                self._total_bytes = 0
+                return
+
+            evicted = []
+            for key, size in rows:
+                if self._total_bytes <= self._max_bytes:
+                    break
+                evicted.append((key,))
+                self._total_bytes -= size
+            with connection:
+                connection.executemany('DELETE FROM entries WHERE key = ?', evicted)
+            self._count(evictions=len(evicted))
+
+    def _open(self):
+        """Create the schema, drop the file if it's broken. Return the total bytes of the entries."""
+        try:
+            return self._initialize(self._connection())
+        except sqlite3.DatabaseError:
+            logger.exception(f'Disk cache {self._path} is broken, create it again')
+            return self._recreate()
+
+    def _error(self, exception, message):
+        """Log an error of the cache, drop the file if it turned out broken"""
+        logger.exception(message)
+        self._count(errors=1)
+        # a corrupt or foreign file raises DatabaseError itself, its subclasses are e.g. locks and constraints
+        if type(exception) is not sqlite3.DatabaseError:
+            return
+
+        logger.error(f'Disk cache {self._path} is broken, create it again')
+        try:
+            with self._write_lock:
+                self._total_bytes = self._recreate()
+        except (sqlite3.Error, OSError):
+            logger.exception(f'Cannot create disk cache {self._path} again')
+
+    def _recreate(self):
+        """Remove the files and create the schema again, return the total bytes of the entries"""
+        self._close()
+        self._generation += 1
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self._path + suffix):
+                os.remove(self._path + suffix)
+        return self._initialize(self._connection())
+
+    @staticmethod
+    def _initialize(connection):
+        with connection:
+            connection.execute(_SCHEMA)
+            connection.execute(_ACCESSED_AT_INDEX)
+        return connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _connection(self):
+        """Connection of the current thread, sqlite connections can't be shared by threads"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.generation != self._generation:
+            # the file was created again by another thread
+            self._close()
+            connection = None
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=5)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.generation = self._generation
+        return connection
+
+    def _close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _count(self, **increments):
+        with self._stats_lock:
+            for name, increment in increments.items():
+                setattr(self, '_' + name, getattr(self, '_' + name) + increment)
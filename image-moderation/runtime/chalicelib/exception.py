@@ -75,3 +75,41 @@ class CannotDownloadImageException(Exception):
         msg = f'Cannot download image from {url}, {bucket}/{object_name}'
         super(CannotDownloadImageException, self).__init__(msg)
         self._message = msg
+
+
+class BlacklistedImageException(Exception):
+    @property
+    def message(self):
+        return self._message
+
+    @property
+    def hash_data(self):
+        return self._hash_data
+
+    def __init__(self, hash_data):
+        msg = f'Image {hash_data} is blacklisted'
+        super(BlacklistedImageException, self).__init__(msg)
+        self._message = msg
+        self._hash_data = hash_data
+
+
+class ExecutorRejectedException(Exception):
+    @property
+    def message(self):
+        return self._message
+
+    def __init__(self, executor_name):
+        msg = f'Executor {executor_name} is full'
+        super(ExecutorRejectedException, self).__init__(msg)
+        self._message = msg
+
+
+class DeadlineExceededException(Exception):
+    @property
+    def message(self):
+        return self._message
+
+    def __init__(self, operation_name, timeout_seconds):
+        msg = f'Deadline of {timeout_seconds} seconds exceeded before {operation_name} finished'
+        super(DeadlineExceededException, self).__init__(msg)
+        self._message = msg
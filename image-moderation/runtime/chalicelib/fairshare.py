@@ -0,0 +1,157 @@
+import time
+import logging
+from collections import deque
+from threading import Condition
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# tenant of the requests which don't tell theirs
+DEFAULT_TENANT = 'Default'
+
+
+class _Waiter(object):
+    def __init__(self, cost):
+        self.cost = cost
+        self.granted = False
+
+
+class FairShareScheduler(object):
+    """
+    Slots of the calls in flight to a backend shared by tenants with deficit round robin. Calls start at once while
+    slots are free and no call waits. Otherwise tenants with waiting calls take turns: a tenant earns quantum * weight
+    of credit at its turn and starts its calls while the credit covers their cost, so that busy tenants get slots in
+    proportion to their weights however many calls each one queues.
+    """
+
+    def __init__(self, name, capacity=32, weights=None, default_weight=1.0, quantum=1.0, max_tenants=1024,
+                 clock=time.monotonic):
+        """
+        Args:
+            :weights: dict of positive weight by tenant, tenants not in it have default_weight
+            :max_tenants: counters of idle tenants without a weight are dropped past this number of tenants
+        """
+        # a tenant without credit would never get a slot, and the turns would go round forever
+        if not quantum > 0:
+            raise ValueError(f'Quantum of fair share {name} must be positive: {quantum}')
+        if not default_weight > 0:
+            raise ValueError(f'Default weight of fair share {name} must be positive: {default_weight}')
+        for tenant, weight in (weights if weights is not None else {}).items():
+            if not weight > 0:
+                raise ValueError(f'Weight of tenant {tenant} of fair share {name} must be positive: {weight}')
+        self._name = name
+        self._capacity = capacity
+        self._weights = weights if weights is not None else {}
+        self._default_weight = default_weight
+        self._quantum = quantum
+        self._max_tenants = max_tenants
+        self._clock = clock
+        self._condition = Condition()
+        self._in_flight = 0
+        # waiting calls by tenant, and tenants with waiting calls in the order of their turns
+        self._queues = {}
+        self._turns = deque()
+        self._deficits = {}
+        self._counters = {}
+
+    @property
+    def name(self):
+        return self._name
+
+    def weight(self, tenant):
+        return self._weights.get(tenant, self._default_weight)
+
+    def acquire(self, tenant, cost=1, timeout=None):
+        """Wait for a slot of the tenant, return the time the wait started or None if there's no slot in the timeout"""
+        started_at = self._clock()
+        with self._condition:
+            counters = self._tenant_counters(tenant)
+            if self._in_flight < self._capacity and len(self._turns) == 0:
+                self._start(counters)
+                return started_at
+
+            waiter = _Waiter(cost)
+            if tenant not in self._queues:
+                self._queues[tenant] = deque()
+                self._deficits[tenant] = 0.0
+                self._turns.append(tenant)
+            self._queues[tenant].append(waiter)
+            counters['Waiting'] += 1
+            self._dispatch()
+            granted = self._condition.wait_for(lambda: waiter.granted, timeout=timeout)
+            counters['Waiting'] -= 1
+            if not granted:
+                self._remove(tenant, waiter)
+                counters['Rejected'] += 1
+                # the calls of the next tenants may start once the tenant has no waiting calls
+                self._dispatch()
+                return None
+        return started_at
+
+    def release(self, tenant, started_at):
+        """Release the slot of a call acquired at started_at, the tenant is charged with the time of the call"""
+        with self._condition:
+            counters = self._tenant_counters(tenant)
+            counters['InFlight'] -= 1
+            counters['UsageSeconds'] += self._clock() - started_at
+            self._in_flight -= 1
+            self._dispatch()
+
+    def stats(self):
+        with self._condition:
+            return {tenant: dict(counters, Weight=self.weight(tenant)) for tenant, counters in self._counters.items()}
+
+    def _dispatch(self):
+        """Start waiting calls in turns while there are free slots"""
+        started = False
+        while self._in_flight < self._capacity and len(self._turns) > 0:
+            tenant = self._turns[0]
+            queue = self._queues[tenant]
+            waiter = queue[0]
+            if self._deficits[tenant] < waiter.cost:
+                # the credit is kept to the next turn of the tenant
+                self._deficits[tenant] += self._quantum * self.weight(tenant)
+                self._turns.rotate(-1)
+                continue
+
+            queue.popleft()
+            self._deficits[tenant] -= waiter.cost
+            waiter.granted = True
+            self._start(self._counters[tenant])
+            started = True
+            if len(queue) == 0:
+                # an idle tenant doesn't save credit
+                self._remove(tenant)
+        if started:
+            self._condition.notify_all()
+
+    def _start(self, counters):
+        self._in_flight += 1
+        counters['InFlight'] += 1
+        counters['Calls'] += 1
+
+    def _remove(self, tenant, waiter=None):
+        queue = self._queues.get(tenant)
+        if queue is None:
+            return
+        if waiter is not None:
+            queue.remove(waiter)
+        if len(queue) == 0:
+            del self._queues[tenant]
+            del self._deficits[tenant]
+            self._turns.remove(tenant)
+
+    def _tenant_counters(self, tenant):
+        counters = self._counters.get(tenant)
+        if counters is not None:
+            return counters
+
+        if len(self._counters) >= self._max_tenants:
+            for idle in [name for name, counters in self._counters.items()
+                         if counters['InFlight'] == 0 and counters['Waiting'] == 0 and name not in self._weights]:
+                del self._counters[idle]
+            logger.warning('Fair share of %s dropped the counters of idle tenants, %d tenants left' % (
+                self._name, len(self._counters)))
+        counters = {'InFlight': 0, 'Waiting': 0, 'Calls': 0, 'Rejected': 0, 'UsageSeconds': 0.0}
+        self._counters[tenant] = counters
+        return counters
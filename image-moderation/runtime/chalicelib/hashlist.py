@@ -0,0 +1,149 @@
+import time
+import logging
+from abc import ABC, abstractmethod
+from threading import Lock
+
+from .exception import InvocationException
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+BLACKLIST = 'Blacklist'
+WHITELIST = 'Whitelist'
+LIST_TYPES = [BLACKLIST, WHITELIST]
+
+# the single label of a blacklisted image
+BLACKLISTED_LABEL = {'Label': 'Blacklisted', 'ReturnSource': 'ImageBlacklist', 'Confidence': 100.0}
+
+# max items of a dynamodb batch write
+_BATCH_WRITE_SIZE = 25
+_BATCH_WRITE_MAX_ATTEMPTS = 5
+
+
+# cached lookup of a hash in neither list
+_NOT_LISTED = ''
+
+
+class HashListStore(ABC):
+    """
+    Blacklist and whitelist of image content hashes, blacklist wins if a hash is in both lists
+    """
+
+    @abstractmethod
+    def lookup(self, hash_data):
+        """Return BLACKLIST, WHITELIST or None if the hash is in neither list"""
+        pass
+
+    @abstractmethod
+    def add(self, list_type, hashes: list):
+        pass
+
+    @abstractmethod
+    def remove(self, list_type, hashes: list):
+        pass
+
+
+class InMemoryHashListStore(HashListStore):
+    """Local stand-in of the hash list store"""
+
+    def __init__(self):
+        self._lists = {list_type: set() for list_type in LIST_TYPES}
+        self._lock = Lock()
+
+    def lookup(self, hash_data):
+        with self._lock:
+            for list_type in LIST_TYPES:
+                if hash_data in self._lists[list_type]:
+                    return list_type
+        return None
+
+    def add(self, list_type, hashes: list):
+        with self._lock:
+            self._lists[list_type].update(hashes)
+
+    def remove(self, list_type, hashes: list):
+        with self._lock:
+            self._lists[list_type].difference_update(hashes)
+
+
+class DynamoDBHashListStore(HashListStore):
+    """
+    Hash lists backed by two Amazon DynamoDB tables with Hash as the partition key,
+    both tables are read with one batch get per lookup. Lookups are kept in the optional lookup cache, so changes made
+    by other containers are seen once the cached lookups expire.
+    """
+
+    def __init__(self, dynamodb_client=None, blacklist_table_name='', whitelist_table_name='', lookup_cache=None):
+        """
+        Args:
+            :lookup_cache: optional LRUCache of the lookups with a short ttl
+        """
+        self._dynamodb_client = dynamodb_client
+        self._table_names = {BLACKLIST: blacklist_table_name, WHITELIST: whitelist_table_name}
+        self._lookup_cache = lookup_cache
+
+    def lookup(self, hash_data):
+        if self._lookup_cache is not None:
+            list_type = self._lookup_cache.get(hash_data)
+            if list_type is not None:
+                return list_type if list_type != _NOT_LISTED else None
+
+        list_type = self._lookup(hash_data)
+        if self._lookup_cache is not None:
+            self._lookup_cache.put(hash_data, list_type if list_type is not None else _NOT_LISTED)
+        return list_type
+
+    def _lookup(self, hash_data):
+        key = {'Keys': [{'Hash': {'S': hash_data}}], 'ProjectionExpression': '#h',
+               'ExpressionAttributeNames': {'#h': 'Hash'}}
+        try:
+            response = self._dynamodb_client.batch_get_item(
+                RequestItems={table_name: key for table_name in self._table_names.values()})
+        except Exception as e:
+            logger.exception("Couldn't look up hash {} in tables {}".format(hash_data, self._table_names))
+            raise InvocationException.from_client_exception(client_exception=e,
+                                                            operation_name='DynamoDB_BatchGetItem')
+
+        responses = response.get('Responses', {})
+        for list_type in LIST_TYPES:
+            if len(responses.get(self._table_names[list_type], [])) > 0:
+                return list_type
+        return None
+
+    def add(self, list_type, hashes: list):
+        self._batch_write(list_type, [{'PutRequest': {'Item': {'Hash': {'S': hash_data}}}}
+                                      for hash_data in hashes])
+        self._forget(hashes)
+
+    def remove(self, list_type, hashes: list):
+        self._batch_write(list_type, [{'DeleteRequest': {'Key': {'Hash': {'S': hash_data}}}}
+                                      for hash_data in hashes])
+        self._forget(hashes)
+
+    def _forget(self, hashes: list):
+        if self._lookup_cache is None:
+            return
+        for hash_data in hashes:
+            self._lookup_cache.remove(hash_data)
+
+    def _batch_write(self, list_type, requests: list):
+        table_name = self._table_names[list_type]
+        for start in range(0, len(requests), _BATCH_WRITE_SIZE):
+            request_items = {table_name: requests[start:start + _BATCH_WRITE_SIZE]}
+            try:
+                # retry unprocessed items returned by dynamodb
+                for attempt in range(_BATCH_WRITE_MAX_ATTEMPTS):
+                    if attempt > 0:
+                        time.sleep(0.05 * (2 ** attempt))
+                    response = self._dynamodb_client.batch_write_item(RequestItems=request_items)
+                    request_items = response.get('UnprocessedItems') or {}
+                    if len(request_items) == 0:
+                        break
+            except Exception as e:
+                logger.exception("Couldn't write hashes to table {}".format(table_name))
+                raise InvocationException.from_client_exception(client_exception=e,
+                                                                operation_name='DynamoDB_BatchWriteItem')
+
+            if len(request_items) > 0:
+                raise InvocationException('DynamoDB_BatchWriteItem', 'UnprocessedItems',
+                                          f'{len(request_items[table_name])} hashes are not written to {table_name}')
@@ -0,0 +1,159 @@
+import math
+import logging
+from collections import deque
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait, FIRST_COMPLETED
+
+from .concurrentutils import RoundTripTimer, deadline_timeout
+from .exception import DeadlineExceededException
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class LatencyTracker(object):
+    """Rolling window of the latencies of the latest calls"""
+
+    def __init__(self, window_size=256, min_samples=20):
+        self._latencies = deque(maxlen=window_size)
+        self._min_samples = min_samples
+        self._lock = Lock()
+        self._sorted = None
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._sorted = None
+
+    def percentile(self, percentile):
+        """Latency in seconds of the percentile of the window, None until there are min samples"""
+        with self._lock:
+            if len(self._latencies) < self._min_samples:
+                return None
+            if self._sorted is None:
+                self._sorted = sorted(self._latencies)
+            index = min(len(self._sorted) - 1, max(0, math.ceil(percentile / 100 * len(self._sorted)) - 1))
+            return self._sorted[index]
+
+
+class HedgeBudget(object):
+    """
+    Caps hedged calls to a ratio of the calls: every call earns max_ratio of a token and a hedged call spends one,
+    tokens are capped by max_tokens so that a quiet period doesn't allow a burst of hedged calls.
+    """
+
+    def __init__(self, max_ratio=0.05, max_tokens=10):
+        self._max_ratio = max_ratio
+        self._max_tokens = max_tokens
+        self._tokens = 0.0
+        self._lock = Lock()
+
+    def on_call(self):
+        with self._lock:
+            self._tokens = min(self._max_tokens, self._tokens + self._max_ratio)
+
+    def try_acquire(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Hedger(object):
+    """
+    Calls a backend and, if the call hasn't returned by the percentile latency of the backend, calls it again and
+    takes whichever returns first. The slower call is left running and its result is dropped. Hedged calls are
+    capped by a HedgeBudget, so that a slow backend isn't sent more load than max_ratio. With a deadline, the call
+    raises DeadlineExceededException once it has passed, without waiting for the calls in flight.
+
+    The percentile is that of the backend round trips made by the calls, waits and cache hits before them are not
+    counted. Once there are enough samples, calls run on a pool of max_workers threads, calls beyond it wait for a
+    thread and that wait counts toward the hedge delay.
+    """
+
+    def __init__(self, name, percentile=95, max_ratio=0.05, window_size=256, min_samples=20, max_workers=32):
+        self._name = name
+        self._percentile = percentile
+        self._tracker = LatencyTracker(window_size=window_size, min_samples=min_samples)
+        self._budget = HedgeBudget(max_ratio=max_ratio)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'hedge-{name}')
+        self._lock = Lock()
+        self._calls = 0
+        self._hedged = 0
+        self._hedge_wins = 0
+        self._budget_exhausted = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    def call(self, fn, deadline=None):
+        """Return fn(), raise its error if every call of it fails"""
+        self._budget.on_call()
+        with self._lock:
+            self._calls += 1
+
+        hedge_delay = self._tracker.percentile(self._percentile)
+        if hedge_delay is None:
+            # not enough samples to tell a slow call
+            return self._timed(fn)
+
+        primary = self._executor.submit(self._timed, fn)
+        done, _ = wait([primary], timeout=deadline_timeout(deadline, hedge_delay))
+        if len(done) > 0:
+            return primary.result()
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceededException(self._name, deadline.timeout_seconds)
+        if not self._budget.try_acquire():
+            with self._lock:
+                self._budget_exhausted += 1
+            return self._result(primary, deadline)
+
+        logger.debug('Hedge call of %s after %.3f seconds' % (self._name, hedge_delay))
+        with self._lock:
+            self._hedged += 1
+        hedge = self._executor.submit(self._timed, fn)
+        pending = [primary, hedge]
+        while True:
+            done, _ = wait(pending, timeout=deadline_timeout(deadline), return_when=FIRST_COMPLETED)
+            if len(done) == 0:
+                raise DeadlineExceededException(self._name, deadline.timeout_seconds)
+            for future in [primary, hedge]:
+                if future not in done or future.exception() is not None:
+                    continue
+                if future is hedge:
+                    with self._lock:
+                        self._hedge_wins += 1
+                return future.result()
+
+            pending = [future for future in pending if future not in done]
+            if len(pending) == 0:
+                # both failed
+                return primary.result()
+
+    def stats(self):
+        percentile = self._tracker.percentile(self._percentile)
+        with self._lock:
+            return {
+                'Calls': self._calls,
+                'Hedged': self._hedged,
+                'HedgeWins': self._hedge_wins,
+                'BudgetExhausted': self._budget_exhausted,
+                'HedgeDelayMillis': percentile * 1000 if percentile is not None else None,
+            }
+
+    def _result(self, future, deadline):
+        try:
+            return future.result(timeout=deadline_timeout(deadline))
+        except TimeoutError:
+            raise DeadlineExceededException(self._name, deadline.timeout_seconds)
+
+    def _timed(self, fn):
+        timer = RoundTripTimer()
+        with timer:
+            result = fn()
+        # latency of failed calls doesn't tell how long a response takes, nor that of calls without round trip
+        if timer.seconds is not None:
+            self._tracker.record(timer.seconds)
+        return result
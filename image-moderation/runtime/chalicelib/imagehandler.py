@@ -1,11 +1,15 @@
 import io
+import re
+import time
 import requests
 import hashlib
 import random
 import logging
 from PIL import Image
-from .concurrentutils import Stopwatch
-from .exception import UnsupportedImageException, CannotDownloadImageException
+from .concurrentutils import Stopwatch, deadline_timeout
+from .exception import UnsupportedImageException, CannotDownloadImageException, BlacklistedImageException, \
+    DeadlineExceededException
+from .hashlist import BLACKLIST, WHITELIST
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -23,8 +27,21 @@ class ImageHandler(object):
                  compress_quality_step=8,
                  animation_extraction_size_threshold=5242880,
                  animation_default_small_max_frame=8,
-                 animation_default_large_max_frame=25):
+                 animation_default_large_max_frame=25,
+                 hash_list=None,
+                 frame_cache=None,
+                 url_cache=None,
+                 deadline=None):
         self._s3_client = s3_client
+        self._hash_list = hash_list
+        self._frame_cache = frame_cache
+        # validators and content hash by url
+        self._url_cache = url_cache
+        # downloads time out and resolution stops once the deadline of the request has passed
+        self._deadline = deadline
+        # images fetched by revalidation, and validators of downloaded urls, of this handler
+        self._fetched_images = {}
+        self._url_validators = {}
         self._compress_size = compress_size
         self._compress_quality_step = compress_quality_step
         self._animation_extraction_size_threshold = animation_extraction_size_threshold
@@ -45,7 +62,35 @@ class ImageHandler(object):
         lapsed = stopwatch.stop()
         logger.debug('Downloaded image with lapsed time %.3f from %s' % (lapsed, url))
 
+        return self.resolve_image(image, url)
+
+    def resolve_image(self, image, url=None):
+        """Compress the downloaded image or extract frames for animated images, return frames and image hash"""
+        stopwatch = Stopwatch()
+        stopwatch.start()
+
+        # short circuit blacklisted and whitelisted images before decoding
+        hash_data = self._generate_hash(image)
+        self._remember_url(url, hash_data)
+        if self._hash_list is not None:
+            list_type = self._hash_list.lookup(hash_data)
+            if list_type == BLACKLIST:
+                logger.info(f'Image {hash_data} from {url} is blacklisted')
+                raise BlacklistedImageException(hash_data)
+            if list_type == WHITELIST:
+                logger.info(f'Image {hash_data} from {url} is whitelisted')
+                return [], hash_data
+
+        # reuse frames resolved from the same image
+        frame_cache_key = self._frame_cache_key(hash_data)
+        if self._frame_cache is not None:
+            cached_frames = self._frame_cache.get(frame_cache_key)
+            if cached_frames is not None:
+                logger.debug(f'Found cached frames for image {hash_data} from {url}')
+                return cached_frames, hash_data
+
         # detect image format
+        self._check_deadline('decode')
         logger.debug(f'Start to detect image format for image from {url}')
         image_format, is_animated = self._detect_image_format(image)
         lapsed = stopwatch.stop()
@@ -57,6 +102,7 @@ class ImageHandler(object):
         # handler gif
         image_data_list = [image]
         if is_animated:
+            self._check_deadline('extract')
             stopwatch.start()
             logger.debug(f'Start to extract animated image for image from {url}')
             image_data_list = self._extract_animation_frame(image)
@@ -78,6 +124,7 @@ class ImageHandler(object):
                 continue
 
             # compression
+            self._check_deadline('compress')
             stopwatch.start()
             logger.debug(f'Start to compress image for image from {url}')
             compressed_data = self._compress(image_data, self._compress_size, self._compress_quality_step)
@@ -87,7 +134,20 @@ class ImageHandler(object):
                 'End of compressing image from %d to %d for image lapsed %.3f from %s' %
                 (len(image_data), len(compressed_data), lapsed, url))
 
-        return resolved_size_list, self._generate_hash(image)
+        if self._frame_cache is not None:
+            self._frame_cache.put(frame_cache_key, resolved_size_list)
+        return resolved_size_list, hash_data
+
+    def _check_deadline(self, operation_name):
+        if self._deadline is not None:
+            self._deadline.check(operation_name)
+
+    def _frame_cache_key(self, hash_data):
+        """Frames depend on the compression and extraction settings as well"""
+        return 'frames|{}|{}|{}|{}|{}|{}'.format(hash_data, self._compress_size, self._compress_quality_step,
+                                                 self._animation_extraction_size_threshold,
+                                                 self._animation_default_small_max_frame,
+                                                 self._animation_default_large_max_frame)
 
     def generate_hash(self, url='', bucket='', object_name=''):
         # download image
@@ -99,14 +159,96 @@ class ImageHandler(object):
 
         return self._generate_hash(image)
 
+    def revalidate_url(self, url):
+        """
+        Return the content hash of the image of url if it's not changed since it was downloaded, None otherwise.
+        Fresh images by Cache-Control max-age are not requested, others are requested with If-None-Match and
+        If-Modified-Since, a changed image is kept to be handled without downloading again.
+        """
+        if self._url_cache is None or url is None:
+            return None
+        entry = self._url_cache.get(url)
+        if entry is None:
+            return None
+        if entry['FreshUntil'] > time.time():
+            logger.debug(f'Image from {url} is fresh')
+            return entry['Hash']
+        if entry['ETag'] is None and entry['LastModified'] is None:
+            return None
+
+        headers = {}
+        if entry['ETag'] is not None:
+            headers['If-None-Match'] = entry['ETag']
+        if entry['LastModified'] is not None:
+            headers['If-Modified-Since'] = entry['LastModified']
+        try:
+            with requests.get(url, headers=headers, timeout=deadline_timeout(self._deadline)) as res:
+                validators = self._validators(res.headers)
+                if res.status_code == 304:
+                    logger.debug(f'Image from {url} is not modified')
+                    # a 304 may update the validators and the max age
+                    updated_entry = dict(entry, FreshUntil=validators['FreshUntil'])
+                    for name in ['ETag', 'LastModified']:
+                        if validators[name] is not None:
+                            updated_entry[name] = validators[name]
+                    self._url_cache.put(url, updated_entry)
+                    return entry['Hash']
+                if res.ok and res.content:
+                    self._fetched_images[url] = res.content
+                    self._url_validators[url] = validators
+        except Exception as e:
+            logger.warning(f'Cannot revalidate image from {url}: {e}')
+        return None
+
+    def _remember_url(self, url, hash_data):
+        validators = self._url_validators.pop(url, None) if url is not None else None
+        if self._url_cache is None or validators is None:
+            return
+        if validators.get('NoStore'):
+            self._url_cache.remove(url)
+            return
+
+        self._url_cache.put(url, {'ETag': validators['ETag'],
+                                  'LastModified': validators['LastModified'],
+                                  'FreshUntil': validators['FreshUntil'],
+                                  'Hash': hash_data})
+
+    @staticmethod
+    def _validators(headers):
+        """ETag, Last-Modified and the time until which the response is fresh by Cache-Control max-age"""
+        cache_control = (headers.get('Cache-Control') or '').lower()
+        max_age = re.search(r'(?:^|[,\s])max-age=(\d+)', cache_control)
+        fresh_seconds = int(max_age.group(1)) if max_age is not None and 'no-cache' not in cache_control else 0
+        return {'ETag': headers.get('ETag'),
+                'LastModified': headers.get('Last-Modified'),
+                'FreshUntil': time.time() + fresh_seconds,
+                'NoStore': 'no-store' in cache_control}
+
+    def head_object(self, bucket, object_name):
+        """Return ETag and VersionId of an S3 object without downloading it, None if it cannot be read"""
+        try:
+            response = self._s3_client.head_object(Bucket=bucket, Key=object_name)
+        except Exception as e:
+            logger.warning(f'Cannot head object {bucket}/{object_name}: {e}')
+            return None
+
+        if response is None or response.get('ETag') is None:
+            return None
+        return {'ETag': response['ETag'], 'VersionId': response.get('VersionId')}
+
     def _download_image(self, url='', bucket='', object_name=''):
         """Download image"""
         try:
             if url is not None:
-                with requests.get(url) as res:
+                if url in self._fetched_images:
+                    return self._fetched_images.pop(url)
+
+                with requests.get(url, timeout=deadline_timeout(self._deadline)) as res:
                     if res is None or res.content is None:
                         logger.error("Image is empty from %s" % url)
                         return bytearray()
+                    if self._url_cache is not None and res.ok:
+                        self._url_validators[url] = self._validators(res.headers)
                 return res.content
 
             response = self._s3_client.get_object(Bucket=bucket, Key=object_name)
@@ -115,6 +257,8 @@ class ImageHandler(object):
 
             return response['Body'].read()
         except Exception as e:
+            if self._deadline is not None and self._deadline.expired():
+                raise DeadlineExceededException('download', self._deadline.timeout_seconds)
             raise CannotDownloadImageException(url, bucket, object_name)
 
     def _detect_image_format(self, image_bytes):
@@ -0,0 +1,231 @@
+import json
+import time
+import logging
+from abc import ABC, abstractmethod
+from queue import Queue
+from threading import Thread, Lock
+
+from .exception import InvocationException
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+JOB_STATUS_SUBMITTED = 'SUBMITTED'
+JOB_STATUS_IN_PROGRESS = 'IN_PROGRESS'
+JOB_STATUS_SUCCEEDED = 'SUCCEEDED'
+JOB_STATUS_FAILED = 'FAILED'
+
+
+class JobQueue(ABC):
+    """
+    Queue of moderation jobs, a job is a json serializable dict with JobId and the original request
+    """
+
+    @abstractmethod
+    def submit(self, job: dict):
+        pass
+
+
+class SqsJobQueue(JobQueue):
+    """Job queue backed by Amazon SQS, jobs are consumed by the sqs worker lambda"""
+
+    def __init__(self, sqs_client=None, queue_url=''):
+        self._sqs_client = sqs_client
+        self._queue_url = queue_url
+
+    def submit(self, job: dict):
+        try:
+            self._sqs_client.send_message(QueueUrl=self._queue_url,
+                                          MessageBody=json.dumps(job))
+        except Exception as e:
+            logger.exception("Couldn't submit job {} to queue {}".format(job.get('JobId'), self._queue_url))
+            raise InvocationException.from_client_exception(client_exception=e,
+                                                            operation_name='SQS_SendMessage')
+
+
+class InMemoryJobQueue(JobQueue):
+    """
+    Local stand-in of the job queue, jobs are consumed by a daemon thread in the same process. Like an SQS queue with
+    a redrive policy, a job whose worker raises is received again, up to max_receive_count times.
+    """
+
+    def __init__(self, worker=None, max_receive_count=3):
+        """
+        Args:
+            :worker: function of the job and the number of times it has been received
+        """
+        self._worker = worker
+        self._max_receive_count = max_receive_count
+        self._queue = Queue()
+        self._consumer = None
+        self._lock = Lock()
+
+    def submit(self, job: dict):
+        self._ensure_consumer()
+        # copy like a real queue would do
+        self._queue.put(json.loads(json.dumps(job)))
+
+    def _ensure_consumer(self):
+        with self._lock:
+            if self._consumer is None:
+                self._consumer = Thread(target=self._consume, daemon=True)
+                self._consumer.start()
+
+    def _consume(self):
+        while True:
+            job = self._queue.get()
+            try:
+                for receive_count in range(1, self._max_receive_count + 1):
+                    try:
+                        self._worker(job, receive_count)
+                        break
+                    except Exception:
+                        logger.exception('Job {} failed in the in-memory worker, received {} times'.format(
+                            job.get('JobId'), receive_count))
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Block until all submitted jobs are processed"""
+        self._queue.join()
+
+
+class JobStore(ABC):
+    """
+    Status and results of moderation jobs
+    """
+
+    @abstractmethod
+    def create(self, job_id, request: dict):
+        pass
+
+    @abstractmethod
+    def start(self, job_id):
+        pass
+
+    @abstractmethod
+    def complete(self, job_id, labels: list):
+        pass
+
+    @abstractmethod
+    def fail(self, job_id, error_code, error_message):
+        pass
+
+    @abstractmethod
+    def get(self, job_id):
+        """Return the job as dict with JobId, Status, and Labels or Error once it's done, None if not found"""
+        pass
+
+
+class InMemoryJobStore(JobStore):
+    """Local stand-in of the job store"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = Lock()
+
+    def create(self, job_id, request: dict):
+        with self._lock:
+            self._jobs[job_id] = {'JobId': job_id, 'Status': JOB_STATUS_SUBMITTED, 'CreatedAt': int(time.time())}
+
+    def start(self, job_id):
+        self._update(job_id, {'Status': JOB_STATUS_IN_PROGRESS})
+
+    def complete(self, job_id, labels: list):
+        self._update(job_id, {'Status': JOB_STATUS_SUCCEEDED, 'Labels': labels})
+
+    def fail(self, job_id, error_code, error_message):
+        self._update(job_id, {'Status': JOB_STATUS_FAILED, 'Error': {'Code': error_code, 'Message': error_message}})
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _update(self, job_id, values: dict):
+        with self._lock:
+            job = self._jobs.setdefault(job_id, {'JobId': job_id, 'CreatedAt': int(time.time())})
+            job.update(values)
+
+
+class DynamoDBJobStore(JobStore):
+    """
+    Job store backed by an Amazon DynamoDB table with JobId as the partition key, items expire with ExpiresAt
+    """
+
+    def __init__(self, dynamodb_client=None, table_name='', ttl_seconds=86400):
+        self._dynamodb_client = dynamodb_client
+        self._table_name = table_name
+        self._ttl_seconds = ttl_seconds
+
+    def create(self, job_id, request: dict):
+        now = int(time.time())
+        self._put_item({
+            'JobId': {'S': job_id},
+            'Status': {'S': JOB_STATUS_SUBMITTED},
+            'Request': {'S': json.dumps(request)},
+            'CreatedAt': {'N': str(now)},
+            'ExpiresAt': {'N': str(now + self._ttl_seconds)},
+        })
+
+    def start(self, job_id):
+        self._update_item(job_id, {'Status': {'S': JOB_STATUS_IN_PROGRESS}})
+
+    def complete(self, job_id, labels: list):
+        self._update_item(job_id, {'Status': {'S': JOB_STATUS_SUCCEEDED},
+                                   'Labels': {'S': json.dumps(labels)}})
+
+    def fail(self, job_id, error_code, error_message):
+        self._update_item(job_id, {'Status': {'S': JOB_STATUS_FAILED},
+                                   'Error': {'S': json.dumps({'Code': error_code, 'Message': error_message})}})
+
+    def get(self, job_id):
+        try:
+            response = self._dynamodb_client.get_item(TableName=self._table_name,
+                                                      Key={'JobId': {'S': job_id}},
+                                                      ConsistentRead=True)
+        except Exception as e:
+            logger.exception("Couldn't get job {} from table {}".format(job_id, self._table_name))
+            raise InvocationException.from_client_exception(client_exception=e,
+                                                            operation_name='DynamoDB_GetItem')
+
+        item = response.get('Item')
+        if item is None:
+            return None
+
+        job = {'JobId': item['JobId']['S'],
+               'Status': item['Status']['S'],
+               'CreatedAt': int(item['CreatedAt']['N'])}
+        if item.get('Labels') is not None:
+            job['Labels'] = json.loads(item['Labels']['S'])
+        if item.get('Error') is not None:
+            job['Error'] = json.loads(item['Error']['S'])
+        return job
+
+    def _put_item(self, item):
+        try:
+            self._dynamodb_client.put_item(TableName=self._table_name, Item=item)
+        except Exception as e:
+            logger.exception("Couldn't put job {} to table {}".format(item['JobId']['S'], self._table_name))
+            raise InvocationException.from_client_exception(client_exception=e,
+                                                            operation_name='DynamoDB_PutItem')
+
+    def _update_item(self, job_id, values: dict):
+        names = {}
+        attribute_values = {}
+        expressions = []
+        for index, (name, value) in enumerate(values.items()):
+            names[f'#n{index}'] = name
+            attribute_values[f':v{index}'] = value
+            expressions.append(f'#n{index} = :v{index}')
+
+        try:
+            self._dynamodb_client.update_item(TableName=self._table_name,
+                                              Key={'JobId': {'S': job_id}},
+                                              UpdateExpression='SET ' + ', '.join(expressions),
+                                              ExpressionAttributeNames=names,
+                                              ExpressionAttributeValues=attribute_values)
+        except Exception as e:
+            logger.exception("Couldn't update job {} in table {}".format(job_id, self._table_name))
+            raise InvocationException.from_client_exception(client_exception=e,
+                                                            operation_name='DynamoDB_UpdateItem')
@@ -0,0 +1,85 @@
+import time
+import logging
+from threading import Condition
+
+from .hedging import LatencyTracker
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+INTERACTIVE = 'Interactive'
+BULK = 'Bulk'
+LANES = [INTERACTIVE, BULK]
+
+
+class LaneScheduler(object):
+    """
+    Slots of the calls in flight to a backend shared by the interactive and bulk lanes. Interactive calls may take
+    every slot, bulk calls take at most capacity - reserved slots, so that reserved slots are always left to
+    interactive calls. A bulk call doesn't start while interactive calls are waiting, so that interactive calls go
+    ahead of the queued bulk ones.
+    """
+
+    def __init__(self, name, capacity=32, reserved=8, window_size=1024, clock=time.monotonic):
+        self._name = name
+        self._capacity = capacity
+        self._bulk_capacity = max(0, capacity - reserved)
+        self._clock = clock
+        self._condition = Condition()
+        self._in_flight = {lane: 0 for lane in LANES}
+        self._waiting = {lane: 0 for lane in LANES}
+        self._calls = {lane: 0 for lane in LANES}
+        self._rejected = {lane: 0 for lane in LANES}
+        self._latencies = {lane: LatencyTracker(window_size=window_size, min_samples=1) for lane in LANES}
+        self._queue_latencies = {lane: LatencyTracker(window_size=window_size, min_samples=1) for lane in LANES}
+
+    @property
+    def name(self):
+        return self._name
+
+    def acquire(self, lane, timeout=None):
+        """Wait for a slot of the lane, return the time the wait started or None if there's no slot in the timeout"""
+        started_at = self._clock()
+        with self._condition:
+            self._waiting[lane] += 1
+            try:
+                if not self._condition.wait_for(lambda: self._can_start(lane), timeout=timeout):
+                    self._rejected[lane] += 1
+                    return None
+                self._in_flight[lane] += 1
+                self._calls[lane] += 1
+            finally:
+                self._waiting[lane] -= 1
+                # a bulk call may start once no interactive call waits
+                self._condition.notify_all()
+
+        self._queue_latencies[lane].record(self._clock() - started_at)
+        return started_at
+
+    def release(self, lane, started_at):
+        """Release the slot of a call acquired at started_at, its latency includes the wait for the slot"""
+        self._latencies[lane].record(self._clock() - started_at)
+        with self._condition:
+            self._in_flight[lane] -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            stats = {lane: {'InFlight': self._in_flight[lane],
+                            'Waiting': self._waiting[lane],
+                            'Calls': self._calls[lane],
+                            'Rejected': self._rejected[lane]} for lane in LANES}
+        for lane in LANES:
+            for name, percentile in [('P50Millis', 50), ('P99Millis', 99)]:
+                latency = self._latencies[lane].percentile(percentile)
+                stats[lane][name] = latency * 1000 if latency is not None else None
+            queue_latency = self._queue_latencies[lane].percentile(99)
+            stats[lane]['QueueP99Millis'] = queue_latency * 1000 if queue_latency is not None else None
+        return stats
+
+    def _can_start(self, lane):
+        if sum(self._in_flight.values()) >= self._capacity:
+            return False
+        if lane == INTERACTIVE:
+            return True
+        return self._waiting[INTERACTIVE] == 0 and self._in_flight[BULK] < self._bulk_capacity
@@ -1,9 +1,12 @@
 import logging
 import base64
 import re
-from threading import Thread
-from .concurrentutils import ThreadSafeList, CountDownLatch, Stopwatch
-from .exception import InvocationException
+from threading import Thread, Event
+from functools import partial
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from .concurrentutils import ThreadSafeList, ResultSlots, Stopwatch, RoundTripTimer, deadline_timeout
+from .exception import InvocationException, ExecutorRejectedException, DeadlineExceededException
+from . import lanes, fairshare
 
 _RETURN_RESOURCES = [
     "DetectLabels",
@@ -15,6 +18,65 @@ _RETURN_RESOURCES = [
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# status of a return source in the results
+SOURCE_STATUS_OK = 'Ok'
+SOURCE_STATUS_THROTTLED = 'Throttled'
+SOURCE_STATUS_TIMEOUT = 'Timeout'
+SOURCE_STATUS_ERROR = 'Error'
+# the circuit of the backend is open and the source is skippable
+SOURCE_STATUS_SKIPPED = 'Skipped'
+# frames of the source were left out once a decisive label was detected
+SOURCE_STATUS_SHORT_CIRCUITED = 'ShortCircuited'
+# a source with frames of several statuses has the most severe one
+_SOURCE_STATUS_SEVERITY = [SOURCE_STATUS_OK, SOURCE_STATUS_SHORT_CIRCUITED, SOURCE_STATUS_THROTTLED,
+                           SOURCE_STATUS_TIMEOUT, SOURCE_STATUS_ERROR]
+_THROTTLED_ERROR_CODES = [
+    'ThrottlingException',
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException',
+    'TooManyRequestsException',
+    'ExecutorRejected',
+    'RateLimited',
+    'ConcurrencyLimited',
+    'LaneRejected',
+    'FairShareRejected',
+    'TenantThrottled',
+]
+# errors raised in the container before calling a backend
+_LOCAL_ERROR_CODES = [
+    'ExecutorRejected',
+    'RateLimited',
+    'ConcurrencyLimited',
+    'LaneRejected',
+    'FairShareRejected',
+    'TenantThrottled',
+    'DeadlineExceeded',
+]
+_TIMEOUT_ERROR_CODES = [
+    'DeadlineExceeded',
+    'Timeout',
+    'ReadTimeoutError',
+    'ConnectTimeoutError',
+]
+
+
+class DetectedLabels(list):
+    """Merged labels, with the status and latency of each return source"""
+
+    def __init__(self, labels=(), source_status=None, short_circuited=False, tiers=None):
+        super(DetectedLabels, self).__init__(labels)
+        self.source_status = source_status if source_status is not None else {}
+        # True if the detection ended at a decisive label without the labels of every frame and return source
+        self.short_circuited = short_circuited
+        # tiers of the cascade called, None without cascade
+        self.tiers = tiers
+
+    @property
+    def degraded(self):
+        """True if labels of some return sources are missing, labels left out after a decisive one are not missed"""
+        return any(status['Status'] not in [SOURCE_STATUS_OK, SOURCE_STATUS_SHORT_CIRCUITED]
+                   for status in self.source_status.values())
+
 
 class ModerationHandler(object):
     """
@@ -24,9 +86,70 @@ class ModerationHandler(object):
 
     def __init__(self,
                  rek_client=None,
-                 sagemaker_client=None):
+                 sagemaker_client=None,
+                 concurrency_budget=None,
+                 executors=None,
+                 max_in_flight=None,
+                 deadline=None,
+                 hedgers=None,
+                 retry_policy=None,
+                 concurrency_limiters=None,
+                 skippable_return_sources=None,
+                 lane_schedulers=None,
+                 lane=lanes.INTERACTIVE,
+                 fair_share_schedulers=None,
+                 tenant=fairshare.DEFAULT_TENANT,
+                 tenant_quota=None,
+                 decisive_labels=None,
+                 cascade=None):
+        """
+        Args:
+            rek_client: rekognition client wrapper
+            sagemaker_client: sagemaker client wrapper
+            concurrency_budget: optional semaphore shared by several detections (e.g. a batch) to cap
+                the number of backend calls in flight
+            executors: optional dict of long-lived BoundedExecutor by return source, so that a slow backend
+                can't starve the others. A thread is started per task without executors.
+            max_in_flight: optional semaphore shared by all the detections of the container to cap the number of
+                backend calls in flight
+            deadline: optional Deadline of the request, tasks not finished by then fail with DeadlineExceeded and
+                are cancelled if they haven't started, backend calls in flight are left to their read timeouts
+            hedgers: optional dict of Hedger by return source, to call slow backends again
+            retry_policy: optional RetryPolicy to call backends again after retryable errors, within the deadline
+            concurrency_limiters: optional dict of long-lived AdaptiveConcurrencyLimiter by return source, calls
+                wait for the limiter within the deadline and fail with ConcurrencyLimited otherwise
+            skippable_return_sources: optional return sources left out of the labels without failing the detection
+                when the circuit of their backend is open
+            lane_schedulers: optional dict of long-lived LaneScheduler by return source, calls wait for a slot of
+                the lane within the deadline and fail with LaneRejected otherwise
+            lane: lane of the calls of the handler, Interactive or Bulk
+            fair_share_schedulers: optional dict of long-lived FairShareScheduler by return source, calls wait for
+                a slot of the tenant within the deadline and fail with FairShareRejected otherwise
+            tenant: tenant of the calls of the handler
+            tenant_quota: optional RateLimiter of the backend calls of the tenant, calls over the quota fail with
+                TenantThrottled
+            decisive_labels: optional dict of min confidence by label name. A task detecting one of them ends the
+                detection: tasks not started are cancelled and the results of the tasks in flight are ignored.
+            cascade: optional Cascade calling the tiers of return sources one after the other while labels are
+                uncertain, every return source is called at once without cascade
+        """
         self._rek_client = rek_client
         self._sagemaker_client = sagemaker_client
+        self._concurrency_budget = concurrency_budget
+        self._executors = executors
+        self._max_in_flight = max_in_flight
+        self._deadline = deadline
+        self._hedgers = hedgers
+        self._retry_policy = retry_policy
+        self._concurrency_limiters = concurrency_limiters
+        self._skippable_return_sources = skippable_return_sources if skippable_return_sources is not None else []
+        self._lane_schedulers = lane_schedulers
+        self._lane = lane
+        self._fair_share_schedulers = fair_share_schedulers
+        self._tenant = tenant
+        self._tenant_quota = tenant_quota
+        self._decisive_labels = decisive_labels
+        self._cascade = cascade
 
     def detect_image_labels(self,
                             images,
@@ -35,7 +158,8 @@ class ModerationHandler(object):
                             return_sources=[],
                             min_confidence=50,
                             max_labels=5,
-                            url_hint=''):
+                            url_hint='',
+                            mandatory_return_sources=None):
         """
         Detect labels
 
@@ -46,41 +170,74 @@ class ModerationHandler(object):
             return_sources: return source
             min_confidence: min confidence to filter results
             max_labels: maxLabels to return
+            mandatory_return_sources: return sources which have to succeed, labels of the other sources are left out
+                if they fail. Every source is mandatory if None.
         Returns:
-            Return a list of labels may not have distinct.
+            Return DetectedLabels, a list of labels may not have distinct.
         """
         if images is None or len(images) == 0:
             return []
 
-        return_sources = return_sources if return_sources is not None else _RETURN_RESOURCES
-
-        all_results = ThreadSafeList()
-
-        start_signal = CountDownLatch(1)
-        done_signal = CountDownLatch(len(return_sources))
-        for image in images:
-            for return_source in return_sources:
-                task_method = getattr(self, 'task_' + self._camel_to_snake(return_source))
-                thread = Thread(target=task_method,
-                                kwargs={'start_signal': start_signal,
-                                        'done_signal': done_signal,
-                                        'all_results': all_results,
-                                        'image_bytes': image,
-                                        'bucket': bucket,
-                                        'object_name': object_name,
-                                        'min_confidence': min_confidence,
-                                        'max_labels': max_labels,
-                                        'url_hint': url_hint
-                                        })
-                thread.start()
-            # wait all complete
-            start_signal.count_down()
-            done_signal.wait()
-
-        if all_results.has_exception():
-            raise InvocationException.backend_exceptions(exceptions=all_results.exceptions())
-
-        results_list = self.merge_results(all_results.list(), max_labels=max_labels)
+        return_sources = self.effective_return_sources(return_sources)
+
+        # return sources are one tier without cascade
+        plan = self._cascade.plan(return_sources) if self._cascade is not None else [(None, return_sources)]
+
+        # every frame and return source is a task, the tasks of a tier are submitted at once
+        tasks = [(return_source, image)
+                 for _, tier_sources in plan for image in images for return_source in tier_sources]
+        all_results = ResultSlots(len(tasks))
+        short_circuit = Event()
+        stopwatch = Stopwatch().start()
+        tiers = []
+        ran = []
+        abandoned = []
+        for tier, tier_sources in plan:
+            if len(tiers) > 0 and not self._escalate(tasks, all_results, ran, abandoned, tier):
+                break
+            indexes = list(range(len(ran), len(ran) + len(images) * len(tier_sources)))
+            abandoned += self._schedule(tasks, all_results, short_circuit,
+                                        indexes=indexes,
+                                        bucket=bucket,
+                                        object_name=object_name,
+                                        min_confidence=min_confidence,
+                                        max_labels=max_labels,
+                                        url_hint=url_hint)
+            tiers.append(tier)
+            ran += indexes
+            if short_circuit.is_set():
+                break
+        if self._cascade is not None:
+            self._cascade.record(plan, tiers, len(images))
+            logger.debug(f'Detected labels with tiers {tiers} of {[tier for tier, _ in plan]} for {url_hint}')
+
+        source_status = self._source_status(tasks, all_results, stopwatch.stop(), abandoned, ran)
+        skipped_sources = self._skipped_sources(source_status, all_results)
+        failed_sources = [return_source for return_source, status in source_status.items()
+                          if status['Status'] not in [SOURCE_STATUS_OK, SOURCE_STATUS_SKIPPED,
+                                                      SOURCE_STATUS_SHORT_CIRCUITED]]
+        short_circuited = short_circuit.is_set()
+        if short_circuited:
+            # errors cannot change the verdict of a decisive label, labels of every finished task are kept
+            logger.info(f'Detected decisive label with {len(abandoned)} tasks left out for {url_hint}')
+            failed_sources = []
+        if len(failed_sources) > 0:
+            if mandatory_return_sources is None or len(failed_sources) == len(source_status) \
+                    or any(return_source in mandatory_return_sources for return_source in failed_sources):
+                raise InvocationException.backend_exceptions(exceptions=[
+                    (return_source, e) for return_source, e in all_results.exceptions()
+                    if return_source not in skipped_sources])
+            logger.warning(f'Detected labels without return sources {failed_sources} for {url_hint}')
+        if len(skipped_sources) > 0:
+            logger.warning(f'Detected labels without return sources {skipped_sources} of open circuits for {url_hint}')
+
+        labels = [label for index in ran
+                  if tasks[index][0] not in failed_sources and tasks[index][0] not in skipped_sources
+                  and index not in abandoned
+                  for label in all_results.labels(index)]
+        results_list = DetectedLabels(self.merge_results(labels, max_labels=max_labels), source_status=source_status,
+                                      short_circuited=short_circuited,
+                                      tiers=tiers if self._cascade is not None else None)
         if len(images) > 0:
             logger.info(
                 'Detected labels with for {} image {}, return source {}, min confidence {}, max labels {}, labels: {}'.format(
@@ -91,9 +248,291 @@ class ModerationHandler(object):
                 .format(bucket, object_name, return_sources, min_confidence, max_labels, results_list))
         return results_list
 
+    def _escalate(self, tasks, all_results: ResultSlots, ran, abandoned, next_tier):
+        """True if the cascade calls the next tier after the tasks which ran"""
+        source_status = self._source_status(tasks, all_results, 0, abandoned, ran)
+        failed_sources = [return_source for return_source, status in source_status.items()
+                          if status['Status'] not in [SOURCE_STATUS_OK, SOURCE_STATUS_SHORT_CIRCUITED]]
+        labels = [label for index in ran if index not in abandoned for label in all_results.labels(index)]
+        return self._cascade.escalate(labels, failed_sources, next_tier)
+
+    def _schedule(self, tasks, all_results: ResultSlots, short_circuit, indexes=None, url_hint='', **kwargs):
+        """
+        Run (return source, image) tasks of the indexes, every task if None, under the in-flight cap and the
+        concurrency budget, on the executor of the return source or on a thread of its own, and write the results of
+        each task into its slot.
+        Return once every task has finished or been cancelled, or once short_circuit is set by a decisive label.
+
+        Returns:
+            indexes of the tasks left out after a decisive label, their slots are not to be read
+        """
+        futures = {}
+        abandoned = []
+        for index in (indexes if indexes is not None else range(len(tasks))):
+            return_source, image = tasks[index]
+            if short_circuit.is_set():
+                abandoned.append(index)
+                all_results.slot(index).add_exception(return_source, self._short_circuited(return_source))
+                continue
+            # the caps are held from the submission, so that tasks waiting for them don't hold pool workers
+            if not self._acquire_caps():
+                all_results.slot(index).add_exception(return_source, self._deadline_exceeded(return_source))
+                continue
+            task_method = getattr(self, 'task_' + self._camel_to_snake(return_source))
+            try:
+                future = self._submit(return_source,
+                                      partial(self._run_task, return_source, task_method, short_circuit),
+                                      all_results=all_results.slot(index),
+                                      image_bytes=image,
+                                      url_hint=url_hint,
+                                      **kwargs)
+            except ExecutorRejectedException as e:
+                self._release_caps()
+                logger.warning(f'Rejected task of {return_source} for {url_hint}: {e.message}')
+                all_results.slot(index).add_exception(return_source,
+                                                      InvocationException(operation_name=return_source,
+                                                                          error_code='ExecutorRejected',
+                                                                          error_message=e.message))
+                continue
+
+            future.add_done_callback(lambda _: self._release_caps())
+            futures[future] = (index, return_source)
+
+        not_done = set(futures)
+        while len(not_done) > 0 and not short_circuit.is_set():
+            done, not_done = wait(not_done, timeout=deadline_timeout(self._deadline), return_when=FIRST_COMPLETED)
+            if len(done) == 0:
+                break
+        for future in not_done:
+            index, return_source = futures[future]
+            if short_circuit.is_set():
+                # tasks may have finished before the decisive label, their slots are complete
+                if future.done():
+                    continue
+                future.cancel()
+                abandoned.append(index)
+                all_results.slot(index).add_exception(return_source, self._short_circuited(return_source))
+                continue
+            future.cancel()
+            logger.warning(f'Abandoned task of {return_source} for {url_hint} after the deadline')
+            all_results.slot(index).add_exception(return_source, self._deadline_exceeded(return_source))
+        return abandoned
+
+    def _run_task(self, return_source, task_method, short_circuit, all_results, **kwargs):
+        stopwatch = Stopwatch().start()
+        try:
+            # tasks queued past the deadline or a decisive label don't call the backends
+            if self._deadline is not None and self._deadline.expired():
+                all_results.add_exception(return_source, self._deadline_exceeded(return_source))
+                return
+            if short_circuit.is_set():
+                all_results.add_exception(return_source, self._short_circuited(return_source))
+                return
+            task_method(all_results=all_results, **kwargs)
+            if self._is_decisive(all_results.labels()):
+                short_circuit.set()
+        finally:
+            all_results.set_latency(stopwatch.stop())
+
+    @classmethod
+    def _source_status(cls, tasks, all_results: ResultSlots, lapsed, abandoned=(), indexes=None):
+        """
+        Status and latency of every return source of the tasks of the indexes, every task if None. The latency of a
+        source is the one of its slowest frame.
+        """
+        source_status = {}
+        for index in (indexes if indexes is not None else range(len(tasks))):
+            return_source = tasks[index][0]
+            status = source_status.setdefault(return_source, {'Status': SOURCE_STATUS_OK, 'LatencyMillis': 0})
+            # tasks which didn't finish took as long as the detection
+            latency = all_results.latency(index)
+            latency = latency if latency is not None else lapsed
+            status['LatencyMillis'] = max(status['LatencyMillis'], int(latency * 1000))
+
+            exception = all_results.exception(index)
+            if index in abandoned:
+                # tasks in flight may still write their slots
+                error_code = 'ShortCircuited'
+            elif exception is None:
+                continue
+            else:
+                error_code = getattr(exception[1], 'error_code', type(exception[1]).__name__)
+            frame_status = cls.status_of(error_code)
+            if _SOURCE_STATUS_SEVERITY.index(frame_status) > _SOURCE_STATUS_SEVERITY.index(status['Status']):
+                status['Status'] = frame_status
+                status['ErrorCode'] = error_code
+        return source_status
+
+    def _skipped_sources(self, source_status, all_results: ResultSlots):
+        """Skippable return sources whose every error is an open circuit, their status is set to Skipped"""
+        skipped_sources = []
+        for return_source in self._skippable_return_sources:
+            error_codes = [getattr(e, 'error_code', None) for source, e in all_results.exceptions()
+                           if source == return_source]
+            if len(error_codes) > 0 and all(error_code == 'CircuitOpen' for error_code in error_codes):
+                source_status[return_source]['Status'] = SOURCE_STATUS_SKIPPED
+                source_status[return_source]['ErrorCode'] = 'CircuitOpen'
+                skipped_sources.append(return_source)
+        return skipped_sources
+
+    @staticmethod
+    def status_of(error_code):
+        """Status of a return source failing with error_code"""
+        if error_code == 'ShortCircuited':
+            return SOURCE_STATUS_SHORT_CIRCUITED
+        if error_code in _THROTTLED_ERROR_CODES:
+            return SOURCE_STATUS_THROTTLED
+        if error_code in _TIMEOUT_ERROR_CODES:
+            return SOURCE_STATUS_TIMEOUT
+        return SOURCE_STATUS_ERROR
+
+    def _invoke(self, return_source, backend_call):
+        """
+        Call the backend of the return source, each retried call may be hedged, and each of its hedged calls is
+        counted in the quota of the tenant, waits for its share and its lane, and is limited
+        """
+        limiter = self._concurrency_limiters.get(return_source) if self._concurrency_limiters is not None else None
+        if limiter is not None:
+            backend_call = partial(self._call_limited, return_source, limiter, backend_call)
+        scheduler = self._lane_schedulers.get(return_source) if self._lane_schedulers is not None else None
+        if scheduler is not None:
+            backend_call = partial(self._call_in_lane, return_source, scheduler, backend_call)
+        fair_share = self._fair_share_schedulers.get(return_source) if self._fair_share_schedulers is not None else None
+        if fair_share is not None:
+            backend_call = partial(self._call_fair_share, return_source, fair_share, backend_call)
+        if self._tenant_quota is not None:
+            backend_call = partial(self._call_in_quota, return_source, backend_call)
+        hedger = self._hedgers.get(return_source) if self._hedgers is not None else None
+        if hedger is not None:
+            # a hedged duplicate takes slots and quota of its own, like any call to the backend
+            backend_call = partial(self._call_hedged, return_source, hedger, backend_call)
+        if self._retry_policy is not None:
+            return self._retry_policy.call(backend_call, deadline=self._deadline, name=return_source)
+        return backend_call()
+
+    def _call_hedged(self, return_source, hedger, backend_call):
+        try:
+            return hedger.call(backend_call, deadline=self._deadline)
+        except DeadlineExceededException:
+            raise self._deadline_exceeded(return_source)
+
+    def _call_limited(self, return_source, limiter, backend_call):
+        if not limiter.acquire(timeout=deadline_timeout(self._deadline)):
+            raise InvocationException(operation_name=return_source,
+                                      error_code='ConcurrencyLimited',
+                                      error_message=f'Concurrency limit {limiter.limit} of {return_source} reached')
+
+        # only the backend round trips tell its latency, not the cache hits and rate limiter waits of the client
+        timer = RoundTripTimer()
+        try:
+            with timer:
+                labels = backend_call()
+        except InvocationException as e:
+            # throttles and timeouts are signs of overload, other errors don't tell about capacity
+            dropped = self.status_of(e.error_code) in [SOURCE_STATUS_THROTTLED, SOURCE_STATUS_TIMEOUT] \
+                and e.error_code not in _LOCAL_ERROR_CODES
+            limiter.release(latency=None, dropped=dropped)
+            raise
+        except BaseException:
+            limiter.release()
+            raise
+        limiter.release(latency=timer.seconds)
+        return labels
+
+    def _call_in_lane(self, return_source, scheduler, backend_call):
+        started_at = scheduler.acquire(self._lane, timeout=deadline_timeout(self._deadline))
+        if started_at is None:
+            raise InvocationException(operation_name=return_source,
+                                      error_code='LaneRejected',
+                                      error_message=f'No slot of {return_source} for {self._lane} calls')
+        try:
+            return backend_call()
+        finally:
+            scheduler.release(self._lane, started_at)
+
+    def _call_fair_share(self, return_source, scheduler, backend_call):
+        started_at = scheduler.acquire(self._tenant, timeout=deadline_timeout(self._deadline))
+        if started_at is None:
+            raise InvocationException(operation_name=return_source,
+                                      error_code='FairShareRejected',
+                                      error_message=f'No slot of {return_source} for tenant {self._tenant}')
+        try:
+            return backend_call()
+        finally:
+            scheduler.release(self._tenant, started_at)
+
+    def _call_in_quota(self, return_source, backend_call):
+        if not self._tenant_quota.acquire(timeout=deadline_timeout(self._deadline)):
+            raise InvocationException(operation_name=return_source,
+                                      error_code='TenantThrottled',
+                                      error_message=f'Quota of tenant {self._tenant} exceeded')
+        return backend_call()
+
+    def _deadline_kwargs(self):
+        """Deadline argument of the backend clients, left out without a deadline"""
+        return {'deadline': self._deadline} if self._deadline is not None else {}
+
+    def _is_decisive(self, labels):
+        """True if one of the labels reaches the min confidence of a decisive label"""
+        return self._decisive_labels is not None and any(
+            label['Label'] in self._decisive_labels and label['Confidence'] >= self._decisive_labels[label['Label']]
+            for label in labels)
+
+    def _short_circuited(self, return_source):
+        return InvocationException(operation_name=return_source,
+                                   error_code='ShortCircuited',
+                                   error_message=f'Task of {return_source} left out after a decisive label')
+
+    def _deadline_exceeded(self, return_source):
+        return InvocationException(operation_name=return_source,
+                                   error_code='DeadlineExceeded',
+                                   error_message=f'Deadline of {self._deadline.timeout_seconds} seconds exceeded')
+
+    def _submit(self, return_source, task_method, **kwargs):
+        executor = self._executors.get(return_source) if self._executors is not None else None
+        if executor is not None:
+            return executor.submit(task_method, **kwargs)
+
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(task_method(**kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        Thread(target=run).start()
+        return future
+
+    def _acquire_caps(self):
+        """Return False if the caps cannot be acquired before the deadline"""
+        if self._deadline is None:
+            if self._concurrency_budget is not None:
+                self._concurrency_budget.acquire()
+            if self._max_in_flight is not None:
+                self._max_in_flight.acquire()
+            return True
+
+        if self._deadline.expired():
+            return False
+        if self._concurrency_budget is not None and not self._concurrency_budget.acquire(
+                timeout=self._deadline.remaining()):
+            return False
+        if self._max_in_flight is not None and not self._max_in_flight.acquire(timeout=self._deadline.remaining()):
+            if self._concurrency_budget is not None:
+                self._concurrency_budget.release()
+            return False
+        return True
+
+    def _release_caps(self):
+        if self._max_in_flight is not None:
+            self._max_in_flight.release()
+        if self._concurrency_budget is not None:
+            self._concurrency_budget.release()
+
     def task_detect_labels(self,
-                           start_signal,
-                           done_signal,
                            all_results: ThreadSafeList,
                            image_bytes,
                            bucket=None,
@@ -101,17 +540,17 @@ class ModerationHandler(object):
                            min_confidence=60,
                            max_labels=5,
                            url_hint=''):
-        # wait for start signal
-        start_signal.wait()
         stopwatch = Stopwatch().start()
         labels = []
         has_error = False
         try:
-            labels = self._rek_client.detect_labels(image_bytes=image_bytes,
-                                                    bucket=bucket,
-                                                    object_name=object_name,
-                                                    min_confidence=min_confidence,
-                                                    max_labels=max_labels)
+            labels = self._invoke('DetectLabels',
+                                  lambda: self._rek_client.detect_labels(image_bytes=image_bytes,
+                                                                         bucket=bucket,
+                                                                         object_name=object_name,
+                                                                         min_confidence=min_confidence,
+                                                                         max_labels=max_labels,
+                                                                         **self._deadline_kwargs()))
         except InvocationException as e:
             lapsed = stopwatch.stop()
             all_results.add_exception('DetectLabels', e)
@@ -127,8 +566,6 @@ class ModerationHandler(object):
                     e
                 ))
         finally:
-            # finish this task
-            done_signal.count_down()
             all_results.extend(labels)
             if not has_error:
                 lapsed = stopwatch.stop()
@@ -144,8 +581,6 @@ class ModerationHandler(object):
                     ))
 
     def task_detect_moderation_labels(self,
-                                      start_signal,
-                                      done_signal,
                                       all_results: ThreadSafeList,
                                       image_bytes,
                                       bucket=None,
@@ -153,17 +588,17 @@ class ModerationHandler(object):
                                       min_confidence=60,
                                       max_labels=5,
                                       url_hint=''):
-        # wait for start signal
-        start_signal.wait()
         stopwatch = Stopwatch().start()
         labels = []
         has_error = False
         try:
-            labels = self._rek_client.detect_moderation_labels(image_bytes=image_bytes,
-                                                               bucket=bucket,
-                                                               object_name=object_name,
-                                                               min_confidence=min_confidence,
-                                                               max_labels=max_labels)
+            labels = self._invoke('DetectModerationLabels',
+                                  lambda: self._rek_client.detect_moderation_labels(image_bytes=image_bytes,
+                                                                                    bucket=bucket,
+                                                                                    object_name=object_name,
+                                                                                    min_confidence=min_confidence,
+                                                                                    max_labels=max_labels,
+                                                                                    **self._deadline_kwargs()))
 
         except InvocationException as e:
             lapsed = stopwatch.stop()
@@ -180,8 +615,6 @@ class ModerationHandler(object):
                     e
                 ))
         finally:
-            # finish this task
-            done_signal.count_down()
             all_results.extend(labels)
             if not has_error:
                 lapsed = stopwatch.stop()
@@ -197,8 +630,6 @@ class ModerationHandler(object):
                     ))
 
     def task_face_search(self,
-                         start_signal,
-                         done_signal,
                          all_results: ThreadSafeList,
                          image_bytes,
                          bucket=None,
@@ -206,17 +637,17 @@ class ModerationHandler(object):
                          min_confidence=60,
                          max_labels=5,
                          url_hint=''):
-        # wait for start signal
-        start_signal.wait()
         stopwatch = Stopwatch().start()
         labels = []
         has_error = False
         try:
-            labels = self._rek_client.search_faces_by_image(image_bytes=image_bytes,
-                                                            bucket=bucket,
-                                                            object_name=object_name,
-                                                            face_match_threshold=min_confidence,
-                                                            max_faces=max_labels)
+            labels = self._invoke('FaceSearch',
+                                  lambda: self._rek_client.search_faces_by_image(image_bytes=image_bytes,
+                                                                                 bucket=bucket,
+                                                                                 object_name=object_name,
+                                                                                 face_match_threshold=min_confidence,
+                                                                                 max_faces=max_labels,
+                                                                                 **self._deadline_kwargs()))
 
         except InvocationException as e:
             all_results.add_exception('FaceSearch', e)
@@ -235,8 +666,6 @@ class ModerationHandler(object):
                 ))
 
         finally:
-            # finish this task
-            done_signal.count_down()
             all_results.extend(labels)
             if not has_error:
                 lapsed = stopwatch.stop()
@@ -253,8 +682,6 @@ class ModerationHandler(object):
                     ))
 
     def task_celebrity_search(self,
-                              start_signal,
-                              done_signal,
                               all_results: ThreadSafeList,
                               image_bytes,
                               bucket=None,
@@ -262,17 +689,17 @@ class ModerationHandler(object):
                               min_confidence=60,
                               max_labels=5,
                               url_hint=''):
-        # wait for start signal
-        start_signal.wait()
         stopwatch = Stopwatch().start()
         labels = []
         has_error = False
         try:
-            labels = self._rek_client.search_celebrities_by_image(image_bytes=image_bytes,
-                                                                  bucket=bucket,
-                                                                  object_name=object_name,
-                                                                  face_match_threshold=min_confidence,
-                                                                  max_faces=max_labels)
+            labels = self._invoke('CelebritySearch',
+                                  lambda: self._rek_client.search_celebrities_by_image(image_bytes=image_bytes,
+                                                                                       bucket=bucket,
+                                                                                       object_name=object_name,
+                                                                                       face_match_threshold=min_confidence,
+                                                                                       max_faces=max_labels,
+                                                                                       **self._deadline_kwargs()))
         except InvocationException as e:
             all_results.add_exception('CelebritySearch', e)
             has_error = True
@@ -289,9 +716,6 @@ class ModerationHandler(object):
                     e
                 ))
         finally:
-            # finish this task
-            done_signal.count_down()
-
             all_results.extend(labels)
             if not has_error:
                 lapsed = stopwatch.stop()
@@ -308,8 +732,6 @@ class ModerationHandler(object):
                     ))
 
     def task_detect_by_custom_models(self,
-                                     start_signal,
-                                     done_signal,
                                      all_results: ThreadSafeList,
                                      image_bytes,
                                      bucket=None,
@@ -317,14 +739,14 @@ class ModerationHandler(object):
                                      min_confidence=60,
                                      max_labels=5,
                                      url_hint=''):
-        # wait for start signal
-        start_signal.wait()
         stopwatch = Stopwatch().start()
         labels = []
         has_error = False
         try:
-            labels = self._sagemaker_client.detect_labels(image_bytes=image_bytes,
-                                                          min_confidence=min_confidence)
+            labels = self._invoke('DetectByCustomModels',
+                                  lambda: self._sagemaker_client.detect_labels(image_bytes=image_bytes,
+                                                                               min_confidence=min_confidence,
+                                                                               **self._deadline_kwargs()))
 
         except InvocationException as e:
             all_results.add_exception('DetectByCustomModels', e)
@@ -342,9 +764,6 @@ class ModerationHandler(object):
                     e
                 ))
         finally:
-            # finish this task
-            done_signal.count_down()
-
             all_results.extend(labels)
             if not has_error:
                 lapsed = stopwatch.stop()
@@ -360,6 +779,11 @@ class ModerationHandler(object):
                         labels
                     ))
 
+    @staticmethod
+    def effective_return_sources(return_sources=None):
+        """Return sources used for detection when the client doesn't specify them"""
+        return return_sources if return_sources is not None else _RETURN_RESOURCES
+
     @staticmethod
     def merge_results(src_labels: list, max_labels: int = 5):
         # merge labels with max value of label key
@@ -0,0 +1,133 @@
+import io
+import math
+from itertools import combinations
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+from PIL import Image
+
+
+def dhash(image_bytes, hash_size=8):
+    """
+    Difference hash of an image, compare brightness of adjacent pixels on a small grayscale thumbnail.
+    Resized, re-encoded or metadata stripped copies of an image have the same or a close hash.
+
+    Returns:
+        int of hash_size * hash_size bits
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        thumbnail = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = np.asarray(thumbnail, dtype=np.int16)
+
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class MultiIndexHashIndex(object):
+    """
+    Index of perceptual hashes for hamming distance search, bounded by size with first in first out eviction.
+
+    Hashes are split into m blocks and every block is indexed by an exact-match dict. Two hashes within
+    max_distance bits must have one block within max_distance // m bits, so a search only probes the block
+    values within that radius and checks the hashes found, instead of all the entries. Blocks are as wide as
+    log2(max_size) bits by default so that a probe finds about one hash.
+    """
+
+    def __init__(self, max_distance=4, bits=64, max_size=100000, blocks=None):
+        self._max_distance = max_distance
+        self._bits = bits
+        self._max_size = max_size
+        if blocks is None:
+            blocks = max(1, min(max_distance + 1, bits // max(1, math.ceil(math.log2(max(max_size, 2))))))
+        block_size = bits // blocks
+        radius = max_distance // blocks
+        # (shift, mask, probe masks) of each block, the last one takes the remaining bits
+        self._blocks = []
+        for index in range(blocks):
+            width = block_size if index < blocks - 1 else bits - block_size * (blocks - 1)
+            self._blocks.append((index * block_size, (1 << width) - 1, self._probe_masks(width, radius)))
+        self._block_tables = [dict() for _ in range(blocks)]
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._searches = 0
+        self._matches = 0
+
+    @staticmethod
+    def _probe_masks(width, radius):
+        masks = []
+        for distance in range(radius + 1):
+            for bits in combinations(range(width), distance):
+                masks.append(sum(1 << bit for bit in bits))
+        return masks
+
+    def put(self, hash_value, value):
+        with self._lock:
+            if hash_value not in self._entries:
+                for table, block in zip(self._block_tables, self._block_values(hash_value)):
+                    table.setdefault(block, set()).add(hash_value)
+            self._entries[hash_value] = value
+            while len(self._entries) > self._max_size:
+                self._remove(next(iter(self._entries)))
+
+    def get(self, hash_value):
+        """Value of the exact hash"""
+        with self._lock:
+            return self._entries.get(hash_value)
+
+    def search(self, hash_value, max_distance=None):
+        """
+        Return (distance, hash, value) of the nearest indexed hash within max_distance, None if there's none.
+        max_distance cannot be larger than the one of the index.
+        """
+        max_distance = self._max_distance if max_distance is None else min(max_distance, self._max_distance)
+        nearest = None
+        with self._lock:
+            self._searches += 1
+            if hash_value in self._entries:
+                self._matches += 1
+                return 0, hash_value, self._entries[hash_value]
+
+            checked = set()
+            for table, (shift, mask, probe_masks) in zip(self._block_tables, self._blocks):
+                block = (hash_value >> shift) & mask
+                for probe_mask in probe_masks:
+                    for candidate in table.get(block ^ probe_mask, ()):
+                        if candidate in checked:
+                            continue
+                        checked.add(candidate)
+                        distance = hamming_distance(hash_value, candidate)
+                        if distance <= max_distance and (nearest is None or distance < nearest[0]):
+                            nearest = (distance, candidate, self._entries[candidate])
+            if nearest is not None:
+                self._matches += 1
+        return nearest
+
+    def stats(self):
+        with self._lock:
+            return {
+                'Size': len(self._entries),
+                'MaxSize': self._max_size,
+                'MaxDistance': self._max_distance,
+                'Searches': self._searches,
+                'Matches': self._matches,
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _block_values(self, hash_value):
+        return [(hash_value >> shift) & mask for shift, mask, _ in self._blocks]
+
+    def _remove(self, hash_value):
+        del self._entries[hash_value]
+        for table, block in zip(self._block_tables, self._block_values(hash_value)):
+            hashes = table[block]
+            hashes.discard(hash_value)
+            if len(hashes) == 0:
+                del table[block]
@@ -0,0 +1,210 @@
+import logging
+from threading import Lock, Thread
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+from .concurrentutils import Stopwatch, deadline_timeout
+from .exception import DeadlineExceededException
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class Stage(object):
+    """
+    A step of a pipeline, fn is called with the values of inputs as keyword arguments and returns the value of its
+    output, or a tuple of the values of its outputs if it has several, a ValueError is raised if their number
+    differs from the outputs. A stage on the calling thread is run by the
+    thread calling run instead of the executor, e.g. a stage fanning out to executors of its own.
+    """
+
+    def __init__(self, name, fn, inputs=(), outputs=None, calling_thread=False):
+        self._name = name
+        self._fn = fn
+        self._inputs = tuple(inputs)
+        self._outputs = tuple(outputs) if outputs is not None else (name,)
+        self._calling_thread = calling_thread
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def inputs(self):
+        return self._inputs
+
+    @property
+    def outputs(self):
+        return self._outputs
+
+    @property
+    def calling_thread(self):
+        return self._calling_thread
+
+    def run(self, values):
+        result = self._fn(**{name: values[name] for name in self._inputs})
+        if len(self._outputs) == 1:
+            return {self._outputs[0]: result}
+        # missing values would leave the stages depending on them waiting forever
+        if not isinstance(result, (tuple, list)) or len(result) != len(self._outputs):
+            raise ValueError(f'Stage {self._name} returned {len(result) if isinstance(result, (tuple, list)) else 1} '
+                             f'values for outputs {list(self._outputs)}')
+        return dict(zip(self._outputs, result))
+
+
+class PipelineRun(object):
+    """Values produced by a run of a pipeline and the lapsed seconds of its stages"""
+
+    def __init__(self, values, timings):
+        self._values = values
+        self._timings = timings
+
+    @property
+    def values(self):
+        return self._values
+
+    @property
+    def timings(self):
+        return self._timings
+
+
+class Pipeline(object):
+    """
+    DAG of stages, a stage runs as soon as the values of its inputs are ready. Values which no stage produces are
+    the inputs of a run. Stages run on the executor, or on threads of their own without an executor; a stage which
+    is the only one to run, or a stage on the calling thread, is run on the calling thread once the other ready
+    stages are submitted.
+
+    The first error of a stage is raised by run, stages not started yet are skipped. With a deadline, run raises
+    DeadlineExceededException once it has passed, without waiting for the stages in flight. The deadline is the
+    input named deadline of the stages, so that they can bound their own blocking calls.
+    """
+
+    def __init__(self, stages, executor=None):
+        self._stages = list(stages)
+        self._executor = executor
+        self._lock = Lock()
+        self._stats = {stage.name: {'Count': 0, 'Errors': 0, 'TotalMillis': 0.0, 'MaxMillis': 0.0}
+                       for stage in self._stages}
+
+        producers = {}
+        for stage in self._stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f'{output} is produced by both {producers[output]} and {stage.name}')
+                producers[output] = stage.name
+        self._inputs = set(name for stage in self._stages for name in stage.inputs if name not in producers)
+        self._check_acyclic(producers)
+
+    @property
+    def stages(self):
+        return list(self._stages)
+
+    @property
+    def inputs(self):
+        return set(self._inputs)
+
+    def with_stage(self, stage):
+        """Return a pipeline with the stage added, on the same executor"""
+        return Pipeline(self._stages + [stage], executor=self._executor)
+
+    def run(self, deadline=None, **inputs):
+        missing = self._inputs - set(inputs) - {'deadline'}
+        if len(missing) > 0:
+            raise ValueError(f'Missing inputs {sorted(missing)}')
+
+        values = dict(inputs, deadline=deadline)
+        timings = {}
+        pending = list(self._stages)
+        futures = {}
+        while len(pending) > 0 or len(futures) > 0:
+            ready = [stage for stage in pending if all(name in values for name in stage.inputs)]
+            for stage in ready:
+                pending.remove(stage)
+                if deadline is not None:
+                    deadline.check(stage.name)
+            if len(ready) == 1 and len(futures) == 0:
+                values.update(self._run_stage(ready[0], values, timings))
+                continue
+
+            for stage in ready:
+                if not stage.calling_thread:
+                    futures[self._submit(stage, dict(values), timings)] = stage
+            for stage in ready:
+                if stage.calling_thread:
+                    values.update(self._run_stage(stage, values, timings))
+            if len(futures) == 0:
+                continue
+
+            done, _ = wait(list(futures), timeout=deadline_timeout(deadline), return_when=FIRST_COMPLETED)
+            if len(done) == 0:
+                raise DeadlineExceededException(', '.join(stage.name for stage in futures.values()),
+                                                deadline.timeout_seconds)
+            for future in done:
+                del futures[future]
+                # stages in flight are left running, their values are dropped
+                values.update(future.result())
+
+        return PipelineRun(values, timings)
+
+    def stats(self):
+        with self._lock:
+            return {name: {'Count': stats['Count'],
+                           'Errors': stats['Errors'],
+                           'AvgMillis': stats['TotalMillis'] / stats['Count'] if stats['Count'] > 0 else 0.0,
+                           'MaxMillis': stats['MaxMillis']}
+                    for name, stats in self._stats.items()}
+
+    def _submit(self, stage, values, timings):
+        if self._executor is not None:
+            return self._executor.submit(self._run_stage, stage, values, timings)
+
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(self._run_stage(stage, values, timings))
+            except BaseException as e:
+                future.set_exception(e)
+
+        Thread(target=run).start()
+        return future
+
+    def _run_stage(self, stage, values, timings):
+        stopwatch = Stopwatch().start()
+        failed = True
+        try:
+            outputs = stage.run(values)
+            failed = False
+            return outputs
+        finally:
+            lapsed = stopwatch.stop()
+            timings[stage.name] = lapsed
+            logger.debug('Stage %s lapsed %.3f%s' % (stage.name, lapsed, ' with error' if failed else ''))
+            with self._lock:
+                stats = self._stats[stage.name]
+                stats['Count'] += 1
+                stats['Errors'] += 1 if failed else 0
+                stats['TotalMillis'] += lapsed * 1000
+                stats['MaxMillis'] = max(stats['MaxMillis'], lapsed * 1000)
+
+    def _check_acyclic(self, producers):
+        visiting = set()
+        visited = set()
+        stages = {stage.name: stage for stage in self._stages}
+
+        def visit(stage):
+            if stage.name in visited:
+                return
+            if stage.name in visiting:
+                raise ValueError(f'Stage {stage.name} depends on itself')
+            visiting.add(stage.name)
+            for name in stage.inputs:
+                if name in producers:
+                    visit(stages[producers[name]])
+            visiting.remove(stage.name)
+            visited.add(stage.name)
+
+        for stage in self._stages:
+            visit(stage)
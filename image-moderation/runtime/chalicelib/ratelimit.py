@@ -0,0 +1,232 @@
+import time
+import logging
+from threading import Lock
+
+from .exception import InvocationException
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# attempts of a conditional write of the shared bucket before falling back to the local one
+_SHARED_UPDATE_MAX_ATTEMPTS = 3
+
+
+def reserve(tokens, updated_at, now, rate, burst, count, max_wait_seconds):
+    """
+    Reserve count tokens of a token bucket refilled at rate tokens per second up to burst. Tokens go negative when
+    reserved ahead of the refill, so that callers queue in order.
+
+    Returns:
+        (tokens left, seconds to wait before calling) or None if the wait is longer than max_wait_seconds
+    """
+    tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+    left = tokens - count
+    wait = max(0.0, -left / rate)
+    if wait > max_wait_seconds:
+        return None
+    return left, wait
+
+
+def parse_limits(limits, setting):
+    """
+    Parse limits formatted as name:rate:burst, the name may contain colons.
+
+    Returns:
+        list of (name, rate, burst)
+    Raises:
+        ValueError if a limit is malformed, its rate is not positive or its burst is less than one token
+    """
+    parsed = []
+    for limit in limits:
+        try:
+            name, rate, burst = limit.rsplit(':', 2)
+            rate, burst = float(rate), float(burst)
+        except ValueError:
+            raise ValueError(f'Limit in {setting} must be name:rate:burst: {limit}')
+        # a bucket without refill divides by zero, one holding less than a token never has one to give
+        if not rate > 0 or not burst >= 1:
+            raise ValueError(f'Limit in {setting} must have a positive rate and a burst of at least 1: {limit}')
+        parsed.append((name, rate, burst))
+    return parsed
+
+
+class RateLimiter(object):
+    """
+    Token bucket of the calls of a backend operation in the container, a call waits for its token up to
+    max_wait_seconds or the timeout of acquire and is rejected if it would wait longer.
+    """
+
+    def __init__(self, name, rate, burst, max_wait_seconds=1.0, clock=time.monotonic, sleep=time.sleep):
+        if not rate > 0:
+            raise ValueError(f'Rate of {name} must be positive: {rate}')
+        if not burst >= 1:
+            raise ValueError(f'Burst of {name} must be at least 1: {burst}')
+        self._name = name
+        self._rate = rate
+        self._burst = burst
+        self._max_wait_seconds = max_wait_seconds
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = Lock()
+        self._tokens = float(burst)
+        self._updated_at = clock()
+        self._acquired = 0
+        self._delayed = 0
+        self._rejected = 0
+        self._wait_seconds = 0.0
+
+    @property
+    def name(self):
+        return self._name
+
+    def acquire(self, timeout=None):
+        """Return True once the call can be made, False if it cannot be made within the timeout"""
+        max_wait_seconds = self._max_wait_seconds if timeout is None else min(self._max_wait_seconds, timeout)
+        wait = self._reserve(max(0.0, max_wait_seconds))
+        with self._lock:
+            if wait is None:
+                self._rejected += 1
+                return False
+            self._acquired += 1
+            self._delayed += 1 if wait > 0 else 0
+            self._wait_seconds += wait
+
+        if wait > 0:
+            self._sleep(wait)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'Acquired': self._acquired,
+                'Delayed': self._delayed,
+                'Rejected': self._rejected,
+                'AvgWaitMillis': self._wait_seconds * 1000 / self._acquired if self._acquired > 0 else 0.0,
+            }
+
+    def _reserve(self, max_wait_seconds):
+        """Return seconds to wait for a token, None if it is longer than max_wait_seconds"""
+        with self._lock:
+            now = self._clock()
+            reserved = reserve(self._tokens, self._updated_at, now, self._rate, self._burst, 1, max_wait_seconds)
+            if reserved is None:
+                return None
+            self._tokens, wait = reserved
+            self._updated_at = now
+            return wait
+
+
+class DynamoDBRateLimiter(RateLimiter):
+    """
+    Token bucket shared by all the containers in an Amazon DynamoDB table with Name as the partition key. Containers
+    lease lease_size tokens at a time with conditional writes, so that the table is not written once per call.
+    Leased tokens are handed out no earlier than the lease was reserved for, those not spent in lease_seconds after
+    that are dropped, and a new lease replaces the tokens left of the previous one. The table is read and written
+    without holding the lease lock. The container falls back to a local bucket of the same rate if the table cannot
+    be updated.
+    """
+
+    def __init__(self, name, rate, burst, dynamodb_client=None, table_name='', lease_size=5, lease_seconds=1.0,
+                 max_wait_seconds=1.0, wall_clock=time.time, **kwargs):
+        super(DynamoDBRateLimiter, self).__init__(name, rate, burst, max_wait_seconds=max_wait_seconds, **kwargs)
+        self._dynamodb_client = dynamodb_client
+        self._table_name = table_name
+        self._lease_size = max(1, min(lease_size, int(burst)))
+        self._lease_seconds = lease_seconds
+        self._wall_clock = wall_clock
+        self._leased = 0
+        self._leased_from = 0.0
+        self._leased_until = 0.0
+        self._lease_lock = Lock()
+
+    def _reserve(self, max_wait_seconds):
+        wait = self._reserve_leased(max_wait_seconds)
+        if wait is not None:
+            return wait
+
+        try:
+            for count in sorted({self._lease_size, 1}, reverse=True):
+                wait = self._reserve_shared(count, max_wait_seconds)
+                if wait is not None:
+                    self._lease(count - 1, wait)
+                    return wait
+            return None
+        except InvocationException as e:
+            logger.warning('Rate limit {} falls back to the container: {}'.format(self._name, e))
+            return super(DynamoDBRateLimiter, self)._reserve(max_wait_seconds)
+
+    def _reserve_leased(self, max_wait_seconds):
+        """Return seconds to wait for a leased token, None if there's none to be had within max_wait_seconds"""
+        with self._lease_lock:
+            now = self._clock()
+            if self._leased == 0 or now >= self._leased_until:
+                return None
+            # the tokens of the lease were reserved ahead of the refill for the wait of the lease
+            wait = max(0.0, self._leased_from - now)
+            if wait > max_wait_seconds:
+                return None
+            self._leased -= 1
+            return wait
+
+    def _lease(self, count, wait):
+        with self._lease_lock:
+            self._leased = count
+            self._leased_from = self._clock() + wait
+            self._leased_until = self._leased_from + self._lease_seconds
+
+    def _reserve_shared(self, count, max_wait_seconds):
+        for _ in range(_SHARED_UPDATE_MAX_ATTEMPTS):
+            try:
+                item = self._dynamodb_client.get_item(TableName=self._table_name,
+                                                      Key={'Name': {'S': self._name}},
+                                                      ConsistentRead=True).get('Item')
+            except Exception as e:
+                raise InvocationException.from_client_exception(client_exception=e, operation_name='GetItem')
+
+            now = self._wall_clock()
+            if item is None:
+                tokens, updated_at = float(self._burst), now
+                condition = {'ConditionExpression': 'attribute_not_exists(#n)',
+                             'ExpressionAttributeNames': {'#n': 'Name'}}
+            else:
+                tokens, updated_at = float(item['Tokens']['N']), float(item['UpdatedAt']['N'])
+                condition = {'ConditionExpression': 'UpdatedAt = :previous',
+                             'ExpressionAttributeValues': {':previous': item['UpdatedAt']}}
+            reserved = reserve(tokens, updated_at, now, self._rate, self._burst, count, max_wait_seconds)
+            if reserved is None:
+                return None
+
+            try:
+                self._dynamodb_client.put_item(TableName=self._table_name,
+                                               Item={'Name': {'S': self._name},
+                                                     'Tokens': {'N': repr(reserved[0])},
+                                                     'UpdatedAt': {'N': repr(now)}},
+                                               **condition)
+                return reserved[1]
+            except Exception as e:
+                if not _is_conditional_check_failed(e):
+                    raise InvocationException.from_client_exception(client_exception=e, operation_name='PutItem')
+                # another container updated the bucket in between, read it again
+
+        raise InvocationException(operation_name='PutItem', error_code='ConditionalCheckFailedException',
+                                  error_message=f'Bucket {self._name} is contended')
+
+
+def _is_conditional_check_failed(e):
+    response = getattr(e, 'response', None)
+    return response is not None and response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+def acquire(rate_limiters, operation_name, deadline=None):
+    """
+    Wait for the rate limiter of the operation if there's one, raise InvocationException RateLimited if the call
+    cannot be made before the deadline or the max wait of the limiter.
+    """
+    rate_limiter = rate_limiters.get(operation_name) if rate_limiters is not None else None
+    if rate_limiter is None:
+        return
+    timeout = deadline.remaining() if deadline is not None else None
+    if not rate_limiter.acquire(timeout=timeout):
+        raise InvocationException(operation_name=operation_name,
+                                  error_code='RateLimited',
+                                  error_message=f'Rate limit of {operation_name} exceeded')
@@ -2,6 +2,9 @@ import logging
 import base64
 
 from .exception import InvocationException
+from .cache import backend_response_cache_key
+from .concurrentutils import round_trip
+from . import ratelimit, circuitbreaker
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -20,10 +23,22 @@ class RekognitonClient(object):
                  enable_moderation_filter=True,
                  label_inclusion_filters=[],
                  moderation_label_inclusion_filters=[],
-                 collection_id='face_collection_id'):
+                 collection_id='face_collection_id',
+                 response_cache=None,
+                 cached_min_confidence=50,
+                 cached_max_labels=100,
+                 rate_limiters=None,
+                 circuit_breakers=None):
         """
         Args:
             :boto3_client: A Boto3 Rekognition client.
+            :response_cache: optional cache of raw responses by image bytes. Labels are detected with
+                cached_min_confidence and cached_max_labels once and filtered for each call, calls asking for
+                lower confidence or more labels bypass the cache.
+            :rate_limiters: optional dict of RateLimiter by operation name (DetectLabels, DetectModerationLabels,
+                SearchFacesByImage, RecognizeCelebrities), calls wait for their limiter within the deadline
+            :circuit_breakers: optional dict of CircuitBreaker by operation name, calls of an open circuit fail
+                with CircuitOpen
         """
         self._boto3_client = boto3_client
         self._customer_facial_threshold = customer_facial_threshold
@@ -32,6 +47,11 @@ class RekognitonClient(object):
         self._collection_id = collection_id
         self._label_inclusion_filters = label_inclusion_filters
         self._moderation_label_inclusion_filters = moderation_label_inclusion_filters
+        self._response_cache = response_cache
+        self._cached_min_confidence = cached_min_confidence
+        self._cached_max_labels = cached_max_labels
+        self._rate_limiters = rate_limiters
+        self._circuit_breakers = circuit_breakers
 
     @staticmethod
     def _get_json_value_with_default(json_data, key, default):
@@ -63,6 +83,33 @@ class RekognitonClient(object):
         byte_data = image_bytes if image_bytes is not None else bytearray()
         return base64.b64encode(byte_data)[0:100]
 
+    @staticmethod
+    def _filter_labels(labels, min_confidence, max_labels):
+        filtered_labels = [label for label in labels if label['Confidence'] >= min_confidence]
+        return sorted(filtered_labels, key=lambda item: item['Confidence'], reverse=True)[0:max_labels]
+
+    def _invoke_with_cache(self, operation_name, image_bytes, min_confidence, max_labels, invoke):
+        """
+        Invoke the backend with invoke(min_confidence, max_labels), or reuse the raw response of the same image bytes.
+
+        Returns:
+            (response, cached) the response is detected with the cache floor and needs to be filtered if cached
+        """
+        if self._response_cache is None or image_bytes is None \
+                or min_confidence < self._cached_min_confidence or max_labels > self._cached_max_labels:
+            return invoke(min_confidence, max_labels), False
+
+        key = backend_response_cache_key(operation_name, image_bytes)
+        response = self._response_cache.get(key)
+        if response is None:
+            response = invoke(self._cached_min_confidence, self._cached_max_labels)
+            # request id of the backend call is not shared
+            self._response_cache.put(key, {name: value for name, value in response.items()
+                                           if name != 'ResponseMetadata'})
+        else:
+            logger.debug('Reuse cached response of {} for key {}'.format(operation_name, key))
+        return response, True
+
     @property
     def label_inclusion_filters(self):
         return self._label_inclusion_filters
@@ -71,7 +118,50 @@ class RekognitonClient(object):
     def moderation_label_inclusion_filters(self):
         return self._moderation_label_inclusion_filters
 
-    def detect_labels(self, image_bytes, bucket=None, object_name=None, min_confidence=60, max_labels=5):
+    @staticmethod
+    def _image(image_bytes, bucket, object_name):
+        if image_bytes is not None:
+            return {
+                'Bytes': image_bytes,
+            }
+
+        return {
+            'S3Object': {
+                'Bucket': bucket,
+                'Name': object_name
+            },
+        }
+
+    def _detect_labels_request(self, image_bytes, bucket, object_name, min_confidence, max_labels):
+        return {
+            'Image': self._image(image_bytes, bucket, object_name),
+            'MaxLabels': max_labels,
+            'MinConfidence': min_confidence,
+            'Settings': {
+                'GeneralLabels': {
+                    "LabelInclusionFilters": self._label_inclusion_filters
+                },
+            }
+        }
+
+    def _invoke_detect_labels(self, image_bytes, bucket, object_name, min_confidence, max_labels, deadline=None):
+        ratelimit.acquire(self._rate_limiters, 'DetectLabels', deadline)
+        with circuitbreaker.guard(self._circuit_breakers, 'DetectLabels'):
+            try:
+                with round_trip():
+                    response = self._boto3_client.detect_labels(
+                        **self._detect_labels_request(image_bytes, bucket, object_name, min_confidence, max_labels))
+            except Exception as e:
+                logger.exception(
+                    "Couldn't detect labels with for base64(data): {} or {}/{}".format(
+                        self._image_log_bytes_str(image_bytes), bucket, object_name))
+
+                raise InvocationException.from_client_exception(client_exception=e,
+                                                                operation_name='Rekognition_DetectLabels')
+        return response
+
+    def detect_labels(self, image_bytes, bucket=None, object_name=None, min_confidence=60, max_labels=5,
+                      deadline=None):
         """
         DetectLabels
 
@@ -80,46 +170,20 @@ class RekognitonClient(object):
             :bucket: Bucket name of identifies an S3 object as the image source
             :object_name: Object name of identifies an S3 object as the image source
             :min_confidence: The minimum confidence level for the labels to return
+            :deadline: optional Deadline of the request, bounding the wait for the rate limiter
         """
-        image_bytes_for_log = self._image_log_bytes_str(image_bytes)
-        try:
-            if image_bytes is not None:
-                response = self._boto3_client.detect_labels(
-                    Image={
-                        'Bytes': image_bytes,
-                    },
-                    MaxLabels=max_labels,
-                    MinConfidence=min_confidence,
-                    Settings={
-                        'GeneralLabels': {
-                            "LabelInclusionFilters": self._label_inclusion_filters
-                        },
-                    }
-                )
-            else:
-                response = self._boto3_client.detect_labels(
-                    Image={
-                        'S3Object': {
-                            'Bucket': bucket,
-                            'Name': object_name
-                        },
-                    },
-                    MaxLabels=max_labels,
-                    MinConfidence=min_confidence,
-                    Settings={
-                        'GeneralLabels': {
-                            "LabelInclusionFilters": self._label_inclusion_filters
-                        },
-                    }
-                )
-        except Exception as e:
-            logger.exception(
-                "Couldn't detect labels with for base64(data): {} or {}/{}".format(
-                    image_bytes_for_log, bucket, object_name))
-
-            raise InvocationException.from_client_exception(client_exception=e,
-                                                            operation_name='Rekognition_DetectLabels')
+        response, cached = self._invoke_with_cache('Rekognition_DetectLabels',
+                                                   image_bytes, min_confidence, max_labels,
+                                                   lambda confidence, labels: self._invoke_detect_labels(
+                                                       image_bytes, bucket, object_name, confidence, labels,
+                                                       deadline))
+        if cached:
+            response = dict(response, Labels=self._filter_labels(response['Labels'], min_confidence, max_labels))
+
+        return self._labels_from_response(response, image_bytes, bucket, object_name)
 
+    def _labels_from_response(self, response, image_bytes, bucket, object_name):
+        image_bytes_for_log = self._image_log_bytes_str(image_bytes)
         logger.debug("Detected labels with response {} for base64(data) {} or {}/{} "
                      .format(response,
                              image_bytes_for_log,
@@ -160,7 +224,29 @@ class RekognitonClient(object):
 
         return labels
 
-    def detect_moderation_labels(self, image_bytes, bucket=None, object_name=None, min_confidence=60, max_labels=5):
+    def _detect_moderation_labels_request(self, image_bytes, bucket, object_name, min_confidence):
+        return {
+            'Image': self._image(image_bytes, bucket, object_name),
+            'MinConfidence': min_confidence
+        }
+
+    def _invoke_detect_moderation_labels(self, image_bytes, bucket, object_name, min_confidence, deadline=None):
+        ratelimit.acquire(self._rate_limiters, 'DetectModerationLabels', deadline)
+        with circuitbreaker.guard(self._circuit_breakers, 'DetectModerationLabels'):
+            try:
+                with round_trip():
+                    response = self._boto3_client.detect_moderation_labels(
+                        **self._detect_moderation_labels_request(image_bytes, bucket, object_name, min_confidence))
+            except Exception as e:
+                logger.exception("Couldn't detect moderation labels for base64(data): {} or {}/{}"
+                                 .format(self._image_log_bytes_str(image_bytes), bucket, object_name))
+
+                raise InvocationException.from_client_exception(client_exception=e,
+                                                                operation_name='Rekognition_DetectModerationLabels')
+        return response
+
+    def detect_moderation_labels(self, image_bytes, bucket=None, object_name=None, min_confidence=60, max_labels=5,
+                                 deadline=None):
         """
         DetectModerationLabels
 
@@ -169,33 +255,20 @@ class RekognitonClient(object):
             :bucket: Bucket name of identifies an S3 object as the image source
             :object_name: Object name of identifies an S3 object as the image source
             :min_confidence: The minimum confidence level for the labels to return
+            :deadline: optional Deadline of the request, bounding the wait for the rate limiter
         """
-        image_bytes_for_log = self._image_log_bytes_str(image_bytes)
-        try:
-            if image_bytes is not None:
-                response = self._boto3_client.detect_moderation_labels(
-                    Image={
-                        'Bytes': image_bytes,
-                    },
-                    MinConfidence=min_confidence
-                )
-            else:
-                response = self._boto3_client.detect_moderation_labels(
-                    Image={
-                        'S3Object': {
-                            'Bucket': bucket,
-                            'Name': object_name
-                        },
-                    },
-                    MinConfidence=min_confidence
-                )
-        except Exception as e:
-            logger.exception("Couldn't detect moderation labels for base64(data): {} or {}/{}"
-                             .format(image_bytes_for_log, bucket, object_name))
-
-            raise InvocationException.from_client_exception(client_exception=e,
-                                                            operation_name='Rekognition_DetectModerationLabels')
-
+        # max labels is applied after the inclusion filter, so the response doesn't depend on it
+        response, cached = self._invoke_with_cache('Rekognition_DetectModerationLabels',
+                                                   image_bytes, min_confidence, 0,
+                                                   lambda confidence, labels: self._invoke_detect_moderation_labels(
+                                                       image_bytes, bucket, object_name, confidence, deadline))
+        if cached:
+            response = dict(response, ModerationLabels=[label for label in response['ModerationLabels']
+                                                        if label['Confidence'] >= min_confidence])
+
+        return self._moderation_labels_from_response(response, max_labels, image_bytes, bucket, object_name)
+
+    def _moderation_labels_from_response(self, response, max_labels, image_bytes, bucket, object_name):
         # process response
         request_id = self._get_request_id(response)
         all_labels = []
@@ -214,53 +287,52 @@ class RekognitonClient(object):
 
         labels = sorted_labels[0:max_labels]
         logger.debug("Detected moderation with rek req id {} labels with labels {}, base64(data): {} or {}/{}"
-                     .format(request_id, labels, image_bytes_for_log, bucket, object_name))
+                     .format(request_id, labels, self._image_log_bytes_str(image_bytes), bucket, object_name))
 
         return labels
 
+    def _search_faces_request(self, image_bytes, bucket, object_name, face_match_threshold, max_faces):
+        return {
+            'CollectionId': self._collection_id,
+            'FaceMatchThreshold': max(self._customer_facial_threshold, face_match_threshold),
+            'Image': self._image(image_bytes, bucket, object_name),
+            'MaxFaces': max_faces
+        }
+
+    @staticmethod
+    def _is_no_faces_exception(e):
+        return hasattr(e, 'args') and isinstance(e.args, tuple) and 'no faces in the image' in e.args[0]
+
     def search_faces_by_image(self,
                               image_bytes,
                               bucket=None,
                               object_name=None,
                               face_match_threshold=85,
-                              max_faces=5):
+                              max_faces=5,
+                              deadline=None):
         """SearchFacesByImage"""
-        match_threshold = max(self._customer_facial_threshold, face_match_threshold)
-        image_bytes_for_log = self._image_log_bytes_str(image_bytes)
-        try:
-            if image_bytes is not None:
-                response = self._boto3_client.search_faces_by_image(
-                    CollectionId=self._collection_id,
-                    FaceMatchThreshold=match_threshold,
-                    Image={
-                        'Bytes': image_bytes,
-                    },
-                    MaxFaces=max_faces
-                )
-            else:
-                response = self._boto3_client.search_faces_by_image(
-                    CollectionId=self._collection_id,
-                    FaceMatchThreshold=match_threshold,
-                    Image={
-                        'S3Object': {
-                            'Bucket': bucket,
-                            'Name': object_name
-                        },
-                    },
-                    MaxFaces=max_faces
-                )
-        except Exception as e:
-            # suppress no face exception
-            if hasattr(e, 'args') and isinstance(e.args, tuple) and 'no faces in the image' in e.args[0]:
-                return []
-
-            logger.exception(
-                "Couldn't search faces in collection {} for base64(data): {} or {}/{}"
-                .format(self._collection_id, image_bytes_for_log, bucket, object_name))
-
-            raise InvocationException.from_client_exception(client_exception=e,
-                                                            operation_name='Rekognition_SearchFacesByImage')
-
+        ratelimit.acquire(self._rate_limiters, 'SearchFacesByImage', deadline)
+        with circuitbreaker.guard(self._circuit_breakers, 'SearchFacesByImage'):
+            try:
+                with round_trip():
+                    response = self._boto3_client.search_faces_by_image(
+                        **self._search_faces_request(image_bytes, bucket, object_name, face_match_threshold,
+                                                     max_faces))
+            except Exception as e:
+                # suppress no face exception
+                if self._is_no_faces_exception(e):
+                    return []
+
+                logger.exception(
+                    "Couldn't search faces in collection {} for base64(data): {} or {}/{}"
+                    .format(self._collection_id, self._image_log_bytes_str(image_bytes), bucket, object_name))
+
+                raise InvocationException.from_client_exception(client_exception=e,
+                                                                operation_name='Rekognition_SearchFacesByImage')
+
+        return self._faces_from_response(response, max_faces, image_bytes, bucket, object_name)
+
+    def _faces_from_response(self, response, max_faces, image_bytes, bucket, object_name):
         request_id = self._get_request_id(response)
         faces = []
         for face in response['FaceMatches']:
@@ -275,7 +347,7 @@ class RekognitonClient(object):
                      .format(request_id,
                              self._collection_id,
                              faces,
-                             image_bytes_for_log,
+                             self._image_log_bytes_str(image_bytes),
                              bucket, object_name))
 
         # return labels for max labels
@@ -310,34 +382,28 @@ class RekognitonClient(object):
                                     bucket=None,
                                     object_name=None,
                                     face_match_threshold=95,
-                                    max_faces=5):
+                                    max_faces=5,
+                                    deadline=None):
         """RecognizeCelebrities"""
+        ratelimit.acquire(self._rate_limiters, 'RecognizeCelebrities', deadline)
+        with circuitbreaker.guard(self._circuit_breakers, 'RecognizeCelebrities'):
+            try:
+                with round_trip():
+                    response = self._boto3_client.recognize_celebrities(
+                        Image=self._image(image_bytes, bucket, object_name))
+            except Exception as e:
+                logger.exception(
+                    "Couldn't search celebrities for base64(data): {} or {}/{}"
+                    .format(self._image_log_bytes_str(image_bytes), bucket, object_name))
+
+                raise InvocationException.from_client_exception(client_exception=e,
+                                                                operation_name='Rekognition_SearchFacesByImage')
+
+        return self._celebrities_from_response(response, face_match_threshold, max_faces,
+                                               image_bytes, bucket, object_name)
+
+    def _celebrities_from_response(self, response, face_match_threshold, max_faces, image_bytes, bucket, object_name):
         match_threshold = max(self._celebrity_facial_threshold, face_match_threshold)
-        image_bytes_for_log = self._image_log_bytes_str(image_bytes)
-        try:
-            if image_bytes is not None:
-                response = self._boto3_client.recognize_celebrities(
-                    Image={
-                        'Bytes': image_bytes,
-                    }
-                )
-            else:
-                response = self._boto3_client.recognize_celebrities(
-                    Image={
-                        'S3Object': {
-                            'Bucket': bucket,
-                            'Name': object_name
-                        },
-                    }
-                )
-        except Exception as e:
-            logger.exception(
-                "Couldn't search celebrities for base64(data): {} or {}/{}"
-                .format(image_bytes_for_log, bucket, object_name))
-
-            raise InvocationException.from_client_exception(client_exception=e,
-                                                            operation_name='Rekognition_SearchFacesByImage')
-
         request_id = self._get_request_id(response)
         faces = []
         for face in response['CelebrityFaces']:
@@ -358,6 +424,6 @@ class RekognitonClient(object):
                      .format(request_id,
                              self._collection_id,
                              deduplicated_faces,
-                             image_bytes_for_log,
+                             self._image_log_bytes_str(image_bytes),
                              bucket, object_name))
         return deduplicated_faces[0:max_faces]
@@ -0,0 +1,121 @@
+import time
+import random
+import logging
+from threading import Lock
+
+from .exception import InvocationException
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# error codes of backend calls which may succeed if called again
+RETRYABLE_ERROR_CODES = [
+    'ThrottlingException',
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException',
+    'TooManyRequestsException',
+    'ServiceUnavailableException',
+    'ServiceUnavailable',
+    'InternalServerError',
+    'InternalFailure',
+    'ReadTimeoutError',
+    'ConnectTimeoutError',
+    'EndpointConnectionError',
+    'ConnectionClosedError',
+]
+
+
+class RetryBudget(object):
+    """
+    Caps retries to a ratio of the calls: every call earns ratio of a token and a retry spends one. Tokens are capped
+    by max_tokens, the bucket starts full so that a cold container can retry.
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self._ratio = ratio
+        self._max_tokens = max_tokens
+        self._tokens = float(max_tokens)
+        self._lock = Lock()
+
+    def on_call(self):
+        with self._lock:
+            self._tokens = min(self._max_tokens, self._tokens + self._ratio)
+
+    def try_acquire(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """
+    Call a backend again when it fails with a retryable error, up to max_attempts calls. Calls are spaced by
+    decorrelated jitter backoff, a random delay between base_seconds and 3 times the previous delay capped by
+    cap_seconds. Retries stop when the budget is exhausted or the delay would pass the deadline, and the last error is
+    raised.
+    """
+
+    def __init__(self, max_attempts=3, base_seconds=0.05, cap_seconds=1.0, budget=None,
+                 retryable_error_codes=None, sleep=time.sleep, uniform=random.uniform):
+        """
+        Args:
+            :budget: RetryBudget shared by the calls of the policy, retries are not capped if None
+            :retryable_error_codes: error codes of InvocationException to retry, RETRYABLE_ERROR_CODES if None
+        """
+        self._max_attempts = max_attempts
+        self._base_seconds = base_seconds
+        self._cap_seconds = cap_seconds
+        self._budget = budget
+        self._retryable_error_codes = set(retryable_error_codes if retryable_error_codes is not None
+                                          else RETRYABLE_ERROR_CODES)
+        self._sleep = sleep
+        self._uniform = uniform
+        self._lock = Lock()
+        self._calls = 0
+        self._retries = 0
+        self._budget_exhausted = 0
+        self._deadline_exhausted = 0
+
+    def call(self, fn, deadline=None, name=''):
+        """Return fn(), raise the InvocationException of its last call"""
+        if self._budget is not None:
+            self._budget.on_call()
+        with self._lock:
+            self._calls += 1
+
+        delay = self._base_seconds
+        attempt = 1
+        while True:
+            try:
+                return fn()
+            except InvocationException as e:
+                if attempt >= self._max_attempts or e.error_code not in self._retryable_error_codes:
+                    raise
+
+                delay = min(self._cap_seconds, self._uniform(self._base_seconds, delay * 3))
+                if deadline is not None and deadline.remaining() <= delay:
+                    with self._lock:
+                        self._deadline_exhausted += 1
+                    raise
+                if self._budget is not None and not self._budget.try_acquire():
+                    with self._lock:
+                        self._budget_exhausted += 1
+                    raise
+
+                logger.warning('Retry %s after %.3f seconds, attempt %d failed with %s' % (
+                    name, delay, attempt, e.error_code))
+                with self._lock:
+                    self._retries += 1
+                self._sleep(delay)
+                attempt += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'Calls': self._calls,
+                'Retries': self._retries,
+                'BudgetExhausted': self._budget_exhausted,
+                'DeadlineExhausted': self._deadline_exhausted,
+            }
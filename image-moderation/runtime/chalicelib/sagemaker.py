@@ -3,6 +3,9 @@ import base64
 import json
 
 from .exception import InvocationException
+from .cache import backend_response_cache_key
+from .concurrentutils import round_trip
+from . import ratelimit, circuitbreaker
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -14,20 +17,44 @@ class SageMakerClient(object):
     around parts of the Boto3 Amazon Rekognition API.
     """
 
-    def __init__(self, sagemaker_client=None, endpoint_name=""):
+    def __init__(self, sagemaker_client=None, endpoint_name="", response_cache=None, rate_limiter=None,
+                 circuit_breaker=None):
         """
         Args:
             :boto3_client: A Boto3 sagemaker client.
+            :response_cache: optional cache of parsed endpoint responses by image bytes
+            :rate_limiter: optional RateLimiter of the endpoint invocations
+            :circuit_breaker: optional CircuitBreaker of the endpoint, invocations fail with CircuitOpen while open
         """
         self._sagemaker_client = sagemaker_client
         self._endpoint_name = endpoint_name
-
-    def detect_labels(self, image_bytes, min_confidence=60):
+        self._response_cache = response_cache
+        self._rate_limiters = {'InvokeEndpoint': rate_limiter} if rate_limiter is not None else None
+        self._circuit_breakers = {'InvokeEndpoint': circuit_breaker} if circuit_breaker is not None else None
+
+    def _invoke_endpoint(self, image_bytes, deadline=None):
+        ratelimit.acquire(self._rate_limiters, 'InvokeEndpoint', deadline)
+        with circuitbreaker.guard(self._circuit_breakers, 'InvokeEndpoint'):
+            try:
+                with round_trip():
+                    response = self._sagemaker_client.invoke_endpoint(**self._invoke_endpoint_request(image_bytes))
+            except Exception as e:
+                logger.exception(
+                    "Detect labels by sagemaker endpoint {} has invocation exception with data base64(data): {}".format(
+                        self._endpoint_name, base64.b64encode(image_bytes)[0:100]))
+
+                raise InvocationException.from_client_exception(client_exception=e,
+                                                                operation_name='Sagemaker_' + self._endpoint_name)
+
+        return json.loads(response['Body'].read())
+
+    def detect_labels(self, image_bytes, min_confidence=60, deadline=None):
         """
         Send request to sagemaker endpoint to detect labels
 
         Args:
             :image_bytes: images bytes for detection. if no
+            :deadline: optional Deadline of the request, bounding the wait for the rate limiter
         """
 
         # Do not remove the following lines. It is for auto IAM policy
@@ -35,21 +62,27 @@ class SageMakerClient(object):
         #     test = boto3.client('sagemaker-runtime')
         #     test.invoke_endpoint()
 
-        try:
-            response = self._sagemaker_client.invoke_endpoint(
-                EndpointName=self._endpoint_name,
-                ContentType='application/x-image',
-                Body=image_bytes,
-                Accept='application/json')
-        except Exception as e:
-            logger.exception(
-                "Detect labels by sagemaker endpoint {} has invocation exception with data base64(data): {}".format(
-                    self._endpoint_name, base64.b64encode(image_bytes)[0:100]))
-
-            raise InvocationException.from_client_exception(client_exception=e,
-                                                            operation_name='Sagemaker_' + self._endpoint_name)
-
-        response = json.loads(response['Body'].read())
+        # the endpoint returns all the labels, min confidence is applied to the cached response as well
+        if self._response_cache is None:
+            response = self._invoke_endpoint(image_bytes, deadline)
+        else:
+            key = backend_response_cache_key('Sagemaker_' + self._endpoint_name, image_bytes)
+            response = self._response_cache.get(key)
+            if response is None:
+                response = self._invoke_endpoint(image_bytes, deadline)
+                self._response_cache.put(key, response)
+
+        return self._labels_from_response(response, image_bytes, min_confidence)
+
+    def _invoke_endpoint_request(self, image_bytes):
+        return {
+            'EndpointName': self._endpoint_name,
+            'ContentType': 'application/x-image',
+            'Body': image_bytes,
+            'Accept': 'application/json'
+        }
+
+    def _labels_from_response(self, response, image_bytes, min_confidence):
         min_confidence_frac = min_confidence / 100
 
         if response.get('CustomLabels') is None:
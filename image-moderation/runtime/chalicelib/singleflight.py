@@ -0,0 +1,89 @@
+import copy
+import logging
+from threading import Lock
+from concurrent.futures import Future, TimeoutError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class SingleFlightTimeoutException(Exception):
+    @property
+    def message(self):
+        return self._message
+
+    def __init__(self, key, timeout):
+        msg = f'Timed out after {timeout} seconds waiting for the in-flight call of {key}'
+        super(SingleFlightTimeoutException, self).__init__(msg)
+        self._message = msg
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key, the first caller (leader) runs the call and
+    the others (followers) wait for its result or its exception.
+
+    A call is in flight only until the leader finishes, so a failed call is never shared with later callers.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+        self._leaders = 0
+        self._followers = 0
+        self._timeouts = 0
+
+    def do(self, key, fn, timeout=None):
+        """
+        Run fn once for concurrent callers of the same key.
+
+        Args:
+            key: key of the call
+            fn: function without arguments
+            timeout: max seconds for a follower to wait, SingleFlightTimeoutException is raised if exceeded
+        Returns:
+            Result of fn, a copy of it for followers.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+                self._leaders += 1
+            else:
+                self._followers += 1
+
+        if not is_leader:
+            logger.debug(f'Wait for the in-flight call of {key}')
+            try:
+                return copy.deepcopy(future.result(timeout=timeout))
+            except TimeoutError:
+                with self._lock:
+                    self._timeouts += 1
+                raise SingleFlightTimeoutException(key, timeout)
+
+        # the call is forgotten before followers are woken up, later callers start a new call
+        try:
+            result = fn()
+        except BaseException as e:
+            self._forget(key)
+            future.set_exception(e)
+            raise
+
+        self._forget(key)
+        future.set_result(copy.deepcopy(result))
+        return result
+
+    def _forget(self, key):
+        with self._lock:
+            del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'InFlight': len(self._calls),
+                'Leaders': self._leaders,
+                'Followers': self._followers,
+                'Timeouts': self._timeouts,
+            }
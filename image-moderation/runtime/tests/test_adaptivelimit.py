@@ -0,0 +1,67 @@
+from threading import Thread
+from unittest import TestCase
+
+from chalicelib.adaptivelimit import AdaptiveConcurrencyLimiter
+
+
+class TestAdaptiveConcurrencyLimiter(TestCase):
+    def _fill(self, limiter):
+        """Acquire every slot of the limit, so that the limit is in use"""
+        count = limiter.limit
+        for _ in range(count):
+            self.assertTrue(limiter.acquire(timeout=0))
+        return count
+
+    def test_grow_with_steady_latency(self):
+        limiter = AdaptiveConcurrencyLimiter('DetectLabels', initial_limit=4, max_limit=6)
+
+        for _ in range(3):
+            count = self._fill(limiter)
+            for _ in range(count):
+                limiter.release(latency=0.1)
+
+        self.assertEqual(limiter.limit, 6)
+
+    def test_no_growth_when_idle(self):
+        limiter = AdaptiveConcurrencyLimiter('DetectLabels', initial_limit=4)
+
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(latency=0.1)
+
+        self.assertEqual(limiter.limit, 4)
+
+    def test_shrink_with_rising_latency(self):
+        limiter = AdaptiveConcurrencyLimiter('DetectLabels', initial_limit=20, smoothing=1.0)
+        for _ in range(5):
+            limiter.acquire()
+            limiter.release(latency=0.1)
+
+        limiter.acquire()
+        limiter.release(latency=0.4)
+
+        # gradient of 2 * 0.1 / 0.4
+        self.assertEqual(limiter.limit, 10)
+        self.assertEqual(limiter.stats()['MinLatencyMillis'], 100)
+
+    def test_shrink_on_throttles(self):
+        limiter = AdaptiveConcurrencyLimiter('DetectByCustomModels', initial_limit=10, min_limit=2, backoff_ratio=0.5)
+
+        for expected in [5, 2, 2]:
+            limiter.acquire()
+            limiter.release(dropped=True)
+            self.assertEqual(limiter.limit, expected)
+        self.assertEqual(limiter.stats()['Dropped'], 3)
+
+    def test_acquire_with_timeout(self):
+        limiter = AdaptiveConcurrencyLimiter('DetectLabels', initial_limit=1)
+        self.assertTrue(limiter.acquire(timeout=0))
+        self.assertFalse(limiter.acquire(timeout=0.05))
+        self.assertEqual(limiter.stats()['Rejected'], 1)
+
+        # a release wakes up a waiting call
+        releaser = Thread(target=limiter.release, kwargs={'latency': 0.1})
+        releaser.start()
+        self.assertTrue(limiter.acquire(timeout=5))
+        releaser.join()
+        self.assertEqual(limiter.stats()['InFlight'], 1)
@@ -1,15 +1,23 @@
 import os
+import io
 import json
 import ast
 from datetime import datetime
+from threading import Thread, Event
 
 import app
+import numpy as np
+from PIL import Image
+from chalicelib import exception, cache, hashlist, perceptualhash, jobqueue, ratelimit
+from chalicelib.moderationhandler import DetectedLabels
 from chalicelib.exception import InvocationException
+from chalicelib.singleflight import SingleFlight
 
 from unittest import TestCase
-from unittest.mock import Mock, MagicMock
+from unittest.mock import Mock, MagicMock, patch
 from pytest import fixture
 from chalice.test import Client
+from chalice import TooManyRequestsError
 
 
 @fixture
@@ -292,3 +300,847 @@ class TestDetectLabels(TestCase):
             url_hint=url)
 
     
+
+
+class TestDetectLabelsBatch(TestCase):
+    def test_detect_labels_batch_without_images(self):
+        # request server
+        response = self._api_client.http.post(
+            '/Moderation/DetectImageLabelsBatch',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps({
+                'Images': [],
+                'MinConfidence': 30
+            })
+        )
+
+        # assert
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json_body['Code'], 'BadRequestError')
+
+    def test_detect_labels_batch_with_per_item_results(self):
+        url = 'https://www.test.com'
+        image_data = [bytes('1' * 8, 'ascii')]
+        labels = [
+            {
+                "Label": "terrisom",
+                "ReturnSource": "DetectLabels",
+                "Confidence": 88.88}]
+
+        def image_handler(url, bucket=None, object_name=None):
+            if bucket == 'bucket':
+                raise ValueError('unexpected')
+            return image_data, "tested_hash_image_data"
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(side_effect=image_handler)
+        # mock labels handler
+        app.get_detect_labels_handler = Mock()
+        app.get_detect_labels_handler().detect_image_labels = MagicMock(
+            side_effect=[labels, InvocationException.backend_exceptions(exceptions=[('op1', Exception('ex_op1'))])])
+
+        ## invoke server
+        response = self._api_client.http.post(
+            '/Moderation/DetectImageLabelsBatch',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps({
+                'Images': [
+                    {'Image': {'Url': url}, 'Description': 'first'},
+                    {'Image': {'Url': url}},
+                    {'Image': {'Object': {'Bucket': 'bucket', 'Name': 'object key'}}}
+                ],
+                'ReturnSource': ['DetectByCustomModels'],
+                'MinConfidence': 30
+            })
+        )
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json_body['Results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual([result['Index'] for result in results], [0, 1, 2])
+        self.assertEqual(results[0]['Description'], 'first')
+
+        # one item succeeded and one was throttled, whichever of the two items ran first
+        items = sorted(results[0:2], key=lambda result: 'Error' in result)
+        self.assertEqual(items[0]['Labels'], labels)
+        self.assertEqual(items[1]['Error']['Code'], 'TooManyRequestsError')
+        self.assertEqual(items[1]['Error']['Message'], '[op1 has errors: ex_op1]')
+
+        # unexpected errors are reported for the item only
+        self.assertEqual(results[2]['Error']['Code'], 'InternalServerError')
+
+        # backends are called through one shared handler
+        self.assertEqual(app.get_detect_labels_handler().detect_image_labels.call_count, 2)
+
+
+    def test_detect_labels_batch_with_deadline(self):
+        url = 'https://www.test.com'
+        release = Event()
+
+        def image_handler(url, bucket=None, object_name=None):
+            if bucket == 'bucket':
+                release.wait(5)
+            return [bytes('1' * 8, 'ascii')], "deadline_hash_image_data"
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(side_effect=image_handler)
+        # mock labels handler
+        app.get_detect_labels_handler = Mock()
+        app.get_detect_labels_handler().detect_image_labels = MagicMock(return_value=[])
+
+        with patch.object(app, '_REQUEST_TIMEOUT_SECONDS', 0.2), \
+                patch.object(app, 'get_verdict_cache', return_value=None):
+            response = self._api_client.http.post(
+                '/Moderation/DetectImageLabelsBatch',
+                headers={'Content-Type': 'application/json'},
+                body=json.dumps({
+                    'Images': [
+                        {'Image': {'Url': url}},
+                        {'Image': {'Object': {'Bucket': 'bucket', 'Name': 'object key'}}, 'Description': 'slow'}
+                    ],
+                    'MinConfidence': 30
+                })
+            )
+        release.set()
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json_body['Results']
+        self.assertEqual(results[0], {'Index': 0, 'Labels': []})
+        self.assertEqual(results[1]['Description'], 'slow')
+        self.assertEqual(results[1]['Error']['Code'], 'TooManyRequestsError')
+
+
+class TestDetectLabelsJobs(TestCase):
+    def test_get_job_not_found(self):
+        response = self._api_client.http.get('/Moderation/DetectImageLabelsJobs/not-existed')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json_body['Code'], 'NotFoundError')
+
+    def test_submit_job_with_bad_priority(self):
+        store = jobqueue.InMemoryJobStore()
+        with patch.object(app, 'get_job_store', return_value=store):
+            response = self._api_client.http.post(
+                '/Moderation/DetectImageLabelsJobs',
+                headers={'Content-Type': 'application/json', 'X-Moderation-Priority': 'Urgent'},
+                body=json.dumps({'Image': {'Url': 'https://www.test.com'}}))
+
+        self.assertEqual(response.status_code, 400)
+        # no job is left behind
+        self.assertEqual(store._jobs, {})
+
+    def test_submit_job_with_partial_results(self):
+        response = self._api_client.http.post(
+            '/Moderation/DetectImageLabelsJobs',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps({'Image': {'Url': 'https://www.test.com'}, 'PartialResults': True}))
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_submit_and_poll_job(self):
+        url = 'https://www.test.com'
+        image_data = [bytes('1' * 8, 'ascii')]
+        labels = [
+            {
+                "Label": "terrisom",
+                "ReturnSource": "DetectLabels",
+                "Confidence": 88.88}]
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[image_data, "tested_hash_image_data"])
+        # mock labels handler
+        app.get_detect_labels_handler = Mock()
+        app.get_detect_labels_handler().detect_image_labels = MagicMock(return_value=labels)
+
+        # submit
+        response = self._api_client.http.post(
+            '/Moderation/DetectImageLabelsJobs',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps({
+                'Image': {
+                    'Url': url
+                },
+                'MinConfidence': 30
+            })
+        )
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json_body['Status'], 'SUBMITTED')
+        job_id = response.json_body['JobId']
+
+        # wait for the in-memory worker
+        app.get_job_queue().join()
+
+        # poll
+        response = self._api_client.http.get(f'/Moderation/DetectImageLabelsJobs/{job_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json_body['Status'], 'SUCCEEDED')
+        self.assertEqual(response.json_body['Labels'], labels)
+
+        # assert detection handler
+        app.get_detect_labels_handler().detect_image_labels.assert_called_with(
+            return_sources=None,
+            images=image_data,
+            min_confidence=30,
+            max_labels=50,
+            url_hint=url)
+
+    def test_process_failed_job(self):
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(
+            side_effect=exception.UnsupportedImageException('UNKNOWN'))
+
+        app.get_job_store().create('job-failed', {})
+        app.process_moderation_jobs(
+            {'Records': [{'body': json.dumps({'JobId': 'job-failed',
+                                               'Request': {'Image': {'Url': 'https://www.test.com'}}}),
+                          'receiptHandle': 'handle'}]},
+            None)
+
+        job = app.get_job_store().get('job-failed')
+        self.assertEqual(job['Status'], 'FAILED')
+        self.assertEqual(job['Error'], {'Code': 'BadRequestError', 'Message': 'Unsupported image format UNKNOWN'})
+
+    def test_process_throttled_job(self):
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[[bytes('1' * 8, 'ascii')], 'throttled_job'])
+        job = {'JobId': 'job-throttled', 'Request': {'Image': {'Url': 'https://www.test.com/throttled.png'}}}
+
+        app.get_job_store().create('job-throttled', {})
+        with patch.object(app, 'get_detect_labels_handler') as get_handler, \
+                patch.object(app, 'get_verdict_cache', return_value=None):
+            get_handler().detect_image_labels = MagicMock(side_effect=InvocationException(
+                operation_name='DetectLabels', error_code='ThrottlingException', error_message='Rate exceeded'))
+
+            # the message is received again
+            with self.assertRaises(TooManyRequestsError):
+                app.process_moderation_jobs(
+                    {'Records': [{'body': json.dumps(job), 'receiptHandle': 'handle',
+                                  'attributes': {'ApproximateReceiveCount': '1'}}]},
+                    None)
+            self.assertEqual(app.get_job_store().get('job-throttled')['Status'], 'IN_PROGRESS')
+
+            app.process_moderation_jobs(
+                {'Records': [{'body': json.dumps(job), 'receiptHandle': 'handle',
+                              'attributes': {'ApproximateReceiveCount': '3'}}]},
+                None)
+
+        self.assertEqual(app.get_job_store().get('job-throttled')['Status'], 'FAILED')
+        self.assertEqual(app.get_job_store().get('job-throttled')['Error']['Code'], 'TooManyRequestsError')
+
+
+class TestVerdictCache(TestCase):
+    def test_detect_labels_with_cached_verdict(self):
+        url = 'https://www.test.com'
+        image_data = [bytes('1' * 8, 'ascii')]
+        labels = [
+            {
+                "Label": "terrisom",
+                "ReturnSource": "DetectLabels",
+                "Confidence": 88.88}]
+        verdict_cache = cache.LRUCache()
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[image_data, "cached_hash_image_data"])
+        # mock labels handler
+        app.get_detect_labels_handler = Mock()
+        app.get_detect_labels_handler().detect_image_labels = MagicMock(return_value=labels)
+
+        with patch.object(app, 'get_verdict_cache', return_value=verdict_cache):
+            for min_confidence in [30, 30, 40]:
+                response = self._api_client.http.post(
+                    '/Moderation/DetectImageLabels',
+                    headers={'Content-Type': 'application/json'},
+                    body=json.dumps({
+                        'Image': {
+                            'Url': url
+                        },
+                        'MinConfidence': min_confidence
+                    })
+                )
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json_body['Labels'], labels)
+
+            metrics = self._api_client.http.get('/Moderation/Metrics').json_body
+
+        # the second request is served from cache, the third has different parameters
+        self.assertEqual(app.get_detect_labels_handler().detect_image_labels.call_count, 2)
+        self.assertEqual(metrics['VerdictCache']['Hits'], 1)
+        self.assertEqual(metrics['VerdictCache']['Misses'], 2)
+
+
+class TestObjectVerdictCache(TestCase):
+    def test_detect_labels_with_cached_object_verdict(self):
+        image_data = [bytes('1' * 8, 'ascii')]
+        labels = [
+            {
+                "Label": "terrisom",
+                "ReturnSource": "DetectLabels",
+                "Confidence": 88.88}]
+        verdict_cache = cache.LRUCache()
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[image_data, "object_hash_image_data"])
+        app.get_image_handler().head_object = MagicMock(side_effect=[{'ETag': '"etag-1"', 'VersionId': None},
+                                                                     {'ETag': '"etag-1"', 'VersionId': None},
+                                                                     {'ETag': '"etag-2"', 'VersionId': None}])
+        # mock labels handler
+        app.get_detect_labels_handler = Mock()
+        app.get_detect_labels_handler().detect_image_labels = MagicMock(return_value=labels)
+
+        with patch.object(app, 'get_verdict_cache', return_value=verdict_cache), \
+                patch.object(app, '_ENABLE_S3_ETAG_CACHE', True):
+            for _ in range(3):
+                response = self._api_client.http.post(
+                    '/Moderation/DetectImageLabels',
+                    headers={'Content-Type': 'application/json'},
+                    body=json.dumps({
+                        'Image': {
+                            'Object': {
+                                'Bucket': 'bucket',
+                                'Name': 'image.jpg'
+                            }
+                        }
+                    })
+                )
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json_body['Labels'], labels)
+
+        # the second request is served without download, the changed object is downloaded again
+        self.assertEqual(app.get_image_handler().image_handler.call_count, 2)
+        app.get_image_handler().head_object.assert_called_with('bucket', 'image.jpg')
+        # the changed object has the same content, so it's served from the verdict of the content
+        self.assertEqual(app.get_detect_labels_handler().detect_image_labels.call_count, 1)
+
+
+    def test_detect_labels_with_cached_verdict_of_blacklisted_object(self):
+        image_data = [bytes('1' * 8, 'ascii')]
+        labels = [
+            {
+                "Label": "terrisom",
+                "ReturnSource": "DetectLabels",
+                "Confidence": 88.88}]
+        verdict_cache = cache.LRUCache()
+        store = hashlist.InMemoryHashListStore()
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[image_data, "object_hash_image_data"])
+        app.get_image_handler().head_object = MagicMock(return_value={'ETag': '"etag-1"', 'VersionId': None})
+        # mock labels handler
+        app.get_detect_labels_handler = Mock()
+        app.get_detect_labels_handler().detect_image_labels = MagicMock(return_value=labels)
+
+        body = json.dumps({'Image': {'Object': {'Bucket': 'bucket', 'Name': 'image.jpg'}}})
+        with patch.object(app, 'get_verdict_cache', return_value=verdict_cache), \
+                patch.object(app, 'get_hash_list_store', return_value=store), \
+                patch.object(app, '_ENABLE_BLACK_WHITE_LIST', True), \
+                patch.object(app, '_ENABLE_S3_ETAG_CACHE', True):
+            response = self._api_client.http.post('/Moderation/DetectImageLabels',
+                                                  headers={'Content-Type': 'application/json'}, body=body)
+            self.assertEqual(response.json_body['Labels'], labels)
+
+            # the object is blacklisted after its verdict was cached
+            store.add('Blacklist', ['object_hash_image_data'])
+            response = self._api_client.http.post('/Moderation/DetectImageLabels',
+                                                  headers={'Content-Type': 'application/json'}, body=body)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([label['Label'] for label in response.json_body['Labels']], ['Blacklisted'])
+
+        self.assertEqual(app.get_image_handler().image_handler.call_count, 1)
+
+
+class TestUrlCache(TestCase):
+    def test_detect_labels_with_not_modified_url(self):
+        url = 'https://www.test.com/not-modified.jpg'
+        labels = [
+            {
+                "Label": "terrisom",
+                "ReturnSource": "DetectLabels",
+                "Confidence": 88.88}]
+        verdict_cache = cache.LRUCache()
+        verdict_cache.put(cache.verdict_cache_key('url_hash_image_data', ['DetectLabels'], 60, 50), labels)
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().revalidate_url = MagicMock(return_value='url_hash_image_data')
+        app.get_image_handler().image_handler = MagicMock()
+
+        with patch.object(app, 'get_verdict_cache', return_value=verdict_cache), \
+                patch.object(app, '_ENABLE_URL_CACHE', True):
+            response = self._api_client.http.post(
+                '/Moderation/DetectImageLabels',
+                headers={'Content-Type': 'application/json'},
+                body=json.dumps({
+                    'Image': {
+                        'Url': url
+                    },
+                    'ReturnSource': ['DetectLabels']
+                })
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json_body['Labels'], labels)
+        app.get_image_handler().revalidate_url.assert_called_once_with(url)
+        app.get_image_handler().image_handler.assert_not_called()
+
+    def test_detect_labels_with_not_modified_whitelisted_url(self):
+        url = 'https://www.test.com/not-modified.jpg'
+        verdict_cache = cache.LRUCache()
+        verdict_cache.put(cache.verdict_cache_key('url_hash_image_data', ['DetectLabels'], 60, 50),
+                          [{"Label": "terrisom", "ReturnSource": "DetectLabels", "Confidence": 88.88}])
+        store = hashlist.InMemoryHashListStore()
+        store.add('Whitelist', ['url_hash_image_data'])
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().revalidate_url = MagicMock(return_value='url_hash_image_data')
+        app.get_image_handler().image_handler = MagicMock()
+
+        with patch.object(app, 'get_verdict_cache', return_value=verdict_cache), \
+                patch.object(app, 'get_hash_list_store', return_value=store), \
+                patch.object(app, '_ENABLE_BLACK_WHITE_LIST', True), \
+                patch.object(app, '_ENABLE_URL_CACHE', True):
+            response = self._api_client.http.post(
+                '/Moderation/DetectImageLabels',
+                headers={'Content-Type': 'application/json'},
+                body=json.dumps({
+                    'Image': {
+                        'Url': url
+                    },
+                    'ReturnSource': ['DetectLabels']
+                })
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json_body['Labels'], [])
+        app.get_image_handler().image_handler.assert_not_called()
+
+
+class TestSingleFlight(TestCase):
+    def test_detect_labels_with_concurrent_requests(self):
+        url = 'https://www.test.com'
+        image_data = [bytes('1' * 8, 'ascii')]
+        labels = [
+            {
+                "Label": "terrisom",
+                "ReturnSource": "DetectLabels",
+                "Confidence": 88.88}]
+        release = Event()
+
+        def detect_image_labels(**kwargs):
+            release.wait(5)
+            return labels
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[image_data, "single_flight_hash_image_data"])
+        # mock labels handler
+        detect_labels_handler = Mock()
+        detect_labels_handler.detect_image_labels = MagicMock(side_effect=detect_image_labels)
+
+        results = []
+        threads = [Thread(target=lambda: results.append(app._detect_labels(url, None, None, None, 50, 10,
+                                                                          detect_labels_handler)))
+                   for _ in range(3)]
+        with patch.object(app, 'get_verdict_cache', return_value=None), \
+                patch.object(app, 'get_perceptual_hash_index', return_value=None), \
+                patch.object(app, '_SINGLE_FLIGHT', SingleFlight()) as single_flight:
+            for thread in threads:
+                thread.start()
+            while single_flight.stats()['Followers'] < 2:
+                release.wait(0.01)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(detect_labels_handler.detect_image_labels.call_count, 1)
+        self.assertEqual(results, [labels] * 3)
+
+
+class TestImageHashList(TestCase):
+    def test_update_hash_list_without_hashes(self):
+        response = self._api_client.http.post(
+            '/Moderation/ImageHashList',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps({
+                'Action': 'Add',
+                'ListType': 'Blacklist'
+            })
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json_body['Message'], "{'_schema': ['Either of Hashes or Images is required!']}")
+
+    def test_update_hash_list_with_invalid_hash(self):
+        response = self._api_client.http.post(
+            '/Moderation/ImageHashList',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps({
+                'Action': 'Add',
+                'ListType': 'Blacklist',
+                'Hashes': ['G' * 64]
+            })
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_update_hash_list(self):
+        hash_data = 'a' * 64
+        store = hashlist.InMemoryHashListStore()
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().generate_hash = MagicMock(return_value='b' * 64)
+
+        with patch.object(app, 'get_hash_list_store', return_value=store):
+            response = self._api_client.http.post(
+                '/Moderation/ImageHashList',
+                headers={'Content-Type': 'application/json'},
+                body=json.dumps({
+                    'Action': 'Add',
+                    'ListType': 'Blacklist',
+                    'Hashes': [hash_data],
+                    'Images': [{'Url': 'https://www.test.com'}]
+                })
+            )
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json_body['Hashes'], [hash_data, 'b' * 64])
+            self.assertEqual(store.lookup(hash_data), 'Blacklist')
+            self.assertEqual(store.lookup('b' * 64), 'Blacklist')
+
+            response = self._api_client.http.post(
+                '/Moderation/ImageHashList',
+                headers={'Content-Type': 'application/json'},
+                body=json.dumps({
+                    'Action': 'Remove',
+                    'ListType': 'Blacklist',
+                    'Hashes': [hash_data]
+                })
+            )
+
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(store.lookup(hash_data))
+
+        app.get_image_handler().generate_hash.assert_called_with('https://www.test.com', bucket=None, object_name=None)
+
+    def test_detect_labels_with_blacklisted_image(self):
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(
+            side_effect=exception.BlacklistedImageException('c' * 64))
+        # mock labels handler
+        app.get_detect_labels_handler = Mock()
+
+        response = self._api_client.http.post(
+            '/Moderation/DetectImageLabels',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps({
+                'Image': {
+                    'Url': 'https://www.test.com'
+                }
+            })
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json_body['Labels'],
+                         [{'Label': 'Blacklisted', 'ReturnSource': 'ImageBlacklist', 'Confidence': 100.0}])
+        app.get_detect_labels_handler().detect_image_labels.assert_not_called()
+
+
+class TestNearDuplicate(TestCase):
+    def test_detect_labels_with_near_duplicate_verdict(self):
+        url = 'https://www.test.com'
+        labels = [
+            {
+                "Label": "terrisom",
+                "ReturnSource": "DetectLabels",
+                "Confidence": 88.88}]
+        pixels = (np.random.default_rng(5).random((32, 32)) * 255).astype(np.uint8).repeat(8, axis=0).repeat(8, axis=1)
+        images = []
+        for image_format, quality in [('PNG', 95), ('JPEG', 70)]:
+            data = io.BytesIO()
+            Image.fromarray(pixels).save(data, format=image_format, quality=quality)
+            images.append(data.getvalue())
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(
+            side_effect=[([images[0]], 'png_hash_image_data'), ([images[1]], 'jpeg_hash_image_data')])
+        # mock labels handler
+        app.get_detect_labels_handler = Mock()
+        app.get_detect_labels_handler().detect_image_labels = MagicMock(return_value=labels)
+
+        index = perceptualhash.MultiIndexHashIndex(max_distance=4)
+        with patch.object(app, 'get_perceptual_hash_index', return_value=index):
+            for _ in images:
+                response = self._api_client.http.post(
+                    '/Moderation/DetectImageLabels',
+                    headers={'Content-Type': 'application/json'},
+                    body=json.dumps({
+                        'Image': {
+                            'Url': url
+                        },
+                        'MinConfidence': 30
+                    })
+                )
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json_body['Labels'], labels)
+
+        # the recompressed image reuses the verdict
+        self.assertEqual(app.get_detect_labels_handler().detect_image_labels.call_count, 1)
+        self.assertEqual(len(index), 1)
+
+    def test_detect_labels_with_near_duplicate_qrcode(self):
+        pixels = (np.random.default_rng(5).random((32, 32)) * 255).astype(np.uint8).repeat(8, axis=0).repeat(8, axis=1)
+        images = []
+        for image_format, quality in [('PNG', 95), ('JPEG', 70)]:
+            data = io.BytesIO()
+            Image.fromarray(pixels).save(data, format=image_format, quality=quality)
+            images.append(data.getvalue())
+
+        def decode_qrcode(image_data_list, qrcode_label, url, deadline=None):
+            qrcode_label['QrcodeData'] = ['https://www.test.com/%d' % len(image_data_list[0])]
+            qrcode_label.pop('BoundingBox', None)
+
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(
+            side_effect=[([images[0]], 'png_hash_image_data'), ([images[1]], 'jpeg_hash_image_data')])
+        app.get_detect_labels_handler = Mock()
+        app.get_detect_labels_handler().detect_image_labels = MagicMock(return_value=[
+            {'Label': 'QR Code', 'ReturnSource': 'DetectLabels', 'Confidence': 99.0,
+             'BoundingBox': {'Left': 0.1, 'Top': 0.1, 'Width': 0.5, 'Height': 0.5}}])
+
+        index = perceptualhash.MultiIndexHashIndex(max_distance=4)
+        qrcode_data = []
+        with patch.object(app, 'get_perceptual_hash_index', return_value=index), \
+                patch.object(app, '_qrcode_handle', side_effect=decode_qrcode):
+            for _ in images:
+                response = self._api_client.http.post(
+                    '/Moderation/DetectImageLabels',
+                    headers={'Content-Type': 'application/json'},
+                    body=json.dumps({'Image': {'Url': 'https://www.test.com'}}))
+                qrcode_data.append(response.json_body['Labels'][0]['QrcodeData'])
+
+        # the QR code of the near-duplicate is decoded from its own image
+        self.assertEqual(app.get_detect_labels_handler().detect_image_labels.call_count, 1)
+        self.assertEqual(qrcode_data, [['https://www.test.com/%d' % len(image)] for image in images])
+
+
+class TestDetectionPipeline(TestCase):
+    def test_detect_labels_with_speculative_qrcode(self):
+        image_data = [bytes('1' * 8, 'ascii')]
+        detect_labels_handler = Mock()
+        detect_labels_handler.detect_image_labels = MagicMock(return_value=[
+            {
+                "Label": "QR Code",
+                "ReturnSource": "DetectLabels",
+                "Confidence": 99.0,
+                "BoundingBox": {"Left": 0.1, "Top": 0.1, "Width": 0.5, "Height": 0.5}}])
+
+        with patch.object(app, '_ENABLE_SPECULATIVE_QRCODE', True), \
+                patch.object(app, '_DETECTION_PIPELINE', None), \
+                patch.object(app.qrcodehandler.QrcodeHandler, 'decode', return_value=['https://www.test.com']) as decode:
+            labels = app._detect_labels_by_backends(image_data, 'https://www.test.com/qrcode.png', None, None, None,
+                                                    50, 10, detect_labels_handler)
+            stats = app.get_detection_pipeline().stats()
+
+        # the frames are scanned once as a whole, not again within the bounding box
+        decode.assert_called_once_with(image_data[0])
+        self.assertEqual(labels, [{"Label": "QR Code", "ReturnSource": "DetectLabels", "Confidence": 99.0,
+                                   "QrcodeData": ['https://www.test.com']}])
+        self.assertEqual(set(stats.keys()), {'backends', 'qrcode_scan', 'qrcode'})
+        self.assertEqual(stats['qrcode']['Count'], 1)
+
+
+class TestPartialResults(TestCase):
+    def test_detect_labels_with_partial_results(self):
+        url = 'https://www.test.com/partial.png'
+        labels = [
+            {
+                "Label": "terrisom",
+                "ReturnSource": "DetectModerationLabels",
+                "Confidence": 88.88}]
+        source_status = {'DetectModerationLabels': {'Status': 'Ok', 'LatencyMillis': 120},
+                         'DetectLabels': {'Status': 'Throttled', 'LatencyMillis': 80,
+                                          'ErrorCode': 'ThrottlingException'}}
+
+        # mock image handler
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[[bytes('1' * 8, 'ascii')],
+                                                                        'partial_hash_image_data'])
+        # mock labels handler
+        app.get_detect_labels_handler = Mock()
+        app.get_detect_labels_handler().detect_image_labels = MagicMock(
+            return_value=DetectedLabels(labels, source_status=source_status))
+
+        verdict_cache = cache.LRUCache(max_size=10)
+        with patch.object(app, 'get_verdict_cache', return_value=verdict_cache):
+            response = self._api_client.http.post(
+                '/Moderation/DetectImageLabels',
+                headers={'Content-Type': 'application/json'},
+                body=json.dumps({
+                    'Image': {
+                        'Url': url
+                    },
+                    'ReturnSource': ['DetectModerationLabels', 'DetectLabels'],
+                    'PartialResults': True
+                })
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json_body['Labels'], labels)
+        self.assertEqual(response.json_body['SourceStatus'], source_status)
+        app.get_detect_labels_handler().detect_image_labels.assert_called_with(
+            return_sources=['DetectModerationLabels', 'DetectLabels'],
+            images=[bytes('1' * 8, 'ascii')],
+            min_confidence=60,
+            max_labels=50,
+            url_hint=url,
+            mandatory_return_sources=['DetectModerationLabels'])
+        # degraded labels are not reused
+        self.assertEqual(len(verdict_cache), 0)
+
+
+class TestPriorityLanes(TestCase):
+    def _post(self, headers=None, **body):
+        return self._api_client.http.post(
+            '/Moderation/DetectImageLabels',
+            headers=dict({'Content-Type': 'application/json'}, **(headers or {})),
+            body=json.dumps(dict({'Image': {'Url': 'https://www.test.com/lane.png'}}, **body)))
+
+    def test_detect_labels_with_priority(self):
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[[bytes('1' * 8, 'ascii')], 'lane_hash'])
+
+        with patch.object(app, 'get_detect_labels_handler') as get_handler, \
+                patch.object(app, 'get_verdict_cache', return_value=None):
+            get_handler().detect_image_labels = MagicMock(return_value=[])
+
+            self.assertEqual(self._post().status_code, 200)
+            self.assertEqual(get_handler.call_args.kwargs['lane'], 'Interactive')
+            self.assertEqual(self._post(headers={'X-Moderation-Priority': 'Bulk'}).status_code, 200)
+            self.assertEqual(get_handler.call_args.kwargs['lane'], 'Bulk')
+            # the body wins over the header
+            self.assertEqual(self._post(headers={'X-Moderation-Priority': 'Bulk'}, Priority='Interactive').status_code,
+                             200)
+            self.assertEqual(get_handler.call_args.kwargs['lane'], 'Interactive')
+
+            self.assertEqual(self._post(headers={'X-Moderation-Priority': 'Urgent'}).status_code, 400)
+            self.assertEqual(self._post(Priority='Urgent').status_code, 400)
+
+
+class TestTenants(TestCase):
+    def test_request_tenant(self):
+        request = Mock(context={'identity': {'sourceIp': '127.0.0.1'}}, headers={})
+        with patch.object(app.app, 'current_request', request, create=True):
+            self.assertEqual(app._request_tenant(), 'Default')
+            request.headers = {'X-Moderation-Tenant': 'TeamA'}
+            self.assertEqual(app._request_tenant(), 'TeamA')
+            # the principal wins over the header, sessions of a role are one tenant
+            request.context = {'identity': {'userArn': 'arn:aws:sts::123456789012:assumed-role/TeamB/session'}}
+            self.assertEqual(app._request_tenant(), 'arn:aws:sts::123456789012:assumed-role/TeamB')
+            request.context = {'identity': {'userArn': 'arn:aws:iam::123456789012:user/TeamC'}}
+            self.assertEqual(app._request_tenant(), 'arn:aws:iam::123456789012:user/TeamC')
+
+    def test_detect_labels_of_tenant(self):
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[[bytes('1' * 8, 'ascii')], 'tenant_hash'])
+
+        with patch.object(app, 'get_detect_labels_handler') as get_handler, \
+                patch.object(app, 'get_verdict_cache', return_value=None):
+            get_handler().detect_image_labels = MagicMock(return_value=[])
+            response = self._api_client.http.post(
+                '/Moderation/DetectImageLabels',
+                headers={'Content-Type': 'application/json', 'X-Moderation-Tenant': 'TeamA'},
+                body=json.dumps({'Image': {'Url': 'https://www.test.com/tenant.png'}}))
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(get_handler.call_args.kwargs['tenant'], 'TeamA')
+
+    def test_tenant_quotas(self):
+        with patch.object(app, '_TENANT_QUOTA_LIMITS', ratelimit.parse_limits(['arn:aws:iam::123456789012:role/TeamA:5:10'],
+                                                                                 'MODERATION_TENANT_QUOTAS')), \
+                patch.object(app, '_TENANT_QUOTAS', None):
+            quotas = app.get_tenant_quotas()
+
+        self.assertEqual(list(quotas.keys()), ['arn:aws:iam::123456789012:role/TeamA'])
+        self.assertTrue(quotas['arn:aws:iam::123456789012:role/TeamA'].acquire(timeout=0))
+
+
+class TestEarlyExit(TestCase):
+    def test_detect_labels_short_circuited(self):
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[[bytes('1' * 8, 'ascii')], 'decisive_hash'])
+        label = {'Label': 'Explicit Nudity', 'Confidence': 98.0, 'ReturnSource': 'DetectModerationLabels'}
+
+        with patch.object(app, 'get_detect_labels_handler') as get_handler, \
+                patch.object(app, 'get_verdict_cache', return_value=None):
+            get_handler().detect_image_labels = MagicMock(return_value=DetectedLabels([label], short_circuited=True))
+            response = self._api_client.http.post(
+                '/Moderation/DetectImageLabels',
+                headers={'Content-Type': 'application/json'},
+                body=json.dumps({'Image': {'Url': 'https://www.test.com/decisive.png'}}))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json_body, {'Labels': [label], 'ShortCircuited': True})
+
+    def test_detect_labels_short_circuited_from_cache(self):
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[[bytes('1' * 8, 'ascii')], 'decisive_hash'])
+        label = {'Label': 'Explicit Nudity', 'Confidence': 98.0, 'ReturnSource': 'DetectModerationLabels'}
+
+        with patch.object(app, 'get_detect_labels_handler') as get_handler, \
+                patch.object(app, 'get_verdict_cache', return_value=cache.LRUCache()):
+            get_handler().detect_image_labels = MagicMock(return_value=DetectedLabels([label], short_circuited=True))
+            for _ in range(2):
+                response = self._api_client.http.post(
+                    '/Moderation/DetectImageLabels',
+                    headers={'Content-Type': 'application/json'},
+                    body=json.dumps({'Image': {'Url': 'https://www.test.com/decisive.png'}}))
+
+                # the reused verdict is still flagged
+                self.assertEqual(response.json_body, {'Labels': [label], 'ShortCircuited': True})
+
+        self.assertEqual(get_handler().detect_image_labels.call_count, 1)
+
+    def test_decisive_labels(self):
+        with patch.object(app, '_EARLY_EXIT_LABELS', ['Explicit Nudity:95', 'Graphic Violence Or Gore:90.5']):
+            self.assertEqual(app._decisive_labels(), {'Explicit Nudity': 95.0, 'Graphic Violence Or Gore': 90.5})
+
+
+class TestCascade(TestCase):
+    def test_detect_labels_with_cascade_tiers(self):
+        app.get_image_handler = Mock()
+        app.get_image_handler().image_handler = MagicMock(return_value=[[bytes('1' * 8, 'ascii')], 'cascade_hash'])
+        label = {'Label': 'Smoking', 'Confidence': 95.0, 'ReturnSource': 'DetectModerationLabels'}
+
+        with patch.object(app, 'get_detect_labels_handler') as get_handler, \
+                patch.object(app, 'get_verdict_cache', return_value=None):
+            get_handler().detect_image_labels = MagicMock(return_value=DetectedLabels([label], tiers=[1]))
+            response = self._api_client.http.post(
+                '/Moderation/DetectImageLabels',
+                headers={'Content-Type': 'application/json'},
+                body=json.dumps({'Image': {'Url': 'https://www.test.com/cascade.png'}}))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json_body, {'Labels': [label], 'CascadeTiers': [1]})
+
+    def test_cascade(self):
+        with patch.object(app, '_ENABLE_CASCADE', True), patch.object(app, '_CASCADE', None), \
+                patch.object(app, '_CASCADE_TIERS', ['DetectModerationLabels:1:1', 'CelebritySearch:2:2.5']):
+            backend_cascade = app.get_cascade()
+
+        self.assertEqual(backend_cascade.plan(['CelebritySearch', 'DetectModerationLabels', 'DetectLabels']),
+                         [(1, ['DetectModerationLabels', 'DetectLabels']), (2, ['CelebritySearch'])])
+        self.assertEqual(backend_cascade.cost(['CelebritySearch'], images=2), 5.0)
@@ -0,0 +1,134 @@
+import io
+import asyncio
+import json
+import hashlib
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import Mock, AsyncMock, MagicMock
+
+from PIL import Image
+
+from chalicelib.asynchandler import AsyncRekognitionClient, AsyncSageMakerClient, AsyncImageHandler, \
+    AsyncModerationHandler, detect_labels
+from chalicelib.exception import InvocationException
+from chalicelib.hashlist import InMemoryHashListStore
+
+
+def _rek_client(delay=0.0):
+    async def detect_labels(**kwargs):
+        await asyncio.sleep(delay)
+        return {'Labels': [{'Name': 'Smoking', 'Confidence': 90.0}]}
+
+    async def detect_moderation_labels(**kwargs):
+        await asyncio.sleep(delay)
+        return {'ModerationLabels': [{'Name': 'Violence', 'Confidence': 80.0}]}
+
+    aio_client = Mock()
+    aio_client.detect_labels = AsyncMock(side_effect=detect_labels)
+    aio_client.detect_moderation_labels = AsyncMock(side_effect=detect_moderation_labels)
+    return aio_client
+
+
+class TestAsyncModerationHandler(IsolatedAsyncioTestCase):
+    async def test_detect_image_labels(self):
+        aio_client = _rek_client()
+        rek_client = AsyncRekognitionClient(aio_client=aio_client, moderation_label_inclusion_filters=['Violence'])
+        handler = AsyncModerationHandler(rek_client=rek_client)
+
+        labels = await handler.detect_image_labels([bytearray([1, 2, 3]), bytearray([4, 5, 6])],
+                                                   return_sources=['DetectLabels', 'DetectModerationLabels'],
+                                                   min_confidence=60,
+                                                   max_labels=5)
+
+        self.assertEqual(labels, [
+            {'Label': 'Smoking', 'ReturnSource': 'DetectLabels', 'Confidence': 90.0},
+            {'Label': 'Violence', 'ReturnSource': 'DetectModerationLabels', 'Confidence': 80.0},
+        ])
+        self.assertEqual(aio_client.detect_labels.await_count, 2)
+        aio_client.detect_moderation_labels.assert_awaited_with(Image={'Bytes': bytearray([4, 5, 6])},
+                                                                MinConfidence=60)
+
+    async def test_detect_image_labels_concurrently(self):
+        aio_client = _rek_client(delay=0.2)
+        handler = AsyncModerationHandler(rek_client=AsyncRekognitionClient(aio_client=aio_client))
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await handler.detect_image_labels([bytearray([i]) for i in range(8)], return_sources=['DetectLabels'])
+
+        self.assertEqual(aio_client.detect_labels.await_count, 8)
+        self.assertLess(loop.time() - started, 0.4)
+
+    async def test_detect_image_labels_with_timeout(self):
+        aio_client = _rek_client(delay=5)
+        sagemaker_client = Mock()
+        sagemaker_client.invoke_endpoint = AsyncMock(side_effect=InvocationException('invoke_endpoint', '01', 'msg'))
+        handler = AsyncModerationHandler(rek_client=AsyncRekognitionClient(aio_client=aio_client),
+                                         sagemaker_client=AsyncSageMakerClient(aio_client=sagemaker_client),
+                                         timeout_seconds=0.05)
+
+        with self.assertRaises(InvocationException) as context:
+            await handler.detect_image_labels([bytearray([1, 2, 3])],
+                                              return_sources=['DetectLabels', 'DetectByCustomModels'])
+
+        self.assertIn('DetectLabels has errors', context.exception.message)
+        self.assertIn('Timeout', context.exception.message)
+        self.assertIn('DetectByCustomModels has errors', context.exception.message)
+
+
+    async def test_detect_image_labels_on_other_loops(self):
+        aio_client = _rek_client()
+        handler = AsyncModerationHandler(rek_client=AsyncRekognitionClient(aio_client=aio_client), max_in_flight=1)
+        await handler.detect_image_labels([bytearray([1])], return_sources=['DetectLabels'])
+
+        # the handler is reused on another loop
+        labels = await asyncio.get_running_loop().run_in_executor(
+            None, asyncio.run, handler.detect_image_labels([bytearray([2])], return_sources=['DetectLabels']))
+
+        self.assertEqual(labels, [{'Label': 'Smoking', 'ReturnSource': 'DetectLabels', 'Confidence': 90.0}])
+        self.assertEqual(aio_client.detect_labels.await_count, 2)
+
+class TestAsyncDetectLabels(IsolatedAsyncioTestCase):
+    async def test_detect_labels(self):
+        data = io.BytesIO()
+        Image.new('RGB', (8, 8), color=(255, 0, 0)).save(data, format='JPEG')
+        data = data.getvalue()
+
+        response = MagicMock()
+        response.read = AsyncMock(return_value=data)
+        http_session = Mock()
+        http_session.get = MagicMock(return_value=MagicMock(__aenter__=AsyncMock(return_value=response),
+                                                            __aexit__=AsyncMock(return_value=False)))
+        body = Mock()
+        body.read = AsyncMock(return_value=json.dumps({'CustomLabels': [{'Confidence': 0.7, 'Label': 'Wine'}]}))
+        sagemaker_client = Mock()
+        sagemaker_client.invoke_endpoint = AsyncMock(return_value={'Body': body})
+
+        labels = await detect_labels(AsyncImageHandler(http_session=http_session),
+                                     AsyncModerationHandler(
+                                         sagemaker_client=AsyncSageMakerClient(aio_client=sagemaker_client,
+                                                                               endpoint_name='endpoint')),
+                                     url='https://example.com/sample.jpg',
+                                     return_sources=['DetectByCustomModels'])
+
+        self.assertEqual(labels, [{'Label': 'Wine', 'ReturnSource': 'DetectByCustomModels', 'Confidence': 70.0}])
+        http_session.get.assert_called_once_with('https://example.com/sample.jpg')
+        self.assertEqual(sagemaker_client.invoke_endpoint.call_args.kwargs['EndpointName'], 'endpoint')
+
+    async def test_detect_labels_with_blacklisted_image(self):
+        response = MagicMock()
+        response.read = AsyncMock(return_value=b'blacklisted image')
+        http_session = Mock()
+        http_session.get = MagicMock(return_value=MagicMock(__aenter__=AsyncMock(return_value=response),
+                                                            __aexit__=AsyncMock(return_value=False)))
+        hash_list = InMemoryHashListStore()
+        hash_list.add('Blacklist', [hashlib.sha256(b'blacklisted image').hexdigest()])
+        image_handler = AsyncImageHandler(http_session=http_session, hash_list=hash_list)
+        aio_client = _rek_client()
+
+        labels = await detect_labels(image_handler,
+                                     AsyncModerationHandler(rek_client=AsyncRekognitionClient(aio_client=aio_client)),
+                                     url='https://example.com/blacklisted.jpg',
+                                     return_sources=['DetectLabels'])
+
+        self.assertEqual(labels, [{'Label': 'Blacklisted', 'ReturnSource': 'ImageBlacklist', 'Confidence': 100.0}])
+        aio_client.detect_labels.assert_not_awaited()
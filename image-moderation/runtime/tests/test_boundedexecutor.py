@@ -0,0 +1,39 @@
+from threading import Event
+from unittest import TestCase
+
+from chalicelib.concurrentutils import BoundedExecutor
+from chalicelib.exception import ExecutorRejectedException
+
+
+class TestBoundedExecutor(TestCase):
+    def test_submit(self):
+        executor = BoundedExecutor('test', max_workers=2, max_queue_size=2)
+        futures = [executor.submit(lambda value: value * 2, value) for value in range(4)]
+
+        self.assertEqual([future.result(5) for future in futures], [0, 2, 4, 6])
+        stats = executor.stats()
+        self.assertEqual(stats['Submitted'], 4)
+        self.assertEqual(stats['Completed'], 4)
+        self.assertEqual(stats['Active'], 0)
+        self.assertEqual(stats['Queued'], 0)
+        executor.shutdown()
+
+    def test_submit_with_full_queue(self):
+        executor = BoundedExecutor('test', max_workers=1, max_queue_size=1)
+        release = Event()
+        running = executor.submit(release.wait, 5)
+        queued = executor.submit(lambda: 'queued')
+
+        with self.assertRaises(ExecutorRejectedException):
+            executor.submit(lambda: 'rejected')
+        stats = executor.stats()
+        self.assertEqual(stats['Rejected'], 1)
+        self.assertEqual(stats['Utilisation'], 1.0)
+
+        # the cancelled task releases its slot
+        self.assertTrue(queued.cancel())
+        executor.submit(lambda: 'accepted')
+        release.set()
+        running.result(5)
+        executor.shutdown()
+        self.assertEqual(executor.stats()['Queued'], 0)
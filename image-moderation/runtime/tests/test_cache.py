@@ -0,0 +1,102 @@
+from unittest import TestCase
+
+from chalicelib.cache import LRUCache, TieredCache, verdict_cache_key, backend_response_cache_key
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(TestCase):
+    def test_get_and_put(self):
+        cache = LRUCache(max_size=2, ttl_seconds=10)
+        labels = [{'Label': 'a', 'Confidence': 90}]
+
+        self.assertIsNone(cache.get('key'))
+        cache.put('key', labels)
+
+        # cached value is not changed by callers
+        labels[0]['Label'] = 'changed'
+        cached = cache.get('key')
+        self.assertEqual(cached, [{'Label': 'a', 'Confidence': 90}])
+        cached[0]['Label'] = 'changed'
+        self.assertEqual(cache.get('key'), [{'Label': 'a', 'Confidence': 90}])
+
+        self.assertEqual(cache.stats(), {'Size': 1, 'MaxSize': 2, 'Hits': 2, 'Misses': 1,
+                                         'Evictions': 0, 'Expirations': 0})
+
+    def test_lru_eviction(self):
+        cache = LRUCache(max_size=2, ttl_seconds=10)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        # a is used recently
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['Evictions'], 1)
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl_expiration(self):
+        clock = FakeClock()
+        cache = LRUCache(max_size=2, ttl_seconds=10, clock=clock)
+        cache.put('a', 1)
+        cache.put('b', 2, ttl_seconds=100)
+
+        clock.now = 10
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.stats()['Expirations'], 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_tiered_cache(self):
+        l1 = LRUCache(max_size=1)
+        l2 = LRUCache(max_size=10)
+        cache = TieredCache(l1, l2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+
+        # a is evicted from l1 and found in l2
+        self.assertIsNone(l1.get('a'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(l1.get('a'), 1)
+
+        cache.remove('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['L2']['Size'], 1)
+
+    def test_tiered_cache_keeps_the_l2_ttl(self):
+        clock = FakeClock()
+        l1 = LRUCache(max_size=10, ttl_seconds=100, clock=clock)
+        l2 = LRUCache(max_size=10, ttl_seconds=100, clock=clock)
+        cache = TieredCache(l1, l2)
+        l2.put('a', 1)
+
+        clock.now += 80
+        self.assertEqual(cache.get_with_ttl('a'), (1, 20))
+        self.assertEqual(l1.get_with_ttl('a'), (1, 20))
+
+        # the copy in l1 expires with the entry in l2
+        clock.now += 20
+        self.assertIsNone(l1.get('a'))
+        self.assertIsNone(cache.get('a'))
+
+    def test_verdict_cache_key(self):
+        self.assertEqual(verdict_cache_key('hash', ['FaceSearch', 'DetectLabels'], 60, 50),
+                         verdict_cache_key('hash', ['DetectLabels', 'FaceSearch'], 60, 50))
+        self.assertNotEqual(verdict_cache_key('hash', ['DetectLabels'], 60, 50),
+                            verdict_cache_key('hash', ['DetectLabels'], 70, 50))
+        self.assertNotEqual(verdict_cache_key('hash', ['DetectLabels'], 60, 50),
+                            verdict_cache_key('hash', ['DetectLabels'], 60, 10))
+
+    def test_backend_response_cache_key(self):
+        self.assertEqual(backend_response_cache_key('Rekognition_DetectLabels', bytes([1, 2, 3])),
+                         backend_response_cache_key('Rekognition_DetectLabels', bytearray([1, 2, 3])))
+        self.assertNotEqual(backend_response_cache_key('Rekognition_DetectLabels', bytes([1, 2, 3])),
+                            backend_response_cache_key('Rekognition_DetectModerationLabels', bytes([1, 2, 3])))
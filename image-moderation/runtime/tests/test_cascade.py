@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+from chalicelib.cascade import Cascade
+
+
+class TestCascade(TestCase):
+    def setUp(self):
+        self._cascade = Cascade({'DetectModerationLabels': 1, 'DetectLabels': 2, 'CelebritySearch': 3},
+                                costs={'CelebritySearch': 2.0},
+                                escalation_labels={'Violence': 2})
+
+    def test_plan(self):
+        self.assertEqual(self._cascade.plan(['DetectLabels', 'DetectModerationLabels', 'DetectByCustomModels']),
+                         [(1, ['DetectModerationLabels', 'DetectByCustomModels']), (2, ['DetectLabels'])])
+
+    def test_escalate(self):
+        self.assertFalse(self._cascade.escalate([], [], 2))
+        self.assertFalse(self._cascade.escalate([{'Label': 'Explicit Nudity', 'Confidence': 95.0}], [], 2))
+        self.assertTrue(self._cascade.escalate([{'Label': 'Explicit Nudity', 'Confidence': 70.0}], [], 2))
+        self.assertTrue(self._cascade.escalate([], ['DetectModerationLabels'], 2))
+        # the policy asks for the tiers up to the one of the label
+        self.assertTrue(self._cascade.escalate([{'Label': 'Violence', 'Confidence': 95.0}], [], 2))
+        self.assertFalse(self._cascade.escalate([{'Label': 'Violence', 'Confidence': 95.0}], [], 3))
+
+    def test_stats(self):
+        plan = self._cascade.plan(['DetectModerationLabels', 'DetectLabels', 'CelebritySearch'])
+        self._cascade.record(plan, [1], images=2)
+        self._cascade.record(plan, [1, 2], images=1)
+
+        self.assertEqual(self._cascade.stats(), {'Detections': 2,
+                                                 'TierCalls': {1: 2, 2: 1},
+                                                 'Cost': 4.0,
+                                                 'SavedCost': 8.0})
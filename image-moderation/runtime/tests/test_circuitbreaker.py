@@ -0,0 +1,102 @@
+from unittest import TestCase
+
+from chalicelib.circuitbreaker import CircuitBreaker, guard, CLOSED, OPEN, HALF_OPEN
+from chalicelib.exception import InvocationException
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _unavailable():
+    return InvocationException('Sagemaker_endpoint', 'ServiceUnavailable', 'Service unavailable')
+
+
+class TestCircuitBreaker(TestCase):
+    def _open(self, breaker):
+        for _ in range(4):
+            self.assertTrue(breaker.allow())
+            breaker.on_failure('ServiceUnavailable')
+
+    def test_open_on_failure_rate(self):
+        breaker = CircuitBreaker('InvokeEndpoint', failure_rate_threshold=0.5, min_calls=4)
+        for _ in range(2):
+            breaker.allow()
+            breaker.on_success(0.1)
+        for _ in range(2):
+            breaker.allow()
+            breaker.on_failure('ServiceUnavailable')
+
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.stats()['Rejected'], 1)
+
+    def test_no_open_on_client_errors(self):
+        breaker = CircuitBreaker('InvokeEndpoint', min_calls=4)
+        for _ in range(10):
+            breaker.allow()
+            breaker.on_failure('InvalidImageFormatException')
+
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_open_on_slow_calls(self):
+        breaker = CircuitBreaker('DetectLabels', slow_call_seconds=1.0, slow_call_rate_threshold=0.5, min_calls=4)
+        for latency in [0.1, 2.0, 0.1, 3.0]:
+            breaker.allow()
+            breaker.on_success(latency)
+
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_half_open_probes(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('InvokeEndpoint', min_calls=4, open_seconds=10, half_open_max_calls=2, clock=clock)
+        self._open(breaker)
+
+        clock.now = 10
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+        # probes are limited
+        self.assertFalse(breaker.allow())
+
+        breaker.on_success(0.1)
+        breaker.on_success(0.1)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.stats()['Transitions'], {CLOSED: 1, OPEN: 1, HALF_OPEN: 1})
+
+    def test_half_open_probe_failure(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('InvokeEndpoint', min_calls=4, open_seconds=10, clock=clock)
+        self._open(breaker)
+
+        clock.now = 10
+        self.assertTrue(breaker.allow())
+        breaker.on_failure('ServiceUnavailable')
+        self.assertEqual(breaker.state, OPEN)
+
+        clock.now = 15
+        self.assertFalse(breaker.allow())
+
+
+class TestGuard(TestCase):
+    def test_guard(self):
+        breaker = CircuitBreaker('InvokeEndpoint', min_calls=2)
+        for _ in range(2):
+            with self.assertRaises(InvocationException):
+                with guard({'InvokeEndpoint': breaker}, 'InvokeEndpoint'):
+                    raise _unavailable()
+
+        with self.assertRaises(InvocationException) as context:
+            with guard({'InvokeEndpoint': breaker}, 'InvokeEndpoint'):
+                self.fail('An open circuit runs no call')
+        self.assertEqual(context.exception.error_code, 'CircuitOpen')
+
+        # no breaker for the operation
+        with guard({'InvokeEndpoint': breaker}, 'DetectLabels'):
+            pass
+        with guard(None, 'InvokeEndpoint'):
+            pass
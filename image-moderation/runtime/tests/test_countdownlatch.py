@@ -2,7 +2,7 @@ from time import sleep
 from threading import Thread
 from unittest import TestCase
 
-from chalicelib.concurrentutils import CountDownLatch, ThreadSafeList
+from chalicelib.concurrentutils import CountDownLatch, ThreadSafeList, ResultSlots
 
 
 class TestCountDownLatch(TestCase):
@@ -18,6 +18,12 @@ class TestCountDownLatch(TestCase):
         numberList.append(i)
         latch_wait_complete.count_down()
 
+    def test_wait_with_timeout(self):
+        latch = CountDownLatch(1)
+        self.assertFalse(latch.wait(timeout=0.05))
+        latch.count_down()
+        self.assertTrue(latch.wait(timeout=0.05))
+
     def test_countdown_one_thread(self):
         latch = CountDownLatch(1)
         thread = Thread(target=TestCountDownLatch.task_wait, args=(self, latch))
@@ -128,3 +134,18 @@ class TestThreadSafeList(TestCase):
         for exception in safe_list.exceptions():
             self.assertEqual(exception[0], 'test_operation_name')
             self.assertEqual(exception[1].args[0], 'Test Exception')
+
+
+class TestResultSlots(TestCase):
+    def test_slots(self):
+        slots = ResultSlots(3)
+        slots.slot(2).extend([3])
+        slots.slot(0).extend([1])
+        slots.slot(0).extend([2])
+        slots.slot(1).add_exception('DetectLabels', ValueError('failed'))
+        slots.slot(1).extend([])
+
+        # results are in the order of the tasks
+        self.assertEqual(slots.list(), [1, 2, 3])
+        self.assertTrue(slots.has_exception())
+        self.assertEqual([name for name, _ in slots.exceptions()], ['DetectLabels'])
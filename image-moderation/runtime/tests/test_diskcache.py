@@ -0,0 +1,148 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock, MagicMock
+from threading import Thread
+
+from chalicelib.diskcache import SQLiteCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class TestSQLiteCache(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def test_get_and_put(self):
+        cache = SQLiteCache(path=self._path)
+        frames = [bytes([1, 2, 3]), bytes([4, 5])]
+
+        self.assertIsNone(cache.get('frames'))
+        cache.put('frames', frames)
+        cache.put('labels', [{'Label': 'a', 'Confidence': 90}])
+
+        self.assertEqual(cache.get('frames'), frames)
+        self.assertEqual(cache.get('labels'), [{'Label': 'a', 'Confidence': 90}])
+        self.assertEqual(len(cache), 2)
+
+        cache.remove('frames')
+        self.assertIsNone(cache.get('frames'))
+        stats = cache.stats()
+        self.assertEqual(stats['Hits'], 2)
+        self.assertEqual(stats['Misses'], 2)
+
+    def test_persistence(self):
+        SQLiteCache(path=self._path).put('key', 'value')
+
+        # a new container process opens the same file
+        cache = SQLiteCache(path=self._path)
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertGreater(cache.stats()['Bytes'], 0)
+
+    def test_lru_eviction_by_bytes(self):
+        clock = FakeClock()
+        cache = SQLiteCache(path=self._path, max_bytes=300, clock=clock)
+        for key in ['a', 'b']:
+            cache.put(key, bytes(100))
+            clock.now += 1
+        # a is used recently
+        self.assertIsNotNone(cache.get('a'))
+        clock.now += 1
+        cache.put('c', bytes(100))
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertLessEqual(cache.stats()['Bytes'], 300)
+        self.assertEqual(cache.stats()['Evictions'], 1)
+
+        # values larger than the cache are not cached
+        cache.put('large', bytes(400))
+        self.assertIsNone(cache.get('large'))
+
+    def test_expiration(self):
+        clock = FakeClock()
+        cache = SQLiteCache(path=self._path, ttl_seconds=10, clock=clock)
+        cache.put('a', 1)
+        cache.put('b', 2, ttl_seconds=100)
+
+        clock.now += 10
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.stats()['Expirations'], 1)
+
+    def test_broken_file(self):
+        with open(self._path, 'wb') as broken_file:
+            broken_file.write(b'not a sqlite database' * 100)
+
+        cache = SQLiteCache(path=self._path)
+        cache.put('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+
+    def test_file_broken_at_runtime(self):
+        cache = SQLiteCache(path=self._path)
+        cache.put('key', 'value')
+        cache._close()
+        for suffix in ['-wal', '-shm']:
+            if os.path.exists(self._path + suffix):
+                os.remove(self._path + suffix)
+        with open(self._path, 'wb') as broken_file:
+            broken_file.write(b'not a sqlite database' * 100)
+
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(len(cache), 0)
+        cache.clear()
+        self.assertEqual(cache.stats()['Errors'], 1)
+
+        # the file is created again
+        cache.put('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+
+    def test_stats_with_failing_connection(self):
+        cache = SQLiteCache(path=self._path)
+        connection = Mock()
+        connection.execute = MagicMock(side_effect=sqlite3.OperationalError('disk I/O error'))
+        cache._local.connection = connection
+
+        stats = cache.stats()
+
+        self.assertEqual(stats['Size'], 0)
+        self.assertEqual(stats['Errors'], 1)
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = SQLiteCache(path=self._path, ttl_seconds=100, clock=clock)
+        cache.put('key', 'value')
+
+        clock.now += 30
+        self.assertEqual(cache.get_with_ttl('key'), ('value', 70))
+        self.assertEqual(cache.get_with_ttl('missing'), (None, None))
+
+    def test_concurrent_threads(self):
+        cache = SQLiteCache(path=self._path)
+
+        def put_and_get(index):
+            for round in range(20):
+                cache.put(f'{index}-{round}', [index, round])
+                self.assertEqual(cache.get(f'{index}-{round}'), [index, round])
+
+        threads = [Thread(target=put_and_get, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(cache), 80)
+        self.assertEqual(cache.stats()['Errors'], 0)
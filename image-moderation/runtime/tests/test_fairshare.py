@@ -0,0 +1,73 @@
+from threading import Thread
+from unittest import TestCase
+
+from chalicelib.fairshare import FairShareScheduler
+
+
+class TestFairShareScheduler(TestCase):
+    def _wait_for_waiting(self, scheduler, tenant, count):
+        while scheduler.stats().get(tenant, {}).get('Waiting', 0) < count:
+            pass
+
+    def test_weighted_turns(self):
+        scheduler = FairShareScheduler('DetectLabels', capacity=1, weights={'TeamA': 2})
+        started_at = scheduler.acquire('TeamC')
+        order = []
+
+        def call(tenant):
+            acquired_at = scheduler.acquire(tenant, timeout=5)
+            order.append(tenant)
+            scheduler.release(tenant, acquired_at)
+
+        # the noisy tenant queues first and the most calls
+        threads = []
+        for tenant, count in [('TeamB', 6), ('TeamA', 4)]:
+            for _ in range(count):
+                thread = Thread(target=call, args=(tenant,))
+                thread.start()
+                threads.append(thread)
+            self._wait_for_waiting(scheduler, tenant, count)
+
+        scheduler.release('TeamC', started_at)
+        for thread in threads:
+            thread.join(5)
+        # TeamA gets 2 calls of every 3 while both tenants wait
+        self.assertEqual(order[:6].count('TeamA'), 4)
+        self.assertEqual(order[6:], ['TeamB'] * 4)
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['TeamA']['Calls'], 4)
+        self.assertEqual(stats['TeamA']['Weight'], 2)
+        self.assertEqual(stats['TeamB']['Calls'], 6)
+        self.assertEqual(stats['TeamB']['Weight'], 1.0)
+        self.assertEqual(stats['TeamB']['InFlight'], 0)
+        self.assertGreater(stats['TeamC']['UsageSeconds'], 0)
+
+    def test_acquire_timeout(self):
+        scheduler = FairShareScheduler('DetectLabels', capacity=1)
+        started_at = scheduler.acquire('TeamA', timeout=0)
+        self.assertIsNotNone(started_at)
+
+        self.assertIsNone(scheduler.acquire('TeamB', timeout=0.01))
+        self.assertEqual(scheduler.stats()['TeamB']['Rejected'], 1)
+        self.assertEqual(scheduler.stats()['TeamB']['Waiting'], 0)
+
+        # the tenant which gave up doesn't hold its turn
+        scheduler.release('TeamA', started_at)
+        self.assertIsNotNone(scheduler.acquire('TeamA', timeout=0))
+
+    def test_idle_tenants_dropped(self):
+        scheduler = FairShareScheduler('DetectLabels', capacity=4, weights={'TeamA': 2}, max_tenants=2)
+        for tenant in ['TeamA', 'TeamB']:
+            scheduler.release(tenant, scheduler.acquire(tenant))
+        scheduler.acquire('TeamC')
+
+        self.assertEqual(sorted(scheduler.stats().keys()), ['TeamA', 'TeamC'])
+
+    def test_non_positive_weights(self):
+        with self.assertRaises(ValueError):
+            FairShareScheduler('DetectLabels', weights={'TeamA': 0})
+        with self.assertRaises(ValueError):
+            FairShareScheduler('DetectLabels', default_weight=-1)
+        with self.assertRaises(ValueError):
+            FairShareScheduler('DetectLabels', quantum=0)
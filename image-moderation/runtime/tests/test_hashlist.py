@@ -0,0 +1,94 @@
+from unittest import TestCase
+from unittest.mock import Mock, MagicMock
+
+from chalicelib.hashlist import InMemoryHashListStore, DynamoDBHashListStore
+from chalicelib.cache import LRUCache
+from chalicelib.exception import InvocationException
+
+
+class TestHashList(TestCase):
+    def test_in_memory_store(self):
+        store = InMemoryHashListStore()
+        store.add('Whitelist', ['a', 'b'])
+        store.add('Blacklist', ['b', 'c'])
+
+        self.assertEqual(store.lookup('a'), 'Whitelist')
+        # blacklist wins
+        self.assertEqual(store.lookup('b'), 'Blacklist')
+        self.assertEqual(store.lookup('c'), 'Blacklist')
+        self.assertIsNone(store.lookup('d'))
+
+        store.remove('Blacklist', ['b'])
+        self.assertEqual(store.lookup('b'), 'Whitelist')
+
+    def test_dynamodb_lookup(self):
+        dynamodb_client = Mock()
+        dynamodb_client.batch_get_item = MagicMock(side_effect=[
+            {'Responses': {'black': [], 'white': [{'Hash': {'S': 'a'}}]}},
+            {'Responses': {'black': [{'Hash': {'S': 'b'}}], 'white': [{'Hash': {'S': 'b'}}]}},
+            {'Responses': {'black': [], 'white': []}}])
+
+        store = DynamoDBHashListStore(dynamodb_client, 'black', 'white')
+
+        self.assertEqual(store.lookup('a'), 'Whitelist')
+        self.assertEqual(store.lookup('b'), 'Blacklist')
+        self.assertIsNone(store.lookup('c'))
+
+        # both tables in one request
+        request_items = dynamodb_client.batch_get_item.call_args.kwargs['RequestItems']
+        self.assertEqual(sorted(request_items.keys()), ['black', 'white'])
+        self.assertEqual(request_items['black']['Keys'], [{'Hash': {'S': 'c'}}])
+
+    def test_dynamodb_cached_lookup(self):
+        now = [0.0]
+        dynamodb_client = Mock()
+        dynamodb_client.batch_get_item = MagicMock(return_value={'Responses': {'black': [], 'white': []}})
+        dynamodb_client.batch_write_item = MagicMock(return_value={})
+
+        store = DynamoDBHashListStore(dynamodb_client, 'black', 'white',
+                                      lookup_cache=LRUCache(max_size=10, ttl_seconds=10, clock=lambda: now[0]))
+
+        self.assertIsNone(store.lookup('a'))
+        self.assertIsNone(store.lookup('a'))
+        self.assertEqual(dynamodb_client.batch_get_item.call_count, 1)
+
+        # changes made in this container are seen at once
+        store.add('Blacklist', ['a'])
+        dynamodb_client.batch_get_item.return_value = {'Responses': {'black': [{'Hash': {'S': 'a'}}], 'white': []}}
+        self.assertEqual(store.lookup('a'), 'Blacklist')
+        self.assertEqual(store.lookup('a'), 'Blacklist')
+        self.assertEqual(dynamodb_client.batch_get_item.call_count, 2)
+
+        # changes made by other containers are seen once the lookup expires
+        dynamodb_client.batch_get_item.return_value = {'Responses': {'black': [], 'white': []}}
+        now[0] = 11.0
+        self.assertIsNone(store.lookup('a'))
+        self.assertEqual(dynamodb_client.batch_get_item.call_count, 3)
+
+    def test_dynamodb_add_in_batches(self):
+        dynamodb_client = Mock()
+        unprocessed = {'black': [{'PutRequest': {'Item': {'Hash': {'S': 'h0'}}}}]}
+        dynamodb_client.batch_write_item = MagicMock(side_effect=[
+            {'UnprocessedItems': unprocessed}, {'UnprocessedItems': {}}, {}])
+
+        store = DynamoDBHashListStore(dynamodb_client, 'black', 'white')
+        store.add('Blacklist', ['h%d' % i for i in range(30)])
+
+        calls = dynamodb_client.batch_write_item.call_args_list
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(calls[0].kwargs['RequestItems']['black']), 25)
+        # unprocessed items are retried
+        self.assertEqual(calls[1].kwargs['RequestItems'], unprocessed)
+        self.assertEqual(len(calls[2].kwargs['RequestItems']['black']), 5)
+
+    def test_dynamodb_remove_with_errors(self):
+        dynamodb_client = Mock()
+        dynamodb_client.batch_write_item = MagicMock(side_effect=Exception('throttled'))
+
+        store = DynamoDBHashListStore(dynamodb_client, 'black', 'white')
+        with self.assertRaises(InvocationException) as raised_exception:
+            store.remove('Whitelist', ['a'])
+
+        self.assertEqual(raised_exception.exception.operation_name, 'DynamoDB_BatchWriteItem')
+        self.assertEqual(dynamodb_client.batch_write_item.call_args.kwargs['RequestItems'],
+                         {'white': [{'DeleteRequest': {'Key': {'Hash': {'S': 'a'}}}}]})
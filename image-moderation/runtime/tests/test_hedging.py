@@ -0,0 +1,119 @@
+from time import sleep
+from threading import Event
+from unittest import TestCase
+
+from chalicelib.hedging import Hedger, HedgeBudget, LatencyTracker
+from chalicelib.concurrentutils import Deadline, round_trip
+from chalicelib.exception import DeadlineExceededException
+
+
+class TestLatencyTracker(TestCase):
+    def test_percentile(self):
+        tracker = LatencyTracker(window_size=100, min_samples=10)
+        for latency in range(1, 10):
+            tracker.record(latency / 100)
+        self.assertIsNone(tracker.percentile(95))
+
+        for latency in range(10, 201):
+            tracker.record(latency / 100)
+
+        # the window keeps the latest 100 latencies
+        self.assertEqual(tracker.percentile(95), 1.95)
+        self.assertEqual(tracker.percentile(50), 1.5)
+
+
+class TestHedgeBudget(TestCase):
+    def test_try_acquire(self):
+        budget = HedgeBudget(max_ratio=0.1, max_tokens=2)
+        for _ in range(9):
+            budget.on_call()
+        self.assertFalse(budget.try_acquire())
+
+        for _ in range(100):
+            budget.on_call()
+        # tokens are capped
+        self.assertTrue(budget.try_acquire())
+        self.assertTrue(budget.try_acquire())
+        self.assertFalse(budget.try_acquire())
+
+
+class TestHedger(TestCase):
+    def _warm_up(self, hedger, count=20):
+        for _ in range(count):
+            hedger.call(self._backend_call)
+
+    @staticmethod
+    def _backend_call(wait_seconds=0.0, round_trip_seconds=0.01):
+        # waits in front of the backend, e.g. for a rate limiter, are not timed
+        sleep(wait_seconds)
+        with round_trip():
+            sleep(round_trip_seconds)
+
+    def test_percentile_of_round_trips(self):
+        hedger = Hedger('DetectModerationLabels', percentile=95, max_ratio=0.5)
+        for _ in range(20):
+            # cache hits make no round trip
+            hedger.call(lambda: 'cached')
+        self.assertIsNone(hedger.stats()['HedgeDelayMillis'])
+
+        for _ in range(20):
+            hedger.call(lambda: self._backend_call(wait_seconds=0.05))
+        self.assertLess(hedger.stats()['HedgeDelayMillis'], 40)
+
+    def test_call_with_slow_backend(self):
+        hedger = Hedger('DetectModerationLabels', percentile=95, max_ratio=0.5)
+        self._warm_up(hedger)
+
+        release = Event()
+        calls = []
+
+        def backend():
+            calls.append(1)
+            # the first call is stuck, the hedged call returns
+            if len(calls) == 1:
+                release.wait(5)
+                return 'slow'
+            return 'fast'
+
+        self.assertEqual(hedger.call(backend), 'fast')
+        release.set()
+        self.assertEqual(len(calls), 2)
+        stats = hedger.stats()
+        self.assertEqual(stats['Hedged'], 1)
+        self.assertEqual(stats['HedgeWins'], 1)
+
+    def test_call_with_exhausted_budget(self):
+        hedger = Hedger('DetectByCustomModels', percentile=95, max_ratio=0.01)
+        self._warm_up(hedger)
+        calls = []
+
+        def backend():
+            calls.append(1)
+            sleep(0.1)
+            return 'slow'
+
+        self.assertEqual(hedger.call(backend), 'slow')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(hedger.stats()['BudgetExhausted'], 1)
+
+    def test_call_with_errors(self):
+        hedger = Hedger('DetectLabels', percentile=95, max_ratio=0.5)
+        self._warm_up(hedger)
+
+        def backend():
+            sleep(0.05)
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            hedger.call(backend)
+        self.assertEqual(hedger.stats()['Hedged'], 1)
+
+    def test_call_with_deadline(self):
+        hedger = Hedger('DetectModerationLabels', percentile=95, max_ratio=0.5)
+        self._warm_up(hedger)
+        release = Event()
+
+        with self.assertRaises(DeadlineExceededException):
+            hedger.call(lambda: release.wait(5), deadline=Deadline(0.1))
+        release.set()
+        self.assertEqual(hedger.stats()['Hedged'], 1)
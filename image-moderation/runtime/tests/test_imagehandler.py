@@ -1,12 +1,14 @@
 import os
 import unittest
 from unittest import TestCase, skip
-from unittest.mock import Mock, MagicMock, call
+from unittest.mock import Mock, MagicMock, call, patch
 from PIL import Image
 import boto3
 
 from chalicelib.imagehandler import ImageHandler
-from chalicelib.exception import UnsupportedImageException
+from chalicelib.exception import UnsupportedImageException, BlacklistedImageException
+from chalicelib.hashlist import InMemoryHashListStore
+from chalicelib.cache import LRUCache
 
 
 class TestImages(TestCase):
@@ -28,6 +30,106 @@ class TestImages(TestCase):
         handler._download_image.assert_called_once
         handler._download_image.assert_called_with(url, bucket=None, object_name=None)
 
+    def test_handle_image_with_hash_lists(self):
+        # prepare data
+        url = "www.test.example"
+        blacklisted_data = bytes('1' * 80, 'ascii')
+        whitelisted_data = bytes('2' * 80, 'ascii')
+
+        handler = ImageHandler(hash_list=InMemoryHashListStore())
+        handler._hash_list.add('Blacklist', [handler._generate_hash(blacklisted_data)])
+        handler._hash_list.add('Whitelist', [handler._generate_hash(whitelisted_data)])
+        handler._detect_image_format = MagicMock(return_value=("PNG", False))
+
+        # blacklisted
+        handler._download_image = MagicMock(return_value=blacklisted_data)
+        with self.assertRaises(BlacklistedImageException) as raised_exception:
+            handler.image_handler(url, None, None)
+        self.assertEqual(raised_exception.exception.hash_data, handler._generate_hash(blacklisted_data))
+
+        # whitelisted
+        handler._download_image = MagicMock(return_value=whitelisted_data)
+        empty_list, hashed_key = handler.image_handler(url, None, None)
+        self.assertEqual(len(empty_list), 0)
+        self.assertEqual(hashed_key, handler._generate_hash(whitelisted_data))
+
+        # images are not decoded
+        handler._detect_image_format.assert_not_called()
+
+    def test_handle_image_with_frame_cache(self):
+        # prepare data
+        url = "www.test.example"
+        image_data = bytes('1' * 80, 'ascii')
+
+        handler = ImageHandler(frame_cache=LRUCache())
+        handler._download_image = MagicMock(return_value=image_data)
+        handler._detect_image_format = MagicMock(return_value=("PNG", False))
+
+        frames, hash_data = handler.image_handler(url, None, None)
+        cached_frames, cached_hash_data = handler.image_handler(url, None, None)
+
+        self.assertEqual(cached_frames, frames)
+        self.assertEqual(cached_hash_data, hash_data)
+        # the cached image is not decoded again
+        handler._detect_image_format.assert_called_once()
+
+    @staticmethod
+    def _response(status_code=200, content=b'', headers=None):
+        response = MagicMock()
+        response.__enter__.return_value = response
+        response.status_code = status_code
+        response.ok = status_code < 400
+        response.content = content
+        response.headers = headers or {}
+        return response
+
+    def test_revalidate_url(self):
+        url = "www.test.example"
+        image_data = bytes('1' * 80, 'ascii')
+        url_cache = LRUCache()
+        handler = ImageHandler(url_cache=url_cache)
+        handler._detect_image_format = MagicMock(return_value=("PNG", False))
+
+        # unknown url
+        self.assertIsNone(handler.revalidate_url(url))
+
+        with patch('chalicelib.imagehandler.requests.get') as get:
+            get.return_value = self._response(content=image_data, headers={'ETag': '"v1"',
+                                                                            'Cache-Control': 'max-age=60'})
+            _, hash_data = handler.image_handler(url, None, None)
+
+            # fresh by max age, no request
+            self.assertEqual(handler.revalidate_url(url), hash_data)
+            self.assertEqual(get.call_count, 1)
+
+            # not modified
+            url_cache.put(url, dict(url_cache.get(url), FreshUntil=0))
+            get.return_value = self._response(status_code=304)
+            self.assertEqual(handler.revalidate_url(url), hash_data)
+            get.assert_called_with(url, headers={'If-None-Match': '"v1"'}, timeout=None)
+
+            # modified, the fetched image is handled without downloading again
+            url_cache.put(url, dict(url_cache.get(url), FreshUntil=0))
+            changed_data = bytes('2' * 80, 'ascii')
+            get.return_value = self._response(content=changed_data, headers={'ETag': '"v2"'})
+            self.assertIsNone(handler.revalidate_url(url))
+            _, changed_hash_data = handler.image_handler(url, None, None)
+            self.assertEqual(get.call_count, 3)
+            self.assertEqual(changed_hash_data, handler._generate_hash(changed_data))
+            self.assertEqual(url_cache.get(url)['ETag'], '"v2"')
+
+    def test_head_object(self):
+        s3_client = Mock()
+        s3_client.head_object = MagicMock(return_value={'ETag': '"etag"', 'VersionId': 'v1', 'ContentLength': 10})
+        handler = ImageHandler(s3_client=s3_client)
+
+        self.assertEqual(handler.head_object('bucket', 'key'), {'ETag': '"etag"', 'VersionId': 'v1'})
+        s3_client.head_object.assert_called_once_with(Bucket='bucket', Key='key')
+
+        # falls back to download
+        s3_client.head_object = MagicMock(side_effect=Exception('403'))
+        self.assertIsNone(handler.head_object('bucket', 'key'))
+
     def test_handle_image_with_unknown_format(self):
         # prepare data
         url = "www.test.example"
@@ -0,0 +1,123 @@
+import json
+from threading import Event
+from unittest import TestCase
+from unittest.mock import Mock, MagicMock
+
+from chalicelib.jobqueue import SqsJobQueue, InMemoryJobQueue, InMemoryJobStore, DynamoDBJobStore
+from chalicelib.exception import InvocationException
+
+
+class TestJobQueue(TestCase):
+    def test_sqs_submit(self):
+        sqs_client = Mock()
+        sqs_client.send_message = MagicMock(return_value={'MessageId': '1'})
+
+        queue = SqsJobQueue(sqs_client, 'https://sqs/queue')
+        queue.submit({'JobId': 'job-1', 'Request': {'Image': {'Url': 'https://www.test.com'}}})
+
+        sqs_client.send_message.assert_called_once()
+        kwargs = sqs_client.send_message.call_args.kwargs
+        self.assertEqual(kwargs['QueueUrl'], 'https://sqs/queue')
+        self.assertEqual(json.loads(kwargs['MessageBody'])['JobId'], 'job-1')
+
+    def test_sqs_submit_with_errors(self):
+        sqs_client = Mock()
+        sqs_client.send_message = MagicMock(side_effect=Exception('throttled'))
+
+        queue = SqsJobQueue(sqs_client, 'https://sqs/queue')
+        with self.assertRaises(InvocationException) as raised_exception:
+            queue.submit({'JobId': 'job-1'})
+
+        self.assertEqual(raised_exception.exception.operation_name, 'SQS_SendMessage')
+
+    def test_in_memory_queue_receives_failed_jobs_again(self):
+        receive_counts = []
+
+        def worker(job, receive_count):
+            receive_counts.append(receive_count)
+            if receive_count < 2:
+                raise Exception('throttled')
+
+        queue = InMemoryJobQueue(worker=worker, max_receive_count=3)
+        queue.submit({'JobId': 'job-1'})
+        queue.join()
+
+        self.assertEqual(receive_counts, [1, 2])
+
+    def test_in_memory_queue_consumes_jobs(self):
+        consumed = []
+        failed = Event()
+
+        def worker(job, receive_count):
+            if job['JobId'] == 'bad':
+                failed.set()
+                raise Exception('bad job')
+            consumed.append(job['JobId'])
+
+        queue = InMemoryJobQueue(worker=worker)
+        queue.submit({'JobId': 'bad'})
+        queue.submit({'JobId': 'job-1'})
+        queue.submit({'JobId': 'job-2'})
+        queue.join()
+
+        # a failed job doesn't stop the consumer
+        self.assertTrue(failed.is_set())
+        self.assertEqual(consumed, ['job-1', 'job-2'])
+
+
+class TestJobStore(TestCase):
+    def test_in_memory_store_lifecycle(self):
+        store = InMemoryJobStore()
+        self.assertIsNone(store.get('job-1'))
+
+        store.create('job-1', {'Image': {}})
+        self.assertEqual(store.get('job-1')['Status'], 'SUBMITTED')
+
+        store.start('job-1')
+        self.assertEqual(store.get('job-1')['Status'], 'IN_PROGRESS')
+
+        store.complete('job-1', [{'Label': 'a', 'Confidence': 90}])
+        job = store.get('job-1')
+        self.assertEqual(job['Status'], 'SUCCEEDED')
+        self.assertEqual(job['Labels'], [{'Label': 'a', 'Confidence': 90}])
+
+        store.create('job-2', {'Image': {}})
+        store.fail('job-2', 'BadRequestError', 'Unsupported image format UNKNOWN')
+        job = store.get('job-2')
+        self.assertEqual(job['Status'], 'FAILED')
+        self.assertEqual(job['Error'], {'Code': 'BadRequestError', 'Message': 'Unsupported image format UNKNOWN'})
+
+    def test_dynamodb_store(self):
+        dynamodb_client = Mock()
+        dynamodb_client.get_item = MagicMock(return_value={'Item': {
+            'JobId': {'S': 'job-1'},
+            'Status': {'S': 'SUCCEEDED'},
+            'CreatedAt': {'N': '100'},
+            'Labels': {'S': json.dumps([{'Label': 'a', 'Confidence': 90}])}}})
+
+        store = DynamoDBJobStore(dynamodb_client, 'jobs', ttl_seconds=60)
+        store.create('job-1', {'Image': {}})
+        store.complete('job-1', [{'Label': 'a', 'Confidence': 90}])
+        job = store.get('job-1')
+
+        # verify put item
+        item = dynamodb_client.put_item.call_args.kwargs['Item']
+        self.assertEqual(item['Status'], {'S': 'SUBMITTED'})
+        self.assertEqual(int(item['ExpiresAt']['N']) - int(item['CreatedAt']['N']), 60)
+
+        # verify update item
+        kwargs = dynamodb_client.update_item.call_args.kwargs
+        self.assertEqual(kwargs['Key'], {'JobId': {'S': 'job-1'}})
+        self.assertEqual(kwargs['UpdateExpression'], 'SET #n0 = :v0, #n1 = :v1')
+        self.assertEqual(kwargs['ExpressionAttributeNames'], {'#n0': 'Status', '#n1': 'Labels'})
+
+        # verify job
+        self.assertEqual(job, {'JobId': 'job-1', 'Status': 'SUCCEEDED', 'CreatedAt': 100,
+                               'Labels': [{'Label': 'a', 'Confidence': 90}]})
+
+    def test_dynamodb_store_without_job(self):
+        dynamodb_client = Mock()
+        dynamodb_client.get_item = MagicMock(return_value={})
+
+        store = DynamoDBJobStore(dynamodb_client, 'jobs')
+        self.assertIsNone(store.get('job-1'))
@@ -0,0 +1,53 @@
+from threading import Thread, Event
+from unittest import TestCase
+
+from chalicelib.lanes import LaneScheduler, INTERACTIVE, BULK
+
+
+class TestLaneScheduler(TestCase):
+    def test_reserved_slots(self):
+        scheduler = LaneScheduler('DetectLabels', capacity=3, reserved=1)
+
+        bulk = [scheduler.acquire(BULK, timeout=0) for _ in range(3)]
+        # bulk calls get the leftover of the reserved slots only
+        self.assertIsNotNone(bulk[0])
+        self.assertIsNotNone(bulk[1])
+        self.assertIsNone(bulk[2])
+
+        interactive = scheduler.acquire(INTERACTIVE, timeout=0)
+        self.assertIsNotNone(interactive)
+        self.assertIsNone(scheduler.acquire(INTERACTIVE, timeout=0))
+
+        scheduler.release(INTERACTIVE, interactive)
+        stats = scheduler.stats()
+        self.assertEqual(stats[BULK]['InFlight'], 2)
+        self.assertEqual(stats[BULK]['Rejected'], 1)
+        self.assertEqual(stats[INTERACTIVE]['Calls'], 1)
+        self.assertIsNotNone(stats[INTERACTIVE]['P99Millis'])
+
+    def test_interactive_ahead_of_queued_bulk(self):
+        scheduler = LaneScheduler('DetectLabels', capacity=1, reserved=0)
+        started_at = scheduler.acquire(BULK)
+        order = []
+        bulk_waiting = Event()
+
+        def call(lane, waiting=None):
+            if waiting is not None:
+                waiting.set()
+            acquired_at = scheduler.acquire(lane, timeout=5)
+            order.append(lane)
+            scheduler.release(lane, acquired_at)
+
+        bulk = Thread(target=call, args=(BULK, bulk_waiting))
+        bulk.start()
+        bulk_waiting.wait(5)
+        interactive = Thread(target=call, args=(INTERACTIVE,))
+        interactive.start()
+        # the bulk call queued first, the interactive one goes first once both are waiting
+        while scheduler.stats()[INTERACTIVE]['Waiting'] == 0 or scheduler.stats()[BULK]['Waiting'] == 0:
+            pass
+
+        scheduler.release(BULK, started_at)
+        bulk.join(5)
+        interactive.join(5)
+        self.assertEqual(order, [INTERACTIVE, BULK])
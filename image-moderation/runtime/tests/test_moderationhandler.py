@@ -1,8 +1,20 @@
+from time import sleep, monotonic
+from threading import Lock, BoundedSemaphore, Event
 from unittest import TestCase
 from unittest.mock import Mock, MagicMock, call
 
-from chalicelib.moderationhandler import ModerationHandler
+from chalicelib.moderationhandler import ModerationHandler, DetectedLabels
 from chalicelib.exception import InvocationException
+from chalicelib.concurrentutils import BoundedExecutor, Deadline, round_trip
+from chalicelib.hedging import Hedger
+from chalicelib.retry import RetryPolicy
+from chalicelib.adaptivelimit import AdaptiveConcurrencyLimiter
+from chalicelib.lanes import LaneScheduler
+from chalicelib.fairshare import FairShareScheduler
+from chalicelib.ratelimit import RateLimiter
+from chalicelib.cascade import Cascade
+from chalicelib.rekognition import RekognitonClient
+from chalicelib.cache import LRUCache
 
 
 class TestDetectLabelsAPI(TestCase):
@@ -275,6 +287,118 @@ class TestDetectLabelsAPI(TestCase):
         sagemaker_client.detect_labels.assert_has_calls(calls=sagemaker_detect_labels_calls,
                                                         any_order=True)
 
+    def test_detect_image_labels_with_concurrency_budget(self):
+        image_list = [bytearray([1, 2, 3])]
+        in_flight = []
+        max_in_flight = []
+        lock = Lock()
+
+        def backend_call(**kwargs):
+            with lock:
+                in_flight.append(1)
+                max_in_flight.append(len(in_flight))
+            sleep(0.05)
+            with lock:
+                in_flight.pop()
+            return [{'Label': 'a', 'Confidence': 30}]
+
+        rek_client = Mock()
+        rek_client.detect_labels = MagicMock(side_effect=backend_call)
+        rek_client.detect_moderation_labels = MagicMock(side_effect=backend_call)
+        sagemaker_client = Mock()
+        sagemaker_client.detect_labels = MagicMock(side_effect=backend_call)
+
+        # handler
+        handler = ModerationHandler(rek_client=rek_client,
+                                    sagemaker_client=sagemaker_client,
+                                    concurrency_budget=BoundedSemaphore(1))
+
+        # invoke
+        results = handler.detect_image_labels(images=image_list,
+                                              return_sources=["DetectLabels", "DetectModerationLabels",
+                                                              "DetectByCustomModels"],
+                                              min_confidence=1,
+                                              max_labels=4)
+
+        # verify results
+        self.assertEqual(1, len(results))
+        self.assertEqual(3, len(max_in_flight))
+        self.assertEqual(1, max(max_in_flight))
+
+    def test_detect_image_labels_with_executors(self):
+        image_list = [bytearray([1, 2, 3]), bytearray([4, 5, 6])]
+
+        rek_client = Mock()
+        rek_client.detect_labels = MagicMock(return_value=[{'Label': 'a', 'Confidence': 30}])
+        sagemaker_client = Mock()
+        sagemaker_client.detect_labels = MagicMock(return_value=[{'Label': 'custom', 'Confidence': 90}])
+        executors = {'DetectLabels': BoundedExecutor('DetectLabels', max_workers=1, max_queue_size=2),
+                     'DetectByCustomModels': BoundedExecutor('DetectByCustomModels', max_workers=1,
+                                                             max_queue_size=1)}
+
+        handler = ModerationHandler(rek_client=rek_client,
+                                    sagemaker_client=sagemaker_client,
+                                    executors=executors)
+
+        results = handler.detect_image_labels(images=image_list,
+                                              return_sources=["DetectLabels", "DetectByCustomModels"],
+                                              min_confidence=1,
+                                              max_labels=4)
+        self.assertEqual(2, len(results))
+        self.assertEqual(executors['DetectLabels'].stats()['Completed'], 2)
+        self.assertEqual(executors['DetectByCustomModels'].stats()['Completed'], 2)
+
+        # a slow custom model endpoint fills its own pool only
+        release = Event()
+        blocked = [executors['DetectByCustomModels'].submit(release.wait, 5) for _ in range(2)]
+        with self.assertRaises(InvocationException) as raised_exception:
+            handler.detect_image_labels(images=image_list,
+                                        return_sources=["DetectLabels", "DetectByCustomModels"],
+                                        min_confidence=1,
+                                        max_labels=4)
+        release.set()
+        for future in blocked:
+            future.result(5)
+
+        self.assertTrue('DetectByCustomModels has errors: ' in raised_exception.exception.message)
+        self.assertEqual(rek_client.detect_labels.call_count, 4)
+        self.assertEqual(executors['DetectByCustomModels'].stats()['Rejected'], 2)
+
+    def test_detect_image_labels_with_multiple_frames(self):
+        image_list = [bytearray([index]) for index in range(6)]
+        in_flight = []
+        max_in_flight = []
+        lock = Lock()
+
+        def backend_call(image_bytes, **kwargs):
+            with lock:
+                in_flight.append(1)
+                max_in_flight.append(len(in_flight))
+            sleep(0.1)
+            with lock:
+                in_flight.pop()
+            return [{'Label': f'frame{image_bytes[0]}', 'Confidence': 30 + image_bytes[0]}]
+
+        rek_client = Mock()
+        rek_client.detect_labels = MagicMock(side_effect=backend_call)
+        rek_client.detect_moderation_labels = MagicMock(side_effect=backend_call)
+
+        handler = ModerationHandler(rek_client=rek_client,
+                                    max_in_flight=BoundedSemaphore(6))
+
+        started = monotonic()
+        results = handler.detect_image_labels(images=image_list,
+                                              return_sources=["DetectLabels", "DetectModerationLabels"],
+                                              min_confidence=1,
+                                              max_labels=10)
+        lapsed = monotonic() - started
+
+        # results of every frame are collected, frames are not detected one after another
+        self.assertEqual(sorted(label['Label'] for label in results), [f'frame{index}' for index in range(6)])
+        self.assertEqual(12, len(max_in_flight))
+        self.assertEqual(6, max(max_in_flight))
+        self.assertLess(lapsed, 0.5)
+
     def test_merge_results(self):
         results = ModerationHandler.merge_results(
             [{'Label': 'a', 'Confidence': 30},
@@ -338,3 +462,389 @@ class TestDetectLabelsAPI(TestCase):
         self.assertEqual('detect_moderation_labels', ModerationHandler._camel_to_snake('DetectModerationLabels'))
         self.assertEqual('face_search', ModerationHandler._camel_to_snake('FaceSearch'))
         self.assertEqual('detect_by_custom_models', ModerationHandler._camel_to_snake('DetectByCustomModels'))
+
+
+class TestDeadline(TestCase):
+    def test_detect_image_labels_with_deadline(self):
+        release = Event()
+        rek_client = Mock()
+        rek_client.detect_labels = MagicMock(side_effect=lambda **kwargs: release.wait(5) and [])
+        rek_client.detect_moderation_labels = MagicMock(return_value=[
+            {'Label': 'Violence', 'ReturnSource': 'DetectModerationLabels', 'Confidence': 80.0}])
+        handler = ModerationHandler(rek_client=rek_client, deadline=Deadline(0.2))
+
+        started = monotonic()
+        with self.assertRaises(InvocationException) as context:
+            handler.detect_image_labels(images=[bytearray([1, 2, 3])],
+                                        return_sources=['DetectLabels', 'DetectModerationLabels'])
+        release.set()
+
+        # the response doesn't wait for the backend call in flight
+        self.assertLess(monotonic() - started, 1)
+        self.assertIn('DetectLabels has errors', context.exception.message)
+        self.assertIn('DeadlineExceeded', context.exception.message)
+        self.assertNotIn('DetectModerationLabels has errors', context.exception.message)
+
+    def test_detect_image_labels_with_deadline_of_clients(self):
+        rek_client = Mock()
+        rek_client.detect_labels = MagicMock(return_value=[])
+        deadline = Deadline(5)
+        handler = ModerationHandler(rek_client=rek_client, deadline=deadline)
+
+        handler.detect_image_labels(images=[bytearray([1, 2, 3])], return_sources=['DetectLabels'])
+
+        # clients bound the wait for their rate limiters by the deadline
+        self.assertIs(rek_client.detect_labels.call_args.kwargs['deadline'], deadline)
+
+    def test_detect_image_labels_after_deadline(self):
+        rek_client = Mock()
+        handler = ModerationHandler(rek_client=rek_client, deadline=Deadline(0))
+
+        with self.assertRaises(InvocationException) as context:
+            handler.detect_image_labels(images=[bytearray([1, 2, 3])], return_sources=['DetectLabels'])
+
+        self.assertIn('DeadlineExceeded', context.exception.message)
+        rek_client.detect_labels.assert_not_called()
+
+
+class TestPartialResults(TestCase):
+    def _rek_client(self):
+        rek_client = Mock()
+        rek_client.detect_labels = MagicMock(
+            side_effect=InvocationException('Rekognition_DetectLabels', 'ThrottlingException', 'Rate exceeded'))
+        rek_client.detect_moderation_labels = MagicMock(return_value=[
+            {'Label': 'Violence', 'ReturnSource': 'DetectModerationLabels', 'Confidence': 80.0}])
+        return rek_client
+
+    def test_detect_image_labels_with_partial_results(self):
+        handler = ModerationHandler(rek_client=self._rek_client())
+
+        labels = handler.detect_image_labels(images=[bytearray([1, 2, 3])],
+                                             return_sources=['DetectLabels', 'DetectModerationLabels'],
+                                             mandatory_return_sources=['DetectModerationLabels'])
+
+        self.assertIsInstance(labels, DetectedLabels)
+        self.assertEqual(labels, [{'Label': 'Violence', 'ReturnSource': 'DetectModerationLabels', 'Confidence': 80.0}])
+        self.assertTrue(labels.degraded)
+        self.assertEqual(labels.source_status['DetectLabels']['Status'], 'Throttled')
+        self.assertEqual(labels.source_status['DetectLabels']['ErrorCode'], 'ThrottlingException')
+        self.assertEqual(labels.source_status['DetectModerationLabels']['Status'], 'Ok')
+        self.assertIn('LatencyMillis', labels.source_status['DetectModerationLabels'])
+
+    def test_detect_image_labels_with_mandatory_source_error(self):
+        handler = ModerationHandler(rek_client=self._rek_client())
+
+        with self.assertRaises(InvocationException):
+            handler.detect_image_labels(images=[bytearray([1, 2, 3])],
+                                        return_sources=['DetectLabels', 'DetectModerationLabels'],
+                                        mandatory_return_sources=['DetectLabels'])
+        # every source is mandatory by default
+        with self.assertRaises(InvocationException):
+            handler.detect_image_labels(images=[bytearray([1, 2, 3])],
+                                        return_sources=['DetectLabels', 'DetectModerationLabels'])
+
+
+class TestHedging(TestCase):
+    def test_detect_image_labels_with_hedger(self):
+        calls = []
+        release = Event()
+
+        def detect_moderation_labels(**kwargs):
+            calls.append(1)
+            # calls after the warm up are stuck except for the hedged one
+            with round_trip():
+                if len(calls) == 21:
+                    release.wait(5)
+            return [{'Label': 'Violence', 'ReturnSource': 'DetectModerationLabels', 'Confidence': 80.0}]
+
+        rek_client = Mock()
+        rek_client.detect_moderation_labels = MagicMock(side_effect=detect_moderation_labels)
+        rek_client.detect_labels = MagicMock(return_value=[])
+        hedger = Hedger('DetectModerationLabels', max_ratio=0.5)
+        handler = ModerationHandler(rek_client=rek_client, hedgers={'DetectModerationLabels': hedger})
+
+        for _ in range(21):
+            labels = handler.detect_image_labels(images=[bytearray([1, 2, 3])],
+                                                 return_sources=['DetectLabels', 'DetectModerationLabels'])
+            self.assertEqual(labels, [{'Label': 'Violence', 'ReturnSource': 'DetectModerationLabels',
+                                       'Confidence': 80.0}])
+        release.set()
+
+        self.assertEqual(rek_client.detect_moderation_labels.call_count, 22)
+        # only the hedged return source is called through the hedger
+        self.assertEqual(rek_client.detect_labels.call_count, 21)
+        self.assertEqual(hedger.stats()['HedgeWins'], 1)
+
+    def test_hedged_call_takes_its_own_quota(self):
+        calls = []
+        release = Event()
+
+        def detect_moderation_labels(**kwargs):
+            calls.append(1)
+            with round_trip():
+                if len(calls) == 21:
+                    release.wait(5)
+            return []
+
+        rek_client = Mock()
+        rek_client.detect_moderation_labels = MagicMock(side_effect=detect_moderation_labels)
+        quota = Mock()
+        quota.acquire = MagicMock(return_value=True)
+        limiter = AdaptiveConcurrencyLimiter('DetectModerationLabels', initial_limit=16)
+        handler = ModerationHandler(rek_client=rek_client,
+                                    hedgers={'DetectModerationLabels': Hedger('DetectModerationLabels', max_ratio=0.5)},
+                                    concurrency_limiters={'DetectModerationLabels': limiter},
+                                    tenant='TeamA', tenant_quota=quota)
+
+        for _ in range(21):
+            handler.detect_image_labels(images=[bytearray([1, 2, 3])], return_sources=['DetectModerationLabels'])
+        self.assertEqual(limiter.stats()['InFlight'], 1)
+        release.set()
+
+        self.assertEqual(rek_client.detect_moderation_labels.call_count, 22)
+        self.assertEqual(quota.acquire.call_count, 22)
+
+
+class TestRetries(TestCase):
+    def test_detect_image_labels_with_retry_policy(self):
+        rek_client = Mock()
+        rek_client.detect_moderation_labels = MagicMock(side_effect=[
+            InvocationException('Rekognition_DetectModerationLabels', 'ThrottlingException', 'Rate exceeded'),
+            [{'Label': 'Violence', 'ReturnSource': 'DetectModerationLabels', 'Confidence': 80.0}]])
+        handler = ModerationHandler(rek_client=rek_client, retry_policy=RetryPolicy(base_seconds=0.01))
+
+        labels = handler.detect_image_labels(images=[bytearray([1, 2, 3])], return_sources=['DetectModerationLabels'])
+
+        self.assertEqual(labels, [{'Label': 'Violence', 'ReturnSource': 'DetectModerationLabels', 'Confidence': 80.0}])
+        self.assertEqual(rek_client.detect_moderation_labels.call_count, 2)
+
+
+class TestConcurrencyLimits(TestCase):
+    def test_detect_image_labels_with_throttles(self):
+        rek_client = Mock()
+        rek_client.detect_labels = MagicMock(
+            side_effect=InvocationException('Rekognition_DetectLabels', 'ThrottlingException', 'Rate exceeded'))
+        rek_client.detect_moderation_labels = MagicMock(return_value=[])
+        limiters = {'DetectLabels': AdaptiveConcurrencyLimiter('DetectLabels', initial_limit=16, backoff_ratio=0.5),
+                    'DetectModerationLabels': AdaptiveConcurrencyLimiter('DetectModerationLabels', initial_limit=16)}
+        handler = ModerationHandler(rek_client=rek_client, concurrency_limiters=limiters)
+
+        with self.assertRaises(InvocationException):
+            handler.detect_image_labels(images=[bytearray([1, 2, 3])],
+                                        return_sources=['DetectLabels', 'DetectModerationLabels'])
+
+        self.assertEqual(limiters['DetectLabels'].limit, 8)
+        self.assertEqual(limiters['DetectLabels'].stats()['InFlight'], 0)
+        self.assertEqual(limiters['DetectModerationLabels'].limit, 16)
+
+    def test_detect_image_labels_with_limit_reached(self):
+        rek_client = Mock()
+        limiter = AdaptiveConcurrencyLimiter('DetectLabels', initial_limit=1)
+        limiter.acquire()
+        handler = ModerationHandler(rek_client=rek_client, concurrency_limiters={'DetectLabels': limiter},
+                                    deadline=Deadline(0.1))
+
+        with self.assertRaises(InvocationException) as context:
+            handler.detect_image_labels(images=[bytearray([1, 2, 3])], return_sources=['DetectLabels'])
+
+        # the call waits for the limiter until the deadline
+        self.assertRegex(context.exception.message, 'DeadlineExceeded|ConcurrencyLimited')
+        rek_client.detect_labels.assert_not_called()
+
+
+    def test_detect_image_labels_with_cached_responses(self):
+        def detect_moderation_labels(**kwargs):
+            sleep(0.02)
+            return {'ModerationLabels': [{'Confidence': 77, 'Name': 'Drinking'}]}
+
+        rek_client_boto3 = Mock()
+        rek_client_boto3.detect_moderation_labels = MagicMock(side_effect=detect_moderation_labels)
+        rek_client = RekognitonClient(rek_client_boto3, response_cache=LRUCache(), cached_min_confidence=50)
+        limiter = AdaptiveConcurrencyLimiter('DetectModerationLabels', initial_limit=16)
+        handler = ModerationHandler(rek_client=rek_client, concurrency_limiters={'DetectModerationLabels': limiter})
+
+        for images in [[bytearray([1, 2, 3])], [bytearray([1, 2, 3])], [bytearray([4, 5, 6])]]:
+            handler.detect_image_labels(images=images, return_sources=['DetectModerationLabels'])
+
+        # the cache hit is not a latency sample, it would make the backend calls look slow and shrink the limit
+        self.assertEqual(rek_client_boto3.detect_moderation_labels.call_count, 2)
+        self.assertEqual(limiter.limit, 16)
+        self.assertGreaterEqual(limiter.stats()['MinLatencyMillis'], 20)
+
+
+class TestCircuitBreakers(TestCase):
+    def _sagemaker_client(self):
+        sagemaker_client = Mock()
+        sagemaker_client.detect_labels = MagicMock(
+            side_effect=InvocationException('InvokeEndpoint', 'CircuitOpen', 'Circuit of InvokeEndpoint is open'))
+        return sagemaker_client
+
+    def test_detect_image_labels_with_skippable_source(self):
+        rek_client = Mock()
+        rek_client.detect_moderation_labels = MagicMock(return_value=[
+            {'Label': 'Violence', 'ReturnSource': 'DetectModerationLabels', 'Confidence': 80.0}])
+        handler = ModerationHandler(rek_client=rek_client, sagemaker_client=self._sagemaker_client(),
+                                    skippable_return_sources=['DetectByCustomModels'])
+
+        labels = handler.detect_image_labels(images=[bytearray([1, 2, 3])],
+                                             return_sources=['DetectModerationLabels', 'DetectByCustomModels'])
+
+        self.assertEqual(labels, [{'Label': 'Violence', 'ReturnSource': 'DetectModerationLabels', 'Confidence': 80.0}])
+        self.assertTrue(labels.degraded)
+        self.assertEqual(labels.source_status['DetectByCustomModels']['Status'], 'Skipped')
+
+    def test_detect_image_labels_with_open_circuit(self):
+        rek_client = Mock()
+        rek_client.detect_moderation_labels = MagicMock(return_value=[])
+        handler = ModerationHandler(rek_client=rek_client, sagemaker_client=self._sagemaker_client())
+
+        with self.assertRaises(InvocationException) as context:
+            handler.detect_image_labels(images=[bytearray([1, 2, 3])],
+                                        return_sources=['DetectModerationLabels', 'DetectByCustomModels'])
+
+        self.assertIn('CircuitOpen', context.exception.message)
+
+
+class TestLanes(TestCase):
+    def test_detect_image_labels_in_bulk_lane(self):
+        rek_client = Mock()
+        rek_client.detect_labels = MagicMock(return_value=[])
+        scheduler = LaneScheduler('DetectLabels', capacity=2, reserved=2)
+        handler = ModerationHandler(rek_client=rek_client, lane_schedulers={'DetectLabels': scheduler}, lane='Bulk',
+                                    deadline=Deadline(0.1))
+
+        # every slot is reserved to interactive calls
+        with self.assertRaises(InvocationException):
+            handler.detect_image_labels(images=[bytearray([1, 2, 3])], return_sources=['DetectLabels'])
+        rek_client.detect_labels.assert_not_called()
+
+        handler = ModerationHandler(rek_client=rek_client, lane_schedulers={'DetectLabels': scheduler})
+        handler.detect_image_labels(images=[bytearray([1, 2, 3])], return_sources=['DetectLabels'])
+        rek_client.detect_labels.assert_called_once()
+        self.assertEqual(scheduler.stats()['Interactive']['Calls'], 1)
+
+
+class TestFairShare(TestCase):
+    def test_detect_image_labels_of_tenant(self):
+        rek_client = Mock()
+        rek_client.detect_labels = MagicMock(return_value=[])
+        scheduler = FairShareScheduler('DetectLabels')
+        quota = RateLimiter('TeamA', rate=0.001, burst=1, max_wait_seconds=0)
+        handler = ModerationHandler(rek_client=rek_client, fair_share_schedulers={'DetectLabels': scheduler},
+                                    tenant='TeamA', tenant_quota=quota)
+
+        handler.detect_image_labels(images=[bytearray([1, 2, 3])], return_sources=['DetectLabels'])
+        self.assertEqual(scheduler.stats()['TeamA']['Calls'], 1)
+
+        # the quota is spent, the call isn't made
+        with self.assertRaisesRegex(InvocationException, 'TenantThrottled'):
+            handler.detect_image_labels(images=[bytearray([1, 2, 3])], return_sources=['DetectLabels'])
+        rek_client.detect_labels.assert_called_once()
+        self.assertEqual(scheduler.stats()['TeamA']['Calls'], 1)
+        self.assertEqual(quota.stats()['Rejected'], 1)
+
+
+class TestEarlyExit(TestCase):
+    _DECISIVE_LABEL = {'Label': 'Explicit Nudity', 'Confidence': 98.0, 'ReturnSource': 'DetectModerationLabels'}
+
+    def test_detect_image_labels_with_decisive_label(self):
+        rek_client = Mock()
+        rek_client.detect_moderation_labels = MagicMock(return_value=[self._DECISIVE_LABEL])
+        # frames after the first one wait for the only worker
+        executors = {'DetectModerationLabels': BoundedExecutor('DetectModerationLabels', max_workers=1)}
+        handler = ModerationHandler(rek_client=rek_client, executors=executors,
+                                    decisive_labels={'Explicit Nudity': 95.0})
+
+        labels = handler.detect_image_labels(images=[bytearray([1]), bytearray([2]), bytearray([3])],
+                                             return_sources=['DetectModerationLabels'])
+
+        self.assertEqual(labels, [self._DECISIVE_LABEL])
+        self.assertTrue(labels.short_circuited)
+        self.assertFalse(labels.degraded)
+        self.assertEqual(labels.source_status['DetectModerationLabels']['Status'], 'ShortCircuited')
+        rek_client.detect_moderation_labels.assert_called_once()
+
+    def test_detect_image_labels_ignoring_tasks_in_flight(self):
+        released = Event()
+
+        def detect_labels(**kwargs):
+            released.wait(5)
+            return [{'Label': 'Gun', 'Confidence': 90.0, 'ReturnSource': 'DetectLabels'}]
+
+        rek_client = Mock()
+        rek_client.detect_labels = MagicMock(side_effect=detect_labels)
+        rek_client.detect_moderation_labels = MagicMock(return_value=[self._DECISIVE_LABEL])
+        handler = ModerationHandler(rek_client=rek_client, decisive_labels={'Explicit Nudity': 95.0})
+
+        try:
+            labels = handler.detect_image_labels(images=[bytearray([1, 2, 3])],
+                                                 return_sources=['DetectLabels', 'DetectModerationLabels'])
+        finally:
+            released.set()
+
+        self.assertEqual(labels, [self._DECISIVE_LABEL])
+        self.assertTrue(labels.short_circuited)
+        self.assertEqual(labels.source_status['DetectLabels']['Status'], 'ShortCircuited')
+        self.assertEqual(labels.source_status['DetectModerationLabels']['Status'], 'Ok')
+
+    def test_detect_image_labels_below_decisive_confidence(self):
+        label = dict(self._DECISIVE_LABEL, Confidence=80.0)
+        rek_client = Mock()
+        rek_client.detect_moderation_labels = MagicMock(return_value=[label])
+        handler = ModerationHandler(rek_client=rek_client, decisive_labels={'Explicit Nudity': 95.0})
+
+        labels = handler.detect_image_labels(images=[bytearray([1]), bytearray([2])],
+                                             return_sources=['DetectModerationLabels'])
+
+        self.assertEqual(labels, [label])
+        self.assertFalse(labels.short_circuited)
+        self.assertEqual(rek_client.detect_moderation_labels.call_count, 2)
+
+
+class TestCascade(TestCase):
+    def _handler(self, moderation_labels):
+        rek_client = Mock()
+        rek_client.detect_moderation_labels = MagicMock(return_value=moderation_labels)
+        rek_client.detect_labels = MagicMock(return_value=[{'Label': 'Gun', 'Confidence': 90.0,
+                                                            'ReturnSource': 'DetectLabels'}])
+        return ModerationHandler(rek_client=rek_client,
+                                 cascade=Cascade({'DetectModerationLabels': 1, 'DetectLabels': 2})), rek_client
+
+    def test_detect_image_labels_with_certain_first_tier(self):
+        label = {'Label': 'Smoking', 'Confidence': 95.0, 'ReturnSource': 'DetectModerationLabels'}
+        handler, rek_client = self._handler([label])
+
+        labels = handler.detect_image_labels(images=[bytearray([1]), bytearray([2])],
+                                             return_sources=['DetectLabels', 'DetectModerationLabels'])
+
+        self.assertEqual(labels, [label])
+        self.assertEqual(labels.tiers, [1])
+        self.assertEqual(list(labels.source_status.keys()), ['DetectModerationLabels'])
+        self.assertEqual(rek_client.detect_moderation_labels.call_count, 2)
+        rek_client.detect_labels.assert_not_called()
+
+    def test_detect_image_labels_with_uncertain_first_tier(self):
+        label = {'Label': 'Smoking', 'Confidence': 70.0, 'ReturnSource': 'DetectModerationLabels'}
+        handler, rek_client = self._handler([label])
+
+        labels = handler.detect_image_labels(images=[bytearray([1])],
+                                             return_sources=['DetectLabels', 'DetectModerationLabels'])
+
+        self.assertEqual([label['Label'] for label in labels], ['Gun', 'Smoking'])
+        self.assertEqual(labels.tiers, [1, 2])
+        self.assertEqual(labels.source_status['DetectLabels']['Status'], 'Ok')
+        rek_client.detect_labels.assert_called_once()
+
+    def test_detect_image_labels_with_failed_first_tier(self):
+        handler, rek_client = self._handler([])
+        rek_client.detect_moderation_labels.side_effect = InvocationException(
+            operation_name='DetectModerationLabels', error_code='ThrottlingException', error_message='Rate exceeded')
+
+        labels = handler.detect_image_labels(images=[bytearray([1])],
+                                             return_sources=['DetectLabels', 'DetectModerationLabels'],
+                                             mandatory_return_sources=['DetectLabels'])
+
+        # the next tier is called for want of the labels of the first one
+        self.assertEqual(labels.tiers, [1, 2])
+        self.assertEqual(labels.source_status['DetectModerationLabels']['Status'], 'Throttled')
+        self.assertEqual([label['Label'] for label in labels], ['Gun'])
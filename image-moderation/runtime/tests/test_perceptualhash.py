@@ -0,0 +1,80 @@
+import io
+import random
+from unittest import TestCase
+
+import numpy as np
+from PIL import Image
+
+from chalicelib.perceptualhash import dhash, hamming_distance, MultiIndexHashIndex
+
+
+def _image_bytes(pixels, size=None, image_format='PNG', quality=95):
+    image = Image.fromarray(pixels)
+    if size is not None:
+        image = image.resize(size)
+    data = io.BytesIO()
+    image.save(data, format=image_format, quality=quality)
+    return data.getvalue()
+
+
+class TestPerceptualHash(TestCase):
+    def setUp(self):
+        generator = np.random.default_rng(7)
+        self._pixels = (generator.random((64, 64, 3)) * 255).astype(np.uint8).repeat(4, axis=0).repeat(4, axis=1)
+
+    def test_dhash_of_resized_and_recompressed_images(self):
+        origin = dhash(_image_bytes(self._pixels))
+        resized = dhash(_image_bytes(self._pixels, size=(128, 128)))
+        recompressed = dhash(_image_bytes(self._pixels, image_format='JPEG', quality=60))
+        other = dhash(_image_bytes(np.flipud(self._pixels).copy()))
+
+        self.assertLessEqual(hamming_distance(origin, resized), 4)
+        self.assertLessEqual(hamming_distance(origin, recompressed), 4)
+        self.assertGreater(hamming_distance(origin, other), 10)
+
+    def test_search_within_distance(self):
+        index = MultiIndexHashIndex(max_distance=4)
+        index.put(0b1111, 'a')
+        index.put(0xFFFF << 40, 'b')
+
+        self.assertEqual(index.search(0b1111), (0, 0b1111, 'a'))
+        self.assertEqual(index.search(0b11110000), None)
+        self.assertEqual(index.search(0b0111 | (1 << 63)), (2, 0b1111, 'a'))
+        self.assertEqual(index.search((0xFFFF << 40) ^ (0b1111 << 45)), (4, 0xFFFF << 40, 'b'))
+        self.assertIsNone(index.search((0xFFFF << 40) ^ (0b11111 << 45)))
+        # search with a smaller distance
+        self.assertIsNone(index.search(0b0111 | (1 << 63), max_distance=1))
+
+        self.assertEqual(index.stats()['Searches'], 6)
+        self.assertEqual(index.stats()['Matches'], 3)
+
+    def test_search_same_as_brute_force(self):
+        generator = random.Random(3)
+        hashes = [generator.getrandbits(64) for _ in range(2000)]
+        index = MultiIndexHashIndex(max_distance=6)
+        for hash_value in hashes:
+            index.put(hash_value, hash_value)
+
+        for _ in range(200):
+            query = generator.choice(hashes)
+            for bit in generator.sample(range(64), generator.randint(0, 8)):
+                query ^= 1 << bit
+
+            expected = min((hamming_distance(query, hash_value) for hash_value in hashes))
+            nearest = index.search(query)
+            if expected <= 6:
+                self.assertEqual(nearest[0], expected)
+            else:
+                self.assertIsNone(nearest)
+
+    def test_eviction(self):
+        index = MultiIndexHashIndex(max_distance=2, max_size=2)
+        index.put(1, 'a')
+        index.put(2, 'b')
+        index.put(1, 'c')
+        index.put(1 << 40, 'd')
+
+        self.assertEqual(len(index), 2)
+        self.assertIsNone(index.get(1))
+        self.assertEqual(index.get(2), 'b')
+        self.assertEqual(index.search(3), (1, 2, 'b'))
@@ -0,0 +1,127 @@
+from threading import Event, current_thread
+from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+
+from chalicelib.pipeline import Stage, Pipeline
+from chalicelib.concurrentutils import Deadline
+from chalicelib.exception import DeadlineExceededException
+
+
+class TestPipeline(TestCase):
+    def test_run(self):
+        calls = []
+
+        def stage(name, value):
+            calls.append(name)
+            return value
+
+        pipeline = Pipeline([
+            Stage('sum', lambda left, right: stage('sum', left + right), inputs=['left', 'right']),
+            Stage('left', lambda x: stage('left', x + 1), inputs=['x']),
+            Stage('right', lambda x: stage('right', x * 2), inputs=['x']),
+            Stage('split', lambda sum: stage('split', (sum // 2, sum % 2)), inputs=['sum'],
+                  outputs=['half', 'rest']),
+        ], executor=ThreadPoolExecutor(max_workers=2))
+
+        run = pipeline.run(x=3)
+
+        self.assertEqual(pipeline.inputs, {'x'})
+        self.assertEqual(run.values, {'x': 3, 'deadline': None, 'left': 4, 'right': 6, 'sum': 10, 'half': 5, 'rest': 0})
+        self.assertEqual(set(calls[0:2]), {'left', 'right'})
+        self.assertEqual(calls[2:], ['sum', 'split'])
+        self.assertEqual(set(run.timings.keys()), {'left', 'right', 'sum', 'split'})
+        self.assertEqual(pipeline.stats()['sum']['Count'], 1)
+
+    def test_run_independent_stages_concurrently(self):
+        left_started = Event()
+        right_started = Event()
+
+        def left():
+            left_started.set()
+            return right_started.wait(5)
+
+        def right():
+            right_started.set()
+            return left_started.wait(5)
+
+        # each stage waits for the other one to start
+        pipeline = Pipeline([Stage('left', left), Stage('right', right)])
+        run = pipeline.run()
+
+        self.assertTrue(run.values['left'])
+        self.assertTrue(run.values['right'])
+
+    def test_run_stage_on_calling_thread(self):
+        threads = {}
+        scanned = Event()
+
+        def stage(name):
+            threads[name] = current_thread()
+            return scanned.wait(5) if name == 'backends' else scanned.set()
+
+        # the executor has no worker left for the stage on the calling thread
+        pipeline = Pipeline([Stage('backends', lambda: stage('backends'), calling_thread=True),
+                             Stage('scan', lambda: stage('scan'))],
+                            executor=ThreadPoolExecutor(max_workers=1))
+        run = pipeline.run()
+
+        self.assertTrue(run.values['backends'])
+        self.assertIs(threads['backends'], current_thread())
+        self.assertIsNot(threads['scan'], current_thread())
+
+    def test_run_with_error(self):
+        calls = []
+
+        def fail(x):
+            raise ValueError('failed')
+
+        pipeline = Pipeline([
+            Stage('fail', fail, inputs=['x']),
+            Stage('after', lambda fail: calls.append(fail), inputs=['fail']),
+        ])
+
+        with self.assertRaises(ValueError):
+            pipeline.run(x=1)
+        with self.assertRaises(ValueError):
+            pipeline.run()
+
+        self.assertEqual(calls, [])
+        self.assertEqual(pipeline.stats()['fail']['Errors'], 1)
+        self.assertEqual(pipeline.stats()['after']['Count'], 0)
+
+    def test_run_with_deadline(self):
+        release = Event()
+        calls = []
+        pipeline = Pipeline([
+            Stage('slow', lambda: release.wait(5)),
+            Stage('fast', lambda deadline: deadline.timeout_seconds, inputs=['deadline']),
+            Stage('after', lambda slow: calls.append(slow), inputs=['slow']),
+        ])
+
+        with self.assertRaises(DeadlineExceededException) as context:
+            pipeline.run(deadline=Deadline(0.1))
+        release.set()
+
+        self.assertIn('slow', context.exception.message)
+        self.assertEqual(calls, [])
+        self.assertEqual(pipeline.stats()['fast']['Count'], 1)
+
+    def test_invalid_pipeline(self):
+        with self.assertRaises(ValueError):
+            Pipeline([Stage('a', lambda b: b, inputs=['b']), Stage('b', lambda a: a, inputs=['a'])])
+        with self.assertRaises(ValueError):
+            Pipeline([Stage('a', lambda: 1), Stage('b', lambda: 2, outputs=['a'])])
+
+    def test_run_with_missing_outputs(self):
+        pipeline = Pipeline([
+            Stage('split', lambda x: (x,), inputs=['x'], outputs=['half', 'rest']),
+            Stage('other', lambda x: x, inputs=['x']),
+            Stage('sum', lambda half, rest: half + rest, inputs=['half', 'rest']),
+        ], executor=ThreadPoolExecutor(max_workers=2))
+
+        with self.assertRaises(ValueError) as context:
+            pipeline.run(x=3)
+
+        self.assertIn('split', str(context.exception))
+        self.assertEqual(pipeline.stats()['split']['Errors'], 1)
+        self.assertEqual(pipeline.stats()['sum']['Count'], 0)
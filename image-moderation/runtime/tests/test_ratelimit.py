@@ -0,0 +1,152 @@
+from unittest import TestCase
+from unittest.mock import Mock, MagicMock
+
+from botocore.exceptions import ClientError
+
+from chalicelib.ratelimit import RateLimiter, DynamoDBRateLimiter, acquire, parse_limits
+from chalicelib.concurrentutils import Deadline
+from chalicelib.exception import InvocationException
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+class TestRateLimiter(TestCase):
+    def test_acquire(self):
+        clock = FakeClock()
+        limiter = RateLimiter('DetectLabels', rate=10, burst=2, max_wait_seconds=0.25, clock=clock, sleep=clock.sleep)
+
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        # callers queue for the refill
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertEqual([round(seconds, 3) for seconds in clock.sleeps], [0.1, 0.2])
+        self.assertFalse(limiter.acquire())
+
+        clock.now = 1.0
+        self.assertTrue(limiter.acquire())
+        stats = limiter.stats()
+        self.assertEqual(stats['Acquired'], 5)
+        self.assertEqual(stats['Delayed'], 2)
+        self.assertEqual(stats['Rejected'], 1)
+
+    def test_acquire_with_timeout(self):
+        clock = FakeClock()
+        limiter = RateLimiter('DetectLabels', rate=10, burst=1, max_wait_seconds=1, clock=clock, sleep=clock.sleep)
+
+        self.assertTrue(limiter.acquire(timeout=0.05))
+        self.assertFalse(limiter.acquire(timeout=0.05))
+        self.assertTrue(limiter.acquire(timeout=0.5))
+
+
+class TestDynamoDBRateLimiter(TestCase):
+    def _dynamodb_client(self):
+        table = {}
+
+        def get_item(TableName, Key, ConsistentRead):
+            item = table.get(Key['Name']['S'])
+            return {'Item': item} if item is not None else {}
+
+        def put_item(TableName, Item, ConditionExpression, **kwargs):
+            table[Item['Name']['S']] = Item
+
+        dynamodb_client = Mock()
+        dynamodb_client.get_item = MagicMock(side_effect=get_item)
+        dynamodb_client.put_item = MagicMock(side_effect=put_item)
+        return dynamodb_client, table
+
+    def test_acquire_with_lease(self):
+        clock = FakeClock()
+        dynamodb_client, table = self._dynamodb_client()
+        limiter = DynamoDBRateLimiter('DetectLabels', rate=10, burst=10, dynamodb_client=dynamodb_client,
+                                      table_name='rate-limits', lease_size=5, clock=clock, sleep=clock.sleep,
+                                      wall_clock=clock)
+
+        for _ in range(5):
+            self.assertTrue(limiter.acquire())
+        # the leased tokens are spent without writing the table
+        self.assertEqual(dynamodb_client.put_item.call_count, 1)
+        self.assertEqual(float(table['DetectLabels']['Tokens']['N']), 5.0)
+
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(dynamodb_client.put_item.call_count, 2)
+        self.assertEqual(float(table['DetectLabels']['Tokens']['N']), 0.0)
+        self.assertEqual(clock.sleeps, [])
+
+    def test_acquire_with_lease_ahead_of_the_refill(self):
+        clock = FakeClock()
+        dynamodb_client, table = self._dynamodb_client()
+        table['DetectLabels'] = {'Name': {'S': 'DetectLabels'}, 'Tokens': {'N': '0.0'}, 'UpdatedAt': {'N': '0.0'}}
+        limiter = DynamoDBRateLimiter('DetectLabels', rate=10, burst=10, dynamodb_client=dynamodb_client,
+                                      table_name='rate-limits', lease_size=5, clock=clock, sleep=clock.sleep,
+                                      wall_clock=clock)
+
+        # the lease is reserved for 0.5 seconds later, its tokens are not handed out before then
+        self.assertTrue(limiter.acquire())
+        clock.now = 0.2
+        self.assertTrue(limiter.acquire())
+        self.assertEqual([round(seconds, 3) for seconds in clock.sleeps], [0.5, 0.3])
+        self.assertEqual(dynamodb_client.put_item.call_count, 1)
+
+    def test_acquire_with_contention(self):
+        clock = FakeClock()
+        dynamodb_client, _ = self._dynamodb_client()
+        conflict = ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'failed'}},
+                               'PutItem')
+        dynamodb_client.put_item.side_effect = [conflict, None]
+        limiter = DynamoDBRateLimiter('DetectLabels', rate=10, burst=10, dynamodb_client=dynamodb_client,
+                                      table_name='rate-limits', clock=clock, sleep=clock.sleep, wall_clock=clock)
+
+        # the bucket is read again after another container updated it
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(dynamodb_client.get_item.call_count, 2)
+
+    def test_acquire_with_table_error(self):
+        clock = FakeClock()
+        dynamodb_client = Mock()
+        dynamodb_client.get_item = MagicMock(side_effect=Exception('unavailable'))
+        limiter = DynamoDBRateLimiter('DetectLabels', rate=10, burst=1, dynamodb_client=dynamodb_client,
+                                      table_name='rate-limits', max_wait_seconds=0, clock=clock, sleep=clock.sleep)
+
+        # falls back to the bucket of the container
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+
+    def test_invalid_rate_or_burst(self):
+        with self.assertRaises(ValueError):
+            RateLimiter('DetectLabels', rate=0, burst=1)
+        with self.assertRaises(ValueError):
+            RateLimiter('DetectLabels', rate=1, burst=0.5)
+
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits(['DetectLabels:50:50', 'arn:aws:iam::123456789012:role/TeamA:5:10'],
+                                      'MODERATION_RATE_LIMITS'),
+                         [('DetectLabels', 50.0, 50.0), ('arn:aws:iam::123456789012:role/TeamA', 5.0, 10.0)])
+        for limit in ['DetectLabels:0:50', 'DetectLabels:-1:50', 'DetectLabels:50:0.5', 'DetectLabels:50',
+                      'DetectLabels:fast:50']:
+            with self.assertRaises(ValueError) as context:
+                parse_limits([limit], 'MODERATION_RATE_LIMITS')
+            self.assertIn('MODERATION_RATE_LIMITS', str(context.exception))
+
+
+class TestAcquire(TestCase):
+    def test_acquire(self):
+        acquire(None, 'DetectLabels')
+        acquire({}, 'DetectLabels')
+
+        limiter = RateLimiter('DetectLabels', rate=1, burst=1)
+        acquire({'DetectLabels': limiter}, 'DetectLabels', deadline=Deadline(5))
+        with self.assertRaises(InvocationException) as context:
+            acquire({'DetectLabels': limiter}, 'DetectLabels', deadline=Deadline(0.1))
+
+        self.assertEqual(context.exception.error_code, 'RateLimited')
@@ -6,6 +6,8 @@ import unittest
 from unittest.mock import Mock, MagicMock
 from chalicelib.rekognition import RekognitonClient
 from chalicelib.exception import InvocationException
+from chalicelib.cache import LRUCache
+from chalicelib.ratelimit import RateLimiter
 
 
 class TestRekognitonClient(unittest.TestCase):
@@ -474,3 +476,87 @@ class TestRekognitonClient(unittest.TestCase):
                 'Bytes': data,
             }
         )
+
+    def test_detect_labels_with_response_cache(self):
+        data = bytearray([1, 2, 3])
+
+        # mock boto3 client
+        custom_labels = {'Labels': [{'Confidence': 77, 'Name': 'Wine'},
+                                    {'Confidence': 55, 'Name': 'Smoking'},
+                                    {'Confidence': 91, 'Name': 'Weapon'}],
+                         'ResponseMetadata': {'RequestId': 'req-1'}}
+
+        rek_client_boto3 = Mock()
+        rek_client_boto3.detect_labels = MagicMock(return_value=custom_labels)
+
+        client = RekognitonClient(rek_client_boto3, response_cache=LRUCache(), cached_min_confidence=50,
+                                  cached_max_labels=100)
+
+        # detected once with the cache floor, filtered for each threshold
+        self.assertEqual([label['Label'] for label in client.detect_labels(image_bytes=data, min_confidence=60)],
+                         ['Weapon', 'Wine'])
+        self.assertEqual([label['Label'] for label in client.detect_labels(image_bytes=bytearray([1, 2, 3]),
+                                                                           min_confidence=50, max_labels=2)],
+                         ['Weapon', 'Wine'])
+        self.assertEqual([label['Label'] for label in client.detect_labels(image_bytes=data, min_confidence=80)],
+                         ['Weapon'])
+        rek_client_boto3.detect_labels.assert_called_once_with(
+            Image={
+                'Bytes': data,
+            },
+            MaxLabels=100,
+            MinConfidence=50,
+            Settings={
+                'GeneralLabels': {
+                    "LabelInclusionFilters": client.label_inclusion_filters
+                },
+            }
+        )
+
+        # lower confidence than the cache floor bypasses the cache
+        client.detect_labels(image_bytes=data, min_confidence=40)
+        self.assertEqual(rek_client_boto3.detect_labels.call_count, 2)
+
+    def test_detect_moderation_labels_with_response_cache(self):
+        data = bytearray([1, 2, 3])
+
+        # mock boto3 client
+        custom_labels = {'ModerationLabels': [{'Confidence': 77, 'Name': 'Drinking'},
+                                              {'Confidence': 88, 'Name': 'ExcludedLabel'},
+                                              {'Confidence': 55, 'Name': 'Smoking'}]}
+
+        rek_client_boto3 = Mock()
+        rek_client_boto3.detect_moderation_labels = MagicMock(return_value=custom_labels)
+
+        client = RekognitonClient(rek_client_boto3, moderation_label_inclusion_filters=['Drinking', 'Smoking'],
+                                  response_cache=LRUCache(), cached_min_confidence=50)
+
+        self.assertEqual([label['Label'] for label in client.detect_moderation_labels(image_bytes=data,
+                                                                                      min_confidence=50)],
+                         ['Drinking', 'Smoking'])
+        self.assertEqual([label['Label'] for label in client.detect_moderation_labels(image_bytes=data,
+                                                                                      min_confidence=60,
+                                                                                      max_labels=1)],
+                         ['Drinking'])
+        rek_client_boto3.detect_moderation_labels.assert_called_once_with(
+            Image={
+                'Bytes': data,
+            },
+            MinConfidence=50
+        )
+
+
+class TestRekognitonClientRateLimits(unittest.TestCase):
+    def test_detect_labels_with_rate_limiter(self):
+        rek_client_boto3 = Mock()
+        rek_client_boto3.detect_labels = MagicMock(return_value={'Labels': [{'Confidence': 77, 'Name': 'Wine'}]})
+        client = RekognitonClient(rek_client_boto3,
+                                  rate_limiters={'DetectLabels': RateLimiter('DetectLabels', rate=1, burst=1,
+                                                                             max_wait_seconds=0)})
+
+        self.assertEqual(len(client.detect_labels(image_bytes=bytearray([1, 2, 3]))), 1)
+        with self.assertRaises(InvocationException) as raised_exception:
+            client.detect_labels(image_bytes=bytearray([1, 2, 3]))
+
+        self.assertEqual('RateLimited', raised_exception.exception.error_code)
+        rek_client_boto3.detect_labels.assert_called_once()
@@ -0,0 +1,73 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from chalicelib.retry import RetryPolicy, RetryBudget
+from chalicelib.concurrentutils import Deadline
+from chalicelib.exception import InvocationException
+
+
+def _throttled():
+    return InvocationException('Rekognition_DetectLabels', 'ThrottlingException', 'Rate exceeded')
+
+
+class TestRetryBudget(TestCase):
+    def test_try_acquire(self):
+        budget = RetryBudget(ratio=0.5, max_tokens=2)
+        self.assertTrue(budget.try_acquire())
+        self.assertTrue(budget.try_acquire())
+        self.assertFalse(budget.try_acquire())
+
+        budget.on_call()
+        self.assertFalse(budget.try_acquire())
+        budget.on_call()
+        self.assertTrue(budget.try_acquire())
+
+
+class TestRetryPolicy(TestCase):
+    def test_call_with_retryable_error(self):
+        delays = []
+        policy = RetryPolicy(max_attempts=3, base_seconds=0.1, cap_seconds=0.25, sleep=delays.append,
+                             uniform=lambda low, high: high)
+        fn = MagicMock(side_effect=[_throttled(), _throttled(), 'labels'])
+
+        self.assertEqual(policy.call(fn), 'labels')
+        self.assertEqual(fn.call_count, 3)
+        # decorrelated jitter grows from the previous delay and is capped
+        self.assertEqual(delays, [0.25, 0.25])
+        self.assertEqual(policy.stats()['Retries'], 2)
+
+    def test_call_with_max_attempts(self):
+        policy = RetryPolicy(max_attempts=2, sleep=lambda delay: None)
+        fn = MagicMock(side_effect=_throttled())
+
+        with self.assertRaises(InvocationException):
+            policy.call(fn)
+        self.assertEqual(fn.call_count, 2)
+
+    def test_call_with_non_retryable_error(self):
+        policy = RetryPolicy(sleep=lambda delay: None)
+        fn = MagicMock(side_effect=InvocationException('Rekognition_DetectLabels', 'InvalidImageFormatException',
+                                                       'Request has invalid image format'))
+
+        with self.assertRaises(InvocationException):
+            policy.call(fn)
+        fn.assert_called_once()
+
+    def test_call_with_exhausted_budget(self):
+        policy = RetryPolicy(budget=RetryBudget(ratio=0.1, max_tokens=1), sleep=lambda delay: None)
+        fn = MagicMock(side_effect=_throttled())
+
+        with self.assertRaises(InvocationException):
+            policy.call(fn)
+        # one retry from the initial token, the budget is empty after it
+        self.assertEqual(fn.call_count, 2)
+        self.assertEqual(policy.stats()['BudgetExhausted'], 1)
+
+    def test_call_with_deadline(self):
+        policy = RetryPolicy(base_seconds=0.5, sleep=lambda delay: None)
+        fn = MagicMock(side_effect=_throttled())
+
+        with self.assertRaises(InvocationException):
+            policy.call(fn, deadline=Deadline(0.2))
+        fn.assert_called_once()
+        self.assertEqual(policy.stats()['DeadlineExhausted'], 1)
@@ -7,6 +7,8 @@ from unittest.mock import Mock, MagicMock
 
 from chalicelib.sagemaker import SageMakerClient
 from chalicelib.exception import InvocationException
+from chalicelib.cache import LRUCache
+from chalicelib.circuitbreaker import CircuitBreaker
 
 
 @unittest.skipUnless(os.environ.get('RUN_INTEG_TESTS', False),
@@ -90,6 +92,28 @@ class TestSageMakerClient(unittest.TestCase):
             Accept='application/json'
         )
 
+    def test_detect_labels_with_response_cache(self):
+        endpoint_name = "enpoint-sage"
+        data = bytearray([1, 2, 3])
+
+        # mock boto3 client
+        custom_labels = {'CustomLabels': [{'Confidence': 0.55, 'Label': 'Smoking'},
+                                          {'Confidence': 0.77, 'Label': 'Wine'}]}
+
+        response = {}
+        response['Body'] = Mock()
+        response['Body'].read = MagicMock(return_value=json.dumps(custom_labels))
+        sagemaker_client_boto3 = Mock()
+        sagemaker_client_boto3.invoke_endpoint = MagicMock(return_value=response)
+
+        client = SageMakerClient(sagemaker_client_boto3, endpoint_name, response_cache=LRUCache())
+
+        self.assertEqual([label['Label'] for label in client.detect_labels(image_bytes=data, min_confidence=40)],
+                         ['Wine', 'Smoking'])
+        self.assertEqual([label['Label'] for label in client.detect_labels(image_bytes=data, min_confidence=60)],
+                         ['Wine'])
+        self.assertEqual(sagemaker_client_boto3.invoke_endpoint.call_count, 1)
+
     def test_detect_labels_with_empty_response(self):
         """
         Unit tests
@@ -154,3 +178,24 @@ class TestSageMakerClient(unittest.TestCase):
             Body=data,
             Accept='application/json'
         )
+
+
+class TestSageMakerClientCircuitBreaker(unittest.TestCase):
+    def test_detect_labels_with_open_circuit(self):
+        sagemaker_client_boto3 = Mock()
+        sagemaker_client_boto3.invoke_endpoint = MagicMock(side_effect=Exception('Test purpose'))
+        sagemaker_client_boto3.invoke_endpoint.side_effect.response = {
+            'Error': {'Code': 'ServiceUnavailable', 'Message': 'Service unavailable'}}
+        client = SageMakerClient(sagemaker_client_boto3, 'enpoint-sage',
+                                 circuit_breaker=CircuitBreaker('InvokeEndpoint', min_calls=2))
+
+        for _ in range(2):
+            with self.assertRaises(InvocationException) as raised_exception:
+                client.detect_labels(image_bytes=bytearray([1, 8, 6]))
+            self.assertEqual('ServiceUnavailable', raised_exception.exception.error_code)
+
+        # fail fast without invoking the endpoint
+        with self.assertRaises(InvocationException) as raised_exception:
+            client.detect_labels(image_bytes=bytearray([1, 8, 6]))
+        self.assertEqual('CircuitOpen', raised_exception.exception.error_code)
+        self.assertEqual(sagemaker_client_boto3.invoke_endpoint.call_count, 2)
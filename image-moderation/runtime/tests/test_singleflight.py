@@ -0,0 +1,95 @@
+from unittest import TestCase
+from threading import Thread, Event
+
+from chalicelib.singleflight import SingleFlight, SingleFlightTimeoutException
+
+
+class TestSingleFlight(TestCase):
+    def test_do_with_concurrent_calls(self):
+        single_flight = SingleFlight()
+        started = Event()
+        release = Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return [{'Label': 'a'}]
+
+        results = []
+        leader = Thread(target=lambda: results.append(single_flight.do('key', fn)))
+        leader.start()
+        started.wait(5)
+        followers = [Thread(target=lambda: results.append(single_flight.do('key', fn))) for _ in range(4)]
+        for follower in followers:
+            follower.start()
+        # wait until all the followers joined the call
+        while single_flight.stats()['Followers'] < 4:
+            release.wait(0.01)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[{'Label': 'a'}]] * 5)
+        # followers get their own copies
+        self.assertEqual(len(set(id(result) for result in results)), 5)
+        self.assertEqual(single_flight.stats(), {'InFlight': 0, 'Leaders': 1, 'Followers': 4, 'Timeouts': 0})
+
+    def test_do_with_error(self):
+        single_flight = SingleFlight()
+        started = Event()
+        release = Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError('failed')
+
+        errors = []
+
+        def call():
+            try:
+                single_flight.do('key', fail)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = Thread(target=call)
+        leader.start()
+        started.wait(5)
+        follower = Thread(target=call)
+        follower.start()
+        while single_flight.stats()['Followers'] < 1:
+            release.wait(0.01)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(len(errors), 2)
+        # a failed call is not shared with later callers
+        self.assertEqual(single_flight.do('key', lambda: 'ok'), 'ok')
+        self.assertEqual(single_flight.stats()['Leaders'], 2)
+
+    def test_do_with_timeout(self):
+        single_flight = SingleFlight()
+        started = Event()
+        release = Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'slow'
+
+        leader = Thread(target=lambda: single_flight.do('key', slow))
+        leader.start()
+        started.wait(5)
+
+        with self.assertRaises(SingleFlightTimeoutException):
+            single_flight.do('key', slow, timeout=0.05)
+        release.set()
+        leader.join(5)
+
+        self.assertEqual(single_flight.stats()['Timeouts'], 1)
+        # other keys are not coalesced
+        self.assertEqual(single_flight.do('other', lambda: 'other'), 'other')
@@ -0,0 +1,60 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+
+import aiohttp
+from aiobotocore.session import get_session
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'runtime'))
+
+from chalicelib.asynchandler import AsyncRekognitionClient, AsyncSageMakerClient, AsyncImageHandler, \
+    AsyncModerationHandler, detect_labels
+from chalicelib.exception import InvocationException, CannotDownloadImageException
+
+
+async def detect(urls, return_sources, min_confidence, max_labels, max_in_flight, timeout_seconds):
+    session = get_session()
+    endpoint_name = os.environ.get('SAGEMAKER_ENDPOINT_NAME', '')
+    async with aiohttp.ClientSession() as http_session, \
+            session.create_client('rekognition') as rekognition, \
+            session.create_client('sagemaker-runtime') as sagemaker_runtime:
+        rek_client = AsyncRekognitionClient(
+            aio_client=rekognition,
+            collection_id=os.environ.get('MODERATION_REKOGNITION_COLLECTION_ID', 'face_collection_id'))
+        sagemaker_client = AsyncSageMakerClient(aio_client=sagemaker_runtime, endpoint_name=endpoint_name)
+        image_handler = AsyncImageHandler(http_session=http_session)
+        moderation_handler = AsyncModerationHandler(rek_client=rek_client,
+                                                    sagemaker_client=sagemaker_client,
+                                                    max_in_flight=max_in_flight,
+                                                    timeout_seconds=timeout_seconds)
+
+        async def detect_one(url):
+            try:
+                labels = await detect_labels(image_handler, moderation_handler, url=url,
+                                             return_sources=return_sources,
+                                             min_confidence=min_confidence,
+                                             max_labels=max_labels)
+                return {'Url': url, 'Labels': labels}
+            except (InvocationException, CannotDownloadImageException) as e:
+                return {'Url': url, 'Error': str(e)}
+
+        for result in asyncio.as_completed([detect_one(url) for url in urls]):
+            print(json.dumps(await result, default=str), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Detect labels of image urls, one url per line of stdin if no url '
+                                                 'is given, and print one JSON line per url')
+    parser.add_argument('urls', nargs='*')
+    parser.add_argument('--return-sources', nargs='*', default=['DetectModerationLabels'])
+    parser.add_argument('--min-confidence', type=float, default=50)
+    parser.add_argument('--max-labels', type=int, default=5)
+    parser.add_argument('--max-in-flight', type=int, default=64)
+    parser.add_argument('--timeout-seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    urls = args.urls or [line.strip() for line in sys.stdin if len(line.strip()) > 0]
+    asyncio.run(detect(urls, args.return_sources, args.min_confidence, args.max_labels,
+                       args.max_in_flight, args.timeout_seconds))
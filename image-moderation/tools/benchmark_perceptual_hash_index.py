@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'runtime'))
+
+from chalicelib.perceptualhash import MultiIndexHashIndex
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+
+def near_duplicate(generator, hash_value, max_distance):
+    for bit in generator.sample(range(64), generator.randint(0, max_distance)):
+        hash_value ^= 1 << bit
+    return hash_value
+
+
+def benchmark(size, max_distance, queries=2000, seed=11):
+    generator = random.Random(seed)
+    index = MultiIndexHashIndex(max_distance=max_distance, max_size=size)
+    hashes = []
+    started = time.perf_counter()
+    for _ in range(size):
+        hash_value = generator.getrandbits(64)
+        hashes.append(hash_value)
+        index.put(hash_value, True)
+    build_seconds = time.perf_counter() - started
+
+    results = {}
+    for name, make_query in [('hit', lambda: near_duplicate(generator, generator.choice(hashes), max_distance)),
+                             ('miss', lambda: generator.getrandbits(64))]:
+        latencies = []
+        for _ in range(queries):
+            query = make_query()
+            started = time.perf_counter()
+            index.search(query)
+            latencies.append((time.perf_counter() - started) * 1000000)
+        latencies.sort()
+        results[name] = (percentile(latencies, 50), percentile(latencies, 99))
+
+    print('%10d %8d %10.1f %10.1f %10.1f %10.1f %10.1f' % (
+        size, max_distance, build_seconds,
+        results['hit'][0], results['hit'][1], results['miss'][0], results['miss'][1]))
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000, 1000000]
+    print('%10s %8s %10s %10s %10s %10s %10s' % (
+        'size', 'distance', 'build(s)', 'hit p50', 'hit p99', 'miss p50', 'miss p99'))
+    for max_distance in [4, 6]:
+        for size in sizes:
+            benchmark(size, max_distance)
+    print('latencies are in microseconds')